@@ -25,11 +25,30 @@ class ExitException(Exception):
     pass
 
 
+def _run_batch(comm, calls):
+    """Stand-in for rpc_comm.run_batch() going through the mocked run()"""
+    batched = []
+    for op, data in calls:
+        call = proxy.BatchedCall(op, (data,))
+        try:
+            result = comm.run(op, **data)
+        except proxy.JSONRPCException, err:
+            call.response = {'result': None,
+                             'error': {'name': 'JSONRPCException',
+                                       'message': str(err),
+                                       'traceback': ''}}
+        else:
+            call.response = {'result': result, 'error': None}
+        batched.append(call)
+    return batched
+
+
 class cli_unittest(unittest.TestCase):
     def setUp(self):
         super(cli_unittest, self).setUp()
         self.god = mock.mock_god(debug=CLI_UT_DEBUG, ut=self)
         self.god.stub_class_method(rpc.afe_comm, 'run')
+        self.god.stub_with(rpc.afe_comm, 'run_batch', _run_batch)
         self.god.stub_function(sys, 'exit')
 
         def stub_authorization_headers(*args, **kwargs):
@@ -66,6 +66,12 @@ class host(topic_common.atest):
             self.messages.append('Unlocked host')
 
 
+    def _successful_hosts(self, hosts, results):
+        """Return the hosts whose call in a batch succeeded"""
+        return [host for host, result in zip(hosts, results)
+                if not isinstance(result, topic_common.CliError)]
+
+
     def _cleanup_labels(self, labels, platform=None):
         """Removes the platform label from the overall labels"""
         if platform:
@@ -206,29 +212,36 @@ class host_stat(host):
     def execute(self):
         results = []
         # Convert wildcards into real host stats.
-        existing_hosts = []
+        calls = []
         for host in self.hosts:
             if host.endswith('*'):
-                stats = self.execute_rpc('get_hosts',
-                                         hostname__startswith=host.rstrip('*'))
-                if len(stats) == 0:
+                calls.append(('get_hosts', host,
+                              {'hostname__startswith': host.rstrip('*')}))
+            else:
+                calls.append(('get_hosts', host, {'hostname': host}))
+
+        existing_hosts = []
+        for host, stats in zip(self.hosts, self.execute_rpc_batch(calls)):
+            if len(stats) == 0:
+                if host.endswith('*'):
                     self.failure('No hosts matching %s' % host, item=host,
                                  what_failed='Failed to stat')
-                    continue
-            else:
-                stats = self.execute_rpc('get_hosts', hostname=host)
-                if len(stats) == 0:
+                else:
                     self.failure('Unknown host %s' % host, item=host,
                                  what_failed='Failed to stat')
-                    continue
+                continue
             existing_hosts.extend(stats)
 
+        # The hosts exist, these should succeed
+        calls = []
         for stat in existing_hosts:
             host = stat['hostname']
-            # The host exists, these should succeed
-            acls = self.execute_rpc('get_acl_groups', hosts__hostname=host)
+            calls.append(('get_acl_groups', host, {'hosts__hostname': host}))
+            calls.append(('get_labels', host, {'host__hostname': host}))
+        details = self.execute_rpc_batch(calls)
 
-            labels = self.execute_rpc('get_labels', host__hostname=host)
+        for index, stat in enumerate(existing_hosts):
+            acls, labels = details[2 * index:2 * index + 2]
             results.append ([[stat], acls, labels])
         return results
 
@@ -278,11 +291,13 @@ class host_jobs(host):
             else:
                 real_hosts.append(host)
 
-        for host in real_hosts:
-            queue_entries = self.execute_rpc('get_host_queue_entries',
-                                             host__hostname=host,
-                                             query_limit=self.max_queries,
-                                             sort_by=['-job__id'])
+        calls = [('get_host_queue_entries', host,
+                  {'host__hostname': host,
+                   'query_limit': self.max_queries,
+                   'sort_by': ['-job__id']}) for host in real_hosts]
+        all_entries = self.execute_rpc_batch(calls)
+
+        for host, queue_entries in zip(real_hosts, all_entries):
             jobs = []
             for entry in queue_entries:
                 job = {'job_id': entry['job']['id'],
@@ -344,19 +359,15 @@ class host_mod(host):
 
 
     def execute(self):
-        successes = []
+        calls = []
         for host in self.hosts:
-            try:
-                res = self.execute_rpc('modify_host', item=host,
-                                       id=host, **self.data)
-                # TODO: Make the AFE return True or False,
-                # especially for lock
-                successes.append(host)
-            except topic_common.CliError, full_error:
-                # Already logged by execute_rpc()
-                pass
-
-        return successes
+            data = dict(self.data)
+            data['id'] = host
+            calls.append(('modify_host', host, data))
+        # TODO: Make the AFE return True or False, especially for lock
+        results = self.execute_rpc_batch(calls, allow_failures=True)
+        # Failures are already logged by execute_rpc_batch()
+        return self._successful_hosts(self.hosts, results)
 
 
     def output(self, hosts):
@@ -425,21 +436,6 @@ class host_create(host):
         return (options, leftover)
 
 
-    def _execute_add_one_host(self, host):
-        # Always add the hosts as locked to avoid the host
-        # being picked up by the scheduler before it's ACL'ed
-        self.data['locked'] = True
-        self.execute_rpc('add_host', hostname=host,
-                         status="Ready", **self.data)
-
-        # Now add the platform label
-        labels = self.labels[:]
-        if self.platform:
-            labels.append(self.platform)
-        if len (labels):
-            self.execute_rpc('host_add_labels', id=host, labels=labels)
-
-
     def execute(self):
         # We need to check if these labels & ACLs exist,
         # and create them if not.
@@ -461,25 +457,38 @@ class host_create(host):
         success = self.site_create_hosts_hook()
 
         if len(success):
-            for acl in self.acls:
-                self.execute_rpc('acl_group_add_hosts', id=acl, hosts=success)
-
+            calls = [('acl_group_add_hosts', acl, {'id': acl, 'hosts': success})
+                     for acl in self.acls]
             if not self.locked:
-                for host in success:
-                    self.execute_rpc('modify_host', id=host, locked=False)
+                calls.extend([('modify_host', host,
+                               {'id': host, 'locked': False})
+                              for host in success])
+            self.execute_rpc_batch(calls)
         return success
 
 
     def site_create_hosts_hook(self):
-        success = []
+        # Always add the hosts as locked to avoid the host
+        # being picked up by the scheduler before it's ACL'ed
+        self.data['locked'] = True
+        calls = []
         for host in self.hosts:
-            try:
-                self._execute_add_one_host(host)
-                success.append(host)
-            except topic_common.CliError:
-                pass
+            data = dict(self.data)
+            data.update(hostname=host, status='Ready')
+            calls.append(('add_host', host, data))
+        added = self._successful_hosts(
+                self.hosts, self.execute_rpc_batch(calls, allow_failures=True))
 
-        return success
+        # Now add the platform label
+        labels = self.labels[:]
+        if self.platform:
+            labels.append(self.platform)
+        if not len(labels):
+            return added
+        calls = [('host_add_labels', host, {'id': host, 'labels': labels})
+                 for host in added]
+        return self._successful_hosts(
+                added, self.execute_rpc_batch(calls, allow_failures=True))
 
 
     def output(self, hosts):
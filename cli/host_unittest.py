@@ -1300,13 +1300,13 @@ class host_create_unittest(cli_mock.cli_unittest):
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
-                           ('host_add_labels', {'id': 'host1',
-                                                'labels': ['label0']},
-                            True, None),
                            ('add_host', {'hostname': 'host0',
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
+                           ('host_add_labels', {'id': 'host1',
+                                                'labels': ['label0']},
+                            True, None),
                            ('host_add_labels', {'id': 'host0',
                                                 'labels': ['label0']},
                             True, None),
@@ -1335,13 +1335,13 @@ class host_create_unittest(cli_mock.cli_unittest):
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
-                           ('host_add_labels', {'id': 'host1',
-                                                'labels': ['label0']},
-                            True, None),
                            ('add_host', {'hostname': 'host0',
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
+                           ('host_add_labels', {'id': 'host1',
+                                                'labels': ['label0']},
+                            True, None),
                            ('host_add_labels', {'id': 'host0',
                                                 'labels': ['label0']},
                             True, None),
@@ -1355,6 +1355,39 @@ class host_create_unittest(cli_mock.cli_unittest):
                      out_words_ok=['host0', 'host1'])
 
 
+    def test_execute_create_one_host_fails(self):
+        self.run_cmd(argv=['atest', 'host', 'create', '--lock',
+                           '-b', 'label0', '--acls', 'acl0', 'host0', 'host1',
+                           '--ignore_site_file'],
+                     rpcs=[('get_labels', {'name': 'label0'},
+                            True,
+                            [{u'id': 4,
+                              u'platform': 0,
+                              u'name': u'label0',
+                              u'invalid': False,
+                              u'kernel_config': u''}]),
+                           ('get_acl_groups', {'name': 'acl0'},
+                            True, []),
+                           ('add_acl_group', {'name': 'acl0'},
+                            True, 5),
+                           ('add_host', {'hostname': 'host1',
+                                         'status': 'Ready',
+                                         'locked': True},
+                            True, 42),
+                           ('add_host', {'hostname': 'host0',
+                                         'status': 'Ready',
+                                         'locked': True},
+                            False, 'ValidationError: hostname already exists'),
+                           ('host_add_labels', {'id': 'host1',
+                                                'labels': ['label0']},
+                            True, None),
+                           ('acl_group_add_hosts',
+                            {'id': 'acl0', 'hosts': ['host1']},
+                            True, None)],
+                     out_words_ok=['host1'], out_words_no=['host0'],
+                     err_words_ok=['Operation add_host failed', 'host0'])
+
+
     def test_execute_create_muliple_hosts_label_escaped_quotes(self):
         self.run_cmd(argv=['atest', 'host', 'create',
                            '-b', 'label0,label\\,1,label\\,2',
@@ -1389,14 +1422,14 @@ class host_create_unittest(cli_mock.cli_unittest):
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
-                           ('host_add_labels', {'id': 'host1',
-                                                'labels': ['label0', 'label,1',
-                                                           'label,2']},
-                            True, None),
                            ('add_host', {'hostname': 'host0',
                                          'status': 'Ready',
                                          'locked': True},
                             True, 42),
+                           ('host_add_labels', {'id': 'host1',
+                                                'labels': ['label0', 'label,1',
+                                                           'label,2']},
+                            True, None),
                            ('host_add_labels', {'id': 'host0',
                                                 'labels': ['label0', 'label,1',
                                                            'label,2']},
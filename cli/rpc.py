@@ -63,6 +63,32 @@ class rpc_comm(object):
         return result
 
 
+    def run_batch(self, calls):
+        """
+        Run several RPCs in a single request.
+
+        @param calls: list of (op, data) tuples, data being the dict of
+                keyword arguments of the RPC.
+        @return the list of executed BatchedCall objects, in order.  Reading
+                the "result" of a call that failed raises its error.
+        """
+        if 'AUTOTEST_CLI_DEBUG' in os.environ:
+            print self.web_server, 'batch', calls
+        batch = self.batch()
+        for op, data in calls:
+            getattr(batch, op)(**data)
+        return batch.execute()
+
+
+    def batch(self):
+        """
+        Return a batch proxy.  Calls made through it are queued and sent to
+        the server in a single request by its execute() method (or at the
+        end of a "with" block); each call's "result" is available afterwards.
+        """
+        return rpc_client_lib.get_batch_proxy(self.proxy)
+
+
 class afe_comm(rpc_comm):
     """Handles the AFE setup and communication through RPC"""
     def __init__(self, web_server=None, rpc_path=AFE_RPC_PATH, username=None):
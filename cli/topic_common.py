@@ -470,10 +470,57 @@ class atest(object):
 
 
     def execute_rpc(self, op, item='', **data):
+        return self._call_with_retries(op, item, data,
+                                       lambda: self.afe.run(op, **data))
+
+
+    def execute_rpc_batch(self, calls, allow_failures=False):
+        """
+        Run several RPCs in a single round trip to the server.
+
+        @param calls: list of (op, item, data) tuples, data being the dict
+                of keyword arguments of the RPC and item what failure()
+                reports for it.
+        @param allow_failures: if False, a CliError is raised when any of
+                the calls failed.  If True, the result of a failed call is
+                the CliError instance describing its failure.
+        @return the list of the results of the calls, in order.  Failed
+                calls are always reported through failure().
+        """
+        if not calls:
+            return []
+        ops = []
+        for op, item, data in calls:
+            if op not in ops:
+                ops.append(op)
+        batched = self._call_with_retries(
+                ', '.join(ops), '', {},
+                lambda: self.afe.run_batch([(op, data)
+                                            for op, item, data in calls]))
+
+        results = []
+        failed = 0
+        for (op, item, data), call in zip(calls, batched):
+            try:
+                results.append(call.result)
+            except mock.CheckPlaybackError:
+                raise
+            except Exception, full_error:
+                self.failure(full_error, item=item,
+                             what_failed='Operation %s failed' % op)
+                results.append(CliError(str(full_error)))
+                failed += 1
+        if failed and not allow_failures:
+            raise CliError('%d of %d batched calls failed' %
+                           (failed, len(calls)))
+        return results
+
+
+    def _call_with_retries(self, op, item, data, call):
         retry = 2
         while retry:
             try:
-                return self.afe.run(op, **data)
+                return call()
             except urllib2.URLError, err:
                 if hasattr(err, 'reason'):
                     if 'timed out' not in err.reason:
@@ -770,6 +770,40 @@ class atest_unittest(cli_mock.cli_unittest):
         self.assert_(err.find('http://does_not_exist') >= 0)
 
 
+    def test_execute_rpc_batch(self):
+        rpc.afe_comm.run.expect_call('op0', id=0).and_return('result0')
+        rpc.afe_comm.run.expect_call('op1', id=1).and_return('result1')
+        results = self.atest.execute_rpc_batch([('op0', 'item0', {'id': 0}),
+                                                ('op1', 'item1', {'id': 1})])
+        self.god.check_playback()
+        self.assertEqual(['result0', 'result1'], results)
+
+
+    def test_execute_rpc_batch_failure(self):
+        rpc.afe_comm.run.expect_call('op0', id=0).and_return('result0')
+        rpc.afe_comm.run.expect_call('op1', id=1).and_raises(
+                proxy.JSONRPCException('DoesNotExist: item1'))
+        calls = [('op0', 'item0', {'id': 0}), ('op1', 'item1', {'id': 1})]
+        self.assertRaises(topic_common.CliError,
+                          self.atest.execute_rpc_batch, calls)
+        self.god.check_playback()
+        self.assert_('Operation op1 failed' in self.atest.failed)
+
+
+    def test_execute_rpc_batch_allow_failures(self):
+        rpc.afe_comm.run.expect_call('op0', id=0).and_raises(
+                proxy.JSONRPCException('DoesNotExist: item0'))
+        rpc.afe_comm.run.expect_call('op1', id=1).and_return('result1')
+        results = self.atest.execute_rpc_batch(
+                [('op0', 'item0', {'id': 0}), ('op1', 'item1', {'id': 1})],
+                allow_failures=True)
+        self.god.check_playback()
+        self.assert_(isinstance(results[0], topic_common.CliError))
+        self.assertEqual('result1', results[1])
+        self.assertEqual(set(['item0']),
+                         self.atest.failed['Operation op0 failed'].values()[0])
+
+
     #
     # Print Unit tests
     #
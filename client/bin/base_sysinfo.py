@@ -1,4 +1,5 @@
-import os, shutil, re, glob, subprocess, logging
+import os, shutil, re, glob, subprocess, logging, signal, time, tempfile
+import errno
 
 from autotest_lib.client.common_lib import log
 from autotest_lib.client.bin import utils, package
@@ -24,9 +25,26 @@ _DEFAULT_FILES_TO_LOG_AFTER_ITERATION = [
     "/proc/schedstat", "/proc/meminfo", "/proc/slabinfo", "/proc/interrupts"
     ]
 
+# commands whose output can't change until the next reboot (or package
+# change), so it is collected only once per boot and then copied from a cache
+_BOOT_INVARIANT_COMMANDS = set(["lspci -vvn", "gcc --version", "ld --version"])
+
+# seconds a sysinfo command may run before it gets killed
+_DEFAULT_COMMAND_TIMEOUT = 300
+# maximum number of sysinfo commands running at the same time
+_MAX_PARALLEL_COMMANDS = 8
+_POLL_INTERVAL = 0.05
+
+_BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+_BOOT_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                               "autotest_sysinfo_cache")
+
 
 class loggable(object):
     """ Abstract class for representing all things "loggable" by sysinfo. """
+    # the output only changes across reboots, see base_sysinfo._boot_cache_dir
+    boot_invariant = False
+
     def __init__(self, logf, log_in_keyval):
         self.logf = logf
         self.log_in_keyval = log_in_keyval
@@ -40,6 +58,14 @@ class loggable(object):
             return ""
 
 
+    def start(self, logdir):
+        """ Start logging into logdir. Returns an object with poll() and
+        kill() methods if the logging goes on in the background, or None if
+        it already completed. """
+        self.run(logdir)
+        return None
+
+
 class logfile(loggable):
     def __init__(self, path, logf=None, log_in_keyval=False):
         if not logf:
@@ -78,12 +104,49 @@ class logfile(loggable):
             shutil.copyfile(self.path, os.path.join(logdir, self.logf))
 
 
+class _running_command(object):
+    """ A sysinfo command running in the background, in its own process
+    group so that a timeout kills all of its processes. """
+    def __init__(self, cmd, logpath):
+        stdin = open(os.devnull, "r")
+        stdout = open(logpath, "w")
+        stderr = open(os.devnull, "w")
+        env = os.environ.copy()
+        if "PATH" not in env:
+            env["PATH"] = "/usr/bin:/bin"
+        try:
+            self.sp = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+                                       stderr=stderr, shell=True, env=env,
+                                       preexec_fn=os.setpgrp)
+        finally:
+            for f in (stdin, stdout, stderr):
+                f.close()
+
+
+    def poll(self):
+        return self.sp.poll()
+
+
+    def kill(self):
+        try:
+            os.killpg(self.sp.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.sp.wait()
+
+
 class command(loggable):
-    def __init__(self, cmd, logf=None, log_in_keyval=False):
+    # class level default for instances unpickled from older versions
+    timeout = _DEFAULT_COMMAND_TIMEOUT
+
+    def __init__(self, cmd, logf=None, log_in_keyval=False,
+                 timeout=_DEFAULT_COMMAND_TIMEOUT, boot_invariant=False):
         if not logf:
             logf = cmd.replace(" ", "_")
         super(command, self).__init__(logf, log_in_keyval)
         self.cmd = cmd
+        self.timeout = timeout
+        self.boot_invariant = boot_invariant
 
 
     def __repr__(self):
@@ -111,17 +174,95 @@ class command(loggable):
         return hash((self.cmd, self.logf))
 
 
+    def start(self, logdir):
+        return _running_command(self.cmd, os.path.join(logdir, self.logf))
+
+
     def run(self, logdir):
-        stdin = open(os.devnull, "r")
-        stdout = open(os.path.join(logdir, self.logf), "w")
-        stderr = open(os.devnull, "w")
-        env = os.environ.copy()
-        if "PATH" not in env:
-            env["PATH"] = "/usr/bin:/bin"
-        subprocess.call(self.cmd, stdin=stdin, stdout=stdout, stderr=stderr,
-                        shell=True, env=env)
-        for f in (stdin, stdout, stderr):
-            f.close()
+        run_loggables([self], logdir)
+
+
+def _get_boot_id():
+    try:
+        return utils.read_one_line(_BOOT_ID_PATH)
+    except IOError:
+        return None
+
+
+def _copy_to_cache(path, cache_path):
+    """ Atomically store a copy of path as cache_path. """
+    temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        shutil.copyfile(path, temp_path)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError), e:
+        logging.warning("Failed to cache sysinfo output %s: %s", path, e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def run_loggables(loggables, logdir, cache_dir=None):
+    """
+    Log all of the loggables into logdir. Commands run concurrently (at most
+    _MAX_PARALLEL_COMMANDS at a time) and get killed when they exceed their
+    timeout, while everything else is logged meanwhile.
+
+    @param loggables: An iterable of loggable objects.
+    @param logdir: The directory to store the logs into.
+    @param cache_dir: If not None, a directory with the outputs of
+            boot_invariant loggables collected earlier in this boot, to be
+            reused instead of running them again; new outputs are added.
+    """
+    waiting = []
+    for log in loggables:
+        if cache_dir and log.boot_invariant:
+            cache_path = os.path.join(cache_dir, log.logf)
+            try:
+                shutil.copyfile(cache_path, os.path.join(logdir, log.logf))
+                continue
+            except IOError, e:
+                # not cached yet, or dropped by another job
+                if e.errno != errno.ENOENT:
+                    raise
+        else:
+            cache_path = None
+        waiting.append((log, cache_path))
+
+    running = []
+    try:
+        while waiting or running:
+            while waiting and len(running) < _MAX_PARALLEL_COMMANDS:
+                log, cache_path = waiting.pop(0)
+                job = log.start(logdir)
+                if job is None:
+                    if cache_path:
+                        _copy_to_cache(os.path.join(logdir, log.logf),
+                                       cache_path)
+                    continue
+                deadline = None
+                if log.timeout:
+                    deadline = time.time() + log.timeout
+                running.append((log, job, deadline, cache_path))
+
+            if not running:
+                continue
+            time.sleep(_POLL_INTERVAL)
+            still_running = []
+            for log, job, deadline, cache_path in running:
+                exit_status = job.poll()
+                if exit_status is None:
+                    if deadline is None or time.time() < deadline:
+                        still_running.append((log, job, deadline, cache_path))
+                        continue
+                    logging.warning("sysinfo %r timed out after %d seconds",
+                                    log, log.timeout)
+                    job.kill()
+                elif exit_status == 0 and cache_path:
+                    _copy_to_cache(os.path.join(logdir, log.logf), cache_path)
+            running = still_running
+    finally:
+        for log, job, deadline, cache_path in running:
+            job.kill()
 
 
 class base_sysinfo(object):
@@ -138,7 +279,8 @@ class base_sysinfo(object):
         # pull in the EXTRA post-boot logs to collect
         self.boot_loggables = set()
         for cmd in _DEFAULT_COMMANDS_TO_LOG_PER_BOOT:
-            self.boot_loggables.add(command(cmd))
+            self.boot_loggables.add(
+                command(cmd, boot_invariant=cmd in _BOOT_INVARIANT_COMMANDS))
         for filename in _DEFAULT_FILES_TO_LOG_PER_BOOT:
             self.boot_loggables.add(logfile(filename))
 
@@ -216,6 +358,51 @@ class base_sysinfo(object):
         return logdir
 
 
+    def _get_installed_packages(self):
+        """ Returns the installed packages, only asking the package manager
+        when the package database changed since the last call. """
+        fingerprint = package.database_fingerprint()
+        cached = getattr(self, "_package_list_cache", None)
+        if fingerprint is not None and cached and cached[0] == fingerprint:
+            return cached[1]
+        packages = package.list_all()
+        self._package_list_cache = (fingerprint, packages)
+        return packages
+
+
+    def _boot_cache_dir(self):
+        """ Returns the directory caching the output of the boot invariant
+        loggables for the current boot and installed packages, or None if
+        there is no way to tell when the cached data gets stale. """
+        boot_id = _get_boot_id()
+        fingerprint = package.database_fingerprint()
+        if not boot_id or fingerprint is None:
+            return None
+        key = utils.hash("md5", repr((boot_id, fingerprint))).hexdigest()
+        cache_dir = os.path.join(_BOOT_CACHE_DIR, key)
+        if os.path.isdir(cache_dir):
+            return cache_dir
+        # drop the outputs cached for previous boots and packages, leaving
+        # alone the current ones, which concurrent jobs may be using
+        try:
+            names = os.listdir(_BOOT_CACHE_DIR)
+        except OSError:
+            names = []
+        for name in names:
+            if name != key:
+                shutil.rmtree(os.path.join(_BOOT_CACHE_DIR, name),
+                              ignore_errors=True)
+        try:
+            os.makedirs(cache_dir)
+        except OSError, e:
+            # another job may have just created it
+            if e.errno != errno.EEXIST:
+                logging.warning("Cannot create sysinfo cache %s: %s",
+                                cache_dir, e)
+                return None
+        return cache_dir
+
+
     @log.log_and_ignore_errors("post-reboot sysinfo error:")
     def log_per_reboot_data(self):
         """ Logging hook called whenever a job starts, and again after
@@ -224,19 +411,19 @@ class base_sysinfo(object):
         if not os.path.exists(logdir):
             os.mkdir(logdir)
 
-        for log in (self.test_loggables | self.boot_loggables):
-            log.run(logdir)
+        run_loggables(self.test_loggables | self.boot_loggables, logdir,
+                      cache_dir=self._boot_cache_dir())
 
         # also log any installed packages
         installed_path = os.path.join(logdir, "installed_packages")
-        installed_packages = "\n".join(package.list_all()) + "\n"
+        installed_packages = "\n".join(self._get_installed_packages()) + "\n"
         utils.open_write_close(installed_path, installed_packages)
 
 
     @log.log_and_ignore_errors("pre-test sysinfo error:")
     def log_before_each_test(self, test):
         """ Logging hook called before a test starts. """
-        self._installed_packages = package.list_all()
+        self._installed_packages = self._get_installed_packages()
         if os.path.exists("/var/log/messages"):
             stat = os.stat("/var/log/messages")
             self._messages_size = stat.st_size
@@ -261,8 +448,7 @@ class base_sysinfo(object):
                                                               symlink_dest)
 
         # run all the standard logging commands
-        for log in self.test_loggables:
-            log.run(test_sysinfodir)
+        run_loggables(self.test_loggables, test_sysinfodir)
 
         # grab any new data from /var/log/messages
         self._log_messages(test_sysinfodir)
@@ -273,7 +459,7 @@ class base_sysinfo(object):
 
         # log any changes to installed packages
         old_packages = set(self._installed_packages)
-        new_packages = set(package.list_all())
+        new_packages = set(self._get_installed_packages())
         added_path = os.path.join(test_sysinfodir, "added_packages")
         added_packages = "\n".join(new_packages - old_packages) + "\n"
         utils.open_write_close(added_path, added_packages)
@@ -289,8 +475,7 @@ class base_sysinfo(object):
             iteration = test.iteration
         logdir = self._get_iteration_subdir(test, iteration)
 
-        for log in self.before_iteration_loggables:
-            log.run(logdir)
+        run_loggables(self.before_iteration_loggables, logdir)
 
 
     @log.log_and_ignore_errors("post-test siteration sysinfo error:")
@@ -300,8 +485,7 @@ class base_sysinfo(object):
             iteration = test.iteration
         logdir = self._get_iteration_subdir(test, iteration)
 
-        for log in self.after_iteration_loggables:
-            log.run(logdir)
+        run_loggables(self.after_iteration_loggables, logdir)
 
 
     def _log_messages(self, logdir):
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, time, unittest
+import common
+from autotest_lib.client.common_lib.test_utils import mock
+from autotest_lib.client.bin import base_sysinfo, package
+
+
+class test_run_loggables(unittest.TestCase):
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.logdir)
+        shutil.rmtree(self.cache_dir)
+
+
+    def _read_log(self, logf):
+        return open(os.path.join(self.logdir, logf)).read()
+
+
+    def test_commands_and_files(self):
+        source = os.path.join(self.cache_dir, "source")
+        open(source, "w").write("file contents\n")
+        base_sysinfo.run_loggables(
+            [base_sysinfo.command("echo one", logf="one"),
+             base_sysinfo.command("echo two", logf="two"),
+             base_sysinfo.logfile(source)], self.logdir)
+        self.assertEquals(self._read_log("one"), "one\n")
+        self.assertEquals(self._read_log("two"), "two\n")
+        self.assertEquals(self._read_log("source"), "file contents\n")
+
+
+    def test_commands_run_concurrently(self):
+        commands = [base_sysinfo.command("sleep 1", logf="sleep%d" % i)
+                    for i in xrange(4)]
+        start_time = time.time()
+        base_sysinfo.run_loggables(commands, self.logdir)
+        self.assert_(time.time() - start_time < 3)
+
+
+    def test_timeout(self):
+        start_time = time.time()
+        base_sysinfo.run_loggables(
+            [base_sysinfo.command("echo started; sleep 30", logf="slow",
+                                  timeout=1),
+             base_sysinfo.command("echo fast", logf="fast")], self.logdir)
+        self.assert_(time.time() - start_time < 10)
+        self.assertEquals(self._read_log("slow"), "started\n")
+        self.assertEquals(self._read_log("fast"), "fast\n")
+
+
+    def test_boot_invariant_output_is_cached(self):
+        counter = os.path.join(self.cache_dir, "counter")
+        cmd = base_sysinfo.command("echo run >> %s; echo output" % counter,
+                                   logf="cached", boot_invariant=True)
+        cache = os.path.join(self.cache_dir, "boot")
+        os.mkdir(cache)
+        for i in xrange(2):
+            base_sysinfo.run_loggables([cmd], self.logdir, cache_dir=cache)
+            self.assertEquals(self._read_log("cached"), "output\n")
+        self.assertEquals(open(counter).read(), "run\n")
+
+
+    def test_failed_command_is_not_cached(self):
+        cmd = base_sysinfo.command("echo output; false", logf="failed",
+                                   boot_invariant=True)
+        base_sysinfo.run_loggables([cmd], self.logdir,
+                                   cache_dir=self.cache_dir)
+        self.assertEquals(self._read_log("failed"), "output\n")
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                     "failed")))
+
+
+class test_boot_cache_dir(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_function(base_sysinfo, "_get_boot_id")
+        self.god.stub_function(package, "database_fingerprint")
+        self.tmpdir = tempfile.mkdtemp()
+        self.god.stub_with(base_sysinfo, "_BOOT_CACHE_DIR",
+                           os.path.join(self.tmpdir, "cache"))
+        self.sysinfo = base_sysinfo.base_sysinfo(self.tmpdir)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.tmpdir)
+
+
+    def _cache_dir(self, fingerprint):
+        base_sysinfo._get_boot_id.expect_call().and_return("boot")
+        package.database_fingerprint.expect_call().and_return(fingerprint)
+        return self.sysinfo._boot_cache_dir()
+
+
+    def test_stale_keys_are_dropped(self):
+        old_dir = self._cache_dir(("db", 1))
+        open(os.path.join(old_dir, "cached"), "w").write("output\n")
+        self.assertEquals(self._cache_dir(("db", 1)), old_dir)
+        self.assert_(os.path.exists(os.path.join(old_dir, "cached")))
+
+        # another job created the current key's directory meanwhile
+        new_dir = self._cache_dir(("db", 2))
+        self.assertEquals(os.listdir(base_sysinfo._BOOT_CACHE_DIR),
+                          [os.path.basename(new_dir)])
+        shutil.rmtree(new_dir)
+        self.god.stub_with(base_sysinfo.os.path, "isdir", lambda path: False)
+        os.makedirs(new_dir)
+        open(os.path.join(new_dir, "cached"), "w").write("output\n")
+        self.assertEquals(self._cache_dir(("db", 2)), new_dir)
+        self.assert_(os.path.exists(os.path.join(new_dir, "cached")))
+        self.god.check_playback()
+
+
+class test_installed_packages(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_function(package, "database_fingerprint")
+        self.god.stub_function(package, "list_all")
+        self.resultsdir = tempfile.mkdtemp()
+        self.sysinfo = base_sysinfo.base_sysinfo(self.resultsdir)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.resultsdir)
+
+
+    def test_unchanged_database_is_not_listed_again(self):
+        package.database_fingerprint.expect_call().and_return(("db", 1))
+        package.list_all.expect_call().and_return(["a-1", "b-1"])
+        package.database_fingerprint.expect_call().and_return(("db", 1))
+        self.assertEquals(self.sysinfo._get_installed_packages(),
+                          ["a-1", "b-1"])
+        self.assertEquals(self.sysinfo._get_installed_packages(),
+                          ["a-1", "b-1"])
+        self.god.check_playback()
+
+
+    def test_changed_database_is_listed_again(self):
+        package.database_fingerprint.expect_call().and_return(("db", 1))
+        package.list_all.expect_call().and_return(["a-1"])
+        package.database_fingerprint.expect_call().and_return(("db", 2))
+        package.list_all.expect_call().and_return(["a-2"])
+        self.sysinfo._get_installed_packages()
+        self.assertEquals(self.sysinfo._get_installed_packages(), ["a-2"])
+        self.god.check_playback()
+
+
+    def test_unknown_database_is_always_listed(self):
+        for i in xrange(2):
+            package.database_fingerprint.expect_call().and_return(None)
+            package.list_all.expect_call().and_return(["a-1"])
+        self.sysinfo._get_installed_packages()
+        self.sysinfo._get_installed_packages()
+        self.god.check_playback()
+
+
+if __name__ == "__main__":
+    unittest.main()
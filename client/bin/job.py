@@ -9,7 +9,7 @@ import copy, os, platform, re, shutil, sys, time, traceback, types, glob
 import logging, getpass, errno, weakref
 import cPickle as pickle
 from autotest_lib.client.bin import client_logging_config
-from autotest_lib.client.bin import utils, parallel, kernel, xen
+from autotest_lib.client.bin import utils, parallel, parallel_tests, kernel, xen
 from autotest_lib.client.bin import profilers, boottool, harness
 from autotest_lib.client.bin import config, sysinfo, test, local_host
 from autotest_lib.client.bin import partition as partition_lib
@@ -508,9 +508,15 @@ class base_client_job(base_job.base_job):
 
 
     def _runtest(self, url, tag, args, dargs):
+        def run_test_in_child():
+            try:
+                test.runtest(self, url, tag, args, dargs)
+            finally:
+                # the child exits without running any exit handlers
+                self._logger.flush()
         try:
-            l = lambda : test.runtest(self, url, tag, args, dargs)
-            pid = parallel.fork_start(self.resultdir, l)
+            self._logger.flush()
+            pid = parallel.fork_start(self.resultdir, run_test_in_child)
             parallel.fork_waitfor(self.resultdir, pid)
         except error.TestBaseException:
             # These are already classified with an error type (exit_status)
@@ -807,6 +813,7 @@ class base_client_job(base_job.base_job):
         utils.system("modprobe -r netconsole", ignore_status=True)
 
         # sync first, so that a sync during shutdown doesn't time out
+        self._logger.flush(durable=True)
         utils.system("sync; sync", ignore_status=True)
 
         utils.system("(sleep 5; reboot) </dev/null >/dev/null 2>&1 &")
@@ -817,6 +824,52 @@ class base_client_job(base_job.base_job):
         logging.info("job: noop: " + text)
 
 
+    def _fork_task(self, log_filename, function):
+        """
+        Fork a process running function, which records its status log
+        entries into log_filename, at the current indentation level. Merge
+        them back into the job's status log with _merge_task_log once the
+        process is done.
+
+        @returns the pid of the process.
+        """
+        old_log_filename = self._logger.global_filename
+        self._logger.flush()
+        self._logger.global_filename = log_filename
+        def task_func():
+            # stub out _record_indent with a process-local one
+            base_record_indent = self._record_indent
+            proc_local = self._job_state.property_factory(
+                '_state', '_record_indent.%d' % os.getpid(),
+                base_record_indent, namespace='client')
+            self.__class__._record_indent = proc_local
+            try:
+                function()
+            finally:
+                self._logger.flush()
+        try:
+            return parallel.fork_start(self.resultdir, task_func)
+        finally:
+            self._logger.global_filename = old_log_filename
+
+
+    def _merge_task_log(self, log_filename):
+        """Copy the status log of a task started by _fork_task into the
+        job's status log."""
+        old_log_path = os.path.join(self.resultdir,
+                                    self._logger.global_filename)
+        new_log_path = os.path.join(self.resultdir, log_filename)
+        if os.path.exists(new_log_path):
+            old_log = open(old_log_path, "a")
+            try:
+                new_log = open(new_log_path)
+                old_log.write(new_log.read())
+                new_log.close()
+            finally:
+                old_log.close()
+            os.remove(new_log_path)
+
+
     @_run_test_complete_on_exit
     def parallel(self, *tasklist):
         """Run tasks in parallel"""
@@ -825,19 +878,11 @@ class base_client_job(base_job.base_job):
         old_log_filename = self._logger.global_filename
         for i, task in enumerate(tasklist):
             assert isinstance(task, (tuple, list))
-            self._logger.global_filename = old_log_filename + (".%d" % i)
             def task_func():
-                # stub out _record_indent with a process-local one
-                base_record_indent = self._record_indent
-                proc_local = self._job_state.property_factory(
-                    '_state', '_record_indent.%d' % os.getpid(),
-                    base_record_indent, namespace='client')
-                self.__class__._record_indent = proc_local
                 task[0](*task[1:])
-            pids.append(parallel.fork_start(self.resultdir, task_func))
+            pids.append(self._fork_task(old_log_filename + (".%d" % i),
+                                        task_func))
 
-        old_log_path = os.path.join(self.resultdir, old_log_filename)
-        old_log = open(old_log_path, "a")
         exceptions = []
         for i, pid in enumerate(pids):
             # wait for the task to finish
@@ -846,16 +891,7 @@ class base_client_job(base_job.base_job):
             except Exception, e:
                 exceptions.append(e)
             # copy the logs from the subtask into the main log
-            new_log_path = old_log_path + (".%d" % i)
-            if os.path.exists(new_log_path):
-                new_log = open(new_log_path)
-                old_log.write(new_log.read())
-                new_log.close()
-                old_log.flush()
-                os.remove(new_log_path)
-        old_log.close()
-
-        self._logger.global_filename = old_log_filename
+            self._merge_task_log(old_log_filename + (".%d" % i))
 
         # handle any exceptions raised by the parallel tasks
         if exceptions:
@@ -863,6 +899,117 @@ class base_client_job(base_job.base_job):
             raise error.JobError(msg)
 
 
+    @_run_test_complete_on_exit
+    def run_tests_parallel(self, tests, max_cpus=None, max_mbytes=None,
+                           containers=None):
+        """
+        Run independent tests concurrently, packed onto the CPUs and memory
+        of the machine (or of the cpuset the job runs in) according to what
+        each of them needs; see parallel_tests.get_next for the order in
+        which they start.
+
+        Every test gets its own results directory as with run_test, and the
+        status log entries of each test are kept together in the job's
+        status log.
+
+        @param tests: A list of parallel_tests.test_spec, or of test urls
+                for tests needing a single CPU.
+        @param max_cpus: Use at most this many CPUs.
+        @param max_mbytes: Use at most this many megabytes of memory.
+        @param containers: If True run every test in a cpuset container
+                holding the CPUs and memory given to it. The default is to
+                do so when memory isolation containers are enabled.
+
+        @returns a list with True for each test which passed and False for
+                each one which failed, in the order of tests.
+        """
+        specs = []
+        for spec in tests:
+            if not isinstance(spec, parallel_tests.test_spec):
+                spec = parallel_tests.test_spec(spec)
+            specs.append(spec)
+        pool = parallel_tests.get_machine_pool(max_cpus, max_mbytes)
+        for spec in specs:
+            pool.check(spec)
+        if containers is None:
+            containers = parallel_tests.use_containers()
+
+        old_log_filename = self._logger.global_filename
+        results = [False] * len(specs)
+        pending = range(len(specs))
+        running = {}
+        exceptions = []
+        while pending or running:
+            index = parallel_tests.get_next(pool,
+                                            [specs[i] for i in pending])
+            if index is not None:
+                i = pending.pop(index)
+                cpus, mbytes = pool.allocate(specs[i])
+                dargs = self._number_parallel_test(specs[i].dargs)
+                if containers:
+                    # containers can't be given no memory, tests which
+                    # didn't say how much they need get a share of the pool
+                    container_mbytes = mbytes or (
+                            pool.mbytes * len(cpus) / len(pool.cpus))
+                    task_func = self._get_parallel_test_func(
+                            specs[i], dargs, cpus, container_mbytes)
+                else:
+                    task_func = self._get_parallel_test_func(specs[i], dargs)
+                pid = self._fork_task(old_log_filename + (".%d" % i),
+                                      task_func)
+                running[pid] = (i, cpus, mbytes)
+                continue
+
+            pid, e = parallel.fork_waitfor_any(self.resultdir, running.keys())
+            i, cpus, mbytes = running.pop(pid)
+            pool.release(cpus, mbytes)
+            self._merge_task_log(old_log_filename + (".%d" % i))
+            if e is None:
+                results[i] = True
+            elif not isinstance(e, error.TestBaseException):
+                exceptions.append(e)
+
+        if exceptions:
+            msg = ("%d test(s) failed in job.run_tests_parallel"
+                   % len(exceptions))
+            raise error.JobError(msg)
+        return results
+
+
+    def _number_parallel_test(self, dargs):
+        """Returns a copy of the dargs of a test for run_tests_parallel,
+        with the test's sequence number added to its tag if the job uses
+        sequence numbers. The numbers are handed out by the parent, as the
+        test processes would race each other for the job state."""
+        dargs = dict(dargs)
+        if self.use_sequence_number:
+            tag_parts = ['_%02d_' % self._sequence_number]
+            if dargs.get('tag'):
+                tag_parts.insert(0, str(dargs['tag']))
+            dargs['tag'] = '.'.join(tag_parts)
+            self._sequence_number += 1
+        return dargs
+
+
+    def _get_parallel_test_func(self, spec, dargs, cpus=None, mbytes=None):
+        """Returns the function running a test for run_tests_parallel with
+        the given dargs, in a container with the given CPUs and megabytes of
+        memory if cpus is not None. The function raises a TestFail if the
+        test fails."""
+        def run_test():
+            # the test is numbered already, stop using the job's sequence
+            # number in this process
+            self.__class__._sequence_number = None
+            if not self.run_test(spec.url, *spec.args, **dargs):
+                raise error.TestFail('%s failed' % spec.url)
+        if cpus is None:
+            return run_test
+        def run_test_in_container():
+            parallel_tests.run_in_container('test_%d' % os.getpid(), cpus,
+                                            mbytes, run_test)
+        return run_test_in_container
+
+
     def quit(self):
         # XXX: should have a better name.
         self.harness.run_pause()
@@ -872,11 +1019,14 @@ class base_client_job(base_job.base_job):
     def complete(self, status):
         """Clean up and exit"""
         # We are about to exit 'complete' so clean up the control file.
+        # Turning off the backing file folds its journal back into it.
+        self._state.set_backing_file(None)
         dest = os.path.join(self.resultdir, os.path.basename(self._state_file))
         shutil.move(self._state_file, dest)
 
         self.harness.run_complete()
         self.disable_external_logging()
+        self._logger.flush(durable=True)
         sys.exit(status)
 
 
@@ -1155,6 +1305,9 @@ def runjob(control, drop_caches, options):
     if not options.cont and os.path.isfile(state):
         logging.debug('Cleaning up previously found state file')
         os.remove(state)
+    state_journal = state + base_job.job_state.JOURNAL_SUFFIX
+    if not options.cont and os.path.isfile(state_journal):
+        os.remove(state_journal)
 
     # instantiate the job object ready for the control file.
     myjob = None
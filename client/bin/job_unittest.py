@@ -1,13 +1,14 @@
 #!/usr/bin/python
 
-import logging, os, shutil, sys, time, StringIO
+import logging, os, shutil, sys, tempfile, time, types, StringIO
 import common
 
 from autotest_lib.client.bin import job, boottool, config, sysinfo, harness
 from autotest_lib.client.bin import test, xen, kernel, utils
+from autotest_lib.client.bin import parallel, parallel_tests
 from autotest_lib.client.common_lib import packages, error, log
 from autotest_lib.client.common_lib import logging_manager, logging_config
-from autotest_lib.client.common_lib import base_job_unittest
+from autotest_lib.client.common_lib import base_job, base_job_unittest
 from autotest_lib.client.common_lib.test_utils import mock, unittest
 
 
@@ -691,5 +692,122 @@ class test_base_job(unittest.TestCase):
         self.god.check_playback()
 
 
+class test_run_tests_parallel(job_test_case):
+    def setUp(self):
+        job_test_case.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.job._state = base_job_unittest.stub_job_state()
+        self.job._logger = dummy()
+        self.job._logger.global_filename = 'status'
+        self.job.harness = self.god.create_mock_class(harness.harness,
+                                                      'harness')
+        self.job.drop_caches = False
+        self.job._resultdir = dummy()
+        self.job._resultdir.path = '/results'
+        self.god.stub_function(parallel_tests, 'get_machine_pool')
+        self.god.stub_function(parallel, 'fork_waitfor_any')
+        self.god.stub_function(self.job, '_fork_task')
+        self.god.stub_function(self.job, '_merge_task_log')
+
+
+    def tearDown(self):
+        job_test_case.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+
+    def _expect_fork(self, index, pid):
+        self.job._fork_task.expect_call(
+                'status.%d' % index, mock.is_instance_comparator(
+                    types.FunctionType)).and_return(pid)
+
+
+    def _expect_exit(self, pids, pid, index, exception=None):
+        parallel.fork_waitfor_any.expect_call('/results', pids).and_return(
+                (pid, exception))
+        self.job._merge_task_log.expect_call('status.%d' % index)
+
+
+    def test_packing(self):
+        parallel_tests.get_machine_pool.expect_call(None, None).and_return(
+                parallel_tests.resource_pool([0, 1], 1000))
+        self._expect_fork(0, 100)
+        # the second test needs two CPUs, the third one fits
+        self._expect_fork(2, 102)
+        self._expect_exit([100, 102], 100, 0)
+        self._expect_exit([102], 102, 2, error.TestFail('failed'))
+        self._expect_fork(1, 101)
+        self._expect_exit([101], 101, 1)
+        self.job.harness.run_test_complete.expect_call()
+
+        tests = ['sleeptest',
+                 parallel_tests.test_spec('dbench', cpus=2),
+                 parallel_tests.test_spec('sleeptest', dargs={'tag': '2'})]
+        results = self.job.run_tests_parallel(tests, containers=False)
+        self.god.check_playback()
+        self.assertEquals(results, [True, True, False])
+
+
+    def test_sequence_numbers(self):
+        # the job state is shared with the test processes through its
+        # backing file
+        state_file = os.path.join(self.tmpdir, 'state')
+        self.job._state = base_job.job_state()
+        self.job._state.set_backing_file(state_file)
+        self.job.use_sequence_number = True
+        # stand-ins for the test processes, run once they were all started
+        task_funcs = []
+        def fork_task(log_filename, task_func):
+            task_funcs.append(task_func)
+            return 100 + len(task_funcs)
+        self.god.stub_with(self.job, '_fork_task', fork_task)
+        subdirs = []
+        def run_test(url, *args, **dargs):
+            subdirs.append(self.job._build_tagged_test_name(url, dargs)[1])
+            return True
+        self.god.stub_with(self.job, 'run_test', run_test)
+        # restore the job's sequence number in this process
+        self.god.stub_with(self.job.__class__, '_sequence_number',
+                           base_job.base_job._sequence_number)
+
+        parallel_tests.get_machine_pool.expect_call(None, None).and_return(
+                parallel_tests.resource_pool([0, 1], 1000))
+        self._expect_exit([101, 102], 101, 0)
+        self._expect_exit([102], 102, 1)
+        self.job.harness.run_test_complete.expect_call()
+        tests = ['sleeptest',
+                 parallel_tests.test_spec('sleeptest', dargs={'tag': 'a'})]
+        self.job.run_tests_parallel(tests, containers=False)
+        self.god.check_playback()
+        self.assertEquals(self.job._sequence_number, 3)
+
+        # the parent kept numbering tests while they ran
+        self.job._sequence_number = 5
+        for task_func in task_funcs:
+            task_func()
+        self.assertEquals(subdirs, ['sleeptest._01_', 'sleeptest.a._02_'])
+
+
+    def test_aborted_test(self):
+        parallel_tests.get_machine_pool.expect_call(1, None).and_return(
+                parallel_tests.resource_pool([0], 1000))
+        self._expect_fork(0, 100)
+        self._expect_exit([100], 100, 0, error.JobError('aborted'))
+        self.job.harness.run_test_complete.expect_call()
+
+        self.assertRaises(error.JobError, self.job.run_tests_parallel,
+                          ['sleeptest'], max_cpus=1, containers=False)
+        self.god.check_playback()
+
+
+    def test_test_too_big(self):
+        parallel_tests.get_machine_pool.expect_call(None, None).and_return(
+                parallel_tests.resource_pool([0], 1000))
+        self.job.harness.run_test_complete.expect_call()
+
+        self.assertRaises(error.JobError, self.job.run_tests_parallel,
+                          [parallel_tests.test_spec('dbench', cpus=2)])
+        self.god.check_playback()
+
+
 if __name__ == "__main__":
     unittest.main()
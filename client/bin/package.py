@@ -13,6 +13,14 @@ from autotest_lib.client.common_lib import error
 # As more package methods are implemented, this list grows up
 KNOWN_PACKAGE_MANAGERS = ['rpm', 'dpkg']
 
+# Files rewritten by each package manager whenever a package is installed or
+# removed (and left alone by queries), used to detect package changes cheaply
+PACKAGE_DATABASE_FILES = {
+    'rpm': ['/var/lib/rpm/Packages', '/var/lib/rpm/Packages.db',
+            '/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/rpmdb.sqlite-wal'],
+    'dpkg': ['/var/lib/dpkg/status'],
+    }
+
 
 def _rpm_info(rpm_package):
     """\
@@ -173,6 +181,34 @@ def list_all():
     return installed_packages
 
 
+def database_fingerprint():
+    """\
+    Returns a value that changes whenever packages are installed or removed,
+    computed from the package databases without running the (slow) package
+    manager queries. Two equal fingerprints mean list_all() would return the
+    same packages. Returns None if the package databases can't be found, in
+    which case callers have to fall back to list_all().
+    """
+    support_info = os_support()
+    fingerprint = []
+    for package_manager in KNOWN_PACKAGE_MANAGERS:
+        if not support_info[package_manager]:
+            continue
+        found = False
+        for path in PACKAGE_DATABASE_FILES[package_manager]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint.append((path, stat.st_ino, stat.st_size,
+                                stat.st_mtime))
+            found = True
+        if not found:
+            return None
+
+    return tuple(fingerprint)
+
+
 def info(package):
     """\
     Returns a dictionary with package information about a given package file:
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
 
-import unittest, os
+import unittest, os, shutil, tempfile
 import common
 from autotest_lib.client.common_lib.test_utils import mock
 from autotest_lib.client.bin import package, os_dep, utils
@@ -168,5 +168,31 @@ class TestPackage(unittest.TestCase):
         self.assertEquals(support, exp_support)
 
 
+    def test_database_fingerprint(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            status = os.path.join(tmpdir, 'status')
+            open(status, 'w').write('Package: a\n')
+            self.god.stub_with(package, 'PACKAGE_DATABASE_FILES',
+                               {'rpm': [os.path.join(tmpdir, 'Packages')],
+                                'dpkg': [status]})
+            self.god.stub_function(package, 'os_support')
+            for i in xrange(3):
+                package.os_support.expect_call().and_return(
+                        {'rpm': False, 'dpkg': True, 'conversion': False})
+            package.os_support.expect_call().and_return(
+                    {'rpm': True, 'dpkg': True, 'conversion': False})
+
+            fingerprint = package.database_fingerprint()
+            self.assertEquals(fingerprint, package.database_fingerprint())
+            open(status, 'a').write('Package: b\n')
+            self.assertNotEquals(fingerprint, package.database_fingerprint())
+            # rpm is installed but its database is missing
+            self.assertEquals(package.database_fingerprint(), None)
+            self.god.check_playback()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,7 +2,7 @@
 
 __author__ = """Copyright Andy Whitcroft 2006"""
 
-import sys, logging, os, pickle, traceback, gc
+import sys, logging, os, pickle, traceback, gc, time
 from autotest_lib.client.common_lib import error, utils
 
 def fork_start(tmp, l):
@@ -77,6 +77,29 @@ def fork_waitfor(tmp, pid):
         raise error.TestError("Test subprocess failed rc=%d" % (status))
 
 
+def fork_waitfor_any(tmp, pids, poll_interval=0.1):
+    """
+    Wait for the first of several forked processes to exit.
+
+    @returns a tuple (pid, exception) where exception is what fork_waitfor
+            would have raised for the process, None if it succeeded.
+    """
+    while True:
+        for pid in pids:
+            exited_pid, status = os.waitpid(pid, os.WNOHANG)
+            if not exited_pid:
+                continue
+            try:
+                _check_for_subprocess_exception(tmp, pid)
+                if status:
+                    raise error.TestError("Test subprocess failed rc=%d"
+                                          % (status))
+            except Exception, e:
+                return pid, e
+            return pid, None
+        time.sleep(poll_interval)
+
+
 def fork_nuke_subprocess(tmp, pid):
     utils.nuke_pid(pid)
     _check_for_subprocess_exception(tmp, pid)
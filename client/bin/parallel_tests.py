@@ -0,0 +1,186 @@
+"""
+Packing of independent tests onto the machine, for running them
+concurrently with job.run_tests_parallel().
+
+Every test declares the CPUs and memory it needs (see test_spec); tests are
+started as soon as their needs fit in what the other running tests left
+free. When cpusets are available the CPUs are taken from the cpuset the job
+runs in, and each test can be run in its own container holding the CPUs
+and memory given to it.
+"""
+
+import logging
+from autotest_lib.client.bin import utils, cpuset
+from autotest_lib.client.common_lib import error
+
+
+class test_spec(object):
+    """ A test to run with job.run_tests_parallel() and what it needs """
+    def __init__(self, url, args=(), dargs=None, cpus=1, mbytes=0,
+                 exclusive=False):
+        """
+        @param url: The test to run, as given to job.run_test().
+        @param args: The positional arguments given to job.run_test().
+        @param dargs: The keyword arguments given to job.run_test().
+        @param cpus: The number of CPUs the test keeps busy.
+        @param mbytes: The megabytes of memory the test needs.
+        @param exclusive: True if the test must run alone on the machine,
+                e.g. because it measures performance or changes system
+                settings.
+        """
+        if dargs is None:
+            dargs = {}
+        if cpus < 1:
+            raise ValueError('Tests need at least one CPU')
+        self.url = url
+        self.args = tuple(args)
+        self.dargs = dargs
+        self.cpus = cpus
+        self.mbytes = mbytes
+        self.exclusive = exclusive
+
+
+    def __repr__(self):
+        return 'test_spec(%r, cpus=%d, mbytes=%d, exclusive=%r)' % (
+                self.url, self.cpus, self.mbytes, self.exclusive)
+
+
+class resource_pool(object):
+    """ The CPUs and memory which can be given to parallel tests """
+    def __init__(self, cpus, mbytes):
+        """
+        @param cpus: The ids of the available CPUs.
+        @param mbytes: The megabytes of available memory.
+        """
+        self.cpus = frozenset(cpus)
+        self.mbytes = mbytes
+        self.free_cpus = set(cpus)
+        self.free_mbytes = mbytes
+        self.running = 0
+
+
+    def check(self, spec):
+        """
+        Check that a test can run at all with this pool.
+
+        @raises error.JobError: If the test needs more than the whole pool.
+        """
+        if spec.cpus > len(self.cpus) or spec.mbytes > self.mbytes:
+            raise error.JobError('%r needs more than the %d CPUs and %d MB '
+                                 'available' % (spec, len(self.cpus),
+                                                self.mbytes))
+
+
+    def get_needs(self, spec):
+        """
+        @returns a tuple (number of CPUs, megabytes) a test takes from the
+                pool: the whole pool for exclusive tests.
+        """
+        if spec.exclusive:
+            return len(self.cpus), self.mbytes
+        return spec.cpus, spec.mbytes
+
+
+    def fits(self, spec):
+        cpus, mbytes = self.get_needs(spec)
+        return cpus <= len(self.free_cpus) and mbytes <= self.free_mbytes
+
+
+    def allocate(self, spec):
+        """
+        Take the resources needed by a test from the pool.
+
+        @returns a tuple (set of CPU ids, megabytes) given to the test, None
+                if they aren't free.
+        """
+        if not self.fits(spec):
+            return None
+        count, mbytes = self.get_needs(spec)
+        # keep the CPUs of a test together, they are more likely to share
+        # caches and memory nodes
+        cpus = set(sorted(self.free_cpus)[:count])
+        self.free_cpus -= cpus
+        self.free_mbytes -= mbytes
+        self.running += 1
+        return cpus, mbytes
+
+
+    def release(self, cpus, mbytes):
+        """ Give the resources of a finished test back to the pool. """
+        self.free_cpus |= cpus
+        self.free_mbytes += mbytes
+        self.running -= 1
+
+
+def get_next(pool, pending):
+    """
+    Pick the next test to start.
+
+    Tests start in the order they are given, except that tests which don't
+    fit in the free resources let the following ones start first. An
+    exclusive test waits for all the running tests to finish, and no test
+    after it starts while it waits.
+
+    @param pool: The resource_pool of the machine.
+    @param pending: The list of test_spec not started yet.
+
+    @returns the index in pending of the test to start, None if no test can
+            start before a running test finishes.
+    """
+    for i, spec in enumerate(pending):
+        if pool.fits(spec):
+            return i
+        if spec.exclusive:
+            break
+    return None
+
+
+def get_machine_pool(max_cpus=None, max_mbytes=None):
+    """
+    Get the resources of the machine the parallel tests can use: the CPUs
+    and memory of the cpuset the job runs in, if there is one, or else of
+    the whole machine.
+
+    @param max_cpus: Use at most this many CPUs.
+    @param max_mbytes: Use at most this much memory.
+
+    @returns a resource_pool.
+    """
+    cpus = None
+    mbytes = None
+    if use_containers():
+        container = cpuset.my_container_name()
+        cpus = cpuset.get_cpus(container)
+        mbytes = cpuset.container_mbytes(container)
+    if not cpus:
+        cpus = range(utils.count_cpus())
+    if not mbytes:
+        mbytes = utils.memtotal() / 1024
+    cpus = sorted(cpus)
+    if max_cpus:
+        cpus = cpus[:max_cpus]
+    if max_mbytes:
+        mbytes = min(mbytes, max_mbytes)
+    return resource_pool(cpus, mbytes)
+
+
+def use_containers():
+    """ Whether tests can be run in memory isolated cpuset containers. """
+    cpuset.discover_container_style()
+    return cpuset.mem_isolation_on
+
+
+def run_in_container(name, cpus, mbytes, function):
+    """
+    Run function in a new container nested in the one of the current
+    process, with the given CPUs and megabytes of memory. The container is
+    released when the function returns.
+    """
+    container = cpuset.create_container_with_mbytes_and_specific_cpus(
+            name, mbytes, cpus=cpus, root=cpuset.my_container_name())
+    logging.debug('Running in container %s with CPUs %s', container,
+                  cpuset.abbrev_list(cpus))
+    try:
+        return function()
+    finally:
+        cpuset.release_container(container)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+import unittest
+import common
+from autotest_lib.client.bin import parallel_tests, cpuset, utils
+from autotest_lib.client.common_lib import error
+from autotest_lib.client.common_lib.test_utils import mock
+
+
+class test_resource_pool(unittest.TestCase):
+    def setUp(self):
+        self.pool = parallel_tests.resource_pool([0, 1, 2, 3], 1000)
+
+
+    def test_spec_needs_a_cpu(self):
+        self.assertRaises(ValueError, parallel_tests.test_spec, 'sleeptest',
+                          cpus=0)
+
+
+    def test_allocate_and_release(self):
+        spec = parallel_tests.test_spec('sleeptest', cpus=3, mbytes=600)
+        self.assertEquals(self.pool.allocate(spec), (set([0, 1, 2]), 600))
+        self.assertFalse(self.pool.fits(spec))
+        self.assertEquals(self.pool.allocate(spec), None)
+        self.assertEquals(self.pool.allocate(parallel_tests.test_spec('a')),
+                          (set([3]), 0))
+        self.assertEquals(self.pool.running, 2)
+
+        self.pool.release(set([0, 1, 2]), 600)
+        self.assertEquals(self.pool.free_cpus, set([0, 1, 2]))
+        self.assertEquals(self.pool.free_mbytes, 1000)
+        self.assertEquals(self.pool.running, 1)
+
+
+    def test_memory_limits_packing(self):
+        spec = parallel_tests.test_spec('sleeptest', mbytes=600)
+        self.assert_(self.pool.allocate(spec))
+        self.assertEquals(self.pool.allocate(spec), None)
+
+
+    def test_exclusive_takes_everything(self):
+        spec = parallel_tests.test_spec('sleeptest', exclusive=True)
+        self.assertEquals(self.pool.allocate(spec),
+                          (set([0, 1, 2, 3]), 1000))
+
+
+    def test_check(self):
+        self.pool.check(parallel_tests.test_spec('a', cpus=4, mbytes=1000))
+        self.assertRaises(error.JobError, self.pool.check,
+                          parallel_tests.test_spec('a', cpus=5))
+        self.assertRaises(error.JobError, self.pool.check,
+                          parallel_tests.test_spec('a', mbytes=1001))
+
+
+class test_get_next(unittest.TestCase):
+    def setUp(self):
+        self.pool = parallel_tests.resource_pool([0, 1], 1000)
+        self.pool.allocate(parallel_tests.test_spec('running'))
+
+
+    def test_in_order(self):
+        pending = [parallel_tests.test_spec('a'),
+                   parallel_tests.test_spec('b')]
+        self.assertEquals(parallel_tests.get_next(self.pool, pending), 0)
+
+
+    def test_smaller_tests_go_first(self):
+        pending = [parallel_tests.test_spec('big', cpus=2),
+                   parallel_tests.test_spec('small')]
+        self.assertEquals(parallel_tests.get_next(self.pool, pending), 1)
+
+
+    def test_exclusive_tests_block_the_next_ones(self):
+        pending = [parallel_tests.test_spec('exclusive', exclusive=True),
+                   parallel_tests.test_spec('small')]
+        self.assertEquals(parallel_tests.get_next(self.pool, pending), None)
+
+
+class test_get_machine_pool(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_function(parallel_tests, 'use_containers')
+        self.god.stub_function(utils, 'count_cpus')
+        self.god.stub_function(utils, 'memtotal')
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def test_whole_machine(self):
+        parallel_tests.use_containers.expect_call().and_return(False)
+        utils.count_cpus.expect_call().and_return(8)
+        utils.memtotal.expect_call().and_return(4096 * 1024)
+        pool = parallel_tests.get_machine_pool(max_cpus=6)
+        self.god.check_playback()
+        self.assertEquals(pool.cpus, frozenset(range(6)))
+        self.assertEquals(pool.mbytes, 4096)
+
+
+    def test_container(self):
+        self.god.stub_function(cpuset, 'my_container_name')
+        self.god.stub_function(cpuset, 'get_cpus')
+        self.god.stub_function(cpuset, 'container_mbytes')
+        parallel_tests.use_containers.expect_call().and_return(True)
+        cpuset.my_container_name.expect_call().and_return('job')
+        cpuset.get_cpus.expect_call('job').and_return(set([4, 5, 6, 7]))
+        cpuset.container_mbytes.expect_call('job').and_return(2048)
+        pool = parallel_tests.get_machine_pool(max_mbytes=1024)
+        self.god.check_playback()
+        self.assertEquals(pool.cpus, frozenset([4, 5, 6, 7]))
+        self.assertEquals(pool.mbytes, 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
-import os, copy, logging, errno, fcntl, time, re, weakref, traceback
+import os, copy, logging, errno, fcntl, time, re, weakref, traceback, atexit
+import threading
 import cPickle as pickle
 
 from autotest_lib.client.common_lib import autotemp, error, log
@@ -162,6 +163,78 @@ def with_backing_file(method):
     return wrapped_method
 
 
+def _get_file_fingerprint(file_path):
+    """Returns a tuple identifying the current version of a file, or None."""
+    try:
+        stat = os.stat(file_path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def _apply_state_change(state, change):
+    """Apply a change recorded in a job_state journal to a state dict."""
+    operation, namespace = change[:2]
+    if operation == 'set':
+        name, value = change[2:]
+        state.setdefault(namespace, {})[name] = value
+    elif operation == 'discard':
+        name = change[2]
+        if namespace in state and name in state[namespace]:
+            del state[namespace][name]
+            if not state[namespace]:
+                del state[namespace]
+    elif operation == 'discard_namespace':
+        state.pop(namespace, None)
+    else:
+        raise ValueError('Unknown job state change %r' % (change,))
+
+
+def _read_journal(journal_path, offset, fingerprint):
+    """Read the changes recorded in a job_state journal.
+
+    The journal starts with the fingerprint of the state file it applies
+    to, followed by one pickled change per write. A journal left over
+    from another version of the state file is ignored, as is a record
+    torn by a crash while it was being appended.
+
+    @param journal_path: The path of the journal.
+    @param offset: The offset to start reading from, 0 to read it all.
+    @param fingerprint: The fingerprint of the state file being updated.
+
+    @return: A tuple (changes, offset of the end of the last good record),
+        or None if the journal doesn't apply to the state file.
+    """
+    try:
+        journal = open(journal_path, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return [], 0
+    try:
+        journal.seek(offset)
+        changes = []
+        try:
+            if offset == 0:
+                if os.fstat(journal.fileno()).st_size == 0:
+                    return changes, 0
+                if pickle.load(journal) != fingerprint:
+                    return None
+                offset = journal.tell()
+            while True:
+                changes.append(pickle.load(journal))
+                offset = journal.tell()
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            pass
+        if offset == 0:
+            # not even the header made it to disk
+            return None
+        return changes, offset
+    finally:
+        journal.close()
+
 
 class job_state(object):
     """A class for managing explicit job and user state, optionally persistent.
@@ -172,10 +245,19 @@ class job_state(object):
     as names. Additionally, the namespace 'stateful_property' is used for
     storing the valued associated with properties constructed using the
     property_factory method.
+
+    When a backing file is used, the in-memory state is kept and only
+    revalidated against the backing file on each access. Changes are
+    appended to a journal next to the backing file (see JOURNAL_SUFFIX),
+    which is folded back into the backing file once it grows larger than
+    the backing file itself, and whenever the backing file is changed or
+    turned off.
     """
 
     NO_DEFAULT = object()
     PICKLE_PROTOCOL = 2  # highest protocol available in python 2.4
+    JOURNAL_SUFFIX = '.journal'
+    MIN_COMPACTION_SIZE = 16 * 1024
 
 
     def __init__(self):
@@ -184,13 +266,35 @@ class job_state(object):
         self._backing_file = None
         self._backing_file_initialized = False
         self._backing_file_lock = None
+        # the backing file and journal versions the in-memory state matches
+        self._backing_file_fingerprint = None
+        self._journal_offset = 0
+        self._journal_changes = []
+        self._compaction_needed = False
+
+
+    def _get_journal_path(self):
+        return self._backing_file + self.JOURNAL_SUFFIX
 
 
     def _lock_backing_file(self):
-        """Acquire a lock on the backing file."""
+        """Acquire a lock on the backing file.
+
+        The lock is held on the journal, which is only ever truncated, as
+        the backing file itself gets replaced on compaction.
+        """
         if self._backing_file:
-            self._backing_file_lock = open(self._backing_file, 'a')
-            fcntl.flock(self._backing_file_lock, fcntl.LOCK_EX)
+            journal_path = self._get_journal_path()
+            while True:
+                lock_file = open(journal_path, 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # make sure the journal wasn't removed while we waited
+                path_fingerprint = _get_file_fingerprint(journal_path)
+                if (path_fingerprint and path_fingerprint[0] ==
+                        os.fstat(lock_file.fileno()).st_ino):
+                    break
+                lock_file.close()
+            self._backing_file_lock = lock_file
 
 
     def _unlock_backing_file(self):
@@ -201,29 +305,32 @@ class job_state(object):
             self._backing_file_lock = None
 
 
-    def read_from_file(self, file_path, merge=True):
-        """Read in any state from the file at file_path.
+    def _load_state_file(self, file_path):
+        """Load the state stored in file_path and its journal, if any.
 
-        When merge=True, any state specified only in-memory will be preserved.
-        Any state specified on-disk will be set in-memory, even if an in-memory
-        setting already exists.
-
-        @param file_path: The path where the state should be read from. It must
-            exist but it can be empty.
-        @param merge: If true, merge the on-disk state with the in-memory
-            state. If false, replace the in-memory state with the on-disk
-            state.
-
-        @warning: This method is intentionally concurrency-unsafe. It makes no
-            attempt to control concurrent access to the file at file_path.
+        @return: A tuple (state, fingerprint of file_path, offset of the end
+            of the usable part of the journal).
         """
-
-        # we can assume that the file exists
-        if os.path.getsize(file_path) == 0:
-            on_disk_state = {}
+        fingerprint = _get_file_fingerprint(file_path)
+        if not fingerprint or fingerprint[1] == 0:
+            state = {}
         else:
-            on_disk_state = pickle.load(open(file_path))
+            state = pickle.load(open(file_path))
+        journal = _read_journal(file_path + self.JOURNAL_SUFFIX, 0,
+                                fingerprint)
+        if journal is None:
+            return state, fingerprint, 0
+        changes, journal_offset = journal
+        for change in changes:
+            _apply_state_change(state, change)
+        return state, fingerprint, journal_offset
+
 
+    def _merge_state(self, on_disk_state, merge, file_path):
+        """Merge on_disk_state read from file_path into the in-memory state.
+
+        @see read_from_file for the meaning of merge.
+        """
         if merge:
             # merge the on-disk state with the in-memory state
             for namespace, namespace_dict in on_disk_state.iteritems():
@@ -246,7 +353,29 @@ class job_state(object):
             # just replace the in-memory state with the on-disk state
             self._state = on_disk_state
 
+
+    def read_from_file(self, file_path, merge=True):
+        """Read in any state from the file at file_path.
+
+        When merge=True, any state specified only in-memory will be preserved.
+        Any state specified on-disk will be set in-memory, even if an in-memory
+        setting already exists. Changes still sitting in the journal of
+        file_path, if it is or was used as a backing file, are included.
+
+        @param file_path: The path where the state should be read from. It must
+            exist but it can be empty.
+        @param merge: If true, merge the on-disk state with the in-memory
+            state. If false, replace the in-memory state with the on-disk
+            state.
+
+        @warning: This method is intentionally concurrency-unsafe. It makes no
+            attempt to control concurrent access to the file at file_path.
+        """
+        on_disk_state = self._load_state_file(file_path)[0]
+        self._merge_state(on_disk_state, merge, file_path)
+
         # lock the backing file before we refresh it
+        self._compaction_needed = True
         with_backing_lock(self.__class__._write_to_backing_file)(self)
 
 
@@ -266,30 +395,124 @@ class job_state(object):
             outfile.close()
 
 
+    def _reload_backing_file(self, merge):
+        """Reload the backing file and its journal, with the lock held."""
+        on_disk_state, fingerprint, journal_offset = self._load_state_file(
+                self._backing_file)
+        self._merge_state(on_disk_state, merge, self._backing_file)
+        self._backing_file_fingerprint = fingerprint
+        self._journal_offset = journal_offset
+        journal = self._backing_file_lock
+        if os.fstat(journal.fileno()).st_size != journal_offset:
+            # drop a stale journal or a record torn by a crash
+            journal.truncate(journal_offset)
+
+
     def _read_from_backing_file(self):
         """Refresh the current state from the backing file.
 
         If the backing file has never been read before (indicated by checking
         self._backing_file_initialized) it will merge the file with the
-        in-memory state, rather than overwriting it.
+        in-memory state, rather than overwriting it. Otherwise, the in-memory
+        state is only updated with whatever changed on disk since it was last
+        synchronized.
         """
-        if self._backing_file:
-            merge_backing_file = not self._backing_file_initialized
-            self.read_from_file(self._backing_file, merge=merge_backing_file)
+        if not self._backing_file:
+            return
+        if not self._backing_file_initialized:
+            self._reload_backing_file(merge=True)
             self._backing_file_initialized = True
+            # the merged state must be written out as a whole
+            self._compaction_needed = True
+            return
+
+        fingerprint = _get_file_fingerprint(self._backing_file)
+        if fingerprint != self._backing_file_fingerprint:
+            # replaced, i.e. compacted by someone else
+            self._reload_backing_file(merge=False)
+            return
+        journal_size = os.fstat(self._backing_file_lock.fileno()).st_size
+        if journal_size == self._journal_offset:
+            return
+        journal = None
+        if journal_size > self._journal_offset:
+            journal = _read_journal(self._get_journal_path(),
+                                    self._journal_offset, fingerprint)
+        if journal is None:
+            self._reload_backing_file(merge=False)
+            return
+        changes, self._journal_offset = journal
+        for change in changes:
+            _apply_state_change(self._state, change)
+
+
+    def _compact_backing_file(self):
+        """Write the whole state out to the backing file, emptying the journal.
+
+        The new state is written to a temporary file first and moved over
+        the backing file, so a crash leaves either the old or the new state.
+        A crash before the journal gets emptied is harmless, the journal
+        only applies to the state file it was written for.
+        """
+        temp_path = self._backing_file + '.tmp'
+        self.write_to_file(temp_path)
+        os.rename(temp_path, self._backing_file)
+        self._backing_file_lock.truncate(0)
+        self._backing_file_fingerprint = _get_file_fingerprint(
+                self._backing_file)
+        self._journal_offset = 0
+        self._journal_changes = []
+        self._compaction_needed = False
 
 
     def _write_to_backing_file(self):
-        """Flush the current state to the backing file."""
+        """Flush the current state to the backing file.
+
+        Pending changes are appended to the journal, unless the whole state
+        has to be rewritten anyway.
+        """
+        if not self._backing_file:
+            self._journal_changes = []
+            self._compaction_needed = False
+            return
+        fingerprint = self._backing_file_fingerprint
+        if (self._compaction_needed or fingerprint is None or
+                self._journal_offset > max(self.MIN_COMPACTION_SIZE,
+                                           fingerprint[1])):
+            self._compact_backing_file()
+        elif self._journal_changes:
+            journal = self._backing_file_lock
+            if self._journal_offset == 0:
+                pickle.dump(fingerprint, journal, self.PICKLE_PROTOCOL)
+            for change in self._journal_changes:
+                pickle.dump(change, journal, self.PICKLE_PROTOCOL)
+            journal.flush()
+            self._journal_offset = os.fstat(journal.fileno()).st_size
+            self._journal_changes = []
+
+
+    def _journal_change(self, change):
+        """Record a change to be appended to the journal of the backing file.
+
+        @param change: A tuple (operation, namespace, args...), see
+            _apply_state_change.
+        """
         if self._backing_file:
-            self.write_to_file(self._backing_file)
+            self._journal_changes.append(change)
 
 
     @with_backing_file
     def _synchronize_backing_file(self):
         """Synchronizes the contents of the in-memory and on-disk state."""
-        # state is implicitly synchronized in _with_backing_file methods
-        pass
+        # state is implicitly synchronized in _with_backing_file methods, we
+        # just ask for the journal to be folded into the backing file
+        self._compaction_needed = True
+
+
+    @with_backing_lock
+    def _remove_journal(self):
+        """Remove the (empty) journal of the backing file."""
+        os.remove(self._get_journal_path())
 
 
     def set_backing_file(self, file_path):
@@ -301,10 +524,15 @@ class job_state(object):
         contents. The file will then be kept in sync with the (combined)
         in-memory state. The syncing can be disabled by setting this to None.
 
+        The previous backing file is left as a plain, self-contained state
+        file.
+
         @param file_path: A path on the filesystem that can be read from and
             written to, or None to turn off the backing store.
         """
         self._synchronize_backing_file()
+        if self._backing_file:
+            self._remove_journal()
         self._backing_file = file_path
         self._backing_file_initialized = False
         self._synchronize_backing_file()
@@ -343,6 +571,7 @@ class job_state(object):
         """
         namespace_dict = self._state.setdefault(namespace, {})
         namespace_dict[name] = copy.deepcopy(value)
+        self._journal_change(('set', namespace, name, namespace_dict[name]))
         logging.debug('Persistent state %s.%s now set to %r', namespace,
                       name, value)
 
@@ -371,6 +600,7 @@ class job_state(object):
             del self._state[namespace][name]
             if len(self._state[namespace]) == 0:
                 del self._state[namespace]
+            self._journal_change(('discard', namespace, name))
             logging.debug('Persistent state %s.%s deleted', namespace, name)
         else:
             logging.debug(
@@ -386,6 +616,7 @@ class job_state(object):
         """
         if namespace in self._state:
             del self._state[namespace]
+            self._journal_change(('discard_namespace', namespace))
         logging.debug('Persistent state %s.* deleted', namespace)
 
 
@@ -567,13 +798,139 @@ class status_indenter(object):
         """Decrease indentation by one level."""
 
 
+class _status_log_flusher(object):
+    """Writes out the lines buffered by the status loggers of the process
+    within their FLUSH_INTERVAL, from a single background thread, and closes
+    the loggers when the process exits."""
+
+    def __init__(self):
+        self._reset()
+        self._loggers = weakref.WeakValueDictionary()  # id -> logger
+        atexit.register(self.close_all)
+
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._scheduled = {}  # logger id -> [weakref to logger, ticks waited]
+        self._thread = None
+        self._stopped = False
+
+
+    def _check_for_fork(self):
+        # the thread didn't fork with us, and whoever held the condition
+        # lock in the parent never releases it here
+        if os.getpid() != self._pid:
+            self._reset()
+
+
+    def add(self, logger):
+        """Register a logger to be closed when the process exits."""
+        self._loggers[id(logger)] = logger
+
+
+    def schedule(self, logger):
+        """Make sure logger is flushed within its FLUSH_INTERVAL."""
+        self._check_for_fork()
+        self._cond.acquire()
+        try:
+            if self._stopped or id(logger) in self._scheduled:
+                return
+            self._scheduled[id(logger)] = [weakref.ref(logger), 0]
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name='status_log_flusher')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            elif len(self._scheduled) == 1:
+                # the thread is waiting for something to flush
+                self._cond.notify()
+        finally:
+            self._cond.release()
+
+
+    def unschedule(self, logger):
+        self._check_for_fork()
+        self._cond.acquire()
+        try:
+            self._scheduled.pop(id(logger), None)
+        finally:
+            self._cond.release()
+
+
+    def _run(self):
+        """Wake up every half of the shortest FLUSH_INTERVAL of the scheduled
+        loggers, and flush the loggers which were already scheduled at the
+        previous wake up."""
+        self._cond.acquire()
+        try:
+            while not self._stopped:
+                intervals = [ref().FLUSH_INTERVAL
+                             for ref, ticks in self._scheduled.itervalues()
+                             if ref() is not None]
+                if not intervals:
+                    self._scheduled.clear()
+                    self._cond.wait()
+                    continue
+                self._cond.wait(min(intervals) / 2.0)
+                due = []
+                for key, scheduled in self._scheduled.items():
+                    logger = scheduled[0]()
+                    if logger is None:
+                        del self._scheduled[key]
+                    elif scheduled[1]:
+                        del self._scheduled[key]
+                        due.append(logger)
+                    else:
+                        scheduled[1] += 1
+                self._cond.release()
+                try:
+                    for logger in due:
+                        logger.flush()
+                finally:
+                    self._cond.acquire()
+        finally:
+            self._cond.release()
+
+
+    def close_all(self):
+        """Stop the thread and close all the loggers."""
+        self._check_for_fork()
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._scheduled.clear()
+            self._cond.notify()
+            thread = self._thread
+        finally:
+            self._cond.release()
+        if thread:
+            thread.join()
+        for logger in self._loggers.values():
+            logger.close()
+
+
+_flusher = _status_log_flusher()
+
+
 class status_logger(object):
     """Represents a status log file. Responsible for translating messages
     into on-disk status log lines.
 
+    Log files are kept open and lines are buffered in memory; they're
+    written out at the start and end of every group, by a background thread
+    at most FLUSH_INTERVAL seconds after they were recorded, and whenever
+    flush() is called. Nothing buffered by a parent process is written out
+    by a forked child.
+
     @property global_filename: The filename to write top-level logs to.
     @property subdir_filename: The filename to write subdir-level logs to.
     """
+
+    FLUSH_INTERVAL = 5  # seconds
+    MAX_OPEN_FILES = 32
+
+
     def __init__(self, job, indenter, global_filename='status',
                  subdir_filename='status', record_hook=None):
         """Construct a logger instance.
@@ -597,6 +954,15 @@ class status_logger(object):
         self.subdir_filename = subdir_filename
         self._record_hook = record_hook
 
+        self._pid = os.getpid()
+        self._open_files = {}  # log file path -> fd
+        self._open_order = []  # log file paths, least recently used first
+        self._pending_lines = {}  # log file path -> list of lines
+        self._last_flush_time = time.time()
+        # the lines are also flushed from the flusher's thread
+        self._lock = threading.RLock()
+        _flusher.add(self)
+
 
     def render_entry(self, log_entry):
         """Render a status_log_entry as it would be written to a log file.
@@ -613,6 +979,85 @@ class status_logger(object):
         return '\t' * indent + log_entry.render().rstrip('\n')
 
 
+    def _check_for_fork(self):
+        """Forget the files and lines inherited from a parent process.
+
+        The parent is still responsible for writing out what it buffered,
+        and a child closing its copies of the file descriptors doesn't affect
+        the parent.
+        """
+        if os.getpid() != self._pid:
+            for fd in self._open_files.itervalues():
+                os.close(fd)
+            self._open_files = {}
+            self._open_order = []
+            self._pending_lines = {}
+            # whoever held the lock in the parent didn't fork with us
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+
+
+    def _get_log_fd(self, log_file):
+        """Return an fd for appending to log_file, opening it if needed."""
+        fd = self._open_files.get(log_file)
+        if fd is not None:
+            self._open_order.remove(log_file)
+            self._open_order.append(log_file)
+            return fd
+        if len(self._open_files) >= self.MAX_OPEN_FILES:
+            self._close_log_file(self._open_order[0])
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        self._open_files[log_file] = fd
+        self._open_order.append(log_file)
+        return fd
+
+
+    def _write_pending_lines(self, log_file):
+        lines = self._pending_lines.pop(log_file, None)
+        if lines:
+            data = ''.join(lines)
+            fd = self._get_log_fd(log_file)
+            while data:
+                data = data[os.write(fd, data):]
+
+
+    def _close_log_file(self, log_file):
+        self._write_pending_lines(log_file)
+        os.close(self._open_files.pop(log_file))
+        self._open_order.remove(log_file)
+
+
+    def flush(self, durable=False):
+        """Write out all the buffered status log lines.
+
+        @param durable: If true, also make sure the status logs made it to
+            disk, e.g. before rebooting.
+        """
+        self._check_for_fork()
+        self._lock.acquire()
+        try:
+            _flusher.unschedule(self)
+            for log_file in self._pending_lines.keys():
+                self._write_pending_lines(log_file)
+            if durable:
+                for fd in self._open_files.itervalues():
+                    os.fsync(fd)
+            self._last_flush_time = time.time()
+        finally:
+            self._lock.release()
+
+
+    def close(self):
+        """Write out all the buffered status log lines and close the logs."""
+        self.flush()
+        self._lock.acquire()
+        try:
+            for log_file in list(self._open_order):
+                self._close_log_file(log_file)
+        finally:
+            self._lock.release()
+
+
     def record_entry(self, log_entry, log_in_subdir=True):
         """Record a status_log_entry into the appropriate status log files.
 
@@ -639,20 +1084,30 @@ class status_logger(object):
             log_files.append(os.path.join(job.resultdir, log_entry.subdir,
                                           self.subdir_filename))
 
-        # write out to entry to the log files
-        log_text = self.render_entry(log_entry)
-        for log_file in log_files:
-            fileobj = open(log_file, 'a')
-            try:
-                print >> fileobj, log_text
-            finally:
-                fileobj.close()
-
-        # adjust the indentation if this was a START or END entry
-        if log_entry.is_start():
-            self._indenter.increment()
-        elif log_entry.is_end():
-            self._indenter.decrement()
+        # queue the entry up for the log files, opening them right away so
+        # that a missing directory is still reported here
+        self._check_for_fork()
+        self._lock.acquire()
+        try:
+            log_text = self.render_entry(log_entry) + '\n'
+            for log_file in log_files:
+                self._get_log_fd(log_file)
+                self._pending_lines.setdefault(log_file, []).append(log_text)
+
+            # adjust the indentation if this was a START or END entry
+            if log_entry.is_start():
+                self._indenter.increment()
+            elif log_entry.is_end():
+                self._indenter.decrement()
+
+            if (log_entry.is_start() or log_entry.is_end() or
+                    time.time() - self._last_flush_time >=
+                    self.FLUSH_INTERVAL):
+                self.flush()
+            else:
+                _flusher.schedule(self)
+        finally:
+            self._lock.release()
 
 
 class base_job(object):
@@ -1,10 +1,11 @@
 #!/usr/bin/python
 
-import os, stat, tempfile, shutil, logging
+import os, stat, tempfile, shutil, logging, time
+import cPickle as pickle
 
 import common
 from autotest_lib.client.common_lib import base_job, error
-from autotest_lib.client.common_lib.test_utils import unittest
+from autotest_lib.client.common_lib.test_utils import mock, unittest
 
 
 class stub_job_directory(object):
@@ -54,6 +55,9 @@ class stub_job_state(base_job.job_state):
     def _unlock_backing_file(self):
         pass
 
+    def _journal_change(self, change):
+        pass
+
 
 class test_init(unittest.TestCase):
     class generic_tests(object):
@@ -482,8 +486,9 @@ class test_job_state_with_backing_file(test_job_state):
 
 
     def tearDown(self):
-        if os.path.exists(self.backing_file):
-            os.remove(self.backing_file)
+        for path in (self.backing_file, self.backing_file + '.journal'):
+            if os.path.exists(path):
+                os.remove(path)
 
 
     def test_set_is_persistent(self):
@@ -722,6 +727,88 @@ class test_job_state_set_backing_file(unittest.TestCase):
         self.assertRaises(KeyError, state2.get, 'n7', 'shared5')
 
 
+class test_job_state_journal(unittest.TestCase):
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(suffix='unittest')
+        self.original_wd = os.getcwd()
+        os.chdir(self.testdir)
+        self.state = base_job.job_state()
+        self.state.set_backing_file('backing_file')
+
+
+    def tearDown(self):
+        os.chdir(self.original_wd)
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+
+    def _read_back(self):
+        state = base_job.job_state()
+        state.read_from_file('backing_file')
+        return state
+
+
+    def test_changes_only_append_to_journal(self):
+        backing_file_stat = os.stat('backing_file')
+        self.state.set('ns', 'var1', 1)
+        self.state.set('ns', 'var2', 2)
+        self.state.discard('ns', 'var1')
+        self.assertEqual(backing_file_stat, os.stat('backing_file'))
+        self.assertNotEqual(0, os.path.getsize('backing_file.journal'))
+        state = self._read_back()
+        self.assertFalse(state.has('ns', 'var1'))
+        self.assertEqual(2, state.get('ns', 'var2'))
+
+
+    def test_journal_is_compacted(self):
+        self.state.MIN_COMPACTION_SIZE = 100
+        for i in xrange(20):
+            self.state.set('ns', 'var', i)
+        self.assert_(os.path.getsize('backing_file.journal') < 100)
+        self.assertEqual(19, self._read_back().get('ns', 'var'))
+
+
+    def test_disabling_backing_file_leaves_plain_state_file(self):
+        self.state.set('ns', 'var', 'value')
+        self.state.set_backing_file(None)
+        self.assertFalse(os.path.exists('backing_file.journal'))
+        state = pickle.load(open('backing_file'))
+        self.assertEqual({'ns': {'var': 'value'}}, state)
+
+
+    def test_stale_journal_is_ignored(self):
+        self.state.set('ns', 'var', 'journaled')
+        state = base_job.job_state()
+        state.set('ns', 'other', 'value')
+        state.write_to_file('backing_file')
+        self.assertFalse(self._read_back().has('ns', 'var'))
+        self.assertFalse(self.state.has('ns', 'var'))
+        self.assertEqual('value', self.state.get('ns', 'other'))
+
+
+    def test_torn_journal_record_is_ignored(self):
+        self.state.set('ns', 'var1', 1)
+        journal_size = os.path.getsize('backing_file.journal')
+        self.state.set('ns', 'var2', 'x' * 100)
+        journal = open('backing_file.journal', 'r+')
+        journal.truncate(journal_size + 10)
+        journal.close()
+        state = base_job.job_state()
+        state.set_backing_file('backing_file')
+        self.assertEqual(1, state.get('ns', 'var1'))
+        self.assertFalse(state.has('ns', 'var2'))
+
+
+    def test_get_does_not_reload_unchanged_state(self):
+        self.state.set('ns', 'var', 1)
+        god = mock.mock_god()
+        god.stub_function(base_job.pickle, 'load')
+        try:
+            self.assertEqual(1, self.state.get('ns', 'var'))
+            god.check_playback()
+        finally:
+            god.unstub_all()
+
+
 class test_job_state_backing_file_locking(unittest.TestCase):
     def setUp(self):
         self.testdir = tempfile.mkdtemp(suffix='unittest')
@@ -1140,6 +1227,7 @@ class test_status_logger(unittest.TestCase):
         entries = [self.make_dummy_entry('LINE%d' % x) for x in xrange(3)]
         for entry in entries:
             self.logger.record_entry(entry)
+        self.logger.flush()
         self.assertEqual('LINE0\nLINE1\nLINE2\n', open('status').read())
 
 
@@ -1152,6 +1240,7 @@ class test_status_logger(unittest.TestCase):
         self.logger.record_entry(self.make_dummy_entry('LINE2', subdir='sub'))
         self.logger.record_entry(self.make_dummy_entry('LINE3'))
 
+        self.logger.flush()
         self.assertEqual('LINE1\nLINE2\nLINE3\n', open('global.log').read())
         self.assertEqual('LINE1\nLINE2\n', open('sub/subdir.log').read())
 
@@ -1173,6 +1262,7 @@ class test_status_logger(unittest.TestCase):
         self.logger.record_entry(self.make_dummy_entry('LINE3', subdir='sub2'))
         self.logger.record_entry(self.make_dummy_entry('LINE4'))
 
+        self.logger.flush()
         self.assertEqual('LINE1\nLINE2\n', open('global.log').read())
         self.assertEqual('LINE1\n', open('sub2/subdir.log').read())
         self.assertEqual('LINE3\nLINE4\n', open('global.log2').read())
@@ -1187,6 +1277,7 @@ class test_status_logger(unittest.TestCase):
         self.logger.record_entry(self.make_dummy_entry('LINE3', subdir='abc'))
         self.logger.record_entry(self.make_dummy_entry('LINE4', subdir='123'))
 
+        self.logger.flush()
         self.assertEqual('LINE1\nLINE2\nLINE3\nLINE4\n', open('status').read())
         self.assertEqual('LINE2\nLINE3\n', open('abc/status').read())
         self.assertEqual('LINE4\n', open('123/status').read())
@@ -1200,6 +1291,7 @@ class test_status_logger(unittest.TestCase):
             'LINE3', subdir='sub_nowrite'), log_in_subdir=False)
         self.logger.record_entry(self.make_dummy_entry('LINE4', subdir='sub'))
 
+        self.logger.flush()
         self.assertEqual('LINE1\nLINE2\nLINE3\nLINE4\n', open('status').read())
         self.assertEqual('LINE2\nLINE4\n', open('sub/status').read())
         self.assert_(not os.path.exists('sub_nowrite/status'))
@@ -1217,6 +1309,7 @@ class test_status_logger(unittest.TestCase):
 
         expected_log = ('LINE1\n\tLINE2\n\tLINE3\n\t\tLINE4\n\t\tLINE5\n'
                         '\tLINE6\nLINE7\nLINE8\n')
+        self.logger.flush()
         self.assertEqual(expected_log, open('status').read())
 
 
@@ -1229,9 +1322,99 @@ class test_status_logger(unittest.TestCase):
 
         expected_log = ('LINE1\n  blah\nLINE2\n'
                         '\tLINE3\n  blah\n  two\nLINE4\n')
+        self.logger.flush()
         self.assertEqual(expected_log, open('status').read())
 
 
+    def test_lines_are_buffered_until_flush(self):
+        self.logger.record_entry(self.make_dummy_entry('LINE1'))
+        self.logger.record_entry(self.make_dummy_entry('LINE2'))
+        self.assertEqual('', open('status').read())
+        self.logger.flush()
+        self.assertEqual('LINE1\nLINE2\n', open('status').read())
+
+
+    def test_start_and_end_flush(self):
+        self.logger.record_entry(self.make_dummy_entry('LINE1'))
+        self.logger.record_entry(self.make_dummy_entry('LINE2', start=True))
+        self.assertEqual('LINE1\nLINE2\n', open('status').read())
+        self.logger.record_entry(self.make_dummy_entry('LINE3'))
+        self.logger.record_entry(self.make_dummy_entry('LINE4', end=True))
+        self.assertEqual('LINE1\nLINE2\n\tLINE3\nLINE4\n',
+                         open('status').read())
+
+
+    def test_flush_interval(self):
+        god = mock.mock_god()
+        god.stub_function(base_job.time, 'time')
+        try:
+            base_job.time.time.expect_call().and_return(1000)
+            base_job.time.time.expect_call().and_return(1005)
+            base_job.time.time.expect_call().and_return(1005)
+            self.logger._last_flush_time = 1000
+            self.logger.record_entry(self.make_dummy_entry('LINE1'))
+            self.assertEqual('', open('status').read())
+            self.logger.record_entry(self.make_dummy_entry('LINE2'))
+            self.assertEqual('LINE1\nLINE2\n', open('status').read())
+            god.check_playback()
+        finally:
+            god.unstub_all()
+
+
+    def test_flush_timer(self):
+        self.logger.FLUSH_INTERVAL = 0.1
+        self.logger.record_entry(self.make_dummy_entry('LINE1'))
+        self.assertEqual('', open('status').read())
+        time.sleep(0.5)
+        self.assertEqual('LINE1\n', open('status').read())
+        self.assertFalse(id(self.logger) in base_job._flusher._scheduled)
+
+
+    def test_close_all_at_exit(self):
+        god = mock.mock_god()
+        flusher = base_job._status_log_flusher()
+        god.stub_with(base_job, '_flusher', flusher)
+        try:
+            self.logger = base_job.status_logger(self.job, self.indenter)
+            self.logger.record_entry(self.make_dummy_entry('LINE1'))
+            thread = flusher._thread
+            self.assert_(thread.isAlive())
+            flusher.close_all()
+        finally:
+            god.unstub_all()
+        self.assertFalse(thread.isAlive())
+        self.assertEqual('LINE1\n', open('status').read())
+        self.assertEqual({}, self.logger._open_files)
+
+
+    def test_log_files_are_kept_open(self):
+        os.mkdir('sub')
+        opened_files = []
+        real_open = os.open
+        def counting_open(path, *args):
+            opened_files.append(path)
+            return real_open(path, *args)
+        god = mock.mock_god()
+        god.stub_with(base_job.os, 'open', counting_open)
+        try:
+            for i in xrange(3):
+                self.logger.record_entry(self.make_dummy_entry('LINE%d' % i,
+                                                               subdir='sub'))
+            self.logger.close()
+        finally:
+            god.unstub_all()
+        self.assertEqual(2, len(opened_files))
+        self.assertEqual('LINE0\nLINE1\nLINE2\n', open('sub/status').read())
+
+
+    def test_forked_child_drops_parent_lines(self):
+        self.logger.record_entry(self.make_dummy_entry('PARENT'))
+        self.logger._pid = -1  # as if this process was forked
+        self.logger.record_entry(self.make_dummy_entry('CHILD'))
+        self.logger.flush()
+        self.assertEqual('CHILD\n', open('status').read())
+
+
     def test_hook_is_called(self):
         entries = [self.make_dummy_entry('LINE%d' % x) for x in xrange(5)]
         recorded_entries = []
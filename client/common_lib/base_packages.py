@@ -6,13 +6,36 @@ should inherit this class.
 """
 
 import re, os, sys, traceback, subprocess, shutil, time, traceback, urlparse
-import fcntl, logging
+import fcntl, logging, errno, tempfile
 from autotest_lib.client.common_lib import error, utils, global_config
 
 
 # the name of the checksum file that stores the packages' checksums
 CHECKSUM_FILE = "packages.checksum"
 
+# maximum number of packages HttpFetcher downloads at the same time
+MAX_PARALLEL_DOWNLOADS = 4
+
+# default size limit of a CachingFetcher cache, in bytes
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Compression modes of tar_package(). Package names promise bzip2, so only
+# COMPRESSION_BZIP2 tarballs may be uploaded to repositories; the faster modes
+# are meant for tarballs unpacked by untar_pkg(), which handles all of them.
+COMPRESSION_BZIP2 = 'bzip2'
+COMPRESSION_FAST = 'fast'
+COMPRESSION_NONE = 'none'
+
+# compressors of each mode, in order of preference (parallel ones first)
+_COMPRESSORS = {
+    COMPRESSION_BZIP2: ['lbzip2', 'pbzip2', 'bzip2'],
+    COMPRESSION_FAST: ['pigz -1', 'gzip -1'],
+    COMPRESSION_NONE: [],
+    }
+
+# picks the fastest bzip2 decompressor of the machine running untar_pkg()
+_BZIP2_DECOMPRESSOR = '$(command -v lbzip2 || command -v pbzip2 || echo bzip2)'
+
 
 def parse_ssh_path(repo):
     '''
@@ -73,6 +96,43 @@ def check_write(repo):
         raise error.RepoWriteError('Unable to write to ' + repo)
 
 
+def _find_compressor(compression):
+    """ Return the first installed compressor command for compression. """
+    compressors = _COMPRESSORS[compression]
+    path = os.environ.get('PATH', '/usr/bin:/bin').split(os.pathsep)
+    for compressor in compressors:
+        program = compressor.split()[0]
+        for directory in path:
+            if os.access(os.path.join(directory, program), os.X_OK):
+                return compressor
+    # let the command fail with a meaningful error
+    return compressors[-1]
+
+
+def get_tree_signature(src_dir):
+    """
+    Compute a hash of the names, types, sizes and modification times of
+    everything under src_dir, which changes whenever the tree does.
+    """
+    signature = utils.hash('md5')
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            signature.update('%s %o %d %r\n' % (path, stat.st_mode,
+                                                 stat.st_size, stat.st_mtime))
+            if os.path.islink(path):
+                signature.update(os.readlink(path) + '\n')
+    return signature.hexdigest()
+
+
+def _default_tar_cache_dir():
+    return global_config.global_config.get_config_value(
+            'PACKAGES', 'tar_cache_dir',
+            default=os.path.join(tempfile.gettempdir(), 'autotest_tar_cache'))
+
+
 def trim_custom_directories(repo, older_than_days=40):
     if not repo:
         return
@@ -98,6 +158,24 @@ class RepositoryFetcher(object):
         raise NotImplementedError()
 
 
+    def fetch_pkg_files(self, files):
+        """ Fetch several package files from a package repository. Fetchers
+        that can do better than fetching the files one by one override this.
+
+        @param files: A list of (filename, dest_path) tuples.
+
+        @returns The list of the (filename, dest_path) tuples that could not
+                be fetched.
+        """
+        failed = []
+        for filename, dest_path in files:
+            try:
+                self.fetch_pkg_file(filename, dest_path)
+            except (error.PackageFetchError, error.AutoservRunError):
+                failed.append((filename, dest_path))
+        return failed
+
+
 class HttpFetcher(RepositoryFetcher):
     wget_cmd_pattern = 'wget --connect-timeout=15 -nv %s -O %s'
 
@@ -160,6 +238,42 @@ class HttpFetcher(RepositoryFetcher):
                                                                   package_url))
 
 
+    def fetch_pkg_files(self, files):
+        """ Download all the files with a single command, running up to
+        MAX_PARALLEL_DOWNLOADS wgets at the same time. """
+        logging.info('Fetching %s from %s',
+                     ', '.join(filename for filename, _ in files), self.url)
+
+        # do a quick test to verify the repo is reachable
+        self._quick_http_test()
+
+        # failed downloads leave an empty file behind, remove it so that only
+        # the files that were fetched remain
+        downloads = []
+        for filename, dest_path in files:
+            package_url = os.path.join(self.url, filename)
+            download = self.wget_cmd_pattern % (package_url, dest_path)
+            downloads.append('(%s || rm -f %s) &' % (download, dest_path))
+        batches = []
+        for i in xrange(0, len(downloads), MAX_PARALLEL_DOWNLOADS):
+            batches.append(' '.join(downloads[i:i + MAX_PARALLEL_DOWNLOADS])
+                           + ' wait;')
+        check = 'for f in %s; do [ -e "$f" ] && echo "$f"; done; true' % (
+                ' '.join(dest_path for _, dest_path in files))
+        result = self.run_command(' '.join(batches + [check]))
+
+        fetched = set(result.stdout.splitlines())
+        failed = []
+        for filename, dest_path in files:
+            if dest_path in fetched:
+                logging.debug('Successfully fetched %s from %s', filename,
+                              self.url)
+            else:
+                logging.debug('%s not found in %s', filename, self.url)
+                failed.append((filename, dest_path))
+        return failed
+
+
 class LocalFilesystemFetcher(RepositoryFetcher):
     def __init__(self, package_manager, local_dir):
         self.run_command = package_manager._run_command
@@ -180,6 +294,187 @@ class LocalFilesystemFetcher(RepositoryFetcher):
                 % (filename, self.url), e)
 
 
+class CachingFetcher(RepositoryFetcher):
+    """
+    Read-through cache of packages placed in front of the origin
+    repositories. The cache lives on a drone (or on a directory shared by the
+    drones of a LAN), so that the origin repositories serve every package
+    once instead of once for every machine installing it.
+
+    Cached packages are validated against the origins' packages.checksum,
+    concurrent requests for the same package (from any process using the
+    cache) wait for a single fetch and the least recently used packages are
+    evicted once the cache grows larger than max_size bytes.
+    """
+    # seconds after which the cached packages.checksum is fetched again
+    checksum_max_age = 300
+
+    def __init__(self, package_manager, cache_dir, origin_urls,
+                 max_size=DEFAULT_CACHE_SIZE, send_file=None):
+        """
+        @param package_manager: The package manager fetching from the cache.
+        @param cache_dir: The local directory storing the cached packages.
+        @param origin_urls: The repositories the packages are cached from.
+        @param max_size: The maximum size of the cache, in bytes.
+        @param send_file: Function copying a cached package (a local path) to
+                a destination path of the package manager, e.g. the
+                send_file() method of the host it installs packages on.
+                Defaults to running cp through the package manager.
+        """
+        self.url = cache_dir
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.run_command = package_manager._run_command
+        if send_file:
+            self._send_file = send_file
+        else:
+            self._send_file = self._copy_file
+        self._origin = BasePackageManager(cache_dir, repo_urls=origin_urls,
+                                          do_locking=False)
+
+
+    def _copy_file(self, cached_path, dest_path):
+        self.run_command('cp %s %s' % (cached_path, dest_path))
+
+
+    def _lock(self, filename, blocking=True):
+        """
+        Lock a package of the cache, waiting for the lock unless blocking
+        is False. Returns the locked file (close it to unlock), or None if
+        the package is locked by somebody else and blocking is False.
+        """
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        lockfile = open(os.path.join(self.cache_dir, '.%s.lock' % filename),
+                        'w')
+        try:
+            fcntl.flock(lockfile, flags)
+        except IOError, e:
+            lockfile.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lockfile
+
+
+    def _refresh_checksum_file(self):
+        """
+        Fetch the origins' packages.checksum again if the cached one is too
+        old. The file is replaced atomically since other processes may be
+        reading it.
+        """
+        checksum_path = os.path.join(self.cache_dir, CHECKSUM_FILE)
+        try:
+            age = time.time() - os.stat(checksum_path).st_mtime
+        except OSError:
+            age = None
+        if age is not None and age < self.checksum_max_age:
+            return
+
+        lockfile = self._lock(CHECKSUM_FILE)
+        try:
+            temp_path = '%s.%d.tmp' % (checksum_path, os.getpid())
+            try:
+                self._origin.fetch_pkg(CHECKSUM_FILE, temp_path)
+                os.rename(temp_path, checksum_path)
+            except error.PackageFetchError, e:
+                # keep going with whatever checksums we have
+                logging.warning('Could not refresh %s in %s: %s',
+                                CHECKSUM_FILE, self.cache_dir, e)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        finally:
+            lockfile.close()
+
+
+    def _evict(self):
+        """ Remove the least recently used packages until the cache fits in
+        max_size bytes, skipping the packages currently in use. """
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith('.') or filename == CHECKSUM_FILE:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, filename, stat.st_size))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, filename, size in entries:
+            if total_size <= self.max_size:
+                break
+            lockfile = self._lock(filename, blocking=False)
+            if not lockfile:
+                continue
+            try:
+                logging.debug('Evicting %s from %s', filename, self.cache_dir)
+                try:
+                    os.remove(os.path.join(self.cache_dir, filename))
+                except OSError:
+                    pass
+                total_size -= size
+            finally:
+                lockfile.close()
+
+
+    def fetch_pkg_file(self, filename, dest_path):
+        if self.fetch_pkg_files([(filename, dest_path)]):
+            raise error.PackageFetchError('%s could not be fetched through '
+                                          'the cache %s' % (filename,
+                                                            self.cache_dir))
+
+
+    def fetch_pkg_files(self, files):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._refresh_checksum_file()
+
+        # holding the locks of the packages makes concurrent requests for
+        # them wait for this fetch; take them in order to avoid deadlocks
+        filenames = sorted(set(filename for filename, _ in files
+                               if filename != CHECKSUM_FILE))
+        lockfiles = []
+        try:
+            for filename in filenames:
+                lockfiles.append(self._lock(filename))
+            if filenames:
+                try:
+                    self._origin.fetch_pkgs(filenames, self.cache_dir)
+                except error.PackageFetchError, e:
+                    # send whatever could be fetched
+                    logging.debug('Not all of %s are available from the '
+                                  'origin repositories: %s', filenames, e)
+
+            failed = []
+            for filename, dest_path in files:
+                cached_path = os.path.join(self.cache_dir, filename)
+                if not os.path.exists(cached_path):
+                    failed.append((filename, dest_path))
+                    continue
+                logging.info('Fetching %s from the cache %s to %s', filename,
+                             self.cache_dir, dest_path)
+                try:
+                    self._send_file(cached_path, dest_path)
+                except (error.CmdError, error.AutoservRunError,
+                        IOError, OSError), e:
+                    logging.debug('Sending %s failed: %s', cached_path, e)
+                    failed.append((filename, dest_path))
+                    continue
+                if filename != CHECKSUM_FILE:
+                    # mark the package as recently used
+                    os.utime(cached_path, None)
+        finally:
+            for lockfile in lockfiles:
+                lockfile.close()
+
+        self._evict()
+        return failed
+
+
 class BasePackageManager(object):
     def __init__(self, pkgmgr_dir, hostname=None, repo_urls=None,
                  upload_paths=None, do_locking=True, run_function=utils.run,
@@ -202,8 +497,11 @@ class BasePackageManager(object):
         a package on the local machine or on a remote machine (in which case
         ssh_host's run function is passed in for run_function).
         '''
-        # In memory dictionary that stores the checksum's of packages
+        # In memory dictionary that stores the checksum's of packages, and
+        # the md5sum of the checksum file it was read from, used to notice
+        # when the file changes
         self._checksum_dict = {}
+        self._checksum_version = None
 
         self.pkgmgr_dir = pkgmgr_dir
         self.do_locking = do_locking
@@ -386,22 +684,77 @@ class BasePackageManager(object):
                        packaging system. It should be ignored by externals
                        callers of this method who use it fetch custom packages.
         '''
+        self._fetch_files([(pkg_name, dest_path)], os.path.dirname(dest_path),
+                          repo_url, use_checksum)
+
+
+    def fetch_pkgs(self, pkg_names, dest_dir, repo_url=None,
+                   use_checksum=True):
+        '''
+        Fetch several packages into dest_dir, like fetch_pkg does for a
+        single one. The checksums of all the packages already in dest_dir
+        are checked with a single command and all the missing or stale
+        packages are then requested from each repository in one go.
+        pkg_names    : list of package names (ex: dep-gcc.tar.bz2)
+        dest_dir     : the directory the packages will be fetched to.
+        repo_url     : the URL of the repository where the packages are
+                       located.
+        use_checksum : If False, the packages are always fetched.
+
+        Returns the list of the paths of the packages.
+        '''
+        files = [(pkg_name, os.path.join(dest_dir, pkg_name))
+                 for pkg_name in pkg_names]
+        self._fetch_files(files, dest_dir, repo_url, use_checksum)
+        return [dest_path for pkg_name, dest_path in files]
+
 
+    def _get_local_checksums(self, dest_dir, paths):
+        '''
+        Check that dest_dir exists and compute the md5sum of all the
+        existing files in paths with a single command.
+        Returns a {path: checksum} dictionary.
+        '''
+        cmd = 'cd %s' % dest_dir
+        if paths:
+            cmd += ' && { md5sum %s 2>/dev/null; true; }' % ' '.join(paths)
         try:
-            self._run_command("ls %s" % os.path.dirname(dest_path))
+            output = self._run_command(
+                cmd, _run_command_dargs={'verbose': False}).stdout
         except (error.CmdError, error.AutoservRunError):
             raise error.PackageFetchError("Please provide a valid "
-                                          "destination: %s " % dest_path)
+                                          "destination: %s " % dest_dir)
+        checksums = {}
+        for line in output.splitlines():
+            checksum, path = line.split(None, 1)
+            checksums[path] = checksum
+        return checksums
 
-        # See if the package was already fetched earlier, if so
-        # the checksums need to be compared and the package is now
-        # fetched only if they differ.
-        pkg_exists = False
-        try:
-            self._run_command("ls %s" % dest_path)
-            pkg_exists = True
-        except (error.CmdError, error.AutoservRunError):
-            pass
+
+    def _fetch_files(self, files, dest_dir, repo_url, use_checksum):
+        '''
+        Fetch the (pkg_name, dest_path) files that are missing, or whose
+        checksum does not match the packages' checksum file if use_checksum
+        is set, from the repositories.
+        '''
+        if use_checksum:
+            checksum_path = self._get_checksum_file_path()
+            local_checksums = self._get_local_checksums(
+                    dest_dir, [checksum_path] + [path for _, path in files])
+            # reload the checksum file if somebody changed it
+            checksum_version = local_checksums.get(checksum_path)
+            if (checksum_version is not None and
+                checksum_version != self._checksum_version):
+                self._checksum_dict = {}
+            checksum_dict = self._get_checksum_dict()
+            files = [(pkg_name, dest_path) for pkg_name, dest_path in files
+                     if checksum_dict.get(os.path.basename(dest_path)) is None
+                     or local_checksums.get(dest_path) !=
+                        checksum_dict[os.path.basename(dest_path)]]
+            if not files:
+                return
+        else:
+            self._get_local_checksums(dest_dir, [])
 
         # if a repository location is explicitly provided, fetch the package
         # from there and return
@@ -412,26 +765,25 @@ class BasePackageManager(object):
         else:
             raise error.PackageFetchError("No repository urls specified")
 
-        # install the package from the package repos, try the repos in
+        # install the packages from the package repos, try the repos in
         # reverse order, assuming that the 'newest' repos are most desirable
         for fetcher in reversed(repositories):
             try:
-                # Fetch the package if it is not there, the checksum does
-                # not match, or checksums are disabled entirely
-                need_to_fetch = (
-                        not use_checksum or not pkg_exists
-                        or not self.compare_checksum(dest_path, fetcher.url))
-                if need_to_fetch:
-                    fetcher.fetch_pkg_file(pkg_name, dest_path)
+                files = fetcher.fetch_pkg_files(files)
+            except (error.PackageFetchError, error.AutoservRunError), e:
+                # The repository is not usable, continue looking
+                logging.debug('Packages could not be fetched from %s: %s',
+                              fetcher.url, e)
+            if not files:
                 return
-            except (error.PackageFetchError, error.AutoservRunError):
-                # The package could not be found in this repo, continue looking
+            for pkg_name, dest_path in files:
                 logging.debug('%s could not be fetched from %s', pkg_name,
                               fetcher.url)
 
         repo_url_list = [repo.url for repo in repositories]
         message = ('%s could not be fetched from any of the repos %s' %
-                   (pkg_name, repo_url_list))
+                   (', '.join(pkg_name for pkg_name, _ in files),
+                    repo_url_list))
         logging.error(message)
         # if we got here then that means the package is not found
         # in any of the repositories.
@@ -653,6 +1005,8 @@ class BasePackageManager(object):
             # Read the checksum file into memory
             checksum_file_contents = self._run_command('cat '
                                                        + checksum_path).stdout
+            self._checksum_version = utils.hash(
+                    'md5', checksum_file_contents).hexdigest()
 
             # Return {} if we have an empty checksum file present
             if not checksum_file_contents.strip():
@@ -682,6 +1036,8 @@ class BasePackageManager(object):
         self._run_command('echo "%s" > %s' % (checksum_contents,
                                               checksum_path),
                           _run_command_dargs={'verbose': False})
+        self._checksum_version = utils.hash(
+                'md5', checksum_contents + '\n').hexdigest()
 
 
     def compute_checksum(self, pkg_path):
@@ -739,26 +1095,88 @@ class BasePackageManager(object):
         return (local_checksum == repository_checksum)
 
 
-    def tar_package(self, pkg_name, src_dir, dest_dir, exclude_string=None):
+    def tar_package(self, pkg_name, src_dir, dest_dir, exclude_string=None,
+                    compression=COMPRESSION_BZIP2):
         '''
         Create a tar.bz2 file with the name 'pkg_name' say test-blah.tar.bz2.
         Excludes the directories specified in exclude_string while tarring
         the source. Returns the tarball path.
+        The tarball is compressed as told by compression (one of the
+        COMPRESSION_* modes), with a parallel compressor when one is
+        installed. The tarballs of unchanged source trees are copied from a
+        cache instead of being built again, which also keeps their checksums
+        from changing needlessly.
         '''
         tarball_path = os.path.join(dest_dir, pkg_name)
+        try:
+            cache_key = self._get_tar_cache_key(pkg_name, src_dir,
+                                                exclude_string, compression)
+        except OSError, e:
+            logging.warning('Cannot hash %s, not caching its tarball: %s',
+                            src_dir, e)
+            cache_key = None
+        cache_path = None
+        if cache_key:
+            cache_path = os.path.join(_default_tar_cache_dir(),
+                                      '%s.%s' % (pkg_name, cache_key))
+            if os.path.exists(cache_path):
+                logging.debug('Source of %s unchanged, reusing %s', pkg_name,
+                              cache_path)
+                shutil.copyfile(cache_path, tarball_path)
+                return tarball_path
+
         temp_path = tarball_path + '.tmp'
-        cmd = "tar -cvjf %s -C %s %s " % (temp_path, src_dir, exclude_string)
+        if compression == COMPRESSION_NONE:
+            cmd = "tar -cvf %s -C %s %s " % (temp_path, src_dir,
+                                             exclude_string)
+        else:
+            cmd = "set -o pipefail; tar -cvf - -C %s %s | %s > %s" % (
+                    src_dir, exclude_string, _find_compressor(compression),
+                    temp_path)
 
         try:
             utils.system(cmd)
         except:
-            os.unlink(temp_path)
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
             raise
 
         os.rename(temp_path, tarball_path)
+        # don't cache the tarball if the tree changed while it was built
+        if cache_key and cache_key == self._get_tar_cache_key(
+                pkg_name, src_dir, exclude_string, compression):
+            self._add_to_tar_cache(tarball_path, cache_path, pkg_name)
         return tarball_path
 
 
+    def _get_tar_cache_key(self, pkg_name, src_dir, exclude_string,
+                           compression):
+        key = utils.hash('md5', repr((pkg_name, os.path.abspath(src_dir),
+                                      exclude_string, compression)))
+        key.update(get_tree_signature(src_dir))
+        return key.hexdigest()
+
+
+    def _add_to_tar_cache(self, tarball_path, cache_path, pkg_name):
+        '''
+        Store a copy of tarball_path in the tar cache as cache_path,
+        replacing the older tarballs of pkg_name.
+        '''
+        cache_dir = os.path.dirname(cache_path)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for name in os.listdir(cache_dir):
+                if name.startswith(pkg_name + '.'):
+                    os.remove(os.path.join(cache_dir, name))
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            shutil.copyfile(tarball_path, temp_path)
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError), e:
+            logging.warning('Failed to cache %s in %s: %s', pkg_name,
+                            cache_dir, e)
+
+
     def untar_required(self, tarball_path, dest_dir):
         '''
         Compare the checksum of the tarball_path with the .checksum file
@@ -783,9 +1201,15 @@ class BasePackageManager(object):
         ".checksum" file in the dest_dir containing the checksum
         of the tarball. This method
         assumes that the package to be untarred is of the form
-        <name>.tar.bz2
+        <name>.tar.bz2, but uncompressed and gzipped tarballs are handled too.
+        bzip2 tarballs are decompressed in parallel if lbzip2 or pbzip2 is
+        installed.
         '''
-        self._run_command('tar xjf %s -C %s' % (tarball_path, dest_dir))
+        self._run_command('if [ "$(head -c 3 %s)" = BZh ]; then '
+                          'tar -x --use-compress-program=%s -f %s -C %s; '
+                          'else tar -xf %s -C %s; fi'
+                          % (tarball_path, _BZIP2_DECOMPRESSOR, tarball_path,
+                             dest_dir, tarball_path, dest_dir))
         # Put the .checksum file in the install_dir to note
         # where the package came from
         pkg_checksum = self.compute_checksum(tarball_path)
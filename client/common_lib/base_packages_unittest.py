@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, unittest
+import common
+from autotest_lib.client.common_lib import base_packages, error, utils
+from autotest_lib.client.common_lib.test_utils import mock
+
+
+class counting_runner(object):
+    """ run_function recording the commands it runs. """
+    def __init__(self):
+        self.commands = []
+
+
+    def __call__(self, command, **dargs):
+        self.commands.append(command)
+        return utils.run(command, **dargs)
+
+
+class test_fetch_pkgs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        self.pkgmgr_dir = os.path.join(self.tmpdir, 'pkgmgr')
+        self.dest_dir = os.path.join(self.tmpdir, 'dest')
+        for path in (self.repo, self.pkgmgr_dir, self.dest_dir):
+            os.mkdir(path)
+        self.checksums = {}
+        for name in ('dep-a.tar.bz2', 'dep-b.tar.bz2'):
+            self._add_to_repo(name, name + ' contents')
+        self._write_repo_checksum_file()
+        self.run_function = counting_runner()
+        self.pkgmgr = base_packages.BasePackageManager(
+            self.pkgmgr_dir, repo_urls=[self.repo], do_locking=False,
+            run_function=self.run_function)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _add_to_repo(self, name, contents):
+        open(os.path.join(self.repo, name), 'w').write(contents)
+        self.checksums[name] = utils.hash('md5', contents).hexdigest()
+
+
+    def _write_repo_checksum_file(self):
+        lines = ['%s %s\n' % (checksum, name)
+                 for name, checksum in self.checksums.iteritems()]
+        open(os.path.join(self.repo, base_packages.CHECKSUM_FILE),
+             'w').write(''.join(lines))
+
+
+    def _read_dest(self, name):
+        return open(os.path.join(self.dest_dir, name)).read()
+
+
+    def test_fetch_missing_packages(self):
+        paths = self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'],
+                                       self.dest_dir)
+        self.assertEquals(paths, [os.path.join(self.dest_dir, name)
+                                  for name in ('dep-a.tar.bz2',
+                                               'dep-b.tar.bz2')])
+        self.assertEquals(self._read_dest('dep-a.tar.bz2'),
+                          'dep-a.tar.bz2 contents')
+        self.assertEquals(self._read_dest('dep-b.tar.bz2'),
+                          'dep-b.tar.bz2 contents')
+
+
+    def test_up_to_date_packages_take_a_single_command(self):
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'],
+                               self.dest_dir)
+        self.run_function.commands = []
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'],
+                               self.dest_dir)
+        self.assertEquals(len(self.run_function.commands), 1)
+
+
+    def test_stale_package_is_fetched_again(self):
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'],
+                               self.dest_dir)
+        open(os.path.join(self.dest_dir, 'dep-a.tar.bz2'), 'w').write('junk')
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'],
+                               self.dest_dir)
+        self.assertEquals(self._read_dest('dep-a.tar.bz2'),
+                          'dep-a.tar.bz2 contents')
+
+
+    def test_changed_checksum_file_is_reloaded(self):
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2'], self.dest_dir)
+        self._add_to_repo('dep-a.tar.bz2', 'new contents')
+        self._write_repo_checksum_file()
+        shutil.copy(os.path.join(self.repo, base_packages.CHECKSUM_FILE),
+                    self.pkgmgr_dir)
+        self.pkgmgr.fetch_pkgs(['dep-a.tar.bz2'], self.dest_dir)
+        self.assertEquals(self._read_dest('dep-a.tar.bz2'), 'new contents')
+
+
+    def test_fetch_pkg(self):
+        dest_path = os.path.join(self.dest_dir, 'dep-a.tar.bz2')
+        self.pkgmgr.fetch_pkg('dep-a.tar.bz2', dest_path, use_checksum=True)
+        self.assertEquals(self._read_dest('dep-a.tar.bz2'),
+                          'dep-a.tar.bz2 contents')
+
+
+    def test_missing_package(self):
+        self.assertRaises(error.PackageFetchError, self.pkgmgr.fetch_pkgs,
+                          ['dep-a.tar.bz2', 'dep-c.tar.bz2'], self.dest_dir)
+        self.assertEquals(self._read_dest('dep-a.tar.bz2'),
+                          'dep-a.tar.bz2 contents')
+
+
+    def test_invalid_destination(self):
+        self.assertRaises(error.PackageFetchError, self.pkgmgr.fetch_pkgs,
+                          ['dep-a.tar.bz2'],
+                          os.path.join(self.tmpdir, 'missing'))
+
+
+class test_caching_fetcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(self.repo)
+        self.checksums = {}
+        for name in ('dep-a.tar.bz2', 'dep-b.tar.bz2', 'dep-c.tar.bz2'):
+            self._add_to_repo(name, name + ' contents')
+        self._write_repo_checksum_file()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _add_to_repo(self, name, contents):
+        open(os.path.join(self.repo, name), 'w').write(contents)
+        self.checksums[name] = utils.hash('md5', contents).hexdigest()
+
+
+    def _write_repo_checksum_file(self):
+        lines = ['%s %s\n' % (checksum, name)
+                 for name, checksum in self.checksums.iteritems()]
+        open(os.path.join(self.repo, base_packages.CHECKSUM_FILE),
+             'w').write(''.join(lines))
+
+
+    def _make_client(self, name, max_size=base_packages.DEFAULT_CACHE_SIZE):
+        """ Make a package manager using the cache, along with its
+        destination directory. """
+        client_dir = os.path.join(self.tmpdir, name)
+        os.mkdir(client_dir)
+        pkgmgr = base_packages.BasePackageManager(
+            client_dir, repo_urls=[self.repo], do_locking=False)
+        fetcher = base_packages.CachingFetcher(pkgmgr, self.cache_dir,
+                                               [self.repo], max_size=max_size)
+        pkgmgr.add_repository(fetcher)
+        return pkgmgr, fetcher, client_dir
+
+
+    def _count_origin_fetches(self, fetcher):
+        origin = fetcher._origin.repositories[0]
+        origin.fetched = []
+        fetch_pkg_file = origin.fetch_pkg_file
+        def counting_fetch_pkg_file(filename, dest_path):
+            origin.fetched.append(filename)
+            fetch_pkg_file(filename, dest_path)
+        origin.fetch_pkg_file = counting_fetch_pkg_file
+        return origin.fetched
+
+
+    def test_packages_are_fetched_once(self):
+        for name in ('client1', 'client2'):
+            pkgmgr, fetcher, client_dir = self._make_client(name)
+            fetched = self._count_origin_fetches(fetcher)
+            pkgmgr.fetch_pkgs(['dep-a.tar.bz2', 'dep-b.tar.bz2'], client_dir)
+            self.assertEquals(
+                open(os.path.join(client_dir, 'dep-a.tar.bz2')).read(),
+                'dep-a.tar.bz2 contents')
+        self.assertEquals(fetched, [])
+
+
+    def test_stale_cached_package_is_refetched(self):
+        pkgmgr, fetcher, client_dir = self._make_client('client1')
+        pkgmgr.fetch_pkgs(['dep-a.tar.bz2'], client_dir)
+        self._add_to_repo('dep-a.tar.bz2', 'new contents')
+        self._write_repo_checksum_file()
+
+        pkgmgr, fetcher, client_dir = self._make_client('client2')
+        fetcher.checksum_max_age = 0
+        pkgmgr.fetch_pkgs(['dep-a.tar.bz2'], client_dir)
+        self.assertEquals(
+            open(os.path.join(client_dir, 'dep-a.tar.bz2')).read(),
+            'new contents')
+
+
+    def test_least_recently_used_packages_are_evicted(self):
+        pkgmgr, fetcher, client_dir = self._make_client('client1',
+                                                        max_size=50)
+        for name in ('dep-a.tar.bz2', 'dep-b.tar.bz2', 'dep-c.tar.bz2'):
+            pkgmgr.fetch_pkgs([name], client_dir)
+            # make the fetches distinguishable by mtime
+            for cached in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, cached)
+                os.utime(path, (os.stat(path).st_mtime - 10,) * 2)
+        cached = [name for name in os.listdir(self.cache_dir)
+                  if name.endswith('.tar.bz2')]
+        self.assertEquals(sorted(cached), ['dep-b.tar.bz2', 'dep-c.tar.bz2'])
+
+
+    def test_missing_package_falls_back_to_origins(self):
+        pkgmgr, fetcher, client_dir = self._make_client('client1')
+        self.assertEquals(
+            fetcher.fetch_pkg_files([('dep-x.tar.bz2', '/nonexistent')]),
+            [('dep-x.tar.bz2', '/nonexistent')])
+
+
+class test_tar_package(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmpdir, 'src')
+        self.dest_dir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.dest_dir)
+        open(os.path.join(self.src_dir, 'test.py'), 'w').write('print 1\n')
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.god.stub_with(base_packages, '_default_tar_cache_dir',
+                           lambda: cache_dir)
+        self.god.stub_with(utils, 'system', self._system)
+        self.commands = []
+        self.pkgmgr = base_packages.BasePackageManager(self.tmpdir,
+                                                       do_locking=False)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.tmpdir)
+
+
+    def _system(self, command):
+        self.commands.append(command)
+        return utils.run(command).exit_status
+
+
+    def _check_round_trip(self, compression):
+        tarball = self.pkgmgr.tar_package('test-foo.tar.bz2', self.src_dir,
+                                          self.tmpdir, ' .',
+                                          compression=compression)
+        self.pkgmgr.untar_pkg(tarball, self.dest_dir)
+        self.assertEquals(open(os.path.join(self.dest_dir, 'test.py')).read(),
+                          'print 1\n')
+        return tarball
+
+
+    def test_bzip2(self):
+        tarball = self._check_round_trip(base_packages.COMPRESSION_BZIP2)
+        self.assertEquals(open(tarball).read(3), 'BZh')
+
+
+    def test_fast(self):
+        self._check_round_trip(base_packages.COMPRESSION_FAST)
+
+
+    def test_none(self):
+        self._check_round_trip(base_packages.COMPRESSION_NONE)
+
+
+    def test_unchanged_tree_is_not_tarred_again(self):
+        first = self.pkgmgr.tar_package('test-foo.tar.bz2', self.src_dir,
+                                        self.tmpdir, ' .')
+        checksum = self.pkgmgr.compute_checksum(first)
+        os.remove(first)
+        second = self.pkgmgr.tar_package('test-foo.tar.bz2', self.src_dir,
+                                         self.tmpdir, ' .')
+        self.assertEquals(len(self.commands), 1)
+        self.assertEquals(self.pkgmgr.compute_checksum(second), checksum)
+
+
+    def test_changed_tree_is_tarred_again(self):
+        self.pkgmgr.tar_package('test-foo.tar.bz2', self.src_dir,
+                                self.tmpdir, ' .')
+        open(os.path.join(self.src_dir, 'other.py'), 'w').write('print 2\n')
+        self.pkgmgr.tar_package('test-foo.tar.bz2', self.src_dir,
+                                self.tmpdir, ' .')
+        self.assertEquals(len(self.commands), 2)
+
+
+class test_http_fetcher(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.pkgmgr = base_packages.BasePackageManager(
+            '/pkgmgr', do_locking=False, run_function=self._run)
+        self.fetcher = base_packages.HttpFetcher(self.pkgmgr,
+                                                 'http://repo/packages')
+
+
+    def _run(self, command, **dargs):
+        self.commands.append(command)
+        if command.startswith('mktemp'):
+            stdout = '/tmp/tmp.test\n'
+        elif command.startswith('(wget'):
+            # pretend the first package was the only one found
+            stdout = '/dest/dep-0.tar.bz2\n'
+        else:
+            stdout = ''
+        result = utils.CmdResult(command)
+        result.stdout = stdout
+        return result
+
+
+    def test_fetch_pkg_files(self):
+        files = [('dep-%d.tar.bz2' % i, '/dest/dep-%d.tar.bz2' % i)
+                 for i in xrange(6)]
+        failed = self.fetcher.fetch_pkg_files(files)
+        self.assertEquals(failed, files[1:])
+        downloads = [command for command in self.commands
+                     if command.startswith('(wget')]
+        self.assertEquals(len(downloads), 1)
+        # the downloads run in batches of MAX_PARALLEL_DOWNLOADS
+        self.assertEquals(downloads[0].count('wait;'), 2)
+        self.assertEquals(downloads[0].count('http://repo/packages/dep-'), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,13 @@
 import os, pickle, random, re, resource, select, shutil, signal, StringIO
 import socket, struct, subprocess, sys, time, textwrap, urlparse
 import warnings, smtplib, logging, urllib2
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 try:
     import hashlib
 except ImportError:
     import md5, sha
 from autotest_lib.client.common_lib import error, logging_manager
+from autotest_lib.client.common_lib import sampling_profiler
 
 def deprecated(func):
     """This is a decorator which can be used to mark functions as deprecated.
@@ -984,9 +985,18 @@ def get_cpu_percentage(function, *args, **dargs):
 class SystemLoad(object):
     """
     Get system and/or process values and return average value of load.
+
+    All the monitored /proc files are read by a single thread, which keeps
+    them open between samples and appends the raw values to a preallocated
+    ring buffer; the utilization is only computed when it's asked for (with
+    numpy when it's available).
     """
+    # values of each monitored pid in a sample: 4 CPU values, then 4 memory
+    # values (see __init__)
+    _WIDTH = 8
+
     def __init__(self, pids, advanced=False, time_step=0.1, cpu_cont=False,
-                 use_log=False):
+                 use_log=False, max_samples=36000):
         """
         @param pids: List of pids to be monitored. If pid = 0 whole system will
           be monitored. pid == 0 means whole system.
@@ -995,67 +1005,46 @@ class SystemLoad(object):
         @param time_step: Time step for continuous monitoring.
         @param cpu_cont: If True monitor CPU load continuously.
         @param use_log: If true every monitoring is logged for dump.
+        @param max_samples: Number of samples kept in memory, the oldest ones
+          are dropped from the log (but still count in the averages) when
+          more are taken. Use export() to save all the samples of long
+          running monitoring.
+
+        The monitored values are:
+          whole system: user time, system time, IRQ count, soft IRQ count;
+            MemTotal, MemFree, Buffers, Cached
+          process: user time, system time, minor page faults, major page
+            faults; VmSize, VmRSS, VmPeak, VmSwap
         """
         self.pids = []
         self.stats = {}
         for pid in pids:
             if pid == 0:
-                cpu = FileFieldMonitor("/proc/stat",
-                                       [("cpu", 0), # User Time
-                                        ("cpu", 2), # System Time
-                                        ("intr", 0), # IRQ Count
-                                        ("softirq", 0)], # Soft IRQ Count
-                                       True,
-                                       cpu_cont,
-                                       use_log,
-                                       " +",
-                                       time_step)
-                mem = FileFieldMonitor("/proc/meminfo",
-                                       [("MemTotal:", 0), # Mem Total
-                                        ("MemFree:", 0), # Mem Free
-                                        ("Buffers:", 0), # Buffers
-                                        ("Cached:", 0)], # Cached
-                                       False,
-                                       True,
-                                       use_log,
-                                       " +",
-                                       time_step)
-                self.stats[pid] = ["TOTAL", cpu, mem]
-                self.pids.append(pid)
+                name = "TOTAL"
+            elif type(pid) is int:
+                name = get_process_name(pid)
             else:
-                name = ""
-                if (type(pid) is int):
-                    self.pids.append(pid)
-                    name = get_process_name(pid)
-                else:
-                    self.pids.append(pid[0])
-                    name = pid[1]
-
-                cpu = FileFieldMonitor("/proc/%d/stat" %
-                                       self.pids[-1],
-                                       [("", 13), # User Time
-                                        ("", 14), # System Time
-                                        ("", 9), # Minority Page Fault
-                                        ("", 11)], # Majority Page Fault
-                                       True,
-                                       cpu_cont,
-                                       use_log,
-                                       " +",
-                                       time_step)
-                mem = FileFieldMonitor("/proc/%d/status" %
-                                       self.pids[-1],
-                                       [("VmSize:", 0), # Virtual Memory Size
-                                        ("VmRSS:", 0), # Resident Set Size
-                                        ("VmPeak:", 0), # Peak VM Size
-                                        ("VmSwap:", 0)], # VM in Swap
-                                       False,
-                                       True,
-                                       use_log,
-                                       " +",
-                                       time_step)
-                self.stats[self.pids[-1]] = [name, cpu, mem]
+                pid, name = pid
+            self.pids.append(pid)
+            self.stats[pid] = [name]
 
         self.advanced = advanced
+        self.time_step = time_step
+        self.cpu_cont = cpu_cont
+        self.use_log = use_log
+        self.buffer = sampling_profiler.ring_buffer(
+                1 + self._WIDTH * len(self.pids), max_samples)
+
+        self.start_time = 0
+        self.test_time = 0
+        self._lock = Lock()
+        self._thread = None
+        self._files = {}
+        self._first = None
+        self._last = None
+        self._sums = None
+        self._exported = 0
+        self._status = None
 
 
     def __str__(self):
@@ -1064,37 +1053,228 @@ class SystemLoad(object):
         """
         out = ""
         for pid in self.pids:
-            for stat in self.stats[pid][1:]:
-                out += str(stat.get_status()) + "\n"
+            cpu, mem = self._get_status(pid)
+            out += str(cpu) + "\n" + str(mem) + "\n"
         return out
 
 
+    def _read(self, path):
+        """
+        Read a /proc file, keeping it open for the next samples.
+        """
+        fd = self._files.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self._files[path] = fd
+        else:
+            os.lseek(fd, 0, 0)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return "".join(chunks)
+            chunks.append(chunk)
+
+
+    def _read_fields(self, path, names):
+        """
+        Read the first value of the lines starting with names.
+        """
+        values = dict.fromkeys(names, 0)
+        for line in self._read(path).splitlines():
+            fields = line.split(None, 2)
+            if len(fields) > 1 and fields[0] in values:
+                values[fields[0]] = int(fields[1])
+        return [values[name] for name in names]
+
+
+    def _read_system(self, read_cpu):
+        if read_cpu:
+            stat = self._read("/proc/stat")
+            cpu = stat[:stat.index("\n")].split()
+            counts = {}
+            for line in stat.splitlines():
+                if line.startswith("intr ") or line.startswith("softirq "):
+                    name, count = line.split(None, 2)[:2]
+                    counts[name] = int(count)
+            values = [int(cpu[1]), int(cpu[3]), counts.get("intr", 0),
+                      counts.get("softirq", 0)]
+        else:
+            values = [0] * 4
+        return values + self._read_fields(
+                "/proc/meminfo", ("MemTotal:", "MemFree:", "Buffers:",
+                                  "Cached:"))
+
+
+    def _read_process(self, pid, read_cpu):
+        if read_cpu:
+            stat = self._read("/proc/%d/stat" % pid)
+            # skip the command name, it may contain spaces
+            fields = stat[stat.rindex(")") + 2:].split()
+            values = [int(fields[11]), int(fields[12]), int(fields[7]),
+                      int(fields[9])]
+        else:
+            values = [0] * 4
+        return values + self._read_fields(
+                "/proc/%d/status" % pid, ("VmSize:", "VmRSS:", "VmPeak:",
+                                          "VmSwap:"))
+
+
+    def _sample(self, read_cpu=True):
+        """
+        Take a sample of all the monitored pids. CPU values which are not
+        read are carried over from the previous sample.
+        """
+        sample = [time.time()]
+        for i, pid in enumerate(self.pids):
+            try:
+                if pid == 0:
+                    values = self._read_system(read_cpu)
+                else:
+                    values = self._read_process(pid, read_cpu)
+            except (IOError, OSError):
+                if pid == 0 or self._last is None:
+                    raise
+                # the process is gone, keep its last values
+                start = 1 + i * self._WIDTH
+                values = self._last[start:start + self._WIDTH]
+            if not read_cpu and self._last:
+                start = 1 + i * self._WIDTH
+                values[:4] = self._last[start:start + 4]
+            sample.extend(values)
+
+        self._lock.acquire()
+        try:
+            self.buffer.append(sample)
+            if self._first is None:
+                self._first = sample
+                self._sums = [0] * len(sample)
+            self._last = sample
+            # only the sums of the memory values are used, for the averages
+            for i in xrange(len(sample)):
+                self._sums[i] += sample[i]
+        finally:
+            self._lock.release()
+
+
+    def _run(self):
+        """
+        Sample continuously until stop() is called.
+        """
+        while not select.select([self._stop_read], [], [], self.time_step)[0]:
+            try:
+                self._sample(self.cpu_cont)
+            except (IOError, OSError), e:
+                logging.debug("SystemLoad sampling failed: %s", e)
+
+
     def start(self, pids=[]):
         """
         Start monitoring of the process system usage.
         @param pids: List of PIDs you intend to control. Use pids=[] to control
-            all defined PIDs.
+            all defined PIDs. All the pids are always monitored together, this
+            is kept for compatibility.
         """
-        if pids == []:
-            pids = self.pids
-
-        for pid in pids:
-            for stat in self.stats[pid][1:]:
-                stat.start()
+        if self._thread:
+            self.stop()
+        self.buffer.clear()
+        self._first = self._last = self._sums = None
+        self._exported = 0
+        self._status = None
+        self.start_time = time.time()
+        self._sample()
+        self._stop_read, self._stop_write = os.pipe()
+        self._thread = Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
 
 
     def stop(self, pids=[]):
         """
         Stop monitoring of the process system usage.
         @param pids: List of PIDs you intend to control. Use pids=[] to control
-            all defined PIDs.
+            all defined PIDs. All the pids are always monitored together, this
+            is kept for compatibility.
         """
-        if pids == []:
-            pids = self.pids
+        if not self._thread:
+            return
+        os.write(self._stop_write, "x")
+        self._thread.join()
+        self._thread = None
+        for fd in (self._stop_read, self._stop_write):
+            os.close(fd)
+        self.test_time = time.time() - self.start_time
+        self._sample()
+        for fd in self._files.itervalues():
+            os.close(fd)
+        self._files = {}
+
+
+    def _get_log(self, index, cpu):
+        """
+        Return the logged values of a pid, as a list of lists: the values of
+        each sample for memory, the differences between consecutive samples
+        for CPU.
 
-        for pid in pids:
-            for stat in self.stats[pid][1:]:
-                stat.stop()
+        @param index: Index of the pid in self.pids.
+        @param cpu: True for the CPU values, False for the memory ones.
+        """
+        data = self.buffer.get_data()
+        width = self.buffer.width
+        start = 1 + index * self._WIDTH
+        if not cpu:
+            start += 4
+        if not self.use_log:
+            data = self._first + self._last
+        elif cpu and not self.cpu_cont:
+            # the CPU values only change in the first and last samples
+            data = self._first + self._last
+
+        # numpy is only imported here, as importing it is slow and most
+        # processes using this module never need it
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy:
+            values = numpy.asarray(data, dtype=float).reshape(-1, width)
+            values = values[:, start:start + 4]
+            if cpu:
+                values = numpy.diff(values, axis=0)
+            return values.astype(int).tolist()
+
+        values = [[int(value) for value in data[i + start:i + start + 4]]
+                  for i in xrange(0, len(data), width)]
+        if cpu:
+            values = [map(lambda x, y: x - y, new, old)
+                      for old, new in zip(values, values[1:])]
+        return values
+
+
+    def _get_status(self, pid):
+        """
+        Return the CPU and memory status of a pid, as documented in dump().
+        The status is computed once after monitoring was stopped.
+        """
+        if self._thread:
+            self.stop()
+        if self._first is None:
+            raise error.TestError("SystemLoad monitoring was never started")
+        if self._status is None:
+            self._status = {}
+        if pid not in self._status:
+            index = self.pids.index(pid)
+            start = 1 + index * self._WIDTH
+            num_samples = self.buffer.count
+            cpu = [int(self._last[i] - self._first[i])
+                   for i in xrange(start, start + 4)]
+            mem = [int(self._sums[i]) / num_samples
+                   for i in xrange(start + 4, start + self._WIDTH)]
+            self._status[pid] = ((cpu, self.test_time,
+                                  self._get_log(index, True), self.time_step),
+                                 (mem, self.test_time,
+                                  self._get_log(index, False), self.time_step))
+        return self._status[pid]
 
 
     def dump(self, pids=[]):
@@ -1112,7 +1292,7 @@ class SystemLoad(object):
             PID1_mem_meas:
                 average_values[], test_time, cont_meas_values[[]], time_step
             where average_values[] are the measured values (mem_free,swap,...)
-            which are described in SystemLoad.__init__()-FileFieldMonitor.
+            which are described in SystemLoad.__init__().
             cont_meas_values[[]] is a list of average_values in the sampling
             times.
         """
@@ -1122,15 +1302,47 @@ class SystemLoad(object):
         cpus = []
         memory = []
         for pid in pids:
-            stat = (pid, self.stats[pid][1].get_status())
-            cpus.append(stat)
+            cpus.append((pid, self._get_status(pid)[0]))
         for pid in pids:
-            stat = (pid, self.stats[pid][2].get_status())
-            memory.append(stat)
+            memory.append((pid, self._get_status(pid)[1]))
 
         return (cpus, memory)
 
 
+    def export(self, output):
+        """
+        Write the samples taken since the previous export (or since start())
+        to a file like object, which can be done while monitoring is
+        running. Each sample is written as a line made of the time of the
+        sample and, for every monitored pid, the 8 values described in
+        __init__().
+
+        Samples are dropped from memory after max_samples more are taken, so
+        long running monitoring has to export at least every
+        max_samples * time_step seconds not to lose any.
+
+        @param output: File like object the samples are written to.
+        @return: Number of samples written.
+        """
+        self._lock.acquire()
+        try:
+            count = self.buffer.count - self._exported
+            data = self.buffer.get_data()
+            self._exported = self.buffer.count
+        finally:
+            self._lock.release()
+
+        width = self.buffer.width
+        count = min(count, len(data) / width)
+        if not count:
+            return 0
+        line_format = "%.3f" + " %d" * (width - 1) + "\n"
+        data = data[-count * width:]
+        output.writelines([line_format % tuple(data[i:i + width])
+                           for i in xrange(0, len(data), width)])
+        return count
+
+
     def get_cpu_status_string(self, pids=[]):
         """
         Convert status to string array.
@@ -1152,7 +1364,7 @@ class SystemLoad(object):
         headers.append(("%11s") % "TIME")
         textstatus = []
         for pid in pids:
-            stat = self.stats[pid][1].get_status()
+            stat = self._get_status(pid)[0]
             time = stat[1]
             stat = stat[0]
             textstatus.append(["%s" % self.stats[pid][0],
@@ -1187,7 +1399,7 @@ class SystemLoad(object):
                    ("%11s") % "TIME"]
         textstatus = []
         for pid in pids:
-            stat = self.stats[pid][2].get_status()
+            stat = self._get_status(pid)[1]
             time = stat[1]
             stat = stat[0]
             textstatus.append(["%s" % self.stats[pid][0],
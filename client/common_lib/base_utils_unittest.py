@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import os, unittest, StringIO, socket, urllib2, shutil, subprocess, logging
+import time
 
 import common
 from autotest_lib.client.common_lib import base_utils, autotemp
@@ -795,5 +796,98 @@ class test_get_random_port(unittest.TestCase):
             s = self.do_bind(p, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
             self.assert_(s.getsockname())
 
+
+class test_system_load(unittest.TestCase):
+    def _busy_wait(self, seconds):
+        end_time = time.time() + seconds
+        while time.time() < end_time:
+            pass
+
+
+    def test_dump(self):
+        pid = os.getpid()
+        load = base_utils.SystemLoad([0, (pid, "self")], time_step=0.05,
+                                     cpu_cont=True, use_log=True)
+        load.start()
+        self._busy_wait(0.5)
+        load.stop()
+
+        cpus, memory = load.dump()
+        self.assertEquals([pid for pid, stat in cpus], [0, pid])
+        values, test_time, log, time_step = dict(cpus)[pid]
+        self.assert_(0.5 <= test_time < 5)
+        self.assertEquals(time_step, 0.05)
+        self.assert_(len(log) >= 5)
+        # the per step differences add up to the whole difference
+        self.assertEquals([sum(step) for step in zip(*log)], values)
+        # this process was busy the whole time
+        self.assert_(values[0] + values[1] > 0)
+
+        values, test_time, log, time_step = dict(memory)[0]
+        self.assertEquals(len(log), len(dict(cpus)[0][2]) + 1)
+        mem_total = log[0][0]
+        self.assertEquals(values[0], mem_total)
+        self.assert_(0 < values[1] <= mem_total)
+        self.assert_(dict(memory)[pid][0][1] > 0)
+
+        self.assert_("self" in load.get_cpu_status_string())
+        self.assert_("TOTAL" in load.get_mem_status_string())
+
+
+    def test_without_log(self):
+        load = base_utils.SystemLoad([os.getpid()], time_step=0.01)
+        load.start()
+        self._busy_wait(0.1)
+        cpu, memory = load.dump()
+        # dump() stops the monitoring
+        self.assertEquals(load._thread, None)
+        self.assertEquals(len(cpu[0][1][2]), 1)
+        self.assertEquals(len(memory[0][1][2]), 2)
+
+
+    def test_max_samples(self):
+        load = base_utils.SystemLoad([0], time_step=0.01, cpu_cont=True,
+                                     use_log=True, max_samples=3)
+        load.start()
+        time.sleep(0.1)
+        load.stop()
+        values, test_time, log, time_step = load.dump()[0][0][1]
+        self.assertEquals(len(log), 2)
+        self.assert_(sum([step[0] for step in log]) <= values[0])
+
+
+    def test_export(self):
+        load = base_utils.SystemLoad([0, os.getpid()], time_step=0.01)
+        output = StringIO.StringIO()
+        load.start()
+        time.sleep(0.05)
+        count = load.export(output)
+        time.sleep(0.05)
+        load.stop()
+        count += load.export(output)
+        self.assertEquals(load.export(output), 0)
+
+        lines = output.getvalue().splitlines()
+        self.assertEquals(len(lines), count)
+        self.assertEquals(count, load.buffer.count)
+        for line in lines:
+            self.assertEquals(len(line.split()), 17)
+        times = [float(line.split()[0]) for line in lines]
+        self.assertEquals(times, sorted(times))
+
+
+    def test_exited_process(self):
+        pid = os.fork()
+        if not pid:
+            time.sleep(0.05)
+            os._exit(0)
+        load = base_utils.SystemLoad([(pid, "child")], time_step=0.01)
+        load.start()
+        os.waitpid(pid, 0)
+        time.sleep(0.05)
+        load.stop()
+        self.assert_(load.dump()[1][0][1][0][1] > 0)
+
+
 if __name__ == "__main__":
     unittest.main()
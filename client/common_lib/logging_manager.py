@@ -1,5 +1,8 @@
 import logging, os, signal, sys, warnings
 
+# bytes read at once from the redirected file descriptors
+_LOGGING_READ_SIZE = 1 << 20
+
 # primary public APIs
 
 def configure_logging(logging_config, **kwargs):
@@ -110,6 +113,11 @@ class LoggingFile(object):
         store it in a buffer and wait until we have a complete line.
         @param data - Raw data (a string) that will be processed.
         """
+        if '\n' not in data:
+            # most writes of print statements are parts of a line
+            if data:
+                self._buffer.append(data)
+            return
         # splitlines() discards a trailing blank line, so use split() instead
         data_lines = data.split('\n')
         if len(data_lines) > 1:
@@ -441,6 +449,85 @@ class LoggingManager(object):
         self.undo_redirect()
 
 
+class _LogLineWriter(object):
+    """
+    Logs lines of output at a given level, as calling logging.log() for each
+    of them would, but cheaply enough to keep up with output of hundreds of
+    MB: all the complete lines read at once are formatted with a couple of
+    string operations and written to each logging StreamHandler (which
+    includes the debug log FileHandlers) with a single write. Only handlers
+    which can't be written to that way, because they have filters or don't
+    write to a stream, get a LogRecord for each line, and handlers whose
+    level filters out the output get nothing.
+    """
+    # stands for the message when formatting the prefix and suffix of lines
+    _MARKER = '\0message\0'
+
+    def __init__(self, level):
+        self._level = level
+        self._stream_handlers = []
+        self._record_handlers = []
+        if not logger.isEnabledFor(level):
+            return
+        for handler in logger.handlers:
+            if level < handler.level:
+                continue
+            if (logger.filters or handler.filters or
+                    not isinstance(handler, logging.StreamHandler)):
+                self._record_handlers.append(handler)
+            else:
+                self._stream_handlers.append(handler)
+
+
+    def _make_record(self, message):
+        return logging.LogRecord(logger.name, self._level, __file__, 0,
+                                 message, None, None)
+
+
+    def _get_line_format(self, handler):
+        """
+        @returns a tuple (prefix, suffix) of the lines formatted by handler,
+                None if the formatted lines are not made of the message
+                between a prefix and a suffix.
+        """
+        formatter = handler.formatter or logging._defaultFormatter
+        line = formatter.format(self._make_record(self._MARKER))
+        parts = line.split(self._MARKER)
+        if len(parts) != 2 or '\n' in line:
+            return None
+        return tuple(parts)
+
+
+    def write_lines(self, data):
+        """
+        Log every line of data.
+
+        @param data: A string of complete lines, without the final newline.
+        """
+        for handler in self._stream_handlers:
+            line_format = self._get_line_format(handler)
+            if line_format is None:
+                self._handle_lines(handler, data)
+                continue
+            prefix, suffix = line_format
+            lines = prefix + data.replace('\n', suffix + '\n' + prefix)
+            handler.acquire()
+            try:
+                handler.stream.write(lines + suffix + '\n')
+                handler.flush()
+            finally:
+                handler.release()
+        for handler in self._record_handlers:
+            self._handle_lines(handler, data)
+
+
+    def _handle_lines(self, handler, data):
+        for line in data.split('\n'):
+            record = self._make_record(line)
+            if logger.filter(record):
+                handler.handle(record)
+
+
 class _FdRedirectionStreamManager(_StreamManager):
     """
     Like StreamManager, but also captures output from subprocesses by modifying
@@ -553,11 +640,32 @@ class _FdRedirectionStreamManager(_StreamManager):
         """
         Always run from a subprocess.  Read from read_fd and write to the
         logging module until EOF.
+
+        The input is read in large chunks and the complete lines of each
+        chunk are logged together (see _LogLineWriter). A line longer than
+        the chunk size is logged as several lines.
         """
         signal.signal(signal.SIGTERM, signal.SIG_DFL) # clear handler
-        input_file = os.fdopen(read_fd, 'r')
-        for line in iter(input_file.readline, ''):
-            logging.log(self._level, line.rstrip('\n'))
+        writer = _LogLineWriter(self._level)
+        partial_line = ''
+        while True:
+            data = os.read(read_fd, _LOGGING_READ_SIZE)
+            if not data:
+                break
+            if partial_line:
+                data = partial_line + data
+            end = data.rfind('\n')
+            if end == -1:
+                end = len(data)
+                if end < _LOGGING_READ_SIZE:
+                    partial_line = data
+                    continue
+                partial_line = ''
+            else:
+                partial_line = data[end + 1:]
+            writer.write_lines(data[:end])
+        if partial_line:
+            writer.write_lines(partial_line)
         logging.debug('Logging subprocess finished')
         os._exit(0)
 
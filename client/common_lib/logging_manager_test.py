@@ -231,6 +231,31 @@ class LoggingManagerTest(unittest.TestCase):
         self._check_results()
 
 
+    def test_fd_redirection_read_chunks(self):
+        # lines crossing the chunks read by the logging subprocess, and a
+        # line longer than a chunk
+        old_read_size = logging_manager._LOGGING_READ_SIZE
+        logging_manager._LOGGING_READ_SIZE = 16
+        try:
+            manager = self._setup_manager(
+                    logging_manager.FdRedirectionLoggingManager)
+            manager.start_logging()
+            manager.redirect_to_stream(self._log1)
+            os.system('{ printf "start "; seq 1000 | tr -d "\\n"; seq 10; } '
+                      '>&%d' % self._original_stdout.fileno())
+            manager.undo_redirect()
+            manager.stop_logging()
+        finally:
+            logging_manager._LOGGING_READ_SIZE = old_read_size
+
+        lines = self._log1.getvalue().splitlines()
+        numbers = ['INFO: %d' % i for i in xrange(2, 11)]
+        self.assertEquals(lines[-9:], numbers)
+        self.assertEquals(''.join(line[len('INFO: '):] for line in lines[:-9]),
+                          'start ' + ''.join(str(i) for i in xrange(1, 1001))
+                          + '1')
+
+
     def test_tee_redirect_debug_dir(self):
         manager = self._setup_manager()
         manager.start_logging()
@@ -248,6 +273,63 @@ class LoggingManagerTest(unittest.TestCase):
         self._compare_logs(self._config_object.log, 'hello\n')
 
 
+class LogLineWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.root_logger = logging.getLogger()
+        self._old_handlers = list(self.root_logger.handlers)
+        self._old_level = self.root_logger.level
+        for handler in self._old_handlers:
+            self.root_logger.removeHandler(handler)
+        self.root_logger.setLevel(logging.DEBUG)
+
+
+    def tearDown(self):
+        for handler in list(self.root_logger.handlers):
+            self.root_logger.removeHandler(handler)
+        for handler in self._old_handlers:
+            self.root_logger.addHandler(handler)
+        self.root_logger.setLevel(self._old_level)
+
+
+    def _add_handler(self, level=logging.NOTSET, log_filter=None):
+        output = StringIO.StringIO()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter('<%(levelname)s: %(message)s>'))
+        handler.setLevel(level)
+        if log_filter:
+            handler.addFilter(log_filter)
+        self.root_logger.addHandler(handler)
+        return output
+
+
+    def test_write_lines(self):
+        output = self._add_handler()
+        error_output = self._add_handler(logging.ERROR)
+        writer = logging_manager._LogLineWriter(logging.INFO)
+        writer.write_lines('a\n\nb')
+        writer.write_lines('c')
+        self.assertEquals(output.getvalue(),
+                          '<INFO: a>\n<INFO: >\n<INFO: b>\n<INFO: c>\n')
+        self.assertEquals(error_output.getvalue(), '')
+
+
+    def test_filtered_handler(self):
+        class skip_b(logging.Filter):
+            def filter(self, record):
+                return record.getMessage() != 'b'
+        output = self._add_handler(log_filter=skip_b())
+        writer = logging_manager._LogLineWriter(logging.INFO)
+        writer.write_lines('a\nb\nc')
+        self.assertEquals(output.getvalue(), '<INFO: a>\n<INFO: c>\n')
+
+
+    def test_disabled_level(self):
+        output = self._add_handler()
+        self.root_logger.setLevel(logging.WARNING)
+        logging_manager._LogLineWriter(logging.INFO).write_lines('a')
+        self.assertEquals(output.getvalue(), '')
+
+
 class MonkeyPatchTestCase(unittest.TestCase):
     def setUp(self):
         filename = os.path.split(__file__)[1]
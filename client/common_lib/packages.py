@@ -8,3 +8,6 @@ SitePackageManager = utils.import_site_class(
 
 class PackageManager(SitePackageManager):
     pass
+
+
+CachingFetcher = base_packages.CachingFetcher
@@ -2,6 +2,7 @@ import os, sys
 import common
 
 from autotest_lib.client.common_lib import error, utils, packages
+from autotest_lib.client.common_lib import sampling_profiler
 
 
 class ProfilerNotPresentError(error.JobError):
@@ -18,6 +19,7 @@ class profiler_manager(object):
         self.profile_run_only = False
         self.active_flag = False
         self.created_dirs = []
+        self.sampler = None
 
 
     def load_profiler(self, profiler, args, dargs):
@@ -60,6 +62,46 @@ class profiler_manager(object):
         self.profile_run_only = value
 
 
+    def enable_sampling(self, interval=1.0, pids=None, capacity=3600):
+        """
+        Turn on the built-in sampling profiler, which samples the CPU,
+        memory and disk usage during every test iteration and records their
+        percentiles as perf keyvals of the iteration. See
+        sampling_profiler.sampler for the arguments.
+        """
+        self.sampler = sampling_profiler.sampler(interval, pids, capacity)
+
+
+    def disable_sampling(self):
+        """ Turn off the built-in sampling profiler """
+        self.sampler = None
+
+
+    def start_sampling(self, test):
+        """ Start sampling a test iteration, if sampling is enabled """
+        if self.sampler:
+            self.sampler.start()
+
+
+    def stop_sampling(self, test):
+        """
+        Stop sampling a test iteration, saving the samples into the
+        sampler directory of the test output directory.
+
+        @returns a dictionary of perf keyvals summarizing the iteration,
+                empty if sampling is not enabled.
+        """
+        if not self.sampler:
+            return {}
+        self.sampler.stop()
+        sampler_dir = os.path.join(test.outputdir, 'sampler')
+        if not os.path.exists(sampler_dir):
+            os.makedirs(sampler_dir)
+        self.sampler.write_samples(os.path.join(sampler_dir, 'iteration.%s'
+                                                % test.iteration))
+        return self.sampler.get_keyvals()
+
+
     def before_start(self, test):
         """
         Override to do any setup needed before actually starting the profilers
@@ -0,0 +1,322 @@
+"""\
+Result cache for read-heavy RPC interface functions.
+
+RPC functions decorated with cacheable() have their results stored in a cache
+backend, keyed on the function name plus its normalized arguments.  Entries
+expire after a TTL and are also invalidated by writes: every cache key embeds
+the current value of one or more generation counters ('afe', 'tko', ...),
+and bumping a counter with invalidate() makes all the entries that depend on
+it unreachable.
+
+Generations are bumped when Django models are saved or deleted in the
+frontend, after write RPCs and when the TKO parser commits a job.  With the
+default in-process backend, writes made by other processes (the parser, the
+scheduler) can't invalidate the frontend's entries, so results are up to their
+TTL stale; configure the memcached backend to share the cache and its
+generations between processes.
+
+This module must not import Django, since it is also used by the TKO parser.
+"""
+
+import logging, threading, time
+from autotest_lib.client.common_lib import global_config, utils
+
+_CONFIG_SECTION = 'AUTOTEST_WEB'
+_KEY_PREFIX = 'autotest_rpc_cache'
+
+AFE_GENERATION = 'afe'
+TKO_GENERATION = 'tko'
+ALL_GENERATIONS = (AFE_GENERATION, TKO_GENERATION)
+
+
+class LocalCacheBackend(object):
+    """
+    Thread-safe, in-process cache backend with per-entry expiration.
+    """
+    def __init__(self, max_entries=1000):
+        self._max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiration, value = entry
+            if expiration is not None and expiration < time.time():
+                del self._entries[key]
+                return None
+            return value
+        finally:
+            self._lock.release()
+
+
+    def set(self, key, value, ttl=None):
+        expiration = None
+        if ttl:
+            expiration = time.time() + ttl
+        self._lock.acquire()
+        try:
+            if len(self._entries) >= self._max_entries:
+                self._purge()
+            self._entries[key] = (expiration, value)
+        finally:
+            self._lock.release()
+
+
+    def incr(self, key):
+        self._lock.acquire()
+        try:
+            value = self._entries.get(key, (None, 0))[1] + 1
+            self._entries[key] = (None, value)
+            return value
+        finally:
+            self._lock.release()
+
+
+    def _purge(self):
+        """
+        Drop expired entries; if that isn't enough, drop everything but the
+        generation counters.  Must be called with the lock held.
+        """
+        now = time.time()
+        for key, (expiration, value) in self._entries.items():
+            if expiration is not None and expiration < now:
+                del self._entries[key]
+        if len(self._entries) >= self._max_entries:
+            for key, (expiration, value) in self._entries.items():
+                if expiration is not None:
+                    del self._entries[key]
+
+
+class MemcacheBackend(object):
+    """
+    Cache backend storing entries on memcached servers, which lets several
+    frontend processes (and the TKO parser) share entries and generations.
+    Requires the python-memcached module.
+    """
+    def __init__(self, servers):
+        import memcache
+        self._client = memcache.Client(servers)
+
+
+    def get(self, key):
+        return self._client.get(key)
+
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, time=ttl or 0)
+
+
+    def incr(self, key):
+        value = self._client.incr(key)
+        if value is None:
+            # the counter doesn't exist yet (or was evicted)
+            self._client.add(key, 1)
+            value = self._client.incr(key)
+        return value
+
+
+class CacheStats(object):
+    """
+    Per-function hit and miss counters.
+    """
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, name, hit):
+        self._lock.acquire()
+        try:
+            counts = self._counts.setdefault(name, [0, 0])
+            if hit:
+                counts[0] += 1
+            else:
+                counts[1] += 1
+        finally:
+            self._lock.release()
+
+
+    def get_stats(self):
+        """
+        @returns a dictionary mapping function names to dictionaries with keys
+                'hits', 'misses' and 'hit_rate'.
+        """
+        stats = {}
+        for name, (hits, misses) in self._counts.items():
+            stats[name] = {'hits': hits, 'misses': misses,
+                           'hit_rate': float(hits) / (hits + misses)}
+        return stats
+
+
+    def reset(self):
+        self._counts.clear()
+
+
+_backend = None
+_globally_disabled = False
+stats = CacheStats()
+
+
+def _create_backend():
+    config = global_config.global_config
+    backend_type = config.get_config_value(_CONFIG_SECTION,
+                                           'rpc_cache_backend',
+                                           default='local')
+    if backend_type == 'memcached':
+        servers = config.get_config_value(_CONFIG_SECTION,
+                                          'rpc_cache_memcached_servers',
+                                          type=list, default=[])
+        try:
+            return MemcacheBackend(servers)
+        except ImportError:
+            logging.warning('memcache module not available, falling back '
+                            'to the local RPC cache backend')
+    return LocalCacheBackend()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = _create_backend()
+    return _backend
+
+
+def is_shared():
+    """
+    Tell whether the cache backend is shared with other processes, i.e.
+    whether invalidations reach the frontend.
+    """
+    return not isinstance(get_backend(), LocalCacheBackend)
+
+
+def set_backend(backend):
+    """
+    Replace the cache backend (None to recreate it from the configuration).
+    """
+    global _backend
+    _backend = backend
+
+
+def set_globally_disabled(disabled):
+    """
+    When globally disabled, cacheable functions always run (used by tests).
+    """
+    global _globally_disabled
+    _globally_disabled = disabled
+
+
+def is_enabled():
+    if _globally_disabled:
+        return False
+    return global_config.global_config.get_config_value(
+            _CONFIG_SECTION, 'rpc_cache_enabled', type=bool, default=True)
+
+
+def _generation_key(generation):
+    return '%s:generation:%s' % (_KEY_PREFIX, generation)
+
+
+def invalidate(generations=ALL_GENERATIONS):
+    """
+    Bump the given generation counters, making all the cached results that
+    depend on them unreachable.
+
+    @param generations: a generation name or a sequence of them.
+    """
+    if isinstance(generations, str):
+        generations = (generations,)
+    backend = get_backend()
+    for generation in generations:
+        try:
+            backend.incr(_generation_key(generation))
+        except Exception:
+            logging.exception('Failed to invalidate RPC cache generation %s',
+                              generation)
+
+
+def _normalize(value):
+    """
+    Turn value into a hashable structure that doesn't depend on dictionary
+    ordering, so equivalent filter_data produce the same cache key.
+    """
+    if isinstance(value, dict):
+        items = [(_normalize(key), _normalize(item))
+                 for key, item in value.iteritems()]
+        items.sort()
+        return ('dict', tuple(items))
+    if isinstance(value, (list, tuple)):
+        return tuple([_normalize(item) for item in value])
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+
+def _make_key(name, generations, args, kwargs, extra_key):
+    backend = get_backend()
+    generation_values = [backend.get(_generation_key(generation)) or 0
+                         for generation in generations]
+    key_data = repr((name, generation_values, extra_key, _normalize(args),
+                     _normalize(kwargs)))
+    digest = utils.hash('md5', key_data).hexdigest()
+    return '%s:%s:%s' % (_KEY_PREFIX, name, digest)
+
+
+def cacheable(ttl, generations=(AFE_GENERATION,), key_function=None):
+    """
+    Decorator for RPC interface functions whose results can be cached.
+
+    Results must be treated as read-only by callers, since the in-process
+    backend hands out the same object to every cache hit.
+
+    @param ttl: Maximum age, in seconds, of a cached result.
+    @param generations: Generation names whose invalidation should discard
+            the cached results.
+    @param key_function: Optional function taking no arguments whose return
+            value is added to the cache key, for results that depend on more
+            than the arguments (e.g. the current user).
+    """
+    def decorator(function):
+        name = function.func_name
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return function(*args, **kwargs)
+            extra_key = None
+            if key_function:
+                extra_key = key_function()
+            key = _make_key(name, generations, args, kwargs, extra_key)
+            result = get_backend().get(key)
+            stats.record(name, hit=result is not None)
+            if result is None:
+                result = function(*args, **kwargs)
+                get_backend().set(key, result, ttl)
+            return result
+        wrapper.func_name = name
+        wrapper.__doc__ = function.__doc__
+        wrapper.__module__ = function.__module__
+        return wrapper
+    return decorator
+
+
+def _model_changed(sender, **kwargs):
+    invalidate(sender._meta.app_label)
+
+
+_signals_connected = False
+
+def invalidate_on_model_changes():
+    """
+    Bump the generation named after a model's application label whenever a
+    Django model instance is saved or deleted.
+    """
+    global _signals_connected
+    if _signals_connected:
+        return
+    from django.db.models import signals
+    signals.post_save.connect(_model_changed)
+    signals.post_delete.connect(_model_changed)
+    _signals_connected = True
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import unittest
+import common
+from autotest_lib.client.common_lib import rpc_cache
+from autotest_lib.client.common_lib.test_utils import mock
+
+
+class LocalCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_function(rpc_cache.time, 'time')
+        self.backend = rpc_cache.LocalCacheBackend(max_entries=3)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def test_get_set(self):
+        rpc_cache.time.time.expect_call().and_return(100)
+        rpc_cache.time.time.expect_call().and_return(105)
+        rpc_cache.time.time.expect_call().and_return(111)
+        self.backend.set('key', 'value', ttl=10)
+        self.assertEquals(self.backend.get('key'), 'value')
+        self.assertEquals(self.backend.get('key'), None)
+        self.god.check_playback()
+
+
+    def test_incr(self):
+        self.assertEquals(self.backend.incr('counter'), 1)
+        self.assertEquals(self.backend.incr('counter'), 2)
+        self.assertEquals(self.backend.get('counter'), 2)
+
+
+    def test_purge_keeps_counters(self):
+        rpc_cache.time.time.expect_call().and_return(100)
+        rpc_cache.time.time.expect_call().and_return(100)
+        rpc_cache.time.time.expect_call().and_return(100)
+        rpc_cache.time.time.expect_call().and_return(100)
+        self.backend.incr('counter')
+        self.backend.set('key1', 1, ttl=10)
+        self.backend.set('key2', 2, ttl=10)
+        self.backend.set('key3', 3, ttl=10)
+        self.assertEquals(self.backend.get('counter'), 1)
+        self.god.check_playback()
+
+
+class CacheableTest(unittest.TestCase):
+    def setUp(self):
+        rpc_cache.set_backend(rpc_cache.LocalCacheBackend())
+        rpc_cache.set_globally_disabled(False)
+        rpc_cache.stats.reset()
+        self.calls = []
+
+
+    def tearDown(self):
+        rpc_cache.set_backend(None)
+        rpc_cache.stats.reset()
+
+
+    def _make_function(self, **dargs):
+        @rpc_cache.cacheable(ttl=60, **dargs)
+        def get_things(**filter_data):
+            self.calls.append(filter_data)
+            return len(self.calls)
+        return get_things
+
+
+    def test_caches_on_normalized_arguments(self):
+        get_things = self._make_function()
+        self.assertEquals(get_things(a=1, b={'x': [1, 2], 'y': 3}), 1)
+        self.assertEquals(get_things(b={'y': 3, 'x': [1, 2]}, a=1), 1)
+        self.assertEquals(get_things(a=2), 2)
+        self.assertEquals(len(self.calls), 2)
+        self.assertEquals(rpc_cache.stats.get_stats(),
+                          {'get_things': {'hits': 1, 'misses': 2,
+                                          'hit_rate': 1.0 / 3}})
+
+
+    def test_invalidate(self):
+        get_things = self._make_function(
+                generations=(rpc_cache.TKO_GENERATION,))
+        self.assertEquals(get_things(), 1)
+        rpc_cache.invalidate(rpc_cache.AFE_GENERATION)
+        self.assertEquals(get_things(), 1)
+        rpc_cache.invalidate(rpc_cache.TKO_GENERATION)
+        self.assertEquals(get_things(), 2)
+        rpc_cache.invalidate()
+        self.assertEquals(get_things(), 3)
+
+
+    def test_key_function(self):
+        users = ['user1']
+        get_things = self._make_function(key_function=lambda: users[0])
+        self.assertEquals(get_things(), 1)
+        users[0] = 'user2'
+        self.assertEquals(get_things(), 2)
+        users[0] = 'user1'
+        self.assertEquals(get_things(), 1)
+
+
+    def test_globally_disabled(self):
+        get_things = self._make_function()
+        rpc_cache.set_globally_disabled(True)
+        try:
+            self.assertEquals(get_things(), 1)
+            self.assertEquals(get_things(), 2)
+        finally:
+            rpc_cache.set_globally_disabled(False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,328 @@
+"""
+A lightweight sampling profiler, built into the profiler manager.
+
+While a test iteration runs, a background thread periodically reads the
+system wide CPU, memory and disk counters (/proc/stat, /proc/meminfo and
+/proc/diskstats) along with the CPU time and RSS of a set of processes, and
+stores them in a fixed size ring buffer. When the iteration is done the
+samples are turned into percentile perf keyvals and saved as a compact binary
+time series (see write_samples and read_samples).
+
+The /proc files are kept open between samples and the thread sleeps in
+select(), so a sample costs a few hundred microseconds; the time spent
+sampling is measured and the interval is doubled whenever the overhead goes
+above OVERHEAD_BUDGET.
+"""
+
+import array, logging, os, select, sys, threading, time
+
+# the values of each sample; the counters are cumulative
+FIELDS = ('time', 'cpu_user', 'cpu_nice', 'cpu_system', 'cpu_idle',
+          'cpu_iowait', 'cpu_irq', 'cpu_softirq', 'cpu_steal',
+          'mem_total_kb', 'mem_free_kb', 'mem_buffers_kb', 'mem_cached_kb',
+          'disk_read_sectors', 'disk_write_sectors', 'disk_io_ms',
+          'proc_cpu_ticks', 'proc_rss_pages')
+
+# maximum fraction of the elapsed time spent sampling
+OVERHEAD_BUDGET = 0.01
+
+PERCENTILES = (50, 90, 99)
+
+_MAGIC = 'autotest-samples'
+_VERSION = 1
+_SECTOR_SIZE = 512
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class ring_buffer(object):
+    """ Fixed size buffer of samples, each made of width floats, dropping
+    the oldest samples once capacity samples are stored. """
+    def __init__(self, width, capacity):
+        self.width = width
+        self.capacity = capacity
+        self.data = array.array('d', [0.0]) * (width * capacity)
+        self.count = 0
+
+
+    def clear(self):
+        self.count = 0
+
+
+    def append(self, values):
+        start = (self.count % self.capacity) * self.width
+        self.data[start:start + self.width] = array.array('d', values)
+        self.count += 1
+
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+
+    def get_data(self):
+        """ Returns an array with the stored samples, oldest first. """
+        if self.count <= self.capacity:
+            return self.data[:self.count * self.width]
+        split = (self.count % self.capacity) * self.width
+        return self.data[split:] + self.data[:split]
+
+
+    def get_samples(self):
+        """ Returns the stored samples as a list of tuples, oldest first. """
+        data = self.get_data()
+        return [tuple(data[i:i + self.width])
+                for i in xrange(0, len(data), self.width)]
+
+
+def write_samples(path, data):
+    """
+    Write an array of samples (as returned by ring_buffer.get_data) to path:
+    a text header line followed by the samples as little endian doubles.
+    """
+    if sys.byteorder != 'little':
+        data = array.array('d', data)
+        data.byteswap()
+    output = open(path, 'wb')
+    try:
+        output.write('%s %d %s\n' % (_MAGIC, _VERSION, ','.join(FIELDS)))
+        data.tofile(output)
+    finally:
+        output.close()
+
+
+def read_samples(path):
+    """
+    Read a file written by write_samples.
+
+    @returns a tuple (field names, list of sample tuples).
+    """
+    input = open(path, 'rb')
+    try:
+        magic, version, fields = input.readline().split()
+        if magic != _MAGIC or int(version) != _VERSION:
+            raise ValueError('%s is not a samples file' % path)
+        fields = tuple(fields.split(','))
+        data = array.array('d', input.read())
+    finally:
+        input.close()
+    if sys.byteorder != 'little':
+        data.byteswap()
+    width = len(fields)
+    samples = [tuple(data[i:i + width]) for i in xrange(0, len(data), width)]
+    return fields, samples
+
+
+def _percentile(sorted_values, percent):
+    """ Nearest rank percentile of a sorted list. """
+    index = (len(sorted_values) * percent + 99) // 100 - 1
+    return sorted_values[max(index, 0)]
+
+
+def _get_disks():
+    """ Returns the names of the whole disks, whose statistics include the
+    ones of their partitions. """
+    try:
+        return set(name.replace('!', '/') for name in os.listdir('/sys/block')
+                   if not (name.startswith('loop') or name.startswith('ram')))
+    except OSError:
+        return None
+
+
+class sampler(object):
+    def __init__(self, interval=1.0, pids=None, capacity=3600):
+        """
+        @param interval: Seconds between samples.
+        @param pids: The processes whose CPU time and RSS get sampled, the
+                process calling start() if None.
+        @param capacity: The number of samples kept; an iteration running
+                for longer than interval * capacity seconds only keeps the
+                latest ones.
+        """
+        self.interval = interval
+        self.pids = pids
+        self.buffer = ring_buffer(len(FIELDS), capacity)
+        self.sampling_time = 0.0
+        self.elapsed_time = 0.0
+        self._thread = None
+        self._files = {}
+        self._disks = _get_disks()
+
+
+    def _read(self, path):
+        """ Read a /proc file, keeping it open for the next samples. """
+        fd = self._files.get(path)
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            self._files[path] = fd
+        else:
+            os.lseek(fd, 0, 0)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+
+    def _read_cpu(self):
+        # cpu  user nice system idle iowait irq softirq steal ...
+        line = self._read('/proc/stat').split('\n', 1)[0]
+        values = [float(value) for value in line.split()[1:9]]
+        return values + [0.0] * (8 - len(values))
+
+
+    def _read_memory(self):
+        memory = {}
+        for line in self._read('/proc/meminfo').splitlines():
+            name, value = line.split(':', 1)
+            if name in ('MemTotal', 'MemFree', 'Buffers', 'Cached'):
+                memory[name] = float(value.split()[0])
+        return [memory.get(name, 0.0)
+                for name in ('MemTotal', 'MemFree', 'Buffers', 'Cached')]
+
+
+    def _read_disks(self):
+        read_sectors = write_sectors = io_ms = 0.0
+        for line in self._read('/proc/diskstats').splitlines():
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            if self._disks is not None and fields[2] not in self._disks:
+                continue
+            read_sectors += float(fields[5])
+            write_sectors += float(fields[9])
+            io_ms += float(fields[12])
+        return [read_sectors, write_sectors, io_ms]
+
+
+    def _read_processes(self):
+        ticks = rss = 0.0
+        for pid in self._sampled_pids:
+            path = '/proc/%d/stat' % pid
+            try:
+                stat = self._read(path)
+            except OSError:
+                # the process is gone
+                fd = self._files.pop(path, None)
+                if fd is not None:
+                    os.close(fd)
+                continue
+            # skip the command name, it may contain spaces
+            fields = stat[stat.rindex(')') + 2:].split()
+            ticks += float(fields[11]) + float(fields[12])
+            rss += float(fields[21])
+        return [ticks, rss]
+
+
+    def _sample(self):
+        start = time.time()
+        try:
+            values = ([start] + self._read_cpu() + self._read_memory() +
+                      self._read_disks() + self._read_processes())
+        except (IOError, OSError, ValueError, IndexError), e:
+            logging.debug('Sampling failed: %s', e)
+        else:
+            self.buffer.append(values)
+        self.sampling_time += time.time() - start
+
+
+    def _run(self):
+        while not select.select([self._stop_read], [], [], self.interval)[0]:
+            self._sample()
+
+
+    def start(self):
+        """ Start sampling in a background thread. """
+        if self._thread:
+            raise RuntimeError('sampler already started')
+        if self.pids is None:
+            self._sampled_pids = [os.getpid()]
+        else:
+            self._sampled_pids = list(self.pids)
+        self.buffer.clear()
+        self.sampling_time = 0.0
+        self._start_time = time.time()
+        self._sample()
+        self._stop_read, self._stop_write = os.pipe()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stop(self):
+        """ Stop sampling, taking a last sample. """
+        if not self._thread:
+            return
+        os.write(self._stop_write, 'x')
+        self._thread.join()
+        self._thread = None
+        for fd in (self._stop_read, self._stop_write):
+            os.close(fd)
+        self._sample()
+        for fd in self._files.itervalues():
+            os.close(fd)
+        self._files = {}
+
+        self.elapsed_time = time.time() - self._start_time
+        if self.elapsed_time and (self.sampling_time / self.elapsed_time >
+                                  OVERHEAD_BUDGET):
+            logging.warning('Sampling took %.1f%% of the time, increasing the '
+                            'interval to %g seconds',
+                            100 * self.sampling_time / self.elapsed_time,
+                            self.interval * 2)
+            self.interval *= 2
+
+
+    def get_keyvals(self):
+        """
+        Summarize the samples of the last run into perf keyvals: percentiles
+        of the CPU and IO wait utilization, memory usage, disk throughput and
+        of the CPU usage and RSS of the sampled processes.
+        """
+        samples = [dict(zip(FIELDS, sample))
+                   for sample in self.buffer.get_samples()]
+        series = {}
+        def add(name, value):
+            series.setdefault(name, []).append(value)
+
+        for previous, current in zip(samples, samples[1:]):
+            seconds = current['time'] - previous['time']
+            if seconds <= 0:
+                continue
+            delta = dict((field, current[field] - previous[field])
+                         for field in FIELDS)
+            cpu_total = sum(delta[field] for field in FIELDS
+                            if field.startswith('cpu_'))
+            if cpu_total > 0:
+                busy = cpu_total - delta['cpu_idle'] - delta['cpu_iowait']
+                add('cpu_percent', 100 * busy / cpu_total)
+                add('iowait_percent', 100 * delta['cpu_iowait'] / cpu_total)
+            add('disk_read_kbps',
+                delta['disk_read_sectors'] * _SECTOR_SIZE / 1024 / seconds)
+            add('disk_write_kbps',
+                delta['disk_write_sectors'] * _SECTOR_SIZE / 1024 / seconds)
+            add('proc_cpu_percent', max(delta['proc_cpu_ticks'], 0) * 100.0
+                / _CLOCK_TICKS / seconds)
+        for sample in samples:
+            add('mem_used_mb', (sample['mem_total_kb'] - sample['mem_free_kb']
+                                - sample['mem_buffers_kb']
+                                - sample['mem_cached_kb']) / 1024)
+            add('proc_rss_mb', sample['proc_rss_pages'] * _PAGE_SIZE
+                / (1024.0 * 1024))
+
+        keyvals = {'sampler_samples': len(samples)}
+        if self.elapsed_time:
+            keyvals['sampler_overhead_percent'] = (
+                    100 * self.sampling_time / self.elapsed_time)
+        for name, values in series.iteritems():
+            values.sort()
+            for percent in PERCENTILES:
+                keyvals['sampler_%s_p%d' % (name, percent)] = (
+                        _percentile(values, percent))
+        return keyvals
+
+
+    def write_samples(self, path):
+        """ Save the samples of the last run to path (see read_samples). """
+        write_samples(path, self.buffer.get_data())
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, time, unittest
+import common
+from autotest_lib.client.common_lib import sampling_profiler
+
+
+class test_ring_buffer(unittest.TestCase):
+    def test_keeps_latest_samples(self):
+        buffer = sampling_profiler.ring_buffer(2, 3)
+        self.assertEquals(buffer.get_samples(), [])
+        for i in xrange(5):
+            buffer.append((i, 10 * i))
+        self.assertEquals(len(buffer), 3)
+        self.assertEquals(buffer.get_samples(),
+                          [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)])
+
+
+    def test_clear(self):
+        buffer = sampling_profiler.ring_buffer(1, 3)
+        buffer.append((1,))
+        buffer.clear()
+        self.assertEquals(buffer.get_samples(), [])
+
+
+class test_samples_file(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_round_trip(self):
+        width = len(sampling_profiler.FIELDS)
+        buffer = sampling_profiler.ring_buffer(width, 10)
+        buffer.append(range(width))
+        buffer.append(range(1, width + 1))
+        path = os.path.join(self.tmpdir, 'samples')
+        sampling_profiler.write_samples(path, buffer.get_data())
+        fields, samples = sampling_profiler.read_samples(path)
+        self.assertEquals(fields, sampling_profiler.FIELDS)
+        self.assertEquals(samples, buffer.get_samples())
+
+
+    def test_not_a_samples_file(self):
+        path = os.path.join(self.tmpdir, 'samples')
+        open(path, 'w').write('something else\n')
+        self.assertRaises(ValueError, sampling_profiler.read_samples, path)
+
+
+class test_sampler(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(sampling_profiler._percentile(values, 50), 50)
+        self.assertEquals(sampling_profiler._percentile(values, 99), 99)
+        self.assertEquals(sampling_profiler._percentile([3], 90), 3)
+
+
+    def test_sampling(self):
+        sampler = sampling_profiler.sampler(interval=0.05)
+        sampler.start()
+        end_time = time.time() + 0.5
+        while time.time() < end_time:
+            pass
+        sampler.stop()
+
+        self.assert_(len(sampler.buffer) >= 5)
+        keyvals = sampler.get_keyvals()
+        self.assertEquals(keyvals['sampler_samples'], len(sampler.buffer))
+        for name in ('cpu_percent', 'iowait_percent', 'mem_used_mb',
+                     'disk_read_kbps', 'disk_write_kbps', 'proc_cpu_percent',
+                     'proc_rss_mb'):
+            for percent in sampling_profiler.PERCENTILES:
+                self.assert_('sampler_%s_p%d' % (name, percent) in keyvals)
+        # this process was busy the whole time
+        self.assert_(keyvals['sampler_proc_cpu_percent_p90'] > 50)
+        self.assert_(keyvals['sampler_proc_rss_mb_p50'] > 0)
+
+
+    def test_overhead_is_within_budget(self):
+        sampler = sampling_profiler.sampler(interval=0.01)
+        sampler.start()
+        time.sleep(1)
+        sampler.stop()
+        # sampling 100 times a second still stays way below the budget of
+        # the default interval (one sample a second)
+        self.assert_(sampler.sampling_time < 0.1 * sampler.elapsed_time,
+                     'sampling took %.3fs out of %.3fs'
+                     % (sampler.sampling_time, sampler.elapsed_time))
+
+
+    def test_interval_grows_when_over_budget(self):
+        sampler = sampling_profiler.sampler(interval=0.001)
+        sample = sampler._sample
+        def slow_sample():
+            sample()
+            sampler.sampling_time += 0.001
+        sampler._sample = slow_sample
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+        self.assertEquals(sampler.interval, 0.002)
+
+
+    def test_exited_process(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        sampler = sampling_profiler.sampler(interval=0.05, pids=[pid])
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+        self.assertEquals(sampler.get_keyvals()['sampler_proc_rss_mb_p99'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
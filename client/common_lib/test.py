@@ -106,6 +106,31 @@ class base_test(object):
         print >> open(keyval_path, "a"), ""
 
 
+    def _merge_perf_keyval(self, perf_dict):
+        """
+        Add perf keyvals to the last keyval record written, rather than
+        writing a record of their own, which TKO would take for another
+        iteration.  Keyvals the record already has are left alone.
+        """
+        perf_dict = dict((key, value) for key, value in perf_dict.iteritems()
+                         if key not in self._keyvals[-1]['perf'])
+        self._keyvals[-1]['perf'].update(perf_dict)
+
+        # drop the blank line ending the record, and end it again after
+        # the new keyvals
+        keyval_path = os.path.join(self.resultsdir, "keyval")
+        keyval_file = open(keyval_path, "r+")
+        try:
+            keyval_file.seek(-1, 2)
+            keyval_file.truncate()
+        finally:
+            keyval_file.close()
+        utils.write_keyval(self.resultsdir,
+                           self._append_type_to_keys(perf_dict, "perf"),
+                           type_tag="perf")
+        print >> open(keyval_path, "a"), ""
+
+
     def analyze_perf_constraints(self, constraints):
         if not self._new_keyval:
             return
@@ -194,21 +219,33 @@ class base_test(object):
         for hook in self.before_iteration_hooks:
             hook(self)
 
-        if profile_only:
-            if not self.job.profilers.present():
-                self.job.record('WARN', None, None, 'No profilers have been '
-                                'added but profile_only is set - nothing '
-                                'will be run')
-            self.run_once_profiling(postprocess_profiled_run, *args, **dargs)
-        else:
-            self.before_run_once()
-            self.run_once(*args, **dargs)
-            self.after_run_once()
+        keyvals_written = len(self._keyvals)
+        self.job.profilers.start_sampling(self)
+        try:
+            if profile_only:
+                if not self.job.profilers.present():
+                    self.job.record('WARN', None, None, 'No profilers have '
+                                    'been added but profile_only is set - '
+                                    'nothing will be run')
+                self.run_once_profiling(postprocess_profiled_run, *args,
+                                        **dargs)
+            else:
+                self.before_run_once()
+                self.run_once(*args, **dargs)
+                self.after_run_once()
+        finally:
+            sampler_keyvals = self.job.profilers.stop_sampling(self)
 
         for hook in self.after_iteration_hooks:
             hook(self)
 
         self.postprocess_iteration()
+        # written along with the last keyvals of the iteration
+        if sampler_keyvals:
+            if len(self._keyvals) > keyvals_written:
+                self._merge_perf_keyval(sampler_keyvals)
+            else:
+                self.write_perf_keyval(sampler_keyvals)
         self.analyze_perf_constraints(constraints)
 
 
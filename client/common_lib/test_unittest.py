@@ -4,7 +4,7 @@
 
 __author__ = 'gps@google.com (Gregory P. Smith)'
 
-import unittest
+import os, shutil, tempfile, unittest
 from cStringIO import StringIO
 import common
 from autotest_lib.client.common_lib import error, test
@@ -21,10 +21,15 @@ class TestTestCase(unittest.TestCase):
                     return False
                 def present(self):
                     return True
+                def start_sampling(self, test):
+                    pass
+                def stop_sampling(self, test):
+                    return {}
             self.job = MockJob()
             self.job.default_profile_only = False
             self.job.profilers = MockProfilerManager()
             self._new_keyval = False
+            self._keyvals = []
             self.iteration = 0
             self.before_iteration_hooks = []
             self.after_iteration_hooks = []
@@ -40,6 +45,66 @@ class TestTestCase(unittest.TestCase):
 
 
 
+class Test_base_test_keyvals(TestTestCase):
+    def setUp(self):
+        TestTestCase.setUp(self)
+        self.test.resultsdir = tempfile.mkdtemp()
+        self.test.failed_constraints = []
+
+
+    def tearDown(self):
+        TestTestCase.tearDown(self)
+        shutil.rmtree(self.test.resultsdir)
+
+
+    def _read_keyval(self):
+        return open(os.path.join(self.test.resultsdir, 'keyval')).read()
+
+
+    def _run_iteration(self, run_once, postprocess_iteration):
+        self.god.stub_function(self.test, 'drop_caches_between_iterations')
+        self.god.stub_with(self.test, 'run_once', run_once)
+        self.god.stub_with(self.test, 'postprocess_iteration',
+                           postprocess_iteration)
+        self.god.stub_function(self.test.job.profilers, 'stop_sampling')
+        self.test.drop_caches_between_iterations.expect_call()
+        self.test.job.profilers.stop_sampling.expect_call(
+                self.test).and_return({'sampler_samples': 2, 'speed': 0})
+        self.test._call_run_once([], False, None, (), {})
+        self.god.check_playback()
+
+
+    def _no_keyvals(self):
+        pass
+
+
+    def test_sampler_keyvals_with_run_once_keyvals(self):
+        def run_once():
+            self.test.write_attr_keyval({'mode': 'fast'})
+            self.test.write_perf_keyval({'speed': 10})
+        self._run_iteration(run_once, self._no_keyvals)
+        # merged into the last record, so TKO sees a single iteration
+        self.assertEquals(self._read_keyval(),
+                          'mode{attr}=fast\n\n'
+                          'speed{perf}=10\nsampler_samples{perf}=2\n\n')
+        self.assertEquals(self.test._keyvals[-1]['perf'],
+                          {'speed': 10, 'sampler_samples': 2})
+
+
+    def test_sampler_keyvals_with_postprocess_keyvals(self):
+        def postprocess_iteration():
+            self.test.write_perf_keyval({'speed': 11})
+        self._run_iteration(self._no_keyvals, postprocess_iteration)
+        self.assertEquals(self._read_keyval(),
+                          'speed{perf}=11\nsampler_samples{perf}=2\n\n')
+
+
+    def test_sampler_keyvals_without_keyvals(self):
+        self._run_iteration(self._no_keyvals, self._no_keyvals)
+        self.assertEquals(self._read_keyval(),
+                          'sampler_samples{perf}=2\nspeed{perf}=0\n\n')
+
+
 class Test_base_test_execute(TestTestCase):
     # Test the various behaviors of the base_test.execute() method.
     def setUp(self):
@@ -71,6 +136,27 @@ class Test_base_test_execute(TestTestCase):
         self.god.check_playback()
 
 
+    def test_call_run_once_sampler_keyvals(self):
+        self.god.stub_function(self.test, 'drop_caches_between_iterations')
+        self.god.stub_function(self.test, 'run_once')
+        self.god.stub_function(self.test, 'postprocess_iteration')
+        self.god.stub_function(self.test, 'write_iteration_keyval')
+        self.god.stub_function(self.test, 'analyze_perf_constraints')
+        self.god.stub_function(self.test.job.profilers, 'stop_sampling')
+
+        # keyvals of the sampler are written if the iteration writes none
+        self.test.drop_caches_between_iterations.expect_call()
+        self.test.run_once.expect_call()
+        self.test.job.profilers.stop_sampling.expect_call(
+                self.test).and_return({'sampler_samples': 2})
+        self.test.postprocess_iteration.expect_call()
+        self.test.write_iteration_keyval.expect_call({},
+                                                     {'sampler_samples': 2})
+        self.test.analyze_perf_constraints.expect_call([])
+        self.test._call_run_once([], False, None, (), {})
+        self.god.check_playback()
+
+
     def _expect_call_run_once(self):
         self.test._call_run_once.expect_call((), False, None, (), {})
 
@@ -7,7 +7,7 @@ Script used to parse the test results and generate an HTML report.
 @author: Dror Russo (drusso@redhat.com)
 """
 
-import os, sys, re, getopt, time, datetime, commands
+import os, sys, re, getopt, time, datetime, glob, threading, cPickle
 import common
 
 
@@ -1383,12 +1383,20 @@ function processList(ul) {
 stimelist=[]
 
 
-def make_html_file(metadata, results, tag, host, output_file_name, dirname):
+def make_html_file(metadata, results, tag, host, output_file_name, dirname,
+                   refresh=None):
+    if refresh:
+        # reload the report in the browser as it's refreshed
+        refresh_meta = ('<meta http-equiv="refresh" content="%d">' %
+                        refresh)
+    else:
+        refresh_meta = ''
     html_prefix="""
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
 <head>
 <title>KVM Autotest Results</title>
+%s
 <style type="text/css">
 %s
 </style>
@@ -1405,11 +1413,13 @@ return true;
 </script>
 </head>
 <body>
-"""%(format_css, table_js, maketree_js)
+"""%(refresh_meta, format_css, table_js, maketree_js)
 
 
     if output_file_name:
-        output = open(output_file_name, "w")
+        # write a new file and replace the old report with it at the end,
+        # so it's never seen half written
+        output = open(output_file_name + ".tmp", "w")
     else:   #if no output file defined, print html file to console
         output = sys.stdout
     # create html page
@@ -1526,6 +1536,7 @@ id="t1" class="stats table-autosort:4 table-autofilter table-stripeclass:alterna
     print >> output, "</body></html>"
     if output_file_name:
         output.close()
+        os.rename(output_file_name + ".tmp", output_file_name)
 
 
 def parse_result(dirname,line):
@@ -1559,8 +1570,6 @@ def parse_result(dirname,line):
         result['testcase'] = m1[0][1]
         result['title'] = str(tag)
         result['status'] = parts[1]
-        if result['status'] != 'GOOD':
-            result['log'] = get_exec_log(dirname,tag)
         if len(stimelist)>0:
             pair = parts[4].split('=')
             etime = int(pair[1])
@@ -1571,25 +1580,24 @@ def parse_result(dirname,line):
     return None
 
 
+def get_exec_log_files(resdir, tag):
+    return [os.path.join(resdir, tag, 'debug', 'stderr'),
+            os.path.join(resdir, tag, 'debug', 'stdout'),
+            os.path.join(resdir, tag, 'status'),
+            os.path.join(resdir, tag, 'sysinfo', 'dmesg')]
+
+
 def get_exec_log(resdir, tag):
-    stdout_file = os.path.join(resdir,tag) + '/debug/stdout'
-    stderr_file = os.path.join(resdir,tag) + '/debug/stderr'
-    status_file = os.path.join(resdir,tag) + '/status'
-    dmesg_file = os.path.join(resdir,tag) + '/sysinfo/dmesg'
-    log = ''
-    log += '<br><b>STDERR:</b><br>'
-    log += get_info_file(stderr_file)
-    log += '<br><b>STDOUT:</b><br>'
-    log += get_info_file(stdout_file)
-    log += '<br><b>STATUS:</b><br>'
-    log += get_info_file(status_file)
-    log += '<br><b>DMESG:</b><br>'
-    log += get_info_file(dmesg_file)
-    return log
+    log = []
+    for title, filename in zip(('STDERR', 'STDOUT', 'STATUS', 'DMESG'),
+                               get_exec_log_files(resdir, tag)):
+        log.append('<br><b>%s:</b><br>' % title)
+        log.append(get_info_file(filename))
+    return ''.join(log)
 
 
 def get_info_file(filename):
-    data=''
+    data=[]
     errors = re.compile(r"\b(error|fail|failed)\b", re.IGNORECASE)
     if os.path.isfile(filename):
         f = open('%s' % filename, "r")
@@ -1598,16 +1606,112 @@ def get_info_file(filename):
         rx = re.compile('(\'|\")')
         for line in lines:
             new_line = rx.sub('',line)
-            errors_found = errors.findall(new_line)
-            if len(errors_found)>0:
-                data += '<font color=red>%s</font><br>'%str(new_line)
+            if errors.search(new_line):
+                data.append('<font color=red>%s</font><br>'%str(new_line))
             else:
-                data += '%s<br>'%str(new_line)
+                data.append('%s<br>'%str(new_line))
         if not data:
-            data = 'No Information Found.<br>'
+            data = ['No Information Found.<br>']
     else:
-        data = 'File not found.<br>'
-    return data
+        data = ['File not found.<br>']
+    return ''.join(data)
+
+
+class result_cache(object):
+    """
+    Cache of the logs of the tests of a results directory, kept in a file
+    there and keyed by the modification times of the files they're read
+    from, so that regenerating the report reads only the tests which
+    changed since.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            self.entries = cPickle.load(open(filename, "rb"))
+        except Exception:
+            self.entries = {}
+
+
+    def get(self, key, filenames, func, *args):
+        """
+        Return the cached value of key if none of filenames changed since it
+        was cached, or else func(*args), caching it.
+        """
+        signature = []
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+                signature.append((st.st_mtime, st.st_size))
+            except OSError:
+                signature.append(None)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+        finally:
+            self.lock.release()
+        if entry and entry[0] == signature:
+            return entry[1]
+        value = func(*args)
+        self.lock.acquire()
+        try:
+            self.entries[key] = (signature, value)
+            self.dirty = True
+        finally:
+            self.lock.release()
+        return value
+
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            f = open(self.filename + ".tmp", "wb")
+            try:
+                cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(self.filename + ".tmp", self.filename)
+            self.dirty = False
+        except (IOError, OSError), e:
+            print >> sys.stderr, 'Could not save cache %s: %s' % (
+                    self.filename, e)
+
+
+def run_parallel(func, args_list, threads):
+    """
+    Call func with each tuple of arguments in args_list, in a number of
+    threads.
+
+    @return: The list of results, in the order of args_list.
+    """
+    results = [None] * len(args_list)
+    pending = range(len(args_list))
+    lock = threading.Lock()
+    errors = []
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending or errors:
+                    return
+                i = pending.pop()
+            finally:
+                lock.release()
+            try:
+                results[i] = func(*args_list[i])
+            except Exception:
+                errors.append(sys.exc_info())
+    workers = [threading.Thread(target=worker)
+               for i in range(min(threads, len(args_list)))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
 
 
 
@@ -1618,6 +1722,9 @@ def usage():
           '/usr/local/autotest/client/results/default -f /tmp/myreport.html)'
     print 'add "-R" for an html report with relative-paths (relative '\
           'to results directory)'
+    print 'add "-j <threads>" to read the logs of that many tests at once'
+    print 'add "-l <seconds>" to refresh the report periodically until the '\
+          'job ends (requires -f)'
     print ''
     sys.exit(1)
 
@@ -1627,16 +1734,17 @@ def get_keyval_value(result_dir, key):
     Return the value of the first appearance of key in any keyval file in
     result_dir. If no appropriate line is found, return 'Unknown'.
     """
-    keyval_pattern = os.path.join(result_dir, "kvm.*", "keyval")
-    keyval_lines = commands.getoutput(r"grep -h '\b%s\b.*=' %s"
-                                      % (key, keyval_pattern))
-    if not keyval_lines:
-        return "Unknown"
-    keyval_line = keyval_lines.splitlines()[0]
-    if key in keyval_line and "=" in keyval_line:
-        return keyval_line.split("=")[1].strip()
-    else:
-        return "Unknown"
+    keyval_files = glob.glob(os.path.join(result_dir, "kvm.*", "keyval"))
+    keyval_files.sort()
+    for keyval_file in keyval_files:
+        try:
+            lines = open(keyval_file).readlines()
+        except IOError:
+            continue
+        for line in lines:
+            if "=" in line and line.split("=")[0].strip() == key:
+                return line.split("=", 1)[1].strip()
+    return "Unknown"
 
 
 def get_kvm_version(result_dir):
@@ -1651,12 +1759,87 @@ def get_kvm_version(result_dir):
     return "Kernel: %s<br>Userspace: %s" % (kvm_version, kvm_userspace_version)
 
 
+def make_report(dirname, output_file_name, html_path, threads=8,
+                refresh=None):
+    """
+    Parse the results of a job and write its HTML report.
+
+    @param dirname: The results directory of the job.
+    @param output_file_name: The report file name, or None for stdout.
+    @param html_path: The path of the results directory used in links.
+    @param threads: Number of tests whose logs are read at once.
+    @param refresh: If not None, make browsers reload the report every
+            refresh seconds.
+    """
+    global stimelist
+    stimelist = []
+    res_dir = os.path.abspath(dirname)
+    tag = res_dir
+    status_file_name = dirname + '/status'
+    sysinfo_dir = dirname + '/sysinfo'
+    host = get_info_file('%s/hostname' % sysinfo_dir)
+    rx=re.compile('^\s+[END|START].*$')
+    # create the results set dict
+    results_data=[]
+    if os.path.exists(status_file_name):
+        f = open(status_file_name, "r")
+        lines=f.readlines()
+        f.close()
+        for line in lines:
+            if rx.match(line):
+                result_dict = parse_result(dirname, line)
+                if result_dict:
+                    results_data.append(result_dict)
+    # read the logs of the failed tests, unless cached
+    cache = result_cache(os.path.join(dirname, '.html_report_cache'))
+    failed = [res for res in results_data if res['status'] != 'GOOD']
+    logs = run_parallel(cache.get,
+                        [(res['title'],
+                          get_exec_log_files(dirname, res['title']),
+                          get_exec_log, dirname, res['title'])
+                         for res in failed], threads)
+    for res, log in zip(failed, logs):
+        res['log'] = log
+    cache.save()
+    # create the meta info dict
+    metalist = {
+                'uname': get_info_file('%s/uname' % sysinfo_dir),
+                'cpuinfo':get_info_file('%s/cpuinfo' % sysinfo_dir),
+                'meminfo':get_info_file('%s/meminfo' % sysinfo_dir),
+                'df':get_info_file('%s/df' % sysinfo_dir),
+                'modules':get_info_file('%s/modules' % sysinfo_dir),
+                'gcc':get_info_file('%s/gcc_--version' % sysinfo_dir),
+                'dmidecode':get_info_file('%s/dmidecode' % sysinfo_dir),
+                'dmesg':get_info_file('%s/dmesg' % sysinfo_dir),
+                'kvmver':get_kvm_version(dirname)
+    }
+
+    make_html_file(metalist, results_data, tag, host, output_file_name,
+                   html_path, refresh)
+
+
+def job_finished(dirname):
+    """
+    Return True if the job writing to a results directory has ended.
+    """
+    try:
+        lines = open(os.path.join(dirname, 'status')).readlines()
+    except IOError:
+        return False
+    for line in lines:
+        if line.startswith('END'):
+            return True
+    return False
+
+
 def main(argv):
     dirname = None
     output_file_name = None
     relative_path = False
+    threads = 8
+    refresh = None
     try:
-        opts, args = getopt.getopt(argv, "r:f:h:R", ['help'])
+        opts, args = getopt.getopt(argv, "r:f:h:Rj:l:", ['help'])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -1670,6 +1853,10 @@ def main(argv):
             output_file_name =  arg
         elif opt == '-R':
             relative_path = True
+        elif opt == '-j':
+            threads = int(arg)
+        elif opt == '-l':
+            refresh = int(arg)
         else:
             usage()
             sys.exit(1)
@@ -1679,41 +1866,22 @@ def main(argv):
     if relative_path:
         html_path = ''
 
+    if refresh and not output_file_name:
+        usage()
+        sys.exit(1)
+
     if dirname:
         if os.path.isdir(dirname): # TBD: replace it with a validation of
                                    # autotest result dir
-            res_dir = os.path.abspath(dirname)
-            tag = res_dir
-            status_file_name = dirname + '/status'
-            sysinfo_dir = dirname + '/sysinfo'
-            host = get_info_file('%s/hostname' % sysinfo_dir)
-            rx=re.compile('^\s+[END|START].*$')
-            # create the results set dict
-            results_data=[]
-            if os.path.exists(status_file_name):
-                f = open(status_file_name, "r")
-                lines=f.readlines()
-                f.close()
-                for line in lines:
-                    if rx.match(line):
-                        result_dict = parse_result(dirname, line)
-                        if result_dict:
-                            results_data.append(result_dict)
-            # create the meta info dict
-            metalist = {
-                        'uname': get_info_file('%s/uname' % sysinfo_dir),
-                        'cpuinfo':get_info_file('%s/cpuinfo' % sysinfo_dir),
-                        'meminfo':get_info_file('%s/meminfo' % sysinfo_dir),
-                        'df':get_info_file('%s/df' % sysinfo_dir),
-                        'modules':get_info_file('%s/modules' % sysinfo_dir),
-                        'gcc':get_info_file('%s/gcc_--version' % sysinfo_dir),
-                        'dmidecode':get_info_file('%s/dmidecode' % sysinfo_dir),
-                        'dmesg':get_info_file('%s/dmesg' % sysinfo_dir),
-                        'kvmver':get_kvm_version(dirname)
-            }
-
-            make_html_file(metalist, results_data, tag, host, output_file_name,
-                           html_path)
+            while True:
+                make_report(dirname, output_file_name, html_path, threads,
+                            refresh)
+                if not refresh or job_finished(dirname):
+                    break
+                time.sleep(refresh)
+            # the final report doesn't reload itself
+            if refresh:
+                make_report(dirname, output_file_name, html_path, threads)
             sys.exit(0)
         else:
             print 'Invalid result directory <%s>' % dirname
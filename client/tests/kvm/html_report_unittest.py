@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, time, unittest
+import common
+import html_report
+
+
+STATUS = """START\t----\t----\ttimestamp=1000\tlocaltime=Jan 01 00:00:00
+\tSTART\tkvm.good\tkvm.good\ttimestamp=1000\tlocaltime=Jan 01 00:00:00
+\tEND GOOD\tkvm.good\tkvm.good\ttimestamp=1010\tlocaltime=Jan 01 00:00:10
+\tSTART\tkvm.bad\tkvm.bad\ttimestamp=1010\tlocaltime=Jan 01 00:00:10
+\tEND FAIL\tkvm.bad\tkvm.bad\ttimestamp=1020\tlocaltime=Jan 01 00:00:20
+"""
+
+
+class test_html_report(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.resdir = os.path.join(self.tmpdir, "results")
+        for test in ("kvm.good", "kvm.bad"):
+            os.makedirs(os.path.join(self.resdir, test, "debug"))
+            open(os.path.join(self.resdir, test, "keyval"), "w").write(
+                    "kvm_version=2.6.32\nkvm_userspace_version=0.12.3\n")
+        self.stderr = os.path.join(self.resdir, "kvm.bad", "debug", "stderr")
+        open(self.stderr, "w").write("the guest failed to boot\n")
+        open(os.path.join(self.resdir, "status"), "w").write(STATUS)
+        self.output = os.path.join(self.tmpdir, "report.html")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_get_info_file(self):
+        self.assertEquals(html_report.get_info_file(self.stderr),
+                          "<font color=red>the guest failed to boot\n"
+                          "</font><br>")
+        self.assertEquals(html_report.get_info_file(self.stderr + ".none"),
+                          "File not found.<br>")
+
+
+    def test_get_keyval_value(self):
+        self.assertEquals(html_report.get_keyval_value(self.resdir,
+                                                       "kvm_version"),
+                          "2.6.32")
+        self.assertEquals(html_report.get_keyval_value(self.resdir, "kvm"),
+                          "Unknown")
+
+
+    def test_run_parallel(self):
+        self.assertEquals(html_report.run_parallel(pow, [(i, 2)
+                                                         for i in range(50)],
+                                                   4),
+                          [i * i for i in range(50)])
+        self.assertRaises(ZeroDivisionError, html_report.run_parallel,
+                          divmod, [(1, 0)], 4)
+
+
+    def test_make_report(self):
+        html_report.make_report(self.resdir, self.output, "", refresh=10)
+        report = open(self.output).read()
+        self.assert_('http-equiv="refresh" content="10"' in report)
+        self.assert_("the guest failed to boot" in report)
+        self.assertFalse(os.path.exists(self.output + ".tmp"))
+        self.assert_(html_report.job_finished(self.resdir) is False)
+
+        # a cached log is reused until its files change
+        cache = html_report.result_cache(
+                os.path.join(self.resdir, ".html_report_cache"))
+        self.assertEquals(cache.entries.keys(), ["kvm.bad"])
+        old_get_exec_log = html_report.get_exec_log
+        html_report.get_exec_log = None
+        try:
+            html_report.make_report(self.resdir, self.output, "")
+        finally:
+            html_report.get_exec_log = old_get_exec_log
+        open(self.stderr, "w").write("the guest crashed\n")
+        os.utime(self.stderr, (time.time() + 10, time.time() + 10))
+        html_report.make_report(self.resdir, self.output, "")
+        report = open(self.output).read()
+        self.assert_("the guest crashed" in report)
+        self.assertFalse("http-equiv" in report)
+
+
+    def test_job_finished(self):
+        open(os.path.join(self.resdir, "status"), "a").write(
+                "END GOOD\t----\t----\ttimestamp=1020\n")
+        self.assert_(html_report.job_finished(self.resdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
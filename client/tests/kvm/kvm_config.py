@@ -8,10 +8,15 @@ KVM configuration file utility functions.
 import logging, re, os, sys, optparse, array, traceback, cPickle
 import common
 import kvm_utils
-from autotest_lib.client.common_lib import error
+from autotest_lib.client.common_lib import error, utils
 from autotest_lib.client.common_lib import logging_config, logging_manager
 
 
+# Bump this whenever the format of the parse results changes, to invalidate
+# the results cached by fork_and_parse()
+_CACHE_VERSION = 1
+
+
 class config:
     """
     Parse an input file or string that follows the KVM Test Config File format
@@ -32,6 +37,7 @@ class config:
         self.object_cache = []
         self.object_cache_indices = {}
         self.regex_cache = {}
+        self.content_cache = {}
         self.filename = filename
         self.debug = debug
         if filename:
@@ -60,7 +66,7 @@ class config:
         self.list = self.parse(configreader(str), self.list)
 
 
-    def fork_and_parse(self, filename=None, str=None):
+    def fork_and_parse(self, filename=None, str=None, cache_dir=None):
         """
         Parse a file and/or a string in a separate process to save memory.
 
@@ -71,19 +77,36 @@ class config:
         doing the parsing in a forked process and then terminating it, freeing
         any unneeded memory.
 
+        If cache_dir is given, the results are also saved there, keyed by
+        the contents of the file, of all the files it includes and of the
+        string, and later calls parsing the same contents load them instead
+        of parsing again.
+
         Note: if an exception is raised during parsing, its information will be
         printed, and the resulting list will be empty.  The exception will not
         be raised in the process calling this function.
 
         @param filename: Path of file to parse (optional).
         @param str: String to parse (optional).
-        """
+        @param cache_dir: Directory where parse results are cached
+                (optional).
+        """
+        cache_filename = None
+        if cache_dir:
+            cache_filename = os.path.join(cache_dir, "%s.pickle" %
+                                          self._get_cache_key(filename, str))
+            if self._load_cache(cache_filename):
+                logging.debug("Using cached parse results of %s (%s)",
+                              filename, cache_filename)
+                return
+
         r, w = os.pipe()
         r, w = os.fdopen(r, "r"), os.fdopen(w, "w")
         pid = os.fork()
         if not pid:
             # Child process
             r.close()
+            ok = True
             try:
                 if filename:
                     self.parse_file(filename)
@@ -92,38 +115,160 @@ class config:
             except:
                 traceback.print_exc()
                 self.list = []
+                ok = False
             # Convert the arrays to strings before pickling because at least
             # some Python versions can't pickle/unpickle arrays
             l = [a.tostring() for a in self.list]
-            cPickle.dump((l, self.object_cache), w, -1)
+            cPickle.dump((l, self.object_cache, ok), w, -1)
             w.close()
             os._exit(0)
         else:
             # Parent process
             w.close()
-            (l, self.object_cache) = cPickle.load(r)
+            results = cPickle.load(r)
             r.close()
             os.waitpid(pid, 0)
-            self.list = []
-            for s in l:
-                a = array.array("H")
-                a.fromstring(s)
-                self.list.append(a)
+            (l, object_cache, ok) = results
+            self._set_results(l, object_cache)
+            if cache_filename and ok:
+                self._save_cache(cache_filename, results[:2])
+
+
+    def _get_cache_key(self, filename, str):
+        """
+        Return a hash of everything the results of parsing filename and str
+        depend on: the files read (filename and all the files it includes,
+        directly or not), str and the dicts parsed so far.
+        """
+        hash = utils.hash("sha1")
+        hash.update("%d\0" % _CACHE_VERSION)
+        hash.update(cPickle.dumps(([a.tostring() for a in self.list],
+                                   self.object_cache), -1))
+        # Includes are relative to the last file parsed
+        if filename:
+            dirname = os.path.dirname(filename)
+        elif self.filename:
+            dirname = os.path.dirname(self.filename)
+        else:
+            dirname = None
+        pending = []
+        if filename:
+            pending.append(filename)
+        if str:
+            hash.update("string\0%s\0" % str)
+            pending += _get_includes(str, dirname)
+        # Hashing every file that may be included is enough, even if the
+        # include ends up filtered out
+        seen = set()
+        while pending:
+            path = pending.pop(0)
+            if path in seen:
+                continue
+            seen.add(path)
+            if os.path.exists(path):
+                contents = open(path).read()
+                hash.update("file\0%s\0%d\0" % (path, len(contents)))
+                hash.update(contents)
+                pending += _get_includes(contents, dirname)
+            else:
+                hash.update("missing\0%s\0" % path)
+        return hash.hexdigest()
 
 
-    def get_generator(self):
+    def _set_results(self, l, object_cache):
+        self.object_cache = object_cache
+        self.object_cache_indices = dict((s, i) for i, s in
+                                         enumerate(object_cache))
+        self.content_cache = {}
+        self.list = []
+        for s in l:
+            a = array.array("H")
+            a.fromstring(s)
+            self.list.append(a)
+
+
+    def _load_cache(self, cache_filename):
+        """
+        Load cached parse results, if they exist.
+
+        @return: True if the results were loaded.
+        """
+        try:
+            f = open(cache_filename, "rb")
+        except IOError:
+            return False
+        try:
+            try:
+                (l, object_cache) = cPickle.load(f)
+            except Exception, e:
+                logging.warning("Ignoring invalid config cache file %s: %s",
+                                cache_filename, e)
+                return False
+        finally:
+            f.close()
+        self._set_results(l, object_cache)
+        return True
+
+
+    def _save_cache(self, cache_filename, results):
+        """
+        Save parse results atomically, so that concurrent jobs never load
+        partial results.  Failing to save them isn't an error.
+        """
+        temp_filename = "%s.%d" % (cache_filename, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache_filename)):
+                os.makedirs(os.path.dirname(cache_filename))
+            f = open(temp_filename, "wb")
+            try:
+                cPickle.dump(results, f, -1)
+            finally:
+                f.close()
+            os.rename(temp_filename, cache_filename)
+        except (IOError, OSError), e:
+            logging.warning("Could not save config cache file %s: %s",
+                            cache_filename, e)
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+
+
+    def get_generator(self, only=None, no=None):
         """
         Generate dictionaries from the code parsed so far.  This should
         probably be called after parsing something.
 
+        The only and no filters work like the 'only' and 'no' statements of
+        the config file: they are applied to the dict names before the dicts
+        are generated, so the dicts filtered out cost next to nothing.
+
+        @param only: List of filters; if given, only the dicts whose names
+                match one of them are generated.
+        @param no: List of filters; the dicts whose names match one of them
+                are not generated.
         @return: A dict generator.
         """
+        only = map(self._get_filter_regex, only or [])
+        no = map(self._get_filter_regex, no or [])
         for a in self.list:
-            name, shortname, depend, content = _array_get_all(a,
-                                                              self.object_cache)
-            dict = {"name": name, "shortname": shortname, "depend": depend}
-            self._apply_content_to_dict(dict, content)
-            yield dict
+            name = _array_get_name(a, self.object_cache)
+            if only:
+                for exp in only:
+                    if exp.search(name):
+                        break
+                else:
+                    continue
+            for exp in no:
+                if exp.search(name):
+                    break
+            else:
+                name, shortname, depend = _array_get_header(a,
+                                                            self.object_cache)
+                dict = {"name": name, "shortname": shortname,
+                        "depend": depend}
+                for index in a[a[3]:]:
+                    self._apply_operations_to_dict(dict,
+                                                   self._get_operations(index))
+                yield dict
 
 
     def get_list(self):
@@ -436,6 +581,39 @@ class config:
                 _array_append_to_content(a, str_index)
 
 
+    def _get_operations(self, index):
+        """
+        Return the assignment operations of a content string in the object
+        cache, parsed once and then kept in the content cache.
+
+        @param index: Index of the content string in the object cache.
+        @return: A list of (filters, operator function, key, value) tuples,
+                where filters is a list of compiled filter regexes.
+        """
+        try:
+            return self.content_cache[index]
+        except KeyError:
+            operations = _parse_content(self.object_cache[index],
+                                        self._get_filter_regex)
+            self.content_cache[index] = operations
+            return operations
+
+
+    def _apply_operations_to_dict(self, dict, operations):
+        """
+        Apply parsed assignment operations (see _get_operations) to a dict.
+
+        @param dict: Dictionary to operate on.  Must have 'name' key.
+        @param operations: List of parsed assignment operations.
+        """
+        for filters, op, key, value in operations:
+            for exp in filters:
+                if not exp.search(dict["name"]):
+                    break
+            else:
+                op(dict, key, value)
+
+
     def _apply_content_to_dict(self, dict, content):
         """
         Apply the operations in content (config code containing assignment
@@ -444,29 +622,53 @@ class config:
         @param dict: Dictionary to operate on.  Must have 'name' key.
         @param content: String containing assignment operations.
         """
-        for line in content.splitlines():
-            op_found = None
-            op_pos = len(line)
-            for op in ops:
-                pos = line.find(op)
-                if pos >= 0 and pos < op_pos:
-                    op_found = op
-                    op_pos = pos
-            if not op_found:
-                continue
-            (left, value) = map(str.strip, line.split(op_found, 1))
-            if value and ((value[0] == '"' and value[-1] == '"') or
-                          (value[0] == "'" and value[-1] == "'")):
-                value = value[1:-1]
-            filters_and_key = map(str.strip, left.split(":"))
-            filters = filters_and_key[:-1]
-            key = filters_and_key[-1]
-            for filter in filters:
-                exp = self._get_filter_regex(filter)
-                if not exp.search(dict["name"]):
-                    break
-            else:
-                ops[op_found](dict, key, value)
+        self._apply_operations_to_dict(
+                dict, _parse_content(content, self._get_filter_regex))
+
+
+def _parse_content(content, get_filter_regex):
+    """
+    Parse config code containing assignment operations.
+
+    @param content: String containing assignment operations.
+    @param get_filter_regex: Function returning the regex of a filter.
+    @return: A list of (filters, operator function, key, value) tuples.
+    """
+    operations = []
+    for line in content.splitlines():
+        op_found = None
+        op_pos = len(line)
+        for op in ops:
+            pos = line.find(op)
+            if pos >= 0 and pos < op_pos:
+                op_found = op
+                op_pos = pos
+        if not op_found:
+            continue
+        (left, value) = map(str.strip, line.split(op_found, 1))
+        if value and ((value[0] == '"' and value[-1] == '"') or
+                      (value[0] == "'" and value[-1] == "'")):
+            value = value[1:-1]
+        filters_and_key = map(str.strip, left.split(":"))
+        filters = map(get_filter_regex, filters_and_key[:-1])
+        key = filters_and_key[-1]
+        operations.append((filters, ops[op_found], key, value))
+    return operations
+
+
+_include_regex = re.compile(r"^\s*include\s+(\S+)", re.MULTILINE)
+
+
+def _get_includes(str, dirname):
+    """
+    Return the paths of the files a config string may include.
+
+    @param str: Config string.
+    @param dirname: Directory the included files are relative to.
+    """
+    if not dirname:
+        return []
+    return [os.path.join(dirname, f) for f in _include_regex.findall(str)]
 
 
 # Assignment operators
@@ -652,25 +854,39 @@ def _array_get_name(a, object_cache):
     return ".".join([object_cache[i] for i in a[a[0]:a[1]]])
 
 
-def _array_get_all(a, object_cache):
+def _array_get_header(a, object_cache):
     """
-    Return a 4-tuple containing all the data stored in a given array, in a
-    format that is easy to turn into an actual dictionary.
+    Return the name, shortname and dependencies of a dictionary represented
+    by a given array.
 
     @param a: Array representing a dictionary.
     @param object_cache: A list of strings referenced by elements in the array.
-    @return: A 4-tuple: (name, shortname, depend, content), in which all
-        members are strings except depend which is a list of strings.
+    @return: A 3-tuple: (name, shortname, depend), in which name and
+        shortname are strings and depend is a list of strings.
     """
     name = ".".join([object_cache[i] for i in a[a[0]:a[1]]])
     shortname = ".".join([object_cache[i] for i in a[a[1]:a[2]]])
-    content = "".join([object_cache[i] for i in a[a[3]:]])
     depend = []
     prefix = ""
     for n, d in zip(a[a[0]:a[1]], a[a[2]:a[3]]):
         for dep in object_cache[d].split():
             depend.append(prefix + dep)
         prefix += object_cache[n] + "."
+    return name, shortname, depend
+
+
+def _array_get_all(a, object_cache):
+    """
+    Return a 4-tuple containing all the data stored in a given array, in a
+    format that is easy to turn into an actual dictionary.
+
+    @param a: Array representing a dictionary.
+    @param object_cache: A list of strings referenced by elements in the array.
+    @return: A 4-tuple: (name, shortname, depend, content), in which all
+        members are strings except depend which is a list of strings.
+    """
+    name, shortname, depend = _array_get_header(a, object_cache)
+    content = "".join([object_cache[i] for i in a[a[3]:]])
     return name, shortname, depend, content
 
 
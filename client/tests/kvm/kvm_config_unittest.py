@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, unittest
+import common
+import kvm_config
+
+
+BASE_CFG = """
+variants:
+    - qcow2:
+        image_format = qcow2
+    - raw:
+        image_format = raw
+variants:
+    - smp1:
+        smp = 1
+    - smp2:
+        smp = 2
+        qcow2: extra = yes
+include extra.cfg
+"""
+
+EXTRA_CFG = """
+mem = 512
+"""
+
+
+class test_config(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.filename = os.path.join(self.tmpdir, "base.cfg")
+        open(self.filename, "w").write(BASE_CFG)
+        open(os.path.join(self.tmpdir, "extra.cfg"), "w").write(EXTRA_CFG)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _parse(self, str=None):
+        cfg = kvm_config.config(debug=False)
+        cfg.fork_and_parse(self.filename, str, cache_dir=self.cache_dir)
+        return cfg.get_list()
+
+
+    def test_get_generator(self):
+        dicts = kvm_config.config(self.filename, debug=False).get_list()
+        self.assertEquals([d["name"] for d in dicts],
+                          ["smp1.qcow2", "smp1.raw", "smp2.qcow2", "smp2.raw"])
+        self.assertEquals(dicts[2]["extra"], "yes")
+        self.assertEquals(dicts[2]["mem"], "512")
+        self.assert_("extra" not in dicts[3])
+
+
+    def test_get_generator_filters(self):
+        cfg = kvm_config.config(self.filename, debug=False)
+        dicts = list(cfg.get_generator(only=["smp2"], no=["raw"]))
+        self.assertEquals([d["name"] for d in dicts], ["smp2.qcow2"])
+        self.assertEquals(dicts, [d for d in cfg.get_list()
+                                  if d["name"] == "smp2.qcow2"])
+
+
+    def test_cache(self):
+        dicts = self._parse("smp = 4")
+        self.assertEquals(len(os.listdir(self.cache_dir)), 1)
+        # the cached results are used instead of parsing again
+        parse = kvm_config.config.parse
+        kvm_config.config.parse = None
+        try:
+            self.assertEquals(self._parse("smp = 4"), dicts)
+        finally:
+            kvm_config.config.parse = parse
+        self.assertEquals(dicts[0]["smp"], "4")
+
+
+    def test_cache_key(self):
+        self._parse()
+        self._parse("smp = 4")
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+        # changing an included file invalidates the cached results
+        open(os.path.join(self.tmpdir, "extra.cfg"), "w").write("mem = 1024")
+        self.assertEquals(self._parse()[0]["mem"], "1024")
+        self.assertEquals(len(os.listdir(self.cache_dir)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+"""
+A pool of copy-on-write overlays of golden images.
+
+Tests which need a pristine installed guest don't have to install it again
+or copy its image: they run on a qcow2 overlay backed by the golden image,
+created in milliseconds and thrown away after the test.
+
+The golden images are registered with a hash of their contents, computed
+once and then trusted as long as the file isn't modified.  The overlays of a
+golden image live in a directory named after that hash, so that overlays
+of a golden image which changed since are never used, and are removed by
+collect_garbage().  A few spare overlays are created ahead of the tests that
+will need them, and claimed atomically, so concurrent jobs sharing a pool
+never get the same overlay.
+
+@copyright: Red Hat 2008-2011
+"""
+
+import os, time, logging, threading, cPickle, shutil
+from autotest_lib.client.common_lib import error, utils
+import kvm_utils, kvm_vm
+
+
+# Suffix of the spare overlays, waiting to be claimed by a test
+SPARE_SUFFIX = ".spare"
+
+
+def _hash_file(filename):
+    """
+    Return the sha1 of the contents of a file, like cd_hash.py does, reading
+    it in chunks big enough for disk images.
+    """
+    hash = utils.hash("sha1")
+    f = open(filename, "rb")
+    try:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            hash.update(data)
+    finally:
+        f.close()
+    return hash.hexdigest()
+
+
+class ImagePool(object):
+    """
+    A registry of golden images and of their overlays, in a directory.
+    """
+    def __init__(self, pool_dir, qemu_img_binary="qemu-img"):
+        """
+        @param pool_dir: Directory of the pool.
+        @param qemu_img_binary: Path of qemu-img.
+        """
+        self.pool_dir = pool_dir
+        self.qemu_img_binary = qemu_img_binary
+        self.registry_filename = os.path.join(pool_dir, "registry")
+        self._lock = threading.Lock()
+        if not os.path.isdir(pool_dir):
+            os.makedirs(pool_dir)
+
+
+    def _load_registry(self):
+        """
+        Return the registry: a dict mapping the paths of golden images to
+        (size, mtime, inode, hash) tuples.
+        """
+        try:
+            return cPickle.load(open(self.registry_filename, "rb"))
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return {}
+
+
+    def _save_registry(self, registry):
+        # Written atomically, other jobs may be reading it
+        temp_filename = "%s.%d.%s" % (self.registry_filename, os.getpid(),
+                                      kvm_utils.generate_random_string(4))
+        f = open(temp_filename, "wb")
+        try:
+            cPickle.dump(registry, f, -1)
+        finally:
+            f.close()
+        os.rename(temp_filename, self.registry_filename)
+
+
+    def register(self, golden):
+        """
+        Register a golden image, hashing it if it's new or was modified.
+
+        @param golden: Path of the golden image.
+        @return: The hash of its contents.
+        """
+        golden = os.path.abspath(golden)
+        st = os.stat(golden)
+        key = (st.st_size, st.st_mtime, st.st_ino)
+        self._lock.acquire()
+        try:
+            entry = self._load_registry().get(golden)
+        finally:
+            self._lock.release()
+        if entry and entry[:3] == key:
+            return entry[3]
+
+        logging.debug("Hashing golden image %s...", golden)
+        hash = _hash_file(golden)
+        self._lock.acquire()
+        try:
+            registry = self._load_registry()
+            registry[golden] = key + (hash,)
+            self._save_registry(registry)
+        finally:
+            self._lock.release()
+        return hash
+
+
+    def get_overlay_dir(self, golden, hash):
+        return os.path.join(self.pool_dir, "%s-%s" %
+                            (os.path.basename(golden), hash[:16]))
+
+
+    def _create_overlay(self, golden, filename):
+        """
+        Create a qcow2 overlay backed by a golden image.  The overlay appears
+        under filename only once it's complete.
+        """
+        temp_filename = "%s.tmp" % filename
+        try:
+            utils.system("%s create -f qcow2 -b %s %s" %
+                         (self.qemu_img_binary, os.path.abspath(golden),
+                          temp_filename))
+        except error.CmdError, e:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise error.TestError("Could not create overlay of %s: %s" %
+                                  (golden, e))
+        os.rename(temp_filename, filename)
+
+
+    def get_overlay(self, golden, name):
+        """
+        Return a new overlay of a golden image, taking a spare one if any.
+
+        @param golden: Path of the golden image.
+        @param name: A name identifying the user of the overlay.
+        @return: The path of the overlay (a .qcow2 file).
+        """
+        hash = self.register(golden)
+        overlay_dir = self.get_overlay_dir(golden, hash)
+        if not os.path.isdir(overlay_dir):
+            try:
+                os.makedirs(overlay_dir)
+            except OSError:
+                # created by another job in the meantime
+                pass
+        filename = os.path.join(overlay_dir, "%s-%s.qcow2" %
+                                (name, kvm_utils.generate_random_string(8)))
+        for spare in os.listdir(overlay_dir):
+            if not spare.endswith(SPARE_SUFFIX):
+                continue
+            try:
+                os.rename(os.path.join(overlay_dir, spare), filename)
+                logging.debug("Using spare overlay %s of %s", filename,
+                              golden)
+                return filename
+            except OSError:
+                # claimed by another job
+                continue
+        self._create_overlay(golden, filename)
+        logging.debug("Created overlay %s of %s", filename, golden)
+        return filename
+
+
+    def release(self, overlay):
+        """
+        Remove an overlay once its test is done with it.
+        """
+        if os.path.exists(overlay):
+            os.unlink(overlay)
+
+
+    def add_spares(self, golden, count=1):
+        """
+        Create spare overlays of a golden image, up to count.
+        """
+        hash = self.register(golden)
+        overlay_dir = self.get_overlay_dir(golden, hash)
+        if not os.path.isdir(overlay_dir):
+            try:
+                os.makedirs(overlay_dir)
+            except OSError:
+                pass
+        spares = [f for f in os.listdir(overlay_dir)
+                  if f.endswith(SPARE_SUFFIX)]
+        for i in range(count - len(spares)):
+            self._create_overlay(golden, os.path.join(overlay_dir, "%s%s" %
+                    (kvm_utils.generate_random_string(8), SPARE_SUFFIX)))
+
+
+    def prewarm(self, goldens, spares=1, threads=4):
+        """
+        Register golden images and create their spare overlays in parallel,
+        ahead of the tests which will use them.
+
+        @param goldens: Paths of the golden images.
+        @param spares: Number of spare overlays per golden image.
+        @param threads: Number of golden images processed at once.
+        """
+        pending = [g for g in goldens if os.path.exists(g)]
+        def prewarm_images():
+            while True:
+                self._lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    golden = pending.pop()
+                finally:
+                    self._lock.release()
+                try:
+                    self.add_spares(golden, spares)
+                except Exception, e:
+                    logging.warn("Could not prewarm overlays of %s: %s",
+                                 golden, e)
+        workers = [threading.Thread(target=prewarm_images)
+                   for i in range(min(threads, len(pending)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+    def collect_garbage(self, max_age=24 * 3600):
+        """
+        Remove the overlays of golden images which were modified or removed,
+        their registry entries, and the overlays left behind for more than
+        max_age seconds (e.g. by crashed tests).
+        """
+        self._lock.acquire()
+        try:
+            registry = self._load_registry()
+            current_dirs = set()
+            for golden, entry in registry.items():
+                try:
+                    st = os.stat(golden)
+                except OSError:
+                    del registry[golden]
+                    continue
+                if (st.st_size, st.st_mtime, st.st_ino) != entry[:3]:
+                    del registry[golden]
+                    continue
+                current_dirs.add(os.path.basename(
+                        self.get_overlay_dir(golden, entry[3])))
+            self._save_registry(registry)
+        finally:
+            self._lock.release()
+
+        now = time.time()
+        for name in os.listdir(self.pool_dir):
+            path = os.path.join(self.pool_dir, name)
+            if not os.path.isdir(path):
+                continue
+            if name not in current_dirs:
+                logging.debug("Removing outdated overlays %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            for overlay in os.listdir(path):
+                overlay = os.path.join(path, overlay)
+                if (not overlay.endswith(SPARE_SUFFIX) and
+                    now - os.path.getmtime(overlay) > max_age):
+                    logging.debug("Removing stale overlay %s", overlay)
+                    os.unlink(overlay)
+
+
+def get_pool(params, root_dir):
+    """
+    Return the ImagePool configured in params.
+
+    @param params: A dict containing the image_pool_dir and qemu_img_binary
+            parameters.
+    @param root_dir: Base directory for relative filenames.
+    """
+    return ImagePool(
+            kvm_utils.get_path(root_dir, params.get("image_pool_dir",
+                                                    "images/pool")),
+            kvm_utils.get_path(root_dir, params.get("qemu_img_binary",
+                                                    "qemu-img")))
+
+
+def get_pooled_images(params, root_dir):
+    """
+    Return the images of the VMs in params which are taken from the pool.
+
+    @param params: A dict containing all VM and image parameters.
+    @param root_dir: Base directory for relative filenames.
+    @return: A list of (VM name, image name, golden image path) tuples.
+    """
+    images = []
+    for vm_name in kvm_utils.get_sub_dict_names(params, "vms"):
+        vm_params = kvm_utils.get_sub_dict(params, vm_name)
+        for image_name in kvm_utils.get_sub_dict_names(vm_params, "images"):
+            image_params = kvm_utils.get_sub_dict(vm_params, image_name)
+            if image_params.get("image_pool") == "yes":
+                images.append((vm_name, image_name,
+                               kvm_vm.get_image_filename(image_params,
+                                                         root_dir)))
+    return images
+
+
+def prewarm(tests, root_dir, spares=1):
+    """
+    Prepare the pools of a list of tests: remove their garbage, then create
+    spare overlays of the golden images the tests use.
+
+    @param tests: A list of test dicts.
+    @param root_dir: Base directory for relative filenames.
+    @param spares: Number of spare overlays per golden image.
+    """
+    goldens = {}
+    for test in tests:
+        pool = get_pool(test, root_dir)
+        for vm_name, image_name, golden in get_pooled_images(test, root_dir):
+            goldens.setdefault(pool.pool_dir, (pool, set()))[1].add(golden)
+    for pool, pool_goldens in goldens.values():
+        pool.collect_garbage()
+        pool.prewarm(pool_goldens, spares)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, time, unittest
+import common
+import kvm_image_pool, kvm_preprocessing, kvm_utils
+
+
+# Stands for qemu-img: writes the backing file name into the overlay
+FAKE_QEMU_IMG = """#!/bin/sh
+[ "$1 $2 $3 $4" = "create -f qcow2 -b" ] || exit 1
+echo "$5" > "$6"
+"""
+
+
+class test_image_pool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        qemu_img = os.path.join(self.tmpdir, "qemu-img")
+        open(qemu_img, "w").write(FAKE_QEMU_IMG)
+        os.chmod(qemu_img, 0755)
+        self.golden = os.path.join(self.tmpdir, "golden.raw")
+        open(self.golden, "w").write("installed guest")
+        self.pool_dir = os.path.join(self.tmpdir, "pool")
+        self.pool = kvm_image_pool.ImagePool(self.pool_dir, qemu_img)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _modify_golden(self):
+        open(self.golden, "w").write("installed guest, updated")
+        # make sure the modification time changes
+        os.utime(self.golden, (time.time() + 10, time.time() + 10))
+
+
+    def test_register(self):
+        hash = self.pool.register(self.golden)
+        self.assertEquals(hash, kvm_image_pool._hash_file(self.golden))
+        # the hash is computed once
+        old_hash_file = kvm_image_pool._hash_file
+        kvm_image_pool._hash_file = None
+        try:
+            self.assertEquals(self.pool.register(self.golden), hash)
+        finally:
+            kvm_image_pool._hash_file = old_hash_file
+        self._modify_golden()
+        self.assertNotEquals(self.pool.register(self.golden), hash)
+
+
+    def test_get_overlay(self):
+        overlay = self.pool.get_overlay(self.golden, "vm1-image1")
+        self.assert_(overlay.endswith(".qcow2"))
+        self.assertEquals(open(overlay).read().strip(), self.golden)
+        self.assertNotEquals(self.pool.get_overlay(self.golden, "vm1-image1"),
+                             overlay)
+        self.pool.release(overlay)
+        self.assertFalse(os.path.exists(overlay))
+
+
+    def test_spares(self):
+        self.pool.prewarm([self.golden, os.path.join(self.tmpdir, "missing")],
+                          spares=2)
+        overlay_dir = self.pool.get_overlay_dir(
+                self.golden, self.pool.register(self.golden))
+        self.assertEquals(len(os.listdir(overlay_dir)), 2)
+        overlay = self.pool.get_overlay(self.golden, "vm1-image1")
+        self.assertEquals(open(overlay).read().strip(), self.golden)
+        spares = [f for f in os.listdir(overlay_dir)
+                  if f.endswith(kvm_image_pool.SPARE_SUFFIX)]
+        self.assertEquals(len(spares), 1)
+
+
+    def test_collect_garbage(self):
+        old_overlay = self.pool.get_overlay(self.golden, "old")
+        stale_overlay = self.pool.get_overlay(self.golden, "stale")
+        os.utime(stale_overlay, (0, 0))
+        self.pool.collect_garbage()
+        self.assert_(os.path.exists(old_overlay))
+        self.assertFalse(os.path.exists(stale_overlay))
+
+        self._modify_golden()
+        overlay = self.pool.get_overlay(self.golden, "new")
+        self.pool.collect_garbage()
+        self.assertFalse(os.path.exists(os.path.dirname(old_overlay)))
+        self.assert_(os.path.exists(overlay))
+
+        os.unlink(self.golden)
+        self.pool.collect_garbage()
+        self.assertEquals(os.listdir(self.pool_dir), ["registry"])
+
+
+    def test_get_pooled_images(self):
+        params = {"vms": "vm1 vm2", "images": "image1 image2",
+                  "image_name": "golden", "image_format": "raw",
+                  "image_pool_image1": "yes", "image_name_image1_vm2": "other"}
+        self.assertEquals(
+                kvm_image_pool.get_pooled_images(params, self.tmpdir),
+                [("vm1", "image1", os.path.join(self.tmpdir, "golden.raw")),
+                 ("vm2", "image1", os.path.join(self.tmpdir, "other.raw"))])
+
+
+    def test_setup_image_overlays(self):
+        class fake_test(object):
+            bindir = self.tmpdir
+        params = {"vms": "vm1", "images": "image1", "image_name": "golden",
+                  "image_format": "raw", "image_pool": "yes",
+                  "image_pool_dir": self.pool_dir,
+                  "qemu_img_binary": os.path.join(self.tmpdir, "qemu-img")}
+        kvm_preprocessing.setup_image_overlays(fake_test(), params)
+        vm_params = kvm_utils.get_sub_dict(params, "vm1")
+        image_params = kvm_utils.get_sub_dict(vm_params, "image1")
+        overlay = image_params["image_name"] + ".qcow2"
+        self.assertEquals(open(overlay).read().strip(), self.golden)
+        # the overlay is only removed with its VM
+        self.assertEquals(vm_params["kill_vm"], "yes")
+        self.assertFalse("remove_image" in image_params)
+        kvm_preprocessing.release_image_overlays(fake_test(), vm_params)
+        self.assertFalse(os.path.exists(overlay))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -76,6 +76,13 @@ class Monitor:
     def __del__(self):
         # Automatically close the connection when the instance is garbage
         # collected
+        self.close()
+
+
+    def close(self):
+        """
+        Close the connection to the monitor.
+        """
         try:
             self._socket.shutdown(socket.SHUT_RDWR)
         except socket.error:
@@ -366,15 +373,24 @@ class HumanMonitor(Monitor):
 class QMPMonitor(Monitor):
     """
     Wraps QMP monitor commands.
+
+    In async mode, a background thread reads everything the monitor sends:
+    it hands responses to the commands waiting for them, so that several
+    commands can be in flight at the same time (see send_cmd()), and
+    events to their subscribers and to wait_for_event() as soon as they
+    arrive.
     """
 
-    def __init__(self, name, filename, suppress_exceptions=False):
+    def __init__(self, name, filename, suppress_exceptions=False,
+                 async_mode=False):
         """
         Connect to the monitor socket, read the greeting message and issue the
         qmp_capabilities command.  Also make sure the json module is available.
 
         @param name: Monitor identifier (a string)
         @param filename: Monitor socket filename
+        @param async_mode: If True, read from the monitor in a background
+                thread
         @raise MonitorConnectError: Raised if the connection fails and
                 suppress_exceptions is False
         @raise MonitorProtocolError: Raised if the no QMP greeting message is
@@ -384,12 +400,25 @@ class QMPMonitor(Monitor):
         @note: Other exceptions may be raised if the qmp_capabilities command
                 fails.  See cmd()'s docstring.
         """
+        self._reader_thread = None
         try:
             Monitor.__init__(self, name, filename)
 
             self.protocol = "qmp"
             self._greeting = None
             self._events = []
+            self._event_subscribers = []
+            self._async = False
+            # Protects the following, and is notified whenever they change
+            self._cond = threading.Condition()
+            # Maps the ids of commands sent by send_cmd() to (cmd, args)
+            self._pending = {}
+            # Maps the ids of pending commands to their responses
+            self._responses = {}
+            # Responses nobody is waiting for (e.g. to cmd_raw())
+            self._unclaimed = []
+            # The error which stopped the reader thread, if any
+            self._reader_error = None
 
             # Make sure json is available
             try:
@@ -414,6 +443,13 @@ class QMPMonitor(Monitor):
             # Issue qmp_capabilities
             self.cmd("qmp_capabilities")
 
+            if async_mode:
+                self._async = True
+                self._reader_thread = threading.Thread(
+                        target=self._reader, name="qmp_reader_%s" % name)
+                self._reader_thread.setDaemon(True)
+                self._reader_thread.start()
+
         except MonitorError, e:
             if suppress_exceptions:
                 logging.warn(e)
@@ -421,6 +457,28 @@ class QMPMonitor(Monitor):
                 raise
 
 
+    def __getinitargs__(self):
+        return Monitor.__getinitargs__(self) + (self._async,)
+
+
+    def close(self):
+        """
+        Close the connection to the monitor and wait for the reader thread
+        (in async mode) to stop.
+
+        The reader thread keeps the instance alive, so in async mode the
+        connection is only closed by calling this method.
+        """
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        reader = self._reader_thread
+        if reader and reader is not threading.currentThread():
+            reader.join()
+        Monitor.close(self)
+
+
     # Private methods
 
     def _build_cmd(self, cmd, args=None, id=None):
@@ -467,10 +525,96 @@ class QMPMonitor(Monitor):
             except:
                 pass
         # Keep track of asynchronous events
-        self._events += [obj for obj in objs if "event" in obj]
+        for obj in objs:
+            if isinstance(obj, dict) and "event" in obj:
+                self._handle_event(obj)
         return objs
 
 
+    def _handle_event(self, event):
+        self._cond.acquire()
+        try:
+            self._events.append(event)
+            subscribers = self._event_subscribers[:]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception, e:
+                logging.error("QMP event subscriber failed (monitor '%s', "
+                              "event %r): %s", self.name, event, e)
+
+
+    def _handle_response(self, response):
+        self._cond.acquire()
+        try:
+            id = response.get("id")
+            if isinstance(id, basestring) and id in self._pending:
+                self._responses[id] = response
+            else:
+                self._unclaimed.append(response)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+    def _reader(self):
+        """
+        Read and dispatch everything the monitor sends (in async mode), until
+        the connection is closed.
+        """
+        buffer = ""
+        try:
+            while True:
+                try:
+                    data = self._socket.recv(4096)
+                except socket.error, (errno, msg):
+                    raise MonitorSocketError("Could not receive data from "
+                                             "monitor (%s)" % msg)
+                if not data:
+                    raise MonitorSocketError("Monitor connection closed")
+                lines = (buffer + data).split("\n")
+                buffer = lines.pop()
+                for line in lines:
+                    try:
+                        obj = json.loads(line)
+                    except ValueError:
+                        continue
+                    if not isinstance(obj, dict):
+                        continue
+                    if "event" in obj:
+                        self._handle_event(obj)
+                    elif "return" in obj or "error" in obj:
+                        self._handle_response(obj)
+        except MonitorError, e:
+            self._cond.acquire()
+            try:
+                self._reader_error = e
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+
+    def _wait(self, predicate, end_time):
+        """
+        Wait until predicate() is True (in async mode).  Must be called with
+        self._cond acquired.
+
+        @return: True if predicate() is True, False if end_time passed.
+        @raise MonitorSocketError: Raised if the reader thread stopped
+        """
+        while not predicate():
+            if self._reader_error:
+                raise self._reader_error
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        return True
+
+
     def _send(self, data):
         """
         Send raw data without waiting for response.
@@ -523,6 +667,9 @@ class QMPMonitor(Monitor):
                 (the exception's args are (cmd, args, data) where data is the
                 error data)
         """
+        if self._async:
+            return self.wait_cmd(self.send_cmd(cmd, args), timeout)
+
         if not self._acquire_lock(20):
             raise MonitorLockError("Could not acquire exclusive lock to send "
                                    "QMP command '%s'" % cmd)
@@ -549,6 +696,83 @@ class QMPMonitor(Monitor):
             self._lock.release()
 
 
+    def send_cmd(self, cmd, args=None):
+        """
+        Send a QMP monitor command without waiting for the response (async
+        mode only).  Other commands may be sent before waiting for it.
+
+        @param cmd: Command to send
+        @param args: A dict containing command arguments, or None
+        @return: The id of the command, to pass to wait_cmd()
+        @raise MonitorNotSupportedError: Raised if not in async mode
+        @raise MonitorLockError: Raised if the lock cannot be acquired
+        @raise MonitorSocketError: Raised if a socket error occurs
+        """
+        if not self._async:
+            raise MonitorNotSupportedError("Sending QMP commands without "
+                                           "waiting requires async mode")
+        id = kvm_utils.generate_random_string(8)
+        self._cond.acquire()
+        try:
+            self._pending[id] = (cmd, args)
+        finally:
+            self._cond.release()
+        if not self._acquire_lock(20):
+            self._forget_cmd(id)
+            raise MonitorLockError("Could not acquire exclusive lock to send "
+                                   "QMP command '%s'" % cmd)
+        try:
+            try:
+                self._send(json.dumps(self._build_cmd(cmd, args, id)) + "\n")
+            except MonitorError:
+                self._forget_cmd(id)
+                raise
+        finally:
+            self._lock.release()
+        return id
+
+
+    def _forget_cmd(self, id):
+        self._cond.acquire()
+        try:
+            self._responses.pop(id, None)
+            return self._pending.pop(id)
+        finally:
+            self._cond.release()
+
+
+    def wait_cmd(self, id, timeout=20):
+        """
+        Wait for the response to a command sent by send_cmd().
+
+        @param id: The id returned by send_cmd()
+        @param timeout: Time duration to wait for response
+        @return: The response received
+        @raise MonitorSocketError: Raised if a socket error occurs
+        @raise MonitorProtocolError: Raised if no response is received
+        @raise QMPCmdError: Raised if the response is an error message
+        """
+        end_time = time.time() + timeout
+        self._cond.acquire()
+        try:
+            try:
+                received = self._wait(lambda: id in self._responses,
+                                      end_time)
+            except MonitorError:
+                self._forget_cmd(id)
+                raise
+            r = self._responses.get(id)
+            cmd, args = self._forget_cmd(id)
+        finally:
+            self._cond.release()
+        if not received:
+            raise MonitorProtocolError("Received no response to QMP command "
+                                       "'%s'" % cmd)
+        if "return" in r:
+            return r["return"]
+        raise QMPCmdError(cmd, args, r["error"])
+
+
     def cmd_raw(self, data, timeout=20):
         """
         Send a raw string to the QMP monitor and return the response.
@@ -567,9 +791,25 @@ class QMPMonitor(Monitor):
                                    "data: %r" % data)
 
         try:
-            self._read_objects()
-            self._send(data)
-            r = self._get_response(None, timeout)
+            if self._async:
+                # Forget responses to earlier requests
+                self._cond.acquire()
+                self._unclaimed = []
+                self._cond.release()
+                self._send(data)
+                self._cond.acquire()
+                try:
+                    self._wait(lambda: self._unclaimed,
+                               time.time() + timeout)
+                    r = None
+                    if self._unclaimed:
+                        r = self._unclaimed.pop(0)
+                finally:
+                    self._cond.release()
+            else:
+                self._read_objects()
+                self._send(data)
+                r = self._get_response(None, timeout)
             if r is None:
                 raise MonitorProtocolError("Received no response to data: %r" %
                                            data)
@@ -636,14 +876,19 @@ class QMPMonitor(Monitor):
         @return: A list of events (the objects returned have an "event" key)
         @raise MonitorLockError: Raised if the lock cannot be acquired
         """
-        if not self._acquire_lock(20):
-            raise MonitorLockError("Could not acquire exclusive lock to read "
-                                   "QMP events")
+        if not self._async:
+            if not self._acquire_lock(20):
+                raise MonitorLockError("Could not acquire exclusive lock to "
+                                       "read QMP events")
+            try:
+                self._read_objects()
+            finally:
+                self._lock.release()
+        self._cond.acquire()
         try:
-            self._read_objects()
             return self._events[:]
         finally:
-            self._lock.release()
+            self._cond.release()
 
 
     def get_event(self, name):
@@ -667,10 +912,69 @@ class QMPMonitor(Monitor):
         if not self._acquire_lock(20):
             raise MonitorLockError("Could not acquire exclusive lock to clear "
                                    "QMP event list")
+        self._cond.acquire()
         self._events = []
+        self._cond.release()
         self._lock.release()
 
 
+    def wait_for_event(self, name, timeout=20):
+        """
+        Wait for an event with the given name to be received (or return it
+        at once if it was received since the last clear_events() call).
+
+        @param name: The name of the event to wait for (e.g. 'RESET')
+        @param timeout: Time duration to wait for the event
+        @return: An event object or None if none was received
+        @raise MonitorLockError: Raised if the lock cannot be acquired
+        @raise MonitorSocketError: Raised if a socket error occurs
+        """
+        end_time = time.time() + timeout
+        if not self._async:
+            while True:
+                event = self.get_event(name)
+                if (event or time.time() >= end_time or
+                    not self._data_available(end_time - time.time())):
+                    return event
+        def find_event():
+            for e in self._events:
+                if e.get("event") == name:
+                    return e
+        self._cond.acquire()
+        try:
+            self._wait(find_event, end_time)
+            return find_event()
+        finally:
+            self._cond.release()
+
+
+    def subscribe(self, callback):
+        """
+        Call a function with each event received from now on.  In async mode
+        it's called by the reader thread, otherwise by whichever call reads
+        the event.
+
+        @param callback: A function taking an event object
+        """
+        self._cond.acquire()
+        try:
+            self._event_subscribers.append(callback)
+        finally:
+            self._cond.release()
+
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling a function passed to subscribe().
+        """
+        self._cond.acquire()
+        try:
+            if callback in self._event_subscribers:
+                self._event_subscribers.remove(callback)
+        finally:
+            self._cond.release()
+
+
     def get_greeting(self):
         """
         Return QMP greeting message.
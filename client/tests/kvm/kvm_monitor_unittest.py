@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+import os, shutil, socket, tempfile, threading, time, unittest, json
+import common
+import kvm_monitor
+
+
+class fake_qmp_server(object):
+    """
+    A QMP server which understands a few commands:
+    - query-status: returns at once
+    - slow: returns after 0.3 seconds, after the responses to the commands
+      received in the meantime
+    - system_reset: sends a RESET event 0.2 seconds after returning
+    - quit: closes the connection
+    Other commands return an error.
+    """
+    def __init__(self, filename):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(filename)
+        self.socket.listen(1)
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve)
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def send(self, obj):
+        self.lock.acquire()
+        try:
+            self.conn.sendall(json.dumps(obj) + "\n")
+        finally:
+            self.lock.release()
+
+
+    def send_later(self, delay, obj):
+        timer = threading.Timer(delay, self.send, (obj,))
+        timer.setDaemon(True)
+        timer.start()
+
+
+    def serve(self):
+        self.conn = self.socket.accept()[0]
+        self.send({"QMP": {"version": {}, "capabilities": []}})
+        for line in self.conn.makefile():
+            cmd = json.loads(line)
+            id = cmd.get("id")
+            if cmd["execute"] in ("qmp_capabilities", "query-status"):
+                self.send({"return": {"running": True}, "id": id})
+            elif cmd["execute"] == "slow":
+                self.send_later(0.3, {"return": "slow", "id": id})
+            elif cmd["execute"] == "system_reset":
+                self.send({"return": {}, "id": id})
+                self.send_later(0.2, {"event": "RESET", "timestamp": {}})
+            elif cmd["execute"] == "quit":
+                self.conn.close()
+                return
+            else:
+                self.send({"error": {"class": "CommandNotFound"}, "id": id})
+
+
+class test_qmp_monitor(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "qmp")
+        self.server = fake_qmp_server(self.filename)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _monitor(self, async_mode=True):
+        return kvm_monitor.QMPMonitor("qmp1", self.filename,
+                                      async_mode=async_mode)
+
+
+    def test_cmd(self):
+        monitor = self._monitor()
+        self.assertEquals(monitor.cmd("query-status"), {"running": True})
+        self.assertRaises(kvm_monitor.QMPCmdError, monitor.cmd, "foo")
+        self.assertEquals(monitor.cmd_qmp("query-status", id="x"),
+                          {"return": {"running": True}, "id": "x"})
+
+
+    def test_pipelined_cmds(self):
+        monitor = self._monitor()
+        slow = monitor.send_cmd("slow")
+        fast = monitor.send_cmd("query-status")
+        # the responses come in reverse order
+        self.assertEquals(monitor.wait_cmd(fast), {"running": True})
+        self.assertEquals(monitor.wait_cmd(slow), "slow")
+        self.assertEquals(monitor._pending, {})
+        self.assertRaises(kvm_monitor.MonitorProtocolError,
+                          monitor.wait_cmd, monitor.send_cmd("slow"), 0.1)
+
+
+    def test_send_cmd_needs_async_mode(self):
+        monitor = self._monitor(False)
+        self.assertRaises(kvm_monitor.MonitorNotSupportedError,
+                          monitor.send_cmd, "query-status")
+
+
+    def test_wait_for_event(self):
+        for async_mode in (True, False):
+            self.tearDown()
+            self.setUp()
+            monitor = self._monitor(async_mode)
+            events = []
+            monitor.subscribe(events.append)
+            monitor.cmd("system_reset")
+            self.assertEquals(monitor.wait_for_event("STOP", 0.1), None)
+            start = time.time()
+            event = monitor.wait_for_event("RESET", 5)
+            self.assertEquals(event["event"], "RESET")
+            self.assert_(time.time() - start < 1)
+            self.assertEquals(events, [event])
+            monitor.clear_events()
+            self.assertEquals(monitor.get_events(), [])
+
+
+    def test_connection_closed(self):
+        monitor = self._monitor()
+        id = monitor.send_cmd("quit")
+        self.assertRaises(kvm_monitor.MonitorSocketError, monitor.wait_cmd,
+                          id, 5)
+
+
+    def test_close(self):
+        monitor = self._monitor()
+        reader = monitor._reader_thread
+        self.assert_(reader.isAlive())
+        monitor.close()
+        self.assertFalse(reader.isAlive())
+        self.assertRaises(kvm_monitor.MonitorSocketError, monitor.cmd,
+                          "query-status", timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
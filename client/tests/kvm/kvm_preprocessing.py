@@ -2,6 +2,7 @@ import sys, os, time, commands, re, logging, signal, glob, threading, shutil
 from autotest_lib.client.bin import test, utils
 from autotest_lib.client.common_lib import error
 import kvm_vm, kvm_utils, kvm_subprocess, kvm_monitor, ppm_utils
+import kvm_screendump, kvm_image_pool
 try:
     import PIL.Image
 except ImportError:
@@ -39,6 +40,47 @@ def preprocess_image(test, params):
         raise error.TestError("Could not create image")
 
 
+def setup_image_overlays(test, params):
+    """
+    Make the images taken from the image pool (image_pool = yes) use new
+    overlays of their golden images, by pointing their parameters to the
+    overlays, which are removed after the test unless keep_image_overlay is
+    set.  Spare overlays for the next tests are created in the background.
+    The VMs running on overlays are killed after the test, since the next
+    test gives them new overlays anyway.
+
+    @param test: Autotest test object.
+    @param params: A dict containing all VM and image parameters (modified
+            in place).
+    """
+    images = kvm_image_pool.get_pooled_images(params, test.bindir)
+    if not images:
+        return
+    pool = kvm_image_pool.get_pool(params, test.bindir)
+    for vm_name, image_name, golden in images:
+        if not os.path.exists(golden):
+            raise error.TestError("Golden image %s not found" % golden)
+        overlay = pool.get_overlay(golden, "%s-%s" % (vm_name, image_name))
+        suffix = "_%s_%s" % (image_name, vm_name)
+        image_params = kvm_utils.get_sub_dict(
+                kvm_utils.get_sub_dict(params, vm_name), image_name)
+        params["image_name" + suffix] = os.path.splitext(overlay)[0]
+        params["image_format" + suffix] = "qcow2"
+        params["image_raw_device" + suffix] = "no"
+        params["create_image" + suffix] = "no"
+        params["force_create_image" + suffix] = "no"
+        params["kill_vm_" + vm_name] = "yes"
+        if image_params.get("keep_image_overlay") != "yes":
+            # Removed by postprocess_vm() once the VM is dead, rather than
+            # by postprocess_image(), which runs first
+            params["remove_image_overlay" + suffix] = "yes"
+
+    spares = threading.Thread(target=pool.prewarm,
+                              args=([golden for v, i, golden in images],))
+    spares.setDaemon(True)
+    spares.start()
+
+
 def preprocess_vm(test, params, env, name):
     """
     Preprocess a single VM object according to the instructions in params.
@@ -127,6 +169,7 @@ def postprocess_vm(test, params, env, name):
         logging.debug("VM object found in environment")
     else:
         logging.debug("VM object does not exist in environment")
+        release_image_overlays(test, params)
         return
 
     scrdump_filename = os.path.join(test.debugdir, "post_%s.ppm" % name)
@@ -146,6 +189,23 @@ def postprocess_vm(test, params, env, name):
             logging.debug("'kill_vm' specified; killing VM...")
         vm.destroy(gracefully = params.get("kill_vm_gracefully") == "yes")
 
+    if vm.is_dead():
+        release_image_overlays(test, params)
+
+
+def release_image_overlays(test, params):
+    """
+    Remove the image pool overlays of a VM (see setup_image_overlays()).
+    Only called once the VM is dead, so it never runs on removed files.
+
+    @param test: An Autotest test object.
+    @param params: A dict containing VM postprocessing parameters.
+    """
+    for image_name in kvm_utils.get_sub_dict_names(params, "images"):
+        image_params = kvm_utils.get_sub_dict(params, image_name)
+        if image_params.get("remove_image_overlay") == "yes":
+            kvm_vm.remove_image(image_params, test.bindir)
+
 
 def process_command(test, params, env, command, command_timeout,
                     command_noncritical):
@@ -228,7 +288,11 @@ def preprocess(test, params, env):
     # Destroy and remove VMs that are no longer needed in the environment
     requested_vms = kvm_utils.get_sub_dict_names(params, "vms")
     for key in env.keys():
-        vm = env[key]
+        # VMs are stored as vm__<name>, so the requested ones needn't be
+        # loaded here
+        if not key.startswith("vm__") or key[4:] in requested_vms:
+            continue
+        vm = env.get(key)
         if not kvm_utils.is_vm(vm):
             continue
         if not vm.name in requested_vms:
@@ -270,6 +334,9 @@ def preprocess(test, params, env):
                         int(params.get("pre_command_timeout", "600")),
                         params.get("pre_command_noncritical") == "yes")
 
+    # Run the images taken from the image pool on overlays
+    setup_image_overlays(test, params)
+
     # Preprocess all VMs and images
     process(test, params, env, preprocess_image, preprocess_vm)
 
@@ -400,52 +467,37 @@ def _take_screendumps(test, params, env):
             os.makedirs(temp_dir)
         except OSError:
             pass
-    temp_filename = os.path.join(temp_dir, "scrdump-%s.ppm" %
-                                 kvm_utils.generate_random_string(6))
     delay = float(params.get("screendump_delay", 5))
     quality = int(params.get("screendump_quality", 30))
-
-    cache = {}
-
-    while True:
-        for vm in kvm_utils.env_get_all_vms(env):
-            if not vm.is_alive():
-                continue
-            try:
-                vm.monitor.screendump(temp_filename)
-            except kvm_monitor.MonitorError, e:
-                logging.warn(e)
-                continue
-            if not os.path.exists(temp_filename):
-                logging.warn("VM '%s' failed to produce a screendump", vm.name)
-                continue
-            if not ppm_utils.image_verify_ppm_file(temp_filename):
-                logging.warn("VM '%s' produced an invalid screendump", vm.name)
-                os.unlink(temp_filename)
-                continue
-            screendump_dir = os.path.join(test.debugdir,
-                                          "screendumps_%s" % vm.name)
-            try:
-                os.makedirs(screendump_dir)
-            except OSError:
-                pass
-            screendump_filename = os.path.join(screendump_dir,
-                    "%s_%s.jpg" % (vm.name,
-                                   time.strftime("%Y-%m-%d_%H-%M-%S")))
-            hash = utils.hash_file(temp_filename)
-            if hash in cache:
-                try:
-                    os.link(cache[hash], screendump_filename)
-                except OSError:
-                    pass
-            else:
+    max_changed_bands = int(params.get("screendump_dedup_bands", 0))
+    encoder = kvm_screendump.EncoderPool(
+            int(params.get("screendump_encoder_threads", 2)))
+
+    # The history of every VM is written by a subscriber of its screendump
+    # service, so screendumps taken by the tests (e.g. step files) end up
+    # in the history as well
+    writers = {}
+    try:
+        while True:
+            for vm in kvm_utils.env_get_all_vms(env):
+                if not vm.is_alive():
+                    continue
+                service = kvm_screendump.get_service(vm, temp_dir)
+                if service not in writers:
+                    screendump_dir = os.path.join(test.debugdir,
+                                                  "screendumps_%s" % vm.name)
+                    writers[service] = kvm_screendump.HistoryWriter(
+                            screendump_dir, encoder, delay, quality,
+                            max_changed_bands)
+                    service.subscribe(writers[service])
                 try:
-                    image = PIL.Image.open(temp_filename)
-                    image.save(screendump_filename, format="JPEG", quality=quality)
-                    cache[hash] = screendump_filename
-                except NameError:
-                    pass
-            os.unlink(temp_filename)
-        if _screendump_thread_termination_event.isSet():
-            break
-        _screendump_thread_termination_event.wait(delay)
+                    service.capture(max_age=delay)
+                except kvm_monitor.MonitorError, e:
+                    logging.warn(e)
+            if _screendump_thread_termination_event.isSet():
+                break
+            _screendump_thread_termination_event.wait(delay)
+    finally:
+        for service, writer in writers.items():
+            service.unsubscribe(writer)
+        encoder.close()
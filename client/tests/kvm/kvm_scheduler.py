@@ -1,14 +1,112 @@
-import os, select
+import os, select, glob, re, logging
 import kvm_utils, kvm_vm, kvm_subprocess
+from autotest_lib.client.bin import cpuset, os_dep
+from autotest_lib.client.common_lib import base_job
+
+
+# The parameters which make the VMs of two tests identical, so that the second
+# test can reuse the VMs left running by the first one instead of booting
+# new ones
+VM_PARAMS = ("vms", "images", "image_name", "image_format", "drive_format",
+             "image_snapshot", "mem", "smp", "nics", "nic_model", "cdrom",
+             "extra_params", "qemu_binary", "display")
+
+
+def get_numa_nodes():
+    """
+    Return the CPUs and memory of the NUMA nodes of the host.
+
+    @return: A list of (number of CPUs, MB of memory) tuples, one per node,
+            empty if the host has a single node or if the VMs can't be
+            pinned to a node because numactl is not installed.
+    """
+    try:
+        os_dep.command("numactl")
+    except ValueError:
+        logging.info("numactl is not installed, tests won't be pinned to "
+                     "NUMA nodes")
+        return []
+    nodes = []
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*"):
+        index = int(os.path.basename(path)[4:])
+        cpus = len(cpuset.rangelist_to_set(
+                open(os.path.join(path, "cpulist")).read().strip()))
+        mem = 0
+        for line in open(os.path.join(path, "meminfo")):
+            match = re.search(r"MemTotal:\s+(\d+) kB", line)
+            if match:
+                mem = int(match.group(1)) / 1024
+        nodes.append((index, cpus, mem))
+    nodes.sort()
+    if len(nodes) < 2:
+        return []
+    return [(cpus, mem) for index, cpus, mem in nodes]
+
+
+def find_status_logs(resultdir):
+    """
+    Return the status logs of the jobs whose results are next to the ones of
+    the current job.
+
+    @param resultdir: The results directory of the current job.
+    """
+    return glob.glob(os.path.join(resultdir, "..", "*", "status"))
+
+
+def load_durations(status_log_filenames):
+    """
+    Read the durations of the tests run by previous jobs from their status
+    logs.
+
+    @param status_log_filenames: A list of status log files.
+    @return: A dict mapping test names (e.g. "kvm.qcow2.smp2.boot") to their
+            mean duration in seconds.
+    """
+    all_durations = {}
+    for filename in status_log_filenames:
+        try:
+            lines = open(filename).readlines()
+        except IOError:
+            continue
+        start_times = {}
+        for line in lines:
+            try:
+                entry = base_job.status_log_entry.parse(line.rstrip("\n"))
+            except ValueError:
+                continue
+            if not entry or not entry.operation:
+                continue
+            timestamp = entry.fields.get(entry.TIMESTAMP_FIELD)
+            if timestamp is None:
+                continue
+            if entry.status_code == "START":
+                start_times[entry.operation] = int(timestamp)
+            elif (entry.status_code.startswith("END ") and
+                  entry.operation in start_times):
+                duration = int(timestamp) - start_times.pop(entry.operation)
+                all_durations.setdefault(entry.operation, []).append(duration)
+    durations = {}
+    for name, values in all_durations.items():
+        durations[name] = float(sum(values)) / len(values)
+    return durations
 
 
 class scheduler:
     """
     A scheduler that manages several parallel test execution pipelines on a
     single host.
+
+    Tests are packed onto the workers according to the CPUs (used_cpus) and
+    memory (used_mem) they need, longest tests first when their durations
+    in previous jobs are known.  Tests which fit in a single NUMA node are
+    pinned to it.  Tests sharing an exclusive resource (a writable image, or
+    one of the names listed in exclusive_resources, e.g. the hugepage pool)
+    never run at the same time.  An idle worker prefers tests which can reuse
+    the VMs it left running.
     """
 
-    def __init__(self, tests, num_workers, total_cpus, total_mem, bindir):
+    def __init__(self, tests, num_workers, total_cpus, total_mem, bindir,
+                 numa_nodes=None, durations=None, boot_time=60):
         """
         Initialize the class.
 
@@ -17,12 +115,21 @@ class scheduler:
         @param total_cpus: The total number of CPUs to dedicate to tests.
         @param total_mem: The total amount of memory to dedicate to tests.
         @param bindir: The directory where environment files reside.
+        @param numa_nodes: A list of (number of CPUs, MB of memory) tuples,
+                one per NUMA node of the host (see get_numa_nodes()).
+        @param durations: A dict mapping test names to their expected
+                durations in seconds (see load_durations()).
+        @param boot_time: Seconds saved by reusing the VMs of the previous
+                test instead of booting new ones.
         """
         self.tests = tests
         self.num_workers = num_workers
         self.total_cpus = total_cpus
         self.total_mem = total_mem
         self.bindir = bindir
+        self.numa_nodes = numa_nodes or []
+        self.durations = durations or {}
+        self.boot_time = boot_time
         # Pipes -- s stands for scheduler, w stands for worker
         self.s2w = [os.pipe() for i in range(num_workers)]
         self.w2s = [os.pipe() for i in range(num_workers)]
@@ -63,6 +170,8 @@ class scheduler:
                 test_index = int(cmd[1])
                 test = self.tests[test_index].copy()
                 test.update(self_dict)
+                if len(cmd) > 2:
+                    test["numa_node"] = cmd[2]
                 test = kvm_utils.get_sub_pool(test, index, self.num_workers)
                 test_iterations = int(test.get("iterations", 1))
                 status = run_test_func("kvm", params=test,
@@ -89,6 +198,78 @@ class scheduler:
                 break
 
 
+    def get_needs(self, test):
+        """
+        Return the resources a test needs.
+
+        @param test: A test dictionary.
+        @return: A tuple (CPUs, MB of memory, set of exclusive resources).
+        """
+        cpus = int(test.get("used_cpus", 1))
+        mem = int(test.get("used_mem", 128))
+        resources = set(test.get("exclusive_resources", "").split())
+        for vm_name in kvm_utils.get_sub_dict_names(test, "vms"):
+            vm_params = kvm_utils.get_sub_dict(test, vm_name)
+            for image_name in kvm_utils.get_sub_dict_names(vm_params,
+                                                           "images"):
+                image_params = kvm_utils.get_sub_dict(vm_params, image_name)
+                # Images in snapshot mode or taken from the image pool are
+                # never written
+                if (image_params.get("image_snapshot") != "yes" and
+                    image_params.get("image_pool") != "yes"):
+                    resources.add("image:%s" % kvm_vm.get_image_filename(
+                            image_params, self.bindir))
+        return cpus, mem, resources
+
+
+    def get_expected_duration(self, test, default=0):
+        """
+        Return the expected duration of a test in seconds, default if it
+        never ran before.
+        """
+        return self.durations.get("kvm.%s" % test.get("shortname"), default)
+
+
+    def place(self, needs, usage):
+        """
+        Check whether a test fits in the resources left by the given workers.
+
+        The totals of CPUs and memory are hard limits, except that a test
+        bigger than them can run alone.  NUMA nodes are a preference: the
+        test goes to the node it fits best in, if any, or else runs unpinned.
+
+        @param needs: The needs of the test (see get_needs()).
+        @param usage: A list of the needs and NUMA nodes of the tests the
+                workers run or keep VMs for, as (needs, node) tuples.
+        @return: A tuple (fits, node): whether the test fits, and the NUMA
+                node to pin it to (None for no pinning).
+        """
+        cpus, mem, resources = needs
+        used_cpus = sum([n[0] for n, node in usage])
+        used_mem = sum([n[1] for n, node in usage])
+        if used_cpus and used_cpus + cpus > self.total_cpus:
+            return False, None
+        if used_mem and used_mem + mem > self.total_mem:
+            return False, None
+        for n, node in usage:
+            if n[2] & resources:
+                return False, None
+
+        best_node = None
+        best_left = None
+        for index, (node_cpus, node_mem) in enumerate(self.numa_nodes):
+            cpus_left = node_cpus - cpus - sum([n[0] for n, node in usage
+                                                if node == index])
+            mem_left = node_mem - mem - sum([n[1] for n, node in usage
+                                             if node == index])
+            if cpus_left < 0 or mem_left < 0:
+                continue
+            if best_left is None or (cpus_left, mem_left) < best_left:
+                best_node = index
+                best_left = (cpus_left, mem_left)
+        return True, best_node
+
+
     def scheduler(self):
         """
         The scheduler function.
@@ -100,8 +281,24 @@ class scheduler:
         closing_workers = []
         test_status = ["waiting"] * len(self.tests)
         test_worker = [None] * len(self.tests)
-        used_cpus = [0] * self.num_workers
-        used_mem = [0] * self.num_workers
+        test_needs = [self.get_needs(test) for test in self.tests]
+        # The needs and NUMA node of the last test run by each worker, whose
+        # VMs it may keep running until it cleans up
+        usage = [None] * self.num_workers
+        warm_vms = [None] * self.num_workers
+
+        # Tests which never ran are expected to take as long as the
+        # median test
+        durations = [self.get_expected_duration(test, None)
+                     for test in self.tests]
+        known_durations = sorted([d for d in durations if d is not None])
+        if known_durations:
+            default_duration = known_durations[len(known_durations) / 2]
+        else:
+            default_duration = 0
+        for i, duration in enumerate(durations):
+            if duration is None:
+                durations[i] = default_duration
 
         while True:
             # Wait for a message from a worker
@@ -135,16 +332,25 @@ class scheduler:
 
                 # A worker is done shutting down its VMs and other processes
                 elif msg[0] == "cleanup_done":
-                    used_cpus[worker_index] = 0
-                    used_mem[worker_index] = 0
+                    usage[worker_index] = None
+                    warm_vms[worker_index] = None
                     closing_workers.remove(worker_index)
 
             if not someone_is_ready:
                 continue
 
             for worker in idle_workers[:]:
+                # The usage of the other workers, not including the workers
+                # currently shutting down, and including them
+                other_workers = [i for i in range(self.num_workers)
+                                 if i != worker and usage[i]]
+                soon_usage = [usage[i] for i in other_workers
+                              if i not in closing_workers]
+                current_usage = [usage[i] for i in other_workers]
+
                 # Find a test for this worker
                 test_found = False
+                best = None
                 for i, test in enumerate(self.tests):
                     # We only want "waiting" tests
                     if test_status[i] != "waiting":
@@ -164,40 +370,41 @@ class scheduler:
                             break
                     if not dependencies_satisfied:
                         continue
-                    # Make sure we have enough resources to run the test
-                    test_used_cpus = int(test.get("used_cpus", 1))
-                    test_used_mem = int(test.get("used_mem", 128))
-                    # First make sure the other workers aren't using too many
-                    # CPUs (not including the workers currently shutting down)
-                    uc = (sum(used_cpus) - used_cpus[worker] -
-                          sum(used_cpus[i] for i in closing_workers))
-                    if uc and uc + test_used_cpus > self.total_cpus:
-                        continue
-                    # ... or too much memory
-                    um = (sum(used_mem) - used_mem[worker] -
-                          sum(used_mem[i] for i in closing_workers))
-                    if um and um + test_used_mem > self.total_mem:
+                    # Make sure we have enough resources to run the test:
+                    # first make sure the other workers aren't using too many
+                    # (not including the workers currently shutting down)
+                    if not self.place(test_needs[i], soon_usage)[0]:
                         continue
                     # If we reached this point it means there are, or will
                     # soon be, enough resources to run the test
                     test_found = True
                     # Now check if the test can be run right now, i.e. if the
                     # other workers, including the ones currently shutting
-                    # down, aren't using too many CPUs
-                    uc = (sum(used_cpus) - used_cpus[worker])
-                    if uc and uc + test_used_cpus > self.total_cpus:
-                        continue
-                    # ... or too much memory
-                    um = (sum(used_mem) - used_mem[worker])
-                    if um and um + test_used_mem > self.total_mem:
+                    # down, aren't using too many resources
+                    fits, node = self.place(test_needs[i], current_usage)
+                    if not fits:
                         continue
+                    # Run the longest tests first, counting the boot time
+                    # saved by reusing the VMs of this worker
+                    score = durations[i]
+                    if (warm_vms[worker] is not None and
+                        warm_vms[worker] == self._get_vm_key(test)):
+                        score += self.boot_time
+                    if best is None or score > best[0]:
+                        best = (score, i, node)
+
+                if best:
+                    score, i, node = best
+                    test = self.tests[i]
                     # Everything is OK -- run the test
                     test_status[i] = "running"
                     test_worker[i] = worker
                     idle_workers.remove(worker)
-                    # Update used_cpus and used_mem
-                    used_cpus[worker] = test_used_cpus
-                    used_mem[worker] = test_used_mem
+                    usage[worker] = (test_needs[i], node)
+                    if test.get("kill_vm") == "yes":
+                        warm_vms[worker] = None
+                    else:
+                        warm_vms[worker] = self._get_vm_key(test)
                     # Assign all related tests to this worker
                     for j, other_test in enumerate(self.tests):
                         for other_dep in other_test["depend"]:
@@ -212,12 +419,14 @@ class scheduler:
                                     test_worker[j] = worker
                                     break
                     # Tell the worker to run the test
-                    self.s2w_w[worker].write("run %s\n" % i)
-                    break
+                    if node is None:
+                        self.s2w_w[worker].write("run %s\n" % i)
+                    else:
+                        self.s2w_w[worker].write("run %s %s\n" % (i, node))
 
                 # If there won't be any tests for this worker to run soon, tell
                 # the worker to free its used resources
-                if not test_found and (used_cpus[worker] or used_mem[worker]):
+                elif not test_found and usage[worker]:
                     self.s2w_w[worker].write("cleanup\n")
                     idle_workers.remove(worker)
                     closing_workers.append(worker)
@@ -228,3 +437,7 @@ class scheduler:
                 for worker in idle_workers:
                     self.s2w_w[worker].write("terminate\n")
                 break
+
+
+    def _get_vm_key(self, test):
+        return tuple([test.get(key) for key in VM_PARAMS])
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, threading, unittest
+import common
+from autotest_lib.client.bin import job
+from autotest_lib.client.common_lib import base_job
+import kvm_scheduler
+
+
+def _test(name, depend=(), **params):
+    test = {"name": name, "shortname": name, "depend": list(depend)}
+    test.update(params)
+    return test
+
+
+class fake_workers(object):
+    """
+    Workers speaking the scheduler protocol, which run tests instantly and
+    record their order.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.runs = []
+        self.cleanups = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.worker, args=(i,))
+                        for i in range(scheduler.num_workers)]
+
+
+    def worker(self, index):
+        r = self.scheduler.s2w_r[index]
+        w = self.scheduler.w2s_w[index]
+        w.write("ready\n")
+        while True:
+            cmd = r.readline().split()
+            if cmd[0] == "run":
+                self.lock.acquire()
+                self.runs.append((index, int(cmd[1]), cmd[2:]))
+                self.lock.release()
+                w.write("done %s True\n" % cmd[1])
+                w.write("ready\n")
+            elif cmd[0] == "cleanup":
+                self.cleanups.append(index)
+                w.write("cleanup_done\n")
+                w.write("ready\n")
+            elif cmd[0] == "terminate":
+                break
+
+
+    def run(self):
+        for thread in self.threads:
+            thread.start()
+        self.scheduler.scheduler()
+        for thread in self.threads:
+            thread.join()
+
+
+class test_scheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _scheduler(self, tests, num_workers=1, total_cpus=4, total_mem=4096,
+                   **dargs):
+        return kvm_scheduler.scheduler(tests, num_workers, total_cpus,
+                                       total_mem, self.tmpdir, **dargs)
+
+
+    def test_get_needs(self):
+        s = self._scheduler([])
+        test = _test("a", used_cpus="2", used_mem="1024", vms="vm1 vm2",
+                     images="image1", image_name="foo", image_format="raw",
+                     image_snapshot_vm2="yes",
+                     exclusive_resources=" hugepages")
+        self.assertEquals(s.get_needs(test),
+                          (2, 1024, set(["hugepages", "image:%s/foo.raw" %
+                                         self.tmpdir])))
+        self.assertEquals(s.get_needs(_test("b")), (1, 128, set()))
+
+
+    def test_place(self):
+        s = self._scheduler([], numa_nodes=[(2, 2048), (2, 2048)])
+        small = (1, 1024, set())
+        big = (3, 1024, set())
+        self.assertEquals(s.place(small, []), (True, 0))
+        # best fit: the node with the fewest CPUs left
+        self.assertEquals(s.place(small, [(small, 1)]), (True, 1))
+        # too big for any node
+        self.assertEquals(s.place(big, []), (True, None))
+        # but a test bigger than the whole host can run alone
+        self.assertEquals(s.place((8, 1024, set()), []), (True, None))
+        self.assertEquals(s.place(big, [(small, 0), (small, 1)]),
+                          (False, None))
+        self.assertEquals(s.place((1, 4000, set()), [(small, 0)]),
+                          (False, None))
+        locked = (1, 128, set(["hugepages"]))
+        self.assertEquals(s.place(locked, [(locked, None)]), (False, None))
+
+
+    def test_load_durations(self):
+        filename = os.path.join(self.tmpdir, "status.log")
+        open(filename, "w").write(
+                "START\t----\t----\ttimestamp=100\tlocaltime=x\t\n"
+                "\tSTART\tkvm.a\tkvm.a\ttimestamp=100\tlocaltime=x\t\n"
+                "\t\tGOOD\tkvm.a\tkvm.a\ttimestamp=150\tlocaltime=x\tok\n"
+                "\tEND GOOD\tkvm.a\tkvm.a\ttimestamp=160\tlocaltime=x\t\n"
+                "\tSTART\tkvm.b\tkvm.b\ttimestamp=160\tlocaltime=x\t\n"
+                "\tEND FAIL\tkvm.b\tkvm.b\ttimestamp=170\tlocaltime=x\t\n"
+                "\tSTART\tkvm.a\tkvm.a\ttimestamp=200\tlocaltime=x\t\n"
+                "\tEND GOOD\tkvm.a\tkvm.a\ttimestamp=280\tlocaltime=x\t\n"
+                "END GOOD\t----\t----\ttimestamp=300\tlocaltime=x\t\n")
+        self.assertEquals(kvm_scheduler.load_durations(
+                [filename, os.path.join(self.tmpdir, "missing")]),
+                {"kvm.a": 70.0, "kvm.b": 10.0})
+
+
+    def test_load_durations_of_client_jobs(self):
+        # a previous job, and the current one
+        resultdirs = [os.path.join(self.tmpdir, "results", name)
+                      for name in ("1-job", "2-job")]
+        for resultdir in resultdirs:
+            os.makedirs(resultdir)
+        os.mkdir(os.path.join(resultdirs[0], "kvm.a"))
+        class stub_job(object):
+            resultdir = resultdirs[0]
+            _record_indent = 0
+        previous_job = stub_job()
+        logger = base_job.status_logger(previous_job,
+                                        job.status_indenter(previous_job))
+        for status_code, timestamp in (("START", 100), ("GOOD", 150),
+                                       ("END GOOD", 160)):
+            logger.record_entry(base_job.status_log_entry(
+                    status_code, "kvm.a", "kvm.a", "", None, timestamp))
+        logger.close()
+
+        self.assertEquals(kvm_scheduler.load_durations(
+                kvm_scheduler.find_status_logs(resultdirs[1])),
+                {"kvm.a": 60.0})
+
+
+    def test_longest_first(self):
+        tests = [_test("a"), _test("b"), _test("c"), _test("d")]
+        durations = {"kvm.a": 10, "kvm.b": 100, "kvm.d": 50}
+        workers = fake_workers(self._scheduler(tests, durations=durations))
+        workers.run()
+        # c never ran, it is expected to take the median duration, like d
+        self.assertEquals([i for w, i, args in workers.runs], [1, 2, 3, 0])
+
+
+    def test_dependencies(self):
+        tests = [_test("install"), _test("boot", depend=["install"])]
+        durations = {"kvm.boot": 100}
+        workers = fake_workers(self._scheduler(tests, durations=durations))
+        workers.run()
+        self.assertEquals([i for w, i, args in workers.runs], [0, 1])
+
+
+    def test_warm_vms(self):
+        tests = [_test("a", mem="512"), _test("b", mem="1024"),
+                 _test("c", mem="512")]
+        workers = fake_workers(self._scheduler(tests))
+        workers.run()
+        self.assertEquals([i for w, i, args in workers.runs], [0, 2, 1])
+
+
+    def test_numa_pinning(self):
+        tests = [_test("a", used_cpus="2"), _test("b", used_cpus="4")]
+        workers = fake_workers(self._scheduler(
+                tests, numa_nodes=[(2, 2048), (2, 2048)]))
+        workers.run()
+        self.assertEquals(workers.runs, [(0, 0, ["0"]), (0, 1, [])])
+
+
+    def test_numa_nodes_without_numactl(self):
+        def command(cmd):
+            raise ValueError("Missing command: %s" % cmd)
+        old_command = kvm_scheduler.os_dep.command
+        kvm_scheduler.os_dep.command = command
+        try:
+            self.assertEquals(kvm_scheduler.get_numa_nodes(), [])
+        finally:
+            kvm_scheduler.os_dep.command = old_command
+
+
+    def test_exclusive_resources(self):
+        tests = [_test("a", exclusive_resources="hugepages"),
+                 _test("b", exclusive_resources="hugepages")]
+        workers = fake_workers(self._scheduler(tests, num_workers=2))
+        workers.run()
+        # the worker which ran a cleans up before b runs elsewhere, or runs
+        # b itself
+        self.assertEquals(len(workers.runs), 2)
+        if workers.runs[0][0] != workers.runs[1][0]:
+            self.assertEquals(workers.cleanups[0], workers.runs[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
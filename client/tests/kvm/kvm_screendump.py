@@ -0,0 +1,411 @@
+"""
+Shared screendumps of VMs.
+
+Every VM gets a single ScreendumpService, which captures screendumps through
+the VM's monitor and hands each captured frame to all its subscribers, so the
+regular screendump history and step file barriers don't request separate
+screendumps of the same screen.  The history is written by HistoryWriter
+subscribers, which compare frames through hashes of horizontal bands of the
+image to skip encoding unchanged frames, and leave the JPEG encoding to a
+bounded pool of threads (EncoderPool).  StuckDetector subscribers compare
+frames the same way to warn about screens which stop changing.
+
+@copyright: Red Hat 2008-2011
+"""
+
+import os, time, logging, threading, Queue
+from autotest_lib.client.common_lib import utils
+import kvm_utils, ppm_utils
+try:
+    import PIL.Image
+except ImportError:
+    # kvm_preprocessing warns about it
+    pass
+
+
+# Height (in pixels) of the bands hashed to compare frames
+BAND_HEIGHT = 16
+
+
+class Frame(object):
+    """
+    A screendump of a VM, kept in memory.
+    """
+    def __init__(self, vm_name, width, height, data):
+        """
+        @param vm_name: Name of the VM the screendump was taken from.
+        @param width: Width of the image.
+        @param height: Height of the image.
+        @param data: Image data, in PPM format (without the header).
+        """
+        self.vm_name = vm_name
+        self.width = width
+        self.height = height
+        self.data = data
+        self.time = time.time()
+        self._md5sum = None
+        self._band_hashes = None
+
+
+    def get_md5sum(self):
+        """
+        Return the md5sum of the whole image (see ppm_utils.image_md5sum).
+        """
+        if self._md5sum is None:
+            self._md5sum = ppm_utils.image_md5sum(self.width, self.height,
+                                                  self.data)
+        return self._md5sum
+
+
+    def get_region_md5sum(self, x1, y1, dx, dy, cropped_image_filename=None):
+        """
+        Return the md5sum of a region of the image (see
+        ppm_utils.get_region_md5sum).
+        """
+        return ppm_utils.get_region_md5sum(self.width, self.height, self.data,
+                                           x1, y1, dx, dy,
+                                           cropped_image_filename)
+
+
+    def get_band_hashes(self):
+        """
+        Return the md5 digests of the horizontal bands of BAND_HEIGHT rows
+        the image is made of.  The rows of a band are contiguous in the image
+        data, so they are hashed without any copy.
+        """
+        if self._band_hashes is None:
+            band_size = self.width * BAND_HEIGHT * 3
+            self._band_hashes = [
+                    utils.hash("md5", buffer(self.data, i, band_size)).digest()
+                    for i in xrange(0, self.width * self.height * 3,
+                                    band_size)]
+        return self._band_hashes
+
+
+    def count_changed_bands(self, other):
+        """
+        Return the number of bands of the image which differ from the ones
+        of another frame, or None if the frames have different sizes.
+        """
+        if (self.width, self.height) != (other.width, other.height):
+            return None
+        changed = 0
+        for band, other_band in zip(self.get_band_hashes(),
+                                    other.get_band_hashes()):
+            if band != other_band:
+                changed += 1
+        return changed
+
+
+    def save_ppm(self, filename):
+        ppm_utils.image_write_to_ppm_file(filename, self.width, self.height,
+                                          self.data)
+
+
+    def save_jpeg(self, filename, quality):
+        """
+        Encode the image to a JPEG file.
+
+        @raise NameError: If PIL is not installed.
+        """
+        image = PIL.Image.frombuffer("RGB", (self.width, self.height),
+                                     self.data, "raw", "RGB", 0, 1)
+        image.save(filename, format="JPEG", quality=quality)
+
+
+class ScreendumpService(object):
+    """
+    Takes the screendumps of a VM and hands them out to its subscribers.
+    """
+    def __init__(self, vm, temp_dir):
+        """
+        @param vm: The VM.
+        @param temp_dir: Directory where the screendumps are written by the
+                VM before being read in memory.
+        """
+        self.vm = vm
+        self.temp_dir = temp_dir
+        self.last_frame = None
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+
+    def subscribe(self, callback):
+        """
+        Call callback with every new frame captured from now on.  Callbacks
+        are called from the thread capturing the frame, so they must be quick.
+        """
+        self._lock.acquire()
+        try:
+            self._subscribers.append(callback)
+        finally:
+            self._lock.release()
+
+
+    def unsubscribe(self, callback):
+        self._lock.acquire()
+        try:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+        finally:
+            self._lock.release()
+
+
+    def _take_screendump(self):
+        temp_filename = os.path.join(self.temp_dir, "scrdump-%s-%s.ppm" %
+                                     (self.vm.name,
+                                      kvm_utils.generate_random_string(6)))
+        self.vm.monitor.screendump(temp_filename)
+        if not os.path.exists(temp_filename):
+            logging.warn("VM '%s' failed to produce a screendump",
+                         self.vm.name)
+            return None
+        try:
+            if not ppm_utils.image_verify_ppm_file(temp_filename):
+                logging.warn("VM '%s' produced an invalid screendump",
+                             self.vm.name)
+                return None
+            (w, h, data) = ppm_utils.image_read_from_ppm_file(temp_filename)
+            return Frame(self.vm.name, w, h, data)
+        finally:
+            os.unlink(temp_filename)
+
+
+    def capture(self, max_age=0):
+        """
+        Return a screendump of the VM, reusing the last one captured if it's
+        recent enough.
+
+        @param max_age: Maximum age (in seconds) of the returned frame.
+        @return: A Frame, or None if the VM didn't produce a valid
+                screendump.
+        @raise kvm_monitor.MonitorError: If the screendump command fails.
+        """
+        self._lock.acquire()
+        try:
+            frame = self.last_frame
+            if frame and time.time() - frame.time <= max_age:
+                return frame
+            frame = self._take_screendump()
+            if not frame:
+                return None
+            self.last_frame = frame
+            subscribers = list(self._subscribers)
+        finally:
+            self._lock.release()
+
+        for callback in subscribers:
+            try:
+                callback(frame)
+            except Exception, e:
+                logging.error("Screendump subscriber failed: %s", e)
+        return frame
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_service(vm, temp_dir):
+    """
+    Return the ScreendumpService of a VM, creating it if needed.
+
+    @param vm: The VM.
+    @param temp_dir: Temporary directory for the screendumps, used if the
+            service is created.
+    """
+    _services_lock.acquire()
+    try:
+        service = _services.get(vm.name)
+        if service is None:
+            service = ScreendumpService(vm, temp_dir)
+            _services[vm.name] = service
+        # the VM object may have been recreated
+        service.vm = vm
+        return service
+    finally:
+        _services_lock.release()
+
+
+class EncoderPool(object):
+    """
+    A bounded pool of threads encoding frames to JPEG files.
+    """
+    def __init__(self, threads=2, max_pending=None):
+        """
+        @param threads: Number of encoding threads.
+        @param max_pending: Maximum number of frames waiting to be encoded,
+                twice the number of threads by default.
+        """
+        if max_pending is None:
+            max_pending = 2 * threads
+        self._queue = Queue.Queue(max_pending)
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            frame, filename, quality, callback = job
+            try:
+                frame.save_jpeg(filename, quality)
+            except NameError:
+                # no PIL
+                continue
+            except Exception, e:
+                logging.warn("Failed to save screendump %s: %s", filename, e)
+                continue
+            if callback:
+                callback(frame, filename)
+
+
+    def submit(self, frame, filename, quality, callback=None):
+        """
+        Queue a frame to be encoded, unless too many frames are waiting.
+
+        @param callback: Called with the frame and filename once encoded.
+        @return: True if the frame was queued, False if it was dropped.
+        """
+        try:
+            self._queue.put((frame, filename, quality, callback), False)
+            return True
+        except Queue.Full:
+            return False
+
+
+    def close(self, timeout=None):
+        """
+        Encode the frames still queued and stop the threads.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class HistoryWriter(object):
+    """
+    Screendump subscriber saving the frames of a VM as JPEG files, at most
+    one every delay seconds.  Frames identical to one already saved, or
+    which differ from the last one saved in at most max_changed_bands bands
+    (e.g. just a blinking cursor), are not encoded again: the existing file
+    is linked instead.
+    """
+    def __init__(self, directory, encoder, delay=5, quality=30,
+                 max_changed_bands=0):
+        """
+        @param directory: Directory where the JPEG files are saved.
+        @param encoder: The EncoderPool encoding the frames.
+        @param delay: Minimum time (in seconds) between two saved frames.
+        @param quality: JPEG quality of the saved files.
+        @param max_changed_bands: Number of changed bands below which frames
+                are considered unchanged.
+        """
+        self.directory = directory
+        self.encoder = encoder
+        self.delay = delay
+        self.quality = quality
+        self.max_changed_bands = max_changed_bands
+        self._last_time = None
+        self._last_queued = None
+        # md5sum of the frames saved -> filename
+        self._cache = {}
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+
+    def _on_encoded(self, frame, filename):
+        # Called from the encoding threads
+        self._cache[frame.get_md5sum()] = filename
+
+
+    def _link(self, source, filename):
+        try:
+            os.link(source, filename)
+        except OSError:
+            pass
+
+
+    def __call__(self, frame):
+        if (self._last_time is not None and
+            frame.time - self._last_time < self.delay):
+            return
+        self._last_time = frame.time
+        filename = os.path.join(self.directory, "%s_%s.jpg" %
+                                (frame.vm_name,
+                                 time.strftime("%Y-%m-%d_%H-%M-%S",
+                                               time.localtime(frame.time))))
+
+        source = self._cache.get(frame.get_md5sum())
+        if source:
+            self._link(source, filename)
+            return
+        last = self._last_queued
+        if last:
+            changed = frame.count_changed_bands(last)
+            if changed is not None and changed <= self.max_changed_bands:
+                # The previous frame may still be waiting to be encoded, in
+                # which case this one is simply left out of the history
+                source = self._cache.get(last.get_md5sum())
+                if source:
+                    self._link(source, filename)
+                return
+
+        if self.encoder.submit(frame, filename, self.quality,
+                               self._on_encoded):
+            self._last_queued = frame
+        else:
+            logging.debug("Screendump encoders busy, dropping screendump of "
+                          "VM '%s'", frame.vm_name)
+
+
+class StuckDetector(object):
+    """
+    Screendump subscriber warning when the screen of a VM stops changing,
+    i.e. when max_frames consecutive frames differ in at most
+    max_changed_bands bands.
+    """
+    def __init__(self, description, max_frames=10, max_changed_bands=0):
+        """
+        @param description: What the VM is expected to be doing (e.g. "step
+                5"), for the warning.
+        @param max_frames: Number of unchanged frames after which the screen
+                is considered stuck.
+        @param max_changed_bands: Number of changed bands below which frames
+                are considered unchanged.
+        """
+        self.description = description
+        self.max_frames = max_frames
+        self.max_changed_bands = max_changed_bands
+        self.stuck = False
+        # the first frame of the current unchanged run, and the run length
+        self._reference = None
+        self._unchanged = 0
+
+
+    def __call__(self, frame):
+        reference = self._reference
+        if reference:
+            changed = frame.count_changed_bands(reference)
+            if changed is not None and changed <= self.max_changed_bands:
+                self._unchanged += 1
+                if self._unchanged >= self.max_frames and not self.stuck:
+                    self.stuck = True
+                    logging.warn("Screen of VM '%s' unchanged for %d "
+                                 "screendumps (%.1f seconds) during %s",
+                                 frame.vm_name, self._unchanged,
+                                 frame.time - reference.time,
+                                 self.description)
+                return
+        self._reference = frame
+        self._unchanged = 1
+        self.stuck = False
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, unittest
+import common
+import kvm_screendump, ppm_utils
+
+
+class FakeMonitor(object):
+    def __init__(self, images):
+        self.images = images
+        self.screendumps = 0
+
+
+    def screendump(self, filename):
+        w, h, data = self.images[min(self.screendumps, len(self.images) - 1)]
+        self.screendumps += 1
+        ppm_utils.image_write_to_ppm_file(filename, w, h, data)
+
+
+class FakeVM(object):
+    def __init__(self, name, images):
+        self.name = name
+        self.monitor = FakeMonitor(images)
+
+
+class FakeEncoder(object):
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.jobs = []
+
+
+    def submit(self, frame, filename, quality, callback=None):
+        if not self.accept:
+            return False
+        self.jobs.append((frame, filename))
+        open(filename, "w").write("jpeg")
+        callback(frame, filename)
+        return True
+
+
+def _image(width, height, changed_rows=()):
+    rows = []
+    for y in range(height):
+        if y in changed_rows:
+            rows.append("\xff" * width * 3)
+        else:
+            rows.append("\x00" * width * 3)
+    return width, height, "".join(rows)
+
+
+def _frame(image, t=0, name="vm1"):
+    frame = kvm_screendump.Frame(name, *image)
+    frame.time = t
+    return frame
+
+
+class test_frame(unittest.TestCase):
+    def test_hashes(self):
+        frame = _frame(_image(8, 40))
+        w, h, data = _image(8, 40)
+        self.assertEquals(frame.get_md5sum(),
+                          ppm_utils.image_md5sum(w, h, data))
+        self.assertEquals(frame.get_region_md5sum(1, 2, 3, 4),
+                          ppm_utils.get_region_md5sum(w, h, data, 1, 2, 3, 4))
+        # 40 rows make two full bands and a partial one
+        self.assertEquals(len(frame.get_band_hashes()), 3)
+
+
+    def test_count_changed_bands(self):
+        frame = _frame(_image(8, 40))
+        self.assertEquals(frame.count_changed_bands(_frame(_image(8, 40))), 0)
+        self.assertEquals(
+                frame.count_changed_bands(_frame(_image(8, 40, [0, 1]))), 1)
+        self.assertEquals(
+                frame.count_changed_bands(_frame(_image(8, 40, [0, 39]))), 2)
+        self.assertEquals(frame.count_changed_bands(_frame(_image(8, 32))),
+                          None)
+
+
+class test_service(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.vm = FakeVM("vm1", [_image(4, 4), _image(4, 4, [1])])
+        self.service = kvm_screendump.ScreendumpService(self.vm, self.tmpdir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_capture(self):
+        frames = []
+        self.service.subscribe(frames.append)
+        frame = self.service.capture()
+        self.assertEquals((frame.width, frame.height, frame.data),
+                          _image(4, 4))
+        self.assertEquals(frames, [frame])
+        # the temporary file is gone
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+        self.service.unsubscribe(frames.append)
+        self.assertNotEquals(self.service.capture(), frame)
+        self.assertEquals(frames, [frame])
+
+
+    def test_capture_reuses_recent_frames(self):
+        frame = self.service.capture()
+        self.assert_(self.service.capture(max_age=60) is frame)
+        self.assertEquals(self.vm.monitor.screendumps, 1)
+        frame.time -= 120
+        self.assert_(self.service.capture(max_age=60) is not frame)
+        self.assertEquals(self.vm.monitor.screendumps, 2)
+
+
+    def test_get_service(self):
+        service = kvm_screendump.get_service(self.vm, self.tmpdir)
+        vm = FakeVM("vm1", [])
+        self.assert_(kvm_screendump.get_service(vm, self.tmpdir) is service)
+        self.assert_(service.vm is vm)
+
+
+class test_history_writer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.encoder = FakeEncoder()
+        self.writer = kvm_screendump.HistoryWriter(self.tmpdir, self.encoder,
+                                                   delay=5,
+                                                   max_changed_bands=1)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def test_delay(self):
+        self.writer(_frame(_image(8, 40), 0))
+        self.writer(_frame(_image(8, 40, [20]), 1))
+        self.assertEquals(len(self.encoder.jobs), 1)
+        self.assertEquals(len(os.listdir(self.tmpdir)), 1)
+
+
+    def test_unchanged_frames_are_linked(self):
+        self.writer(_frame(_image(8, 40), 0))
+        # a single band changed
+        self.writer(_frame(_image(8, 40, [0]), 10))
+        self.assertEquals(len(self.encoder.jobs), 1)
+        # two bands changed
+        self.writer(_frame(_image(8, 40, [0, 39]), 20))
+        self.assertEquals(len(self.encoder.jobs), 2)
+        # identical to the first one
+        self.writer(_frame(_image(8, 40), 30))
+        self.assertEquals(len(self.encoder.jobs), 2)
+
+        filenames = [os.path.join(self.tmpdir, f)
+                     for f in sorted(os.listdir(self.tmpdir))]
+        self.assertEquals(len(filenames), 4)
+        inodes = [os.stat(f).st_ino for f in filenames]
+        self.assertEquals(inodes[0], inodes[1])
+        self.assertEquals(inodes[0], inodes[3])
+        self.assertNotEquals(inodes[0], inodes[2])
+
+
+    def test_busy_encoder_drops_frames(self):
+        self.encoder.accept = False
+        self.writer(_frame(_image(8, 40), 0))
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+
+class test_stuck_detector(unittest.TestCase):
+    def test_stuck(self):
+        detector = kvm_screendump.StuckDetector("step 1", max_frames=3,
+                                                max_changed_bands=1)
+        detector(_frame(_image(8, 40), 0))
+        # a single band changed
+        detector(_frame(_image(8, 40, [0]), 1))
+        self.assertFalse(detector.stuck)
+        detector(_frame(_image(8, 40), 2))
+        self.assert_(detector.stuck)
+        # two bands changed
+        detector(_frame(_image(8, 40, [0, 39]), 3))
+        self.assertFalse(detector.stuck)
+
+
+class test_encoder_pool(unittest.TestCase):
+    def test_drops_when_full(self):
+        pool = kvm_screendump.EncoderPool(threads=1, max_pending=1)
+        # stop the thread so that submitted frames stay queued
+        pool._queue.put(None)
+        pool._threads[0].join()
+        frame = _frame(_image(4, 4))
+        self.assert_(pool.submit(frame, "/nonexistent/a.jpg", 30))
+        self.assertFalse(pool.submit(frame, "/nonexistent/b.jpg", 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
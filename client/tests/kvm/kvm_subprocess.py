@@ -185,7 +185,7 @@ if __name__ == "__main__":
 
 # The following is the client part of the module.
 
-import subprocess, time, signal, re, threading, logging
+import subprocess, time, signal, re, threading, logging, errno
 import common, kvm_utils
 
 
@@ -358,13 +358,13 @@ class Spawn:
     responsible for restoring its own state by properly defining
     __getinitargs__().
 
-    The first named pipe is used by _tail(), a function that runs in the
-    background and reports new output from the child as it is produced.
+    The first named pipe is used by Tail, which reports new output from the
+    child in the background as it is produced.
     The second named pipe is used by a set of functions that read and parse
     output as requested by the user in an interactive manner, similar to
     pexpect.
     When unpickled it automatically
-    resumes _tail() if needed.
+    resumes reporting output if needed.
     """
 
     def __init__(self, command=None, id=None, auto_close=False, echo=False,
@@ -630,20 +630,235 @@ class Spawn:
         self.send(str + self.linesep)
 
 
-_thread_kill_requested = False
+class _Poller(object):
+    """
+    Wait for input on a set of file descriptors, using epoll where available
+    and poll elsewhere.
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.eventmask = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            # epoll timeouts are in seconds, poll timeouts in milliseconds
+            self.timeout_scale = 1
+        else:
+            self.poller = select.poll()
+            self.eventmask = select.POLLIN | select.POLLHUP | select.POLLERR
+            self.timeout_scale = 1000
+
+
+    def register(self, fd):
+        self.poller.register(fd, self.eventmask)
+
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # Already closed
+            pass
+
+
+    def poll(self, timeout=None):
+        """
+        Return the file descriptors with pending events.
+
+        @param timeout: Time (seconds) to wait for events, or None to wait
+                indefinitely.
+        """
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout *= self.timeout_scale
+        try:
+            return [fd for fd, event in self.poller.poll(timeout)]
+        except (IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+
+class _TailReactor(object):
+    """
+    Report the output of all Tail instances from a single thread, waiting
+    for all their reader pipes at once.
+
+    The thread exits when no Tail is left, and is started again by the next
+    one.
+    """
+    # Time (seconds) without new data after which an incomplete line of
+    # output is reported anyway
+    flush_delay = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps reader fds to [tail, incomplete line, flush time] lists
+        self.tails = {}
+        self.thread = None
+        self.stop_requested = False
+        self.poller = None
+
+
+    def _setup(self):
+        self.poller = _Poller()
+        # Writing to this pipe wakes the thread up
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.poller.register(self.wakeup_r)
+
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_w, "x")
+        except OSError:
+            # The pipe is full, so the thread is awake anyway
+            pass
+
+
+    def add(self, tail, fd):
+        """
+        Start reporting the output read from fd to tail.
+        """
+        self.lock.acquire()
+        try:
+            if self.poller is None:
+                self._setup()
+            if fd in self.tails:
+                return
+            self.tails[fd] = [tail, "", None]
+            self.poller.register(fd)
+            if self.thread:
+                # Make the thread wait for the new fd too
+                self._wakeup()
+            else:
+                self.thread = threading.Thread(target=self._run,
+                                               name="tail_reactor")
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+
+    def is_reactor_thread(self):
+        return threading.currentThread() is self.thread
+
+
+    def stop(self):
+        """
+        Stop reporting output, and forget all Tail instances.
+        """
+        self.lock.acquire()
+        try:
+            thread = self.thread
+            if thread:
+                self.stop_requested = True
+                self._wakeup()
+        finally:
+            self.lock.release()
+        if thread and thread is not threading.currentThread():
+            thread.join(10)
+        self.lock.acquire()
+        try:
+            for fd, entry in self.tails.items():
+                self.poller.unregister(fd)
+                entry[0]._tail_done.set()
+            self.tails.clear()
+            self.stop_requested = False
+        finally:
+            self.lock.release()
+
+
+    def _read(self, fd):
+        self.lock.acquire()
+        try:
+            entry = self.tails.get(fd)
+        finally:
+            self.lock.release()
+        if not entry:
+            return
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            data = ""
+        if not data:
+            # The process terminated
+            self.lock.acquire()
+            try:
+                del self.tails[fd]
+                self.poller.unregister(fd)
+            finally:
+                self.lock.release()
+            entry[0]._tail_finished(entry[1])
+            return
+        tail = entry[0]
+        buffer = entry[1] + data
+        # Send the output to output_func line by line (except for the last
+        # line)
+        if tail.output_func:
+            lines = buffer.split("\n")
+            for line in lines[:-1]:
+                tail._print_line(line)
+        # Leave only the last line
+        entry[1] = buffer[buffer.rfind("\n") + 1:]
+        if entry[1]:
+            entry[2] = time.time() + self.flush_delay
+        else:
+            entry[2] = None
+
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if self.stop_requested or not self.tails:
+                    self.thread = None
+                    return
+                flush_times = [entry[2] for entry in self.tails.values()
+                               if entry[2]]
+            finally:
+                self.lock.release()
+            timeout = None
+            if flush_times:
+                timeout = max(0, min(flush_times) - time.time())
+            for fd in self.poller.poll(timeout):
+                if fd == self.wakeup_r:
+                    try:
+                        os.read(self.wakeup_r, 1024)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    self._read(fd)
+                except Exception, e:
+                    logging.error("Error while reporting process output: %s",
+                                  e)
+            # No output came for a while; flush the incomplete lines
+            now = time.time()
+            self.lock.acquire()
+            try:
+                entries = self.tails.values()
+            finally:
+                self.lock.release()
+            for entry in entries:
+                if entry[2] and entry[2] <= now:
+                    entry[2] = None
+                    entry[0]._print_line(entry[1])
+                    entry[1] = ""
+
+
+_reactor = _TailReactor()
+
 
 def kill_tail_threads():
     """
-    Kill all Tail threads.
+    Stop reporting the output of all Tail instances.
 
-    After calling this function no new threads should be started.
+    After calling this function no new Tail instances should be started.
     """
-    global _thread_kill_requested
-    _thread_kill_requested = True
-    for t in threading.enumerate():
-        if hasattr(t, "name") and t.name.startswith("tail_thread"):
-            t.join(10)
-    _thread_kill_requested = False
+    _reactor.stop()
 
 
 class Tail(Spawn):
@@ -654,7 +869,8 @@ class Tail(Spawn):
     See Spawn's docstring.
 
     This class uses a single pipe reader to read data in real time from the
-    child process and report it to a given callback function.
+    child process and report it to a given callback function.  The pipes of
+    all instances are read by a single background thread.
     When the child process exits, its exit status is reported to an additional
     callback function.
 
@@ -692,7 +908,7 @@ class Tail(Spawn):
         """
         # Add a reader and a close hook
         self._add_reader("tail")
-        self._add_close_hook(Tail._join_thread)
+        self._add_close_hook(Tail._join_tail)
 
         # Init the superclass
         Spawn.__init__(self, command, id, auto_close, echo, linesep)
@@ -704,10 +920,10 @@ class Tail(Spawn):
         self.output_params = output_params
         self.output_prefix = output_prefix
 
-        # Start the thread in the background
-        self.tail_thread = None
+        # Start reporting output in the background
+        self._tail_done = None
         if termination_func or output_func:
-            self._start_thread()
+            self._start_tail()
 
 
     def __getinitargs__(self):
@@ -726,8 +942,8 @@ class Tail(Spawn):
                 Must take a single parameter -- the exit status.
         """
         self.termination_func = termination_func
-        if termination_func and not self.tail_thread:
-            self._start_thread()
+        if termination_func and not self._is_tailing():
+            self._start_tail()
 
 
     def set_termination_params(self, termination_params):
@@ -748,8 +964,8 @@ class Tail(Spawn):
                 output from the process.  Must take a single string parameter.
         """
         self.output_func = output_func
-        if output_func and not self.tail_thread:
-            self._start_thread()
+        if output_func and not self._is_tailing():
+            self._start_tail()
 
 
     def set_output_params(self, output_params):
@@ -772,79 +988,102 @@ class Tail(Spawn):
         self.output_prefix = output_prefix
 
 
-    def _tail(self):
-        def print_line(text):
-            # Pre-pend prefix and remove trailing whitespace
-            text = self.output_prefix + text.rstrip()
-            # Pass text to output_func
-            try:
-                params = self.output_params + (text,)
-                self.output_func(*params)
-            except TypeError:
-                pass
+    def _print_line(self, text):
+        # Pre-pend prefix and remove trailing whitespace
+        text = self.output_prefix + text.rstrip()
+        # Pass text to output_func
+        try:
+            params = self.output_params + (text,)
+            self.output_func(*params)
+        except TypeError:
+            pass
+
+
+    def _tail_finished(self, buffer):
+        """
+        Called by the reactor when the process terminates.
 
+        @param buffer: The last, incomplete line of output.
+        """
         try:
-            fd = self._get_fd("tail")
-            buffer = ""
-            while True:
-                global _thread_kill_requested
-                if _thread_kill_requested:
-                    return
-                try:
-                    # See if there's any data to read from the pipe
-                    r, w, x = select.select([fd], [], [], 0.05)
-                except:
-                    break
-                if fd in r:
-                    # Some data is available; read it
-                    new_data = os.read(fd, 1024)
-                    if not new_data:
-                        break
-                    buffer += new_data
-                    # Send the output to output_func line by line
-                    # (except for the last line)
-                    if self.output_func:
-                        lines = buffer.split("\n")
-                        for line in lines[:-1]:
-                            print_line(line)
-                    # Leave only the last line
-                    last_newline_index = buffer.rfind("\n")
-                    buffer = buffer[last_newline_index+1:]
-                else:
-                    # No output is available right now; flush the buffer
-                    if buffer:
-                        print_line(buffer)
-                        buffer = ""
-            # The process terminated; print any remaining output
+            # Print any remaining output
             if buffer:
-                print_line(buffer)
+                self._print_line(buffer)
             # Get the exit status, print it and send it to termination_func
             status = self.get_status()
             if status is None:
                 return
-            print_line("(Process terminated with status %s)" % status)
+            self._print_line("(Process terminated with status %s)" % status)
             try:
                 params = self.termination_params + (status,)
                 self.termination_func(*params)
             except TypeError:
                 pass
         finally:
-            self.tail_thread = None
+            self._tail_done.set()
+
+
+    def _is_tailing(self):
+        return self._tail_done is not None and not self._tail_done.isSet()
+
+
+    def _start_tail(self):
+        self._tail_done = threading.Event()
+        fd = self._get_fd("tail")
+        if fd is None:
+            self._tail_finished("")
+        else:
+            _reactor.add(self, fd)
+
+
+    def _join_tail(self):
+        # Wait until the termination of the process is reported, unless
+        # called by the reactor itself (e.g. by output_func)
+        done = self._tail_done
+        if done and not _reactor.is_reactor_thread():
+            done.wait()
 
 
-    def _start_thread(self):
-        self.tail_thread = threading.Thread(target=self._tail,
-                                            name="tail_thread_%s" % self.id)
-        self.tail_thread.start()
+# The following filters look only at the end of the output, growing the
+# window they scan until it contains a complete word or line, so matching
+# the end of a long output doesn't get slower as the output grows.
 
+def _get_last_word(str, window=256):
+    """
+    Return the last word of str, or "" if there are no words.
+    """
+    while True:
+        tail = str[-window:]
+        words = tail.split()
+        # The last word is complete if something precedes it in the window
+        if (window >= len(str) or len(words) > 1 or
+            (words and tail[0].isspace())):
+            break
+        window *= 2
+    if words:
+        return words[-1]
+    else:
+        return ""
 
-    def _join_thread(self):
-        # Wait for the tail thread to exit
-        # (it's done this way because self.tail_thread may become None at any
-        # time)
-        t = self.tail_thread
-        if t:
-            t.join()
+
+def _get_last_nonempty_line(str, window=256):
+    """
+    Return the last non-empty line of str, or "" if there are none.
+    """
+    while True:
+        lines = str[-window:].splitlines()
+        i = len(lines) - 1
+        while i >= 0 and not lines[i].strip():
+            i -= 1
+        # The last line is complete if a line break precedes it
+        if (window >= len(str) or i > 0 or
+            (i == 0 and str[-window - 1] in "\r\n")):
+            break
+        window *= 2
+    if i >= 0:
+        return lines[i]
+    else:
+        return ""
 
 
 class Expect(Tail):
@@ -914,7 +1153,7 @@ class Expect(Tail):
             except:
                 return data
             if fd in r:
-                new_data = os.read(fd, 1024)
+                new_data = os.read(fd, 65536)
                 if not new_data:
                     return data
                 data += new_data
@@ -1015,13 +1254,7 @@ class Expect(Tail):
                 terminates while waiting for output
         @raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_word(str):
-            if str:
-                return str.split()[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_word,
+        return self.read_until_output_matches(patterns, _get_last_word,
                                               timeout, internal_timeout,
                                               print_func)
 
@@ -1049,14 +1282,8 @@ class Expect(Tail):
                 terminates while waiting for output
         @raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_nonempty_line(str):
-            nonempty_lines = [l for l in str.splitlines() if l.strip()]
-            if nonempty_lines:
-                return nonempty_lines[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_nonempty_line,
+        return self.read_until_output_matches(patterns,
+                                              _get_last_nonempty_line,
                                               timeout, internal_timeout,
                                               print_func)
 
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+import random, threading, time, unittest
+import common
+import kvm_subprocess
+
+
+def _get_last_word(str):
+    if str.split():
+        return str.split()[-1]
+    else:
+        return ""
+
+
+def _get_last_nonempty_line(str):
+    nonempty_lines = [l for l in str.splitlines() if l.strip()]
+    if nonempty_lines:
+        return nonempty_lines[-1]
+    else:
+        return ""
+
+
+class test_filters(unittest.TestCase):
+    def test_filters(self):
+        # compare with filters scanning the whole string
+        random.seed(0)
+        for i in range(2000):
+            str = "".join(random.choice("ab \r\n")
+                          for j in range(random.randint(0, 40)))
+            self.assertEquals(kvm_subprocess._get_last_word(str, 2),
+                              _get_last_word(str))
+            self.assertEquals(kvm_subprocess._get_last_nonempty_line(str, 2),
+                              _get_last_nonempty_line(str))
+
+
+class test_tail(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.statuses = []
+        self.lock = threading.Lock()
+
+
+    def _output(self, line):
+        self.lock.acquire()
+        self.lines.append(line)
+        self.lock.release()
+
+
+    def _tail(self, command):
+        return kvm_subprocess.Tail(command, output_func=self._output,
+                                   termination_func=self.statuses.append)
+
+
+    def test_output(self):
+        tails = [self._tail("echo %d; echo -n partial%d; sleep 1; exit %d" %
+                            (i, i, i)) for i in range(3)]
+        time.sleep(0.5)
+        # the incomplete lines are flushed before the processes exit
+        self.assertEquals(sorted(self.lines),
+                          ["0", "1", "2", "partial0", "partial1", "partial2"])
+        # a single thread reports the output of all the processes
+        self.assertEquals(len([t for t in threading.enumerate()
+                               if t.getName() == "tail_reactor"]), 1)
+        # let the processes exit by themselves
+        time.sleep(1)
+        for tail in tails:
+            tail.close()
+        self.assertEquals(sorted(self.statuses), [0, 1, 2])
+        self.assert_("(Process terminated with status 2)" in self.lines)
+        self.assertEquals(kvm_subprocess._reactor.tails, {})
+
+
+    def test_kill_tail_threads(self):
+        tail = self._tail("echo start; sleep 30")
+        time.sleep(0.5)
+        kvm_subprocess.kill_tail_threads()
+        self.assertFalse(kvm_subprocess._reactor.thread)
+        tail.close()
+        self.assertEquals(self.lines, ["start"])
+        self.assertEquals(self.statuses, [])
+
+
+class test_shell_session(unittest.TestCase):
+    def test_cmd_output(self):
+        session = kvm_subprocess.ShellSession("sh")
+        try:
+            session.read_up_to_prompt(timeout=10)
+            self.assertEquals(session.cmd_output("seq 3", timeout=10),
+                              "1\n2\n3\n")
+            self.assertEquals(session.cmd_status("false", timeout=10), 1)
+        finally:
+            session.close()
+
+
+    def test_read_until_last_word_matches(self):
+        session = kvm_subprocess.Expect("echo foo; sleep 1; echo baaar; "
+                                        "sleep 30")
+        try:
+            self.assertEquals(session.read_until_last_word_matches(
+                    ["^foo$", "^ba+r$"], timeout=10), (0, "foo\n"))
+            self.assertEquals(session.read_until_last_word_matches(
+                    ["^ba+r$"], timeout=10), (0, "baaar\n"))
+            self.assertRaises(kvm_subprocess.ExpectTimeoutError,
+                              session.read_until_last_word_matches,
+                              ["^ba+r$"], timeout=0.5)
+        finally:
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
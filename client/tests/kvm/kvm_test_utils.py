@@ -105,9 +105,8 @@ def reboot(vm, session, method="shell", sleep_before_reset=10, nic_index=0,
         logging.info("Monitor command system_reset sent. Waiting for guest to "
                      "go down...")
         # Look for RESET QMP events
-        time.sleep(1)
         for m in monitors:
-            if not m.get_event("RESET"):
+            if not m.wait_for_event("RESET", 10):
                 raise error.TestFail("RESET QMP event not received after "
                                      "system_reset (monitor '%s')" % m.name)
             else:
@@ -180,10 +179,24 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
                     o.get("status") == "canceled")
 
     def wait_for_migration():
-        if not kvm_utils.wait_for(mig_finished, mig_timeout, 2, 2,
-                                  "Waiting for migration to finish..."):
-            raise error.TestFail("Timeout expired while waiting for migration "
-                                 "to finish")
+        if vm.monitor.protocol != "qmp":
+            if not kvm_utils.wait_for(mig_finished, mig_timeout, 2, 2,
+                                      "Waiting for migration to finish..."):
+                raise error.TestFail("Timeout expired while waiting for "
+                                     "migration to finish")
+            return
+        # The source VM stops when the migration completes, so wake up on
+        # its STOP event instead of waiting a whole polling step
+        logging.debug("Waiting for migration to finish...")
+        end_time = time.time() + mig_timeout
+        while not mig_finished():
+            if time.time() > end_time:
+                raise error.TestFail("Timeout expired while waiting for "
+                                     "migration to finish")
+            if vm.monitor.get_event("STOP"):
+                time.sleep(0.1)
+            else:
+                vm.monitor.wait_for_event("STOP", 2)
 
     if dest_host == 'localhost':
         dest_vm = vm.clone()
@@ -211,6 +224,8 @@ def migrate(vm, env=None, mig_timeout=3600, mig_protocol="tcp",
 
             if offline:
                 vm.monitor.cmd("stop")
+            if vm.monitor.protocol == "qmp":
+                vm.monitor.clear_events()
             vm.monitor.migrate(uri)
 
             if mig_cancel:
@@ -5,7 +5,7 @@ KVM test utility functions.
 """
 
 import time, string, random, socket, os, signal, re, logging, commands, cPickle
-import fcntl, shelve, ConfigParser
+import fcntl, shelve, ConfigParser, UserDict, cStringIO, threading
 from autotest_lib.client.bin import utils, os_dep
 from autotest_lib.client.common_lib import error, logging_config
 import kvm_subprocess
@@ -27,15 +27,284 @@ def _unlock_file(f):
     f.close()
 
 
+# Version of the format of env stores (see Env)
+ENV_FORMAT_VERSION = 1
+
+# Entries of these types are never shared by reference between entries
+_ENV_IMMUTABLE_TYPES = (int, long, float, bool, basestring, tuple,
+                        type(None))
+
+
+class EnvError(Exception):
+    pass
+
+
+class Env(UserDict.DictMixin):
+    """
+    The KVM test environment: a dict holding the VMs, sessions and caches
+    kept between tests.
+
+    dump_env() stores it as a directory, with an index and each entry in a
+    pickle of its own.  Entries are unpickled on first access, and only the
+    entries whose pickle changed are written again.  Objects which are
+    entries themselves (e.g. the address cache, which VMs and tcpdump hold
+    too) are pickled as references to their key, so they're still shared
+    once loaded again.
+
+    An env may be used by several threads (e.g. the screendump thread and
+    the test), so entries are accessed under a lock.
+    """
+    def __init__(self, dict=None):
+        """
+        @param dict: Initial entries.
+        """
+        # Entries loaded or set since the env was loaded
+        self._data = {}
+        # The store the env was loaded from, and its index (mapping keys to
+        # (filename, hash) tuples)
+        self._dirname = None
+        self._stored = {}
+        # Stored entries deleted since
+        self._deleted = set()
+        # Entries set since the env was loaded (loaded entries of immutable
+        # types can't have changed otherwise)
+        self._dirty = set()
+        self._lock = threading.RLock()
+        # The entries being unpickled by each thread
+        self._local = threading.local()
+        if dict:
+            self._data.update(dict)
+            self._dirty.update(dict)
+
+
+    def open(self, dirname):
+        """
+        Make the env refer to the entries stored in a directory.
+
+        @raise EnvError: Raised if the index can't be read, or has an
+                unknown format version.
+        """
+        try:
+            index = cPickle.load(open(os.path.join(dirname, "index"), "rb"))
+        except Exception, e:
+            raise EnvError("Could not read env index: %s" % e)
+        if index.get("format") != ENV_FORMAT_VERSION:
+            raise EnvError("Unknown env format version %s" %
+                           index.get("format"))
+        self._dirname = dirname
+        self._stored = index["entries"]
+
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            keys = set(self._data)
+            keys.update(key for key in self._stored
+                        if key not in self._deleted)
+            return list(keys)
+        finally:
+            self._lock.release()
+
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            return key in self._data or (key in self._stored and
+                                         key not in self._deleted)
+        finally:
+            self._lock.release()
+
+
+    has_key = __contains__
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def items(self):
+        # Skip the entries which can't be loaded
+        items = []
+        for key in self.keys():
+            try:
+                items.append((key, self[key]))
+            except KeyError:
+                pass
+        return items
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                return self._data[key]
+            if key not in self._stored or key in self._deleted:
+                raise KeyError(key)
+            # Other threads wait for the lock, so only references made by
+            # the entries this thread is unpickling can be circular
+            loading = self._local.__dict__.setdefault("loading", set())
+            if key in loading:
+                raise EnvError("Circular reference to env entry %r" % key)
+            loading.add(key)
+            try:
+                try:
+                    f = open(os.path.join(self._dirname,
+                                          self._stored[key][0]), "rb")
+                    try:
+                        unpickler = cPickle.Unpickler(f)
+                        unpickler.persistent_load = self.__getitem__
+                        value = unpickler.load()
+                    finally:
+                        f.close()
+                # Almost any exception can be raised during unpickling
+                except Exception, e:
+                    logging.warn("Could not load env entry %r: %s", key, e)
+                    self._deleted.add(key)
+                    raise KeyError(key)
+            finally:
+                loading.discard(key)
+            self._data[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data[key] = value
+            self._dirty.add(key)
+            self._deleted.discard(key)
+        finally:
+            self._lock.release()
+
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            if key not in self:
+                raise KeyError(key)
+            self._data.pop(key, None)
+            self._dirty.discard(key)
+            if key in self._stored:
+                self._deleted.add(key)
+        finally:
+            self._lock.release()
+
+
+    def __repr__(self):
+        items = ["%r: %r" % item for item in self._data.items()]
+        items += ["%r: <not loaded>" % key for key in self.keys()
+                  if key not in self._data]
+        return "{%s}" % ", ".join(items)
+
+
+    def _pickle(self, key, refs):
+        """
+        Return the pickle of an entry.
+
+        @param refs: A dict mapping the ids of shareable entries to their
+                keys.
+        """
+        value = self._data[key]
+        def persistent_id(obj):
+            if obj is not value:
+                return refs.get(id(obj))
+        s = cStringIO.StringIO()
+        pickler = cPickle.Pickler(s, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(value)
+        return s.getvalue()
+
+
+    def save(self, dirname):
+        """
+        Store the env in a directory, writing only the entries which changed
+        since it was loaded from there.  Entries which weren't accessed
+        aren't pickled again, nor are the immutable ones which weren't set.
+        """
+        self._lock.acquire()
+        try:
+            self._save(dirname)
+        finally:
+            self._lock.release()
+
+
+    def _save(self, dirname):
+        if dirname != self._dirname:
+            # Copy all entries to the new store
+            self.items()
+            self._stored = {}
+            self._deleted = set()
+        if os.path.isfile(dirname):
+            # An env file of the old format
+            os.unlink(dirname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        refs = dict((id(value), key) for key, value in self._data.items()
+                    if not isinstance(value, _ENV_IMMUTABLE_TYPES))
+        entries = dict((key, entry) for key, entry in self._stored.items()
+                       if key not in self._deleted)
+        for key, value in self._data.items():
+            if (key in entries and key not in self._dirty and
+                isinstance(value, _ENV_IMMUTABLE_TYPES)):
+                continue
+            data = self._pickle(key, refs)
+            hash = utils.hash("sha1", data).hexdigest()
+            if key in entries and entries[key][1] == hash:
+                continue
+            filename = "%s.pickle" % utils.hash("sha1", key).hexdigest()
+            _write_file_atomically(os.path.join(dirname, filename), data)
+            entries[key] = (filename, hash)
+        _write_file_atomically(os.path.join(dirname, "index"),
+                               cPickle.dumps({"format": ENV_FORMAT_VERSION,
+                                              "entries": entries},
+                                             cPickle.HIGHEST_PROTOCOL))
+        # Remove the entries which were deleted
+        filenames = set(filename for filename, hash in entries.values())
+        for filename in os.listdir(dirname):
+            if filename != "index" and filename not in filenames:
+                os.unlink(os.path.join(dirname, filename))
+
+        self._dirname = dirname
+        self._stored = entries
+        self._deleted = set()
+        self._dirty = set()
+
+
+def _write_file_atomically(filename, data):
+    temp_filename = filename + ".tmp"
+    f = open(temp_filename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(temp_filename, filename)
+
+
 def dump_env(obj, filename):
     """
     Dump KVM test environment to a file.
 
+    @param obj: An Env, or a dict of environment items.
     @param filename: Path to a file where the environment will be dumped to.
     """
-    file = open(filename, "w")
-    cPickle.dump(obj, file)
-    file.close()
+    if not isinstance(obj, Env):
+        obj = Env(obj)
+    obj.save(filename)
 
 
 def load_env(filename, version):
@@ -44,13 +313,19 @@ def load_env(filename, version):
     If the version recorded in the file is lower than version, return an empty
     env.  If some other error occurs during unpickling, return an empty env.
 
-    @param filename: Path to an env file.
+    @param filename: Path to an env file (a directory written by dump_env(),
+            or a single pickle written by older versions).
+    @return: An Env.
     """
-    default = {"version": version}
+    default = Env({"version": version})
+    env = Env()
     try:
-        file = open(filename, "r")
-        env = cPickle.load(file)
-        file.close()
+        if os.path.isdir(filename):
+            env.open(filename)
+        else:
+            file = open(filename, "r")
+            env.update(cPickle.load(file))
+            file.close()
         if env.get("version", 0) < version:
             logging.warn("Incompatible env file found. Not using it.")
             return default
@@ -253,12 +528,16 @@ def is_vm(obj):
 
 def env_get_all_vms(env):
     """
-    Return a list of all VM objects on a given environment.
+    Return a list of all VM objects on a given environment.  Only the VM
+    entries are looked at, so other entries aren't unpickled.
 
     @param env: Dictionary with environment items.
     """
     vms = []
-    for obj in env.values():
+    for key in env.keys():
+        if not key.startswith("vm__"):
+            continue
+        obj = env.get(key)
         if is_vm(obj):
             vms.append(obj)
     return vms
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, threading, time, unittest, cPickle
+import common
+import kvm_utils
+
+
+class fake_vm(object):
+    def __init__(self, name, address_cache):
+        self.name = name
+        self.address_cache = address_cache
+
+
+class VM(fake_vm):
+    """Taken for a VM by kvm_utils.is_vm(), and slow to unpickle."""
+    def __setstate__(self, state):
+        time.sleep(0.1)
+        self.__dict__.update(state)
+
+
+class test_env(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "env")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _dump_and_load(self, env):
+        kvm_utils.dump_env(env, self.filename)
+        return kvm_utils.load_env(self.filename, 0)
+
+
+    def _mtimes(self):
+        mtimes = {}
+        for filename in os.listdir(self.filename):
+            st = os.stat(os.path.join(self.filename, filename))
+            mtimes[filename] = (st.st_mtime, st.st_ino)
+        return mtimes
+
+
+    def test_shared_entries(self):
+        address_cache = {}
+        env = {"version": 0, "address_cache": address_cache,
+               "vm__vm1": fake_vm("vm1", address_cache),
+               "vm__vm2": fake_vm("vm2", address_cache)}
+        env = self._dump_and_load(env)
+        self.assertEquals(sorted(env.keys()),
+                          ["address_cache", "version", "vm__vm1", "vm__vm2"])
+        # entries are loaded on first access
+        self.assertEquals(env._data.keys(), ["version"])
+        vm1 = env["vm__vm1"]
+        self.assertEquals(sorted(env._data.keys()),
+                          ["address_cache", "version", "vm__vm1"])
+        self.assert_(vm1.address_cache is env["address_cache"])
+        self.assert_(env["vm__vm2"].address_cache is env["address_cache"])
+
+
+    def test_incremental_dump(self):
+        env = {"version": 0, "address_cache": {}, "vm__vm1": fake_vm("vm1", {}),
+               "vm__vm2": fake_vm("vm2", {})}
+        env = self._dump_and_load(env)
+        mtimes = self._mtimes()
+        env["vm__vm1"]
+        env["address_cache"]["00:11:22:33:44:55"] = "10.0.0.1"
+        del env["vm__vm2"]
+        env["tcpdump"] = "tail"
+        kvm_utils.dump_env(env, self.filename)
+        new_mtimes = self._mtimes()
+        # only the changed entries are written again
+        changed = [filename for filename in new_mtimes
+                   if mtimes.get(filename) != new_mtimes[filename]]
+        self.assertEquals(len(changed), 3)
+        self.assertEquals(len(new_mtimes), len(mtimes))
+
+        env = kvm_utils.load_env(self.filename, 0)
+        self.assertEquals(sorted(env.keys()),
+                          ["address_cache", "tcpdump", "version", "vm__vm1"])
+        self.assertEquals(env["address_cache"],
+                          {"00:11:22:33:44:55": "10.0.0.1"})
+        self.assertEquals(env["vm__vm1"].name, "vm1")
+
+
+    def test_unchanged_entries_not_pickled(self):
+        env = self._dump_and_load({"version": 0, "foo": "bar",
+                                   "vm__vm1": fake_vm("vm1", {})})
+        pickled = []
+        old_pickle = env._pickle
+        def _pickle(key, refs):
+            pickled.append(key)
+            return old_pickle(key, refs)
+        env._pickle = _pickle
+        env["foo"]
+        env["vm__vm1"]
+        kvm_utils.dump_env(env, self.filename)
+        # loaded mutable entries may have changed in place
+        self.assertEquals(pickled, ["vm__vm1"])
+        env["foo"] = "baz"
+        kvm_utils.dump_env(env, self.filename)
+        self.assertEquals(sorted(pickled), ["foo", "vm__vm1", "vm__vm1"])
+
+
+    def test_get_all_vms(self):
+        env = self._dump_and_load({"version": 0, "address_cache": {},
+                                   "vm__vm1": VM("vm1", {}),
+                                   "vm__vm2": VM("vm2", {})})
+        # concurrent loads of an entry wait for each other
+        results = []
+        def get_all_vms():
+            results.append(kvm_utils.env_get_all_vms(env))
+        threads = [threading.Thread(target=get_all_vms) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(results), 2)
+        self.assertEquals(sorted([vm.name for vm in results[0]]),
+                          ["vm1", "vm2"])
+        for vm in results[0]:
+            self.assert_(vm in results[1])
+        # other entries aren't loaded
+        self.assertEquals(sorted(env._data.keys()),
+                          ["version", "vm__vm1", "vm__vm2"])
+
+
+    def test_old_format(self):
+        cPickle.dump({"version": 0, "foo": "bar"}, open(self.filename, "w"))
+        env = kvm_utils.load_env(self.filename, 0)
+        self.assertEquals(env["foo"], "bar")
+        env = self._dump_and_load(env)
+        self.assert_(os.path.isdir(self.filename))
+        self.assertEquals(env["foo"], "bar")
+
+
+    def test_version(self):
+        env = self._dump_and_load({"version": 0, "foo": "bar"})
+        env = kvm_utils.load_env(self.filename, 1)
+        self.assertEquals(env.items(), [("version", 1)])
+        # the store is replaced when dumped
+        env = self._dump_and_load(env)
+        self.assertEquals(env.items(), [("version", 1)])
+        self.assertEquals(len(os.listdir(self.filename)), 2)
+
+
+    def test_broken_entry(self):
+        env = self._dump_and_load({"version": 0, "foo": "bar", "baz": 1})
+        for filename in os.listdir(self.filename):
+            if filename != "index":
+                open(os.path.join(self.filename, filename), "w").write("x")
+        env = kvm_utils.load_env(self.filename, 0)
+        self.assertEquals(env.items(), [])
+        self.assertEquals(env.get("foo"), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -173,6 +173,8 @@ class VM:
                x11_display -- if specified, the DISPLAY environment variable
                will be be set to this value for the qemu process (useful for
                SDL rendering)
+               numa_node -- if specified, the qemu process is bound to the
+               CPUs and memory of this NUMA node (with numactl)
                images -- a list of image object names, separated by spaces
                nics -- a list of NIC object names, separated by spaces
 
@@ -362,6 +364,10 @@ class VM:
         # Set the X11 display parameter if requested
         if params.get("x11_display"):
             qemu_cmd += "DISPLAY=%s " % params.get("x11_display")
+        # Pin the VM to a NUMA node if requested
+        if params.get("numa_node"):
+            qemu_cmd += ("numactl --cpunodebind=%s --membind=%s " %
+                         (params.get("numa_node"), params.get("numa_node")))
         # Add the qemu binary
         qemu_cmd += qemu_binary
         # Add the VM's name
@@ -698,7 +704,9 @@ class VM:
                             # Add a QMP monitor
                             monitor = kvm_monitor.QMPMonitor(
                                 monitor_name,
-                                self.get_monitor_filename(monitor_name))
+                                self.get_monitor_filename(monitor_name),
+                                async_mode=(monitor_params.get(
+                                        "monitor_async") == "yes"))
                         else:
                             # Add a "human" monitor
                             monitor = kvm_monitor.HumanMonitor(
@@ -709,6 +717,7 @@ class VM:
                     else:
                         if monitor.is_responsive():
                             break
+                        monitor.close()
                     time.sleep(1)
                 else:
                     logging.error("Could not connect to monitor '%s'" %
@@ -816,6 +825,8 @@ class VM:
             logging.error("Process %s is a zombie!" % self.process.get_pid())
 
         finally:
+            for monitor in self.monitors:
+                monitor.close()
             self.monitors = []
             if self.pci_assignable:
                 self.pci_assignable.release_devs()
@@ -1102,7 +1113,8 @@ class VM:
                                            local_path, remote_path,
                                            log_filename, timeout)
         elif client == "rss":
-            c = rss_file_transfer.FileUploadClient(address, port)
+            bulk = self.params.get("file_transfer_bulk") == "yes"
+            c = rss_file_transfer.FileUploadClient(address, port, bulk=bulk)
             c.upload(local_path, remote_path, timeout)
             c.close()
             return True
@@ -1135,7 +1147,8 @@ class VM:
                                              remote_path, local_path,
                                              log_filename, timeout)
         elif client == "rss":
-            c = rss_file_transfer.FileDownloadClient(address, port)
+            bulk = self.params.get("file_transfer_bulk") == "yes"
+            c = rss_file_transfer.FileDownloadClient(address, port, bulk=bulk)
             c.download(remote_path, local_path, timeout)
             c.close()
             return True
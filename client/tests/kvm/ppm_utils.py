@@ -4,8 +4,12 @@ Utility functions to deal with ppm (qemu screendump format) files.
 @copyright: Red Hat 2008-2009
 """
 
-import os, struct, time, re
+import os, time, re, array
 from autotest_lib.client.bin import utils
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Some directory/filename utils, for consistency
 
@@ -85,6 +89,31 @@ def image_write_to_ppm_file(filename, width, height, data):
     fout.close()
 
 
+def _get_pixels(width, height, data):
+    """
+    Return a height x width x 3 numpy array viewing (not copying) the data of
+    an image.
+    """
+    return numpy.frombuffer(data, dtype=numpy.uint8,
+                            count=width*height*3).reshape(height, width, 3)
+
+
+def _clip_region(width, height, x1, y1, dx, dy):
+    if x1 > width - 1: x1 = width - 1
+    if y1 > height - 1: y1 = height - 1
+    if dx > width - x1: dx = width - x1
+    if dy > height - y1: dy = height - y1
+    return (x1, y1, dx, dy)
+
+
+def _region_rows(width, data, x1, y1, dx, dy):
+    """
+    Return buffers over the rows of a region of an image, without copying.
+    """
+    index = (x1 + y1*width) * 3
+    return [buffer(data, index + i*width*3, dx*3) for i in xrange(dy)]
+
+
 def image_crop(width, height, data, x1, y1, dx, dy):
     """
     Crop an image.
@@ -99,15 +128,10 @@ def image_crop(width, height, data, x1, y1, dx, dy):
     @return: A 3-tuple containing the width, height and data of the
     cropped image.
     """
-    if x1 > width - 1: x1 = width - 1
-    if y1 > height - 1: y1 = height - 1
-    if dx > width - x1: dx = width - x1
-    if dy > height - y1: dy = height - y1
-    newdata = ""
-    index = (x1 + y1*width) * 3
-    for i in range(dy):
-        newdata += data[index:(index+dx*3)]
-        index += width*3
+    (x1, y1, dx, dy) = _clip_region(width, height, x1, y1, dx, dy)
+    # Copying whole rows at once is faster than a numpy slice
+    newdata = "".join([str(row) for row in
+                       _region_rows(width, data, x1, y1, dx, dy)])
     return (dx, dy, newdata)
 
 
@@ -140,11 +164,17 @@ def get_region_md5sum(width, height, data, x1, y1, dx, dy,
     @param cropped_image_filename: if not None, write the resulting cropped
             image to a file with this name
     """
-    (cw, ch, cdata) = image_crop(width, height, data, x1, y1, dx, dy)
     # Write cropped image for debugging
     if cropped_image_filename:
+        (cw, ch, cdata) = image_crop(width, height, data, x1, y1, dx, dy)
         image_write_to_ppm_file(cropped_image_filename, cw, ch, cdata)
-    return image_md5sum(cw, ch, cdata)
+        return image_md5sum(cw, ch, cdata)
+    # Otherwise hash the rows of the region in place
+    (x1, y1, dx, dy) = _clip_region(width, height, x1, y1, dx, dy)
+    hash = utils.hash('md5', "P6\n%d %d\n255\n" % (dx, dy))
+    for row in _region_rows(width, data, x1, y1, dx, dy):
+        hash.update(row)
+    return hash.hexdigest()
 
 
 def image_verify_ppm_file(filename):
@@ -183,31 +213,35 @@ def image_comparison(width, height, data1, data2):
 
     @note: Input images must be the same size.
     """
-    newdata = ""
-    i = 0
-    while i < width*height*3:
-        # Compute monochromatic value of current pixel in data1
-        pixel1_str = data1[i:i+3]
-        temp = struct.unpack("BBB", pixel1_str)
-        value1 = int((temp[0] + temp[1] + temp[2]) / 3)
-        # Compute monochromatic value of current pixel in data2
-        pixel2_str = data2[i:i+3]
-        temp = struct.unpack("BBB", pixel2_str)
-        value2 = int((temp[0] + temp[1] + temp[2]) / 3)
-        # Compute average of the two values
-        value = int((value1 + value2) / 2)
-        # Scale value to the upper half of the range [0, 255]
-        value = 128 + value / 2
-        # Compare pixels
-        if pixel1_str == pixel2_str:
-            # Equal -- give the pixel a greenish hue
-            newpixel = [0, value, 0]
+    if not numpy:
+        return _image_comparison_slow(width, height, data1, data2)
+    pixels1 = _get_pixels(width, height, data1).reshape(-1, 3)
+    pixels2 = _get_pixels(width, height, data2).reshape(-1, 3)
+    # Compute monochromatic values of the pixels, and their average
+    value1 = pixels1.sum(axis=1, dtype=numpy.int32) / 3
+    value2 = pixels2.sum(axis=1, dtype=numpy.int32) / 3
+    # Scale value to the upper half of the range [0, 255]
+    value = 128 + (value1 + value2) / 4
+    # Equal pixels get a greenish hue, different ones a reddish one
+    equal = (pixels1 == pixels2).all(axis=1)
+    newpixels = numpy.zeros((width*height, 3), dtype=numpy.uint8)
+    newpixels[:, 1] = numpy.where(equal, value, 0)
+    newpixels[:, 0] = numpy.where(equal, 0, value)
+    return (width, height, newpixels.tostring())
+
+
+def _image_comparison_slow(width, height, data1, data2):
+    pixels1 = array.array("B", data1[:width*height*3])
+    pixels2 = array.array("B", data2[:width*height*3])
+    newpixels = array.array("B", "\0" * (width*height*3))
+    for i in xrange(0, width*height*3, 3):
+        value = 128 + ((pixels1[i] + pixels1[i+1] + pixels1[i+2]) / 3 +
+                       (pixels2[i] + pixels2[i+1] + pixels2[i+2]) / 3) / 4
+        if pixels1[i:i+3] == pixels2[i:i+3]:
+            newpixels[i+1] = value
         else:
-            # Not equal -- give the pixel a reddish hue
-            newpixel = [value, 0, 0]
-        newdata += struct.pack("BBB", newpixel[0], newpixel[1], newpixel[2])
-        i += 3
-    return (width, height, newdata)
+            newpixels[i] = value
+    return (width, height, newpixels.tostring())
 
 
 def image_fuzzy_compare(width, height, data1, data2):
@@ -222,16 +256,23 @@ def image_fuzzy_compare(width, height, data1, data2):
 
     @note: Input images must be the same size.
     """
-    equal = 0.0
-    different = 0.0
-    i = 0
-    while i < width*height*3:
-        pixel1_str = data1[i:i+3]
-        pixel2_str = data2[i:i+3]
-        # Compare pixels
-        if pixel1_str == pixel2_str:
-            equal += 1.0
-        else:
-            different += 1.0
-        i += 3
-    return equal / (equal + different)
+    if numpy:
+        pixels1 = _get_pixels(width, height, data1).reshape(-1, 3)
+        pixels2 = _get_pixels(width, height, data2).reshape(-1, 3)
+        equal = (pixels1 == pixels2).all(axis=1).sum()
+        return float(equal) / (width*height)
+
+    # Compare whole rows first, only the rows which differ are compared
+    # pixel by pixel
+    equal = 0
+    row_size = width*3
+    for index in xrange(0, width*height*3, row_size):
+        row1 = data1[index:index+row_size]
+        row2 = data2[index:index+row_size]
+        if row1 == row2:
+            equal += width
+            continue
+        for i in xrange(0, row_size, 3):
+            if row1[i:i+3] == row2[i:i+3]:
+                equal += 1
+    return float(equal) / (width*height)
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+"""
+Tests for the image functions of ppm_utils. The expected results come from
+the former pixel by pixel implementation, kept here as a reference.
+
+Run with "benchmark" as argument to compare the speed of both
+implementations on screendump sized images.
+"""
+
+import os, random, shutil, struct, sys, tempfile, time, unittest
+import common
+import ppm_utils
+
+
+def _reference_crop(width, height, data, x1, y1, dx, dy):
+    if x1 > width - 1: x1 = width - 1
+    if y1 > height - 1: y1 = height - 1
+    if dx > width - x1: dx = width - x1
+    if dy > height - y1: dy = height - y1
+    newdata = ""
+    index = (x1 + y1*width) * 3
+    for i in range(dy):
+        newdata += data[index:(index+dx*3)]
+        index += width*3
+    return (dx, dy, newdata)
+
+
+def _reference_region_md5sum(width, height, data, x1, y1, dx, dy):
+    (cw, ch, cdata) = _reference_crop(width, height, data, x1, y1, dx, dy)
+    return ppm_utils.image_md5sum(cw, ch, cdata)
+
+
+def _reference_comparison(width, height, data1, data2):
+    newdata = ""
+    i = 0
+    while i < width*height*3:
+        pixel1_str = data1[i:i+3]
+        temp = struct.unpack("BBB", pixel1_str)
+        value1 = int((temp[0] + temp[1] + temp[2]) / 3)
+        pixel2_str = data2[i:i+3]
+        temp = struct.unpack("BBB", pixel2_str)
+        value2 = int((temp[0] + temp[1] + temp[2]) / 3)
+        value = int((value1 + value2) / 2)
+        value = 128 + value / 2
+        if pixel1_str == pixel2_str:
+            newpixel = [0, value, 0]
+        else:
+            newpixel = [value, 0, 0]
+        newdata += struct.pack("BBB", newpixel[0], newpixel[1], newpixel[2])
+        i += 3
+    return (width, height, newdata)
+
+
+def _reference_fuzzy_compare(width, height, data1, data2):
+    equal = 0.0
+    different = 0.0
+    i = 0
+    while i < width*height*3:
+        pixel1_str = data1[i:i+3]
+        pixel2_str = data2[i:i+3]
+        if pixel1_str == pixel2_str:
+            equal += 1.0
+        else:
+            different += 1.0
+        i += 3
+    return equal / (equal + different)
+
+
+def _make_images(width, height, changes):
+    """
+    Return the data of a random image and of a copy with some random pixels
+    changed.
+    """
+    rand = random.Random(width * height)
+    data1 = "".join([chr(rand.randrange(256))
+                     for i in xrange(width*height*3)])
+    data2 = list(data1)
+    for i in xrange(changes):
+        data2[rand.randrange(width*height*3)] = chr(rand.randrange(256))
+    return data1, "".join(data2)
+
+
+class ppm_utils_test(unittest.TestCase):
+    def setUp(self):
+        self.width, self.height = 37, 23
+        self.data1, self.data2 = _make_images(self.width, self.height, 50)
+        self.numpy = ppm_utils.numpy
+
+
+    def tearDown(self):
+        ppm_utils.numpy = self.numpy
+
+
+    def _check(self, function, reference, *args):
+        expected = reference(self.width, self.height, *args)
+        self.assertEquals(function(self.width, self.height, *args), expected)
+        # without numpy too
+        ppm_utils.numpy = None
+        try:
+            self.assertEquals(function(self.width, self.height, *args),
+                              expected)
+        finally:
+            ppm_utils.numpy = self.numpy
+
+
+    def test_crop(self):
+        for region in ((0, 0, 37, 23), (5, 3, 10, 7), (30, 20, 50, 50),
+                       (40, 30, 2, 2)):
+            self._check(ppm_utils.image_crop, _reference_crop, self.data1,
+                        *region)
+
+
+    def test_region_md5sum(self):
+        for region in ((0, 0, 37, 23), (5, 3, 10, 7), (30, 20, 50, 50)):
+            self._check(ppm_utils.get_region_md5sum, _reference_region_md5sum,
+                        self.data1, *region)
+
+
+    def test_region_md5sum_with_cropped_image(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "cropped.ppm")
+            md5sum = ppm_utils.get_region_md5sum(self.width, self.height,
+                                                 self.data1, 5, 3, 10, 7,
+                                                 filename)
+            (w, h, data) = ppm_utils.image_read_from_ppm_file(filename)
+            self.assertEquals((w, h), (10, 7))
+            self.assertEquals(ppm_utils.image_md5sum(w, h, data), md5sum)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_comparison(self):
+        self._check(ppm_utils.image_comparison, _reference_comparison,
+                    self.data1, self.data2)
+
+
+    def test_fuzzy_compare(self):
+        self._check(ppm_utils.image_fuzzy_compare, _reference_fuzzy_compare,
+                    self.data1, self.data2)
+        self._check(ppm_utils.image_fuzzy_compare, _reference_fuzzy_compare,
+                    self.data1, self.data1)
+
+
+def _time(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def benchmark():
+    width, height = 1024, 768
+    data1, data2 = _make_images(width, height, 1000)
+    region = (100, 100, 500, 300)
+    for name, function, reference, args in (
+            ("crop", ppm_utils.image_crop, _reference_crop,
+             (data1,) + region),
+            ("region md5sum", ppm_utils.get_region_md5sum,
+             _reference_region_md5sum, (data1,) + region),
+            ("comparison", ppm_utils.image_comparison, _reference_comparison,
+             (data1, data2)),
+            ("fuzzy compare", ppm_utils.image_fuzzy_compare,
+             _reference_fuzzy_compare, (data1, data2))):
+        reference_time = _time(reference, width, height, *args)
+        new_time = _time(function, width, height, *args)
+        numpy = ppm_utils.numpy
+        ppm_utils.numpy = None
+        try:
+            slow_time = _time(function, width, height, *args)
+        finally:
+            ppm_utils.numpy = numpy
+        print "%s: reference %.3fs, numpy %.3fs, without numpy %.3fs" % (
+                name, reference_time, new_time, slow_time)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        unittest.main()
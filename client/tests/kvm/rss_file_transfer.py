@@ -10,6 +10,10 @@ import socket, struct, time, sys, os, glob
 
 # Globals
 CHUNKSIZE = 65536
+# Bulk transfers use the largest chunks rss.cpp accepts, and larger socket
+# buffers
+BULK_CHUNKSIZE = 1048576
+BULK_BUFSIZE = 4194304
 
 # Protocol message constants
 RSS_MAGIC           = 0x525353
@@ -59,19 +63,36 @@ class FileTransferClient(object):
     Connect to a RSS (remote shell server) and transfer files.
     """
 
-    def __init__(self, address, port, timeout=10):
+    def __init__(self, address, port, timeout=10, bulk=False):
         """
         Connect to a server.
 
         @param address: The server's address
         @param port: The server's port
         @param timeout: Time duration to wait for connection to succeed
+        @param bulk: If True, use large chunks and socket buffers, and send
+                the data in large writes, waiting for the server only when a
+                reply is expected (suitable for large files and for many small
+                files alike)
         @raise FileTransferConnectError: Raised if the connection fails
         @raise FileTransferProtocolError: Raised if an incorrect magic number
                 is received
         """
+        self._bulk = bulk
+        self._send_buffer = []
+        self._send_buffer_size = 0
+        self._receive_buffer = ""
+        self._receive_offset = 0
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.settimeout(timeout)
+        if bulk:
+            self._chunk_size = BULK_CHUNKSIZE
+            # Set before connecting, for the TCP window to scale accordingly
+            for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+                self._socket.setsockopt(socket.SOL_SOCKET, option,
+                                        BULK_BUFSIZE)
+        else:
+            self._chunk_size = CHUNKSIZE
         try:
             self._socket.connect((address, port))
         except socket.error:
@@ -82,7 +103,7 @@ class FileTransferClient(object):
         except FileTransferTimeoutError:
             raise FileTransferConnectError("Timeout expired while waiting to "
                                            "receive magic number")
-        self._send(struct.pack("=i", CHUNKSIZE))
+        self._send(struct.pack("=i", self._chunk_size))
 
 
     def __del__(self):
@@ -97,19 +118,56 @@ class FileTransferClient(object):
 
 
     def _send(self, str):
+        if self._bulk and len(str) < self._chunk_size:
+            # Queue the data, to send it with others in a single write
+            self._send_buffer.append(str)
+            self._send_buffer_size += len(str)
+            if self._send_buffer_size >= self._chunk_size:
+                self._flush()
+            return
+        self._flush()
         try:
             self._socket.sendall(str)
         except socket.error:
             raise FileTransferSendError("Could not send data to server")
 
 
+    def _flush(self):
+        """
+        Send the data queued by _send() in bulk mode.
+        """
+        if not self._send_buffer:
+            return
+        data = "".join(self._send_buffer)
+        self._send_buffer = []
+        self._send_buffer_size = 0
+        try:
+            self._socket.sendall(data)
+        except socket.error:
+            raise FileTransferSendError("Could not send data to server")
+
+
     def _receive(self, size, timeout=10):
+        # The server's reply may depend on everything sent so far
+        self._flush()
         strs = []
+        if self._receive_buffer:
+            # Data read ahead by a previous call
+            offset = self._receive_offset
+            strs.append(self._receive_buffer[offset:offset + size])
+            size -= len(strs[0])
+            self._receive_offset += len(strs[0])
+            if self._receive_offset >= len(self._receive_buffer):
+                self._receive_buffer = ""
         end_time = time.time() + timeout
         while size > 0:
             try:
                 self._socket.settimeout(max(0.0001, end_time - time.time()))
-                data = self._socket.recv(size)
+                if self._bulk:
+                    # Read ahead, to receive many small packets at once
+                    data = self._socket.recv(max(size, self._chunk_size))
+                else:
+                    data = self._socket.recv(size)
             except socket.timeout:
                 raise FileTransferTimeoutError("Timeout expired while "
                                                "receiving data from server")
@@ -119,14 +177,23 @@ class FileTransferClient(object):
             if not data:
                 raise FileTransferProtocolError("Connection closed "
                                                 "unexpectedly")
+            if len(data) > size:
+                self._receive_buffer = data
+                self._receive_offset = size
+                data = data[:size]
             strs.append(data)
             size -= len(data)
         return "".join(strs)
 
 
     def _send_packet(self, str):
-        self._send(struct.pack("=I", len(str)))
-        self._send(str)
+        if self._bulk:
+            self._send(struct.pack("=I", len(str)))
+            self._send(str)
+        else:
+            # A single write, so the size doesn't travel in a segment of its
+            # own
+            self._send(struct.pack("=I", len(str)) + str)
 
 
     def _receive_packet(self, timeout=10):
@@ -139,9 +206,9 @@ class FileTransferClient(object):
         try:
             end_time = time.time() + timeout
             while time.time() < end_time:
-                data = f.read(CHUNKSIZE)
+                data = f.read(self._chunk_size)
                 self._send_packet(data)
-                if len(data) < CHUNKSIZE:
+                if len(data) < self._chunk_size:
                     break
             else:
                 raise FileTransferTimeoutError("Timeout expired while sending "
@@ -165,7 +232,7 @@ class FileTransferClient(object):
                     raise FileTransferProtocolError("Error receiving file %s" %
                                                     filename)
                 f.write(data)
-                if len(data) < CHUNKSIZE:
+                if len(data) < self._chunk_size:
                     break
         finally:
             f.close()
@@ -200,20 +267,22 @@ class FileUploadClient(FileTransferClient):
     Connect to a RSS (remote shell server) and upload files or directory trees.
     """
 
-    def __init__(self, address, port, timeout=10):
+    def __init__(self, address, port, timeout=10, bulk=False):
         """
         Connect to a server.
 
         @param address: The server's address
         @param port: The server's port
         @param timeout: Time duration to wait for connection to succeed
+        @param bulk: If True, transfer files in bulk mode (see
+                FileTransferClient)
         @raise FileTransferConnectError: Raised if the connection fails
         @raise FileTransferProtocolError: Raised if an incorrect magic number
                 is received
         @raise FileTransferSendError: Raised if the RSS_UPLOAD message cannot
                 be sent to the server
         """
-        super(FileUploadClient, self).__init__(address, port, timeout)
+        super(FileUploadClient, self).__init__(address, port, timeout, bulk)
         self._send_msg(RSS_UPLOAD)
 
 
@@ -297,20 +366,22 @@ class FileDownloadClient(FileTransferClient):
     Connect to a RSS (remote shell server) and download files or directory trees.
     """
 
-    def __init__(self, address, port, timeout=10):
+    def __init__(self, address, port, timeout=10, bulk=False):
         """
         Connect to a server.
 
         @param address: The server's address
         @param port: The server's port
         @param timeout: Time duration to wait for connection to succeed
+        @param bulk: If True, transfer files in bulk mode (see
+                FileTransferClient)
         @raise FileTransferConnectError: Raised if the connection fails
         @raise FileTransferProtocolError: Raised if an incorrect magic number
                 is received
         @raise FileTransferSendError: Raised if the RSS_UPLOAD message cannot
                 be sent to the server
         """
-        super(FileDownloadClient, self).__init__(address, port, timeout)
+        super(FileDownloadClient, self).__init__(address, port, timeout, bulk)
         self._send_msg(RSS_DOWNLOAD)
 
 
@@ -396,25 +467,25 @@ class FileDownloadClient(FileTransferClient):
 
 
 def upload(address, port, src_pattern, dst_path, timeout=60,
-           connect_timeout=10):
+           connect_timeout=10, bulk=False):
     """
     Connect to server and upload files.
 
     @see: FileUploadClient
     """
-    client = FileUploadClient(address, port, connect_timeout)
+    client = FileUploadClient(address, port, connect_timeout, bulk)
     client.upload(src_pattern, dst_path, timeout)
     client.close()
 
 
 def download(address, port, src_pattern, dst_path, timeout=60,
-             connect_timeout=10):
+             connect_timeout=10, bulk=False):
     """
     Connect to server and upload files.
 
     @see: FileDownloadClient
     """
-    client = FileDownloadClient(address, port, connect_timeout)
+    client = FileDownloadClient(address, port, connect_timeout, bulk)
     client.download(src_pattern, dst_path, timeout)
     client.close()
 
@@ -430,6 +501,9 @@ def main():
     parser.add_option("-u", "--upload",
                       action="store_true", dest="upload",
                       help="upload files to server")
+    parser.add_option("-b", "--bulk",
+                      action="store_true", dest="bulk",
+                      help="transfer files in bulk mode")
     parser.add_option("-t", "--timeout",
                       type="int", dest="timeout", default=3600,
                       help="transfer timeout")
@@ -442,9 +516,11 @@ def main():
     port = int(port)
 
     if options.download:
-        download(address, port, src_pattern, dst_path, options.timeout)
+        download(address, port, src_pattern, dst_path, options.timeout,
+                 bulk=options.bulk)
     elif options.upload:
-        upload(address, port, src_pattern, dst_path, options.timeout)
+        upload(address, port, src_pattern, dst_path, options.timeout,
+               bulk=options.bulk)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+import os, sys, shutil, socket, struct, tempfile, threading, time, glob
+import unittest
+import common
+import rss_file_transfer
+from rss_file_transfer import RSS_MAGIC, RSS_OK, RSS_ERROR, RSS_UPLOAD
+from rss_file_transfer import RSS_DOWNLOAD, RSS_SET_PATH, RSS_CREATE_FILE
+from rss_file_transfer import RSS_CREATE_DIR, RSS_LEAVE_DIR, RSS_DONE
+
+
+class loopback_server(object):
+    """
+    A stand-in for the file transfer server of rss.cpp, serving one client
+    at a time on the loopback interface.
+    """
+    def __init__(self, discard=False):
+        """
+        @param discard: If True, throw uploaded files away instead of writing
+                them, to measure the transfer alone.
+        """
+        self.discard = discard
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+        self.chunk_sizes = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def serve(self):
+        while True:
+            conn, addr = self.socket.accept()
+            try:
+                self.handle(conn)
+            except (socket.error, struct.error):
+                pass
+            conn.close()
+
+
+    def handle(self, conn):
+        self.r = conn.makefile("rb")
+        self.conn = conn
+        self.send_msg(RSS_MAGIC)
+        self.chunk_size = struct.unpack("=i", self.r.read(4))[0]
+        self.chunk_sizes.append(self.chunk_size)
+        if self.receive_msg() == RSS_UPLOAD:
+            self.handle_upload()
+        else:
+            self.handle_download()
+
+
+    def send_msg(self, msg):
+        self.conn.sendall(struct.pack("=I", msg))
+
+
+    def send_packet(self, str):
+        self.conn.sendall(struct.pack("=I", len(str)) + str)
+
+
+    def receive_msg(self):
+        return struct.unpack("=I", self.r.read(4))[0]
+
+
+    def receive_packet(self):
+        return self.r.read(struct.unpack("=I", self.r.read(4))[0])
+
+
+    def handle_upload(self):
+        path = None
+        while True:
+            msg = self.receive_msg()
+            if msg == RSS_SET_PATH:
+                path = self.receive_packet()
+            elif msg == RSS_CREATE_FILE:
+                filename = os.path.join(path, self.receive_packet())
+                if not self.discard:
+                    f = open(filename, "wb")
+                while True:
+                    data = self.receive_packet()
+                    if not self.discard:
+                        f.write(data)
+                    if len(data) < self.chunk_size:
+                        break
+                if not self.discard:
+                    f.close()
+            elif msg == RSS_CREATE_DIR:
+                path = os.path.join(path, self.receive_packet())
+                if not self.discard:
+                    os.mkdir(path)
+            elif msg == RSS_LEAVE_DIR:
+                path = os.path.dirname(path)
+            elif msg == RSS_DONE:
+                self.send_msg(RSS_OK)
+                return
+
+
+    def send_tree(self, path):
+        if os.path.isdir(path):
+            self.send_msg(RSS_CREATE_DIR)
+            self.send_packet(os.path.basename(path))
+            for filename in os.listdir(path):
+                self.send_tree(os.path.join(path, filename))
+            self.send_msg(RSS_LEAVE_DIR)
+        else:
+            self.send_msg(RSS_CREATE_FILE)
+            self.send_packet(os.path.basename(path))
+            f = open(path, "rb")
+            while True:
+                data = f.read(self.chunk_size)
+                self.send_packet(data)
+                if len(data) < self.chunk_size:
+                    break
+            f.close()
+
+
+    def handle_download(self):
+        if self.receive_msg() != RSS_SET_PATH:
+            return
+        pattern = self.receive_packet()
+        for path in glob.glob(pattern):
+            self.send_tree(path)
+        self.send_msg(RSS_DONE)
+
+
+def _make_tree(root, files, size):
+    """
+    Create a directory tree holding a number of files of a given size.
+    """
+    os.mkdir(root)
+    for i in range(files):
+        dir = os.path.join(root, "dir%d" % (i % 10))
+        if not os.path.isdir(dir):
+            os.mkdir(dir)
+        open(os.path.join(dir, "file%d" % i), "wb").write(
+                os.urandom(size + i % 2))
+
+
+def _read_tree(root):
+    """
+    Return a dict mapping the relative paths of the files under root to
+    their contents.
+    """
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            tree[path[len(root):]] = open(path, "rb").read()
+    return tree
+
+
+class test_file_transfer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = loopback_server()
+        self.src = os.path.join(self.tmpdir, "src")
+        self.dst = os.path.join(self.tmpdir, "dst")
+        os.mkdir(self.dst)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _transfer(self, bulk):
+        rss_file_transfer.upload("127.0.0.1", self.server.port, self.src,
+                                 self.dst, bulk=bulk)
+        self.assertEquals(_read_tree(os.path.join(self.dst, "src")),
+                          _read_tree(self.src))
+        downloaded = os.path.join(self.tmpdir, "downloaded")
+        os.mkdir(downloaded)
+        rss_file_transfer.download("127.0.0.1", self.server.port,
+                                   os.path.join(self.dst, "*"), downloaded,
+                                   bulk=bulk)
+        self.assertEquals(_read_tree(os.path.join(downloaded, "src")),
+                          _read_tree(self.src))
+
+
+    def test_small_files(self):
+        _make_tree(self.src, 200, 100)
+        self._transfer(False)
+        self.assertEquals(self.server.chunk_sizes,
+                          [rss_file_transfer.CHUNKSIZE] * 2)
+
+
+    def test_bulk_small_files(self):
+        _make_tree(self.src, 200, 100)
+        self._transfer(True)
+        self.assertEquals(self.server.chunk_sizes,
+                          [rss_file_transfer.BULK_CHUNKSIZE] * 2)
+
+
+    def test_bulk_large_files(self):
+        # files of exactly one chunk end with an empty chunk
+        _make_tree(self.src, 4, rss_file_transfer.BULK_CHUNKSIZE)
+        self._transfer(True)
+
+
+    def test_not_found(self):
+        self.assertRaises(rss_file_transfer.FileTransferNotFoundError,
+                          rss_file_transfer.upload, "127.0.0.1",
+                          self.server.port, self.src, self.dst, bulk=True)
+        self.assertRaises(rss_file_transfer.FileTransferNotFoundError,
+                          rss_file_transfer.download, "127.0.0.1",
+                          self.server.port, self.src, self.dst, bulk=True)
+
+
+def benchmark(files=5000, size=4096):
+    """
+    Print the throughput of uploads and downloads of a tree of small files,
+    and of a large file, with and without bulk mode.  Uploaded files are
+    thrown away by the server, and downloaded files are those of the source
+    tree.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        server = loopback_server(discard=True)
+        _make_tree(os.path.join(tmpdir, "small"), files, size)
+        large = os.path.join(tmpdir, "large")
+        _make_tree(large, 1, 64 * 1048576)
+        for src, total in ((os.path.join(tmpdir, "small"), files * size),
+                           (large, 64 * 1048576)):
+            for bulk in (False, True):
+                dst = tempfile.mkdtemp(dir=tmpdir)
+                start = time.time()
+                rss_file_transfer.upload("127.0.0.1", server.port, src, dst,
+                                         timeout=600, bulk=bulk)
+                upload_time = time.time() - start
+                downloaded = tempfile.mkdtemp(dir=tmpdir)
+                start = time.time()
+                rss_file_transfer.download("127.0.0.1", server.port, src,
+                                           downloaded, timeout=600, bulk=bulk)
+                download_time = time.time() - start
+                print ("%s, bulk=%s: upload %.1f MB/s, download %.1f MB/s" %
+                       (os.path.basename(src), bulk,
+                        total / upload_time / 1048576,
+                        total / download_time / 1048576))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--benchmark"]:
+        benchmark()
+    else:
+        unittest.main()
@@ -6,7 +6,7 @@ Utilities to perform automatic guest installation using step files.
 
 import os, time, re, shutil, logging
 from autotest_lib.client.common_lib import utils, error
-import kvm_utils, ppm_utils, kvm_subprocess, kvm_monitor
+import kvm_utils, ppm_utils, kvm_subprocess, kvm_monitor, kvm_screendump
 try:
     import PIL.Image
 except ImportError:
@@ -69,84 +69,90 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
 
     failure_message = None
 
-    # Main loop
-    while True:
-        # Check for timeouts
-        if time.time() > end_time:
-            failure_message = "regular timeout"
-            break
-        if time.time() > end_time_stuck:
-            failure_message = "guest is stuck"
-            break
-
-        # Make sure vm is alive
-        if not vm.is_alive():
-            failure_message = "VM is dead"
-            break
-
-        # Request screendump
-        try:
-            vm.monitor.screendump(scrdump_filename)
-        except kvm_monitor.MonitorError, e:
-            logging.warn(e)
-            continue
-
-        # Read image file
-        (w, h, data) = ppm_utils.image_read_from_ppm_file(scrdump_filename)
-
-        # Make sure image is valid
-        if not ppm_utils.image_verify_ppm_file(scrdump_filename):
-            logging.warn("Got invalid screendump: dimensions: %dx%d, "
-                         "data size: %d" % (w, h, len(data)))
-            continue
+    # Screendumps are shared with the regular screendump thread, if running
+    service = kvm_screendump.get_service(vm, debug_dir)
+    last_frame = None
 
-        # Compute md5sum of whole image
-        whole_image_md5sum = ppm_utils.image_md5sum(w, h, data)
+    # Warn about a screen which stops changing during the step
+    stuck_detector = kvm_screendump.StuckDetector("step %s" %
+                                                  current_step_num)
+    service.subscribe(stuck_detector)
 
-        # Write screendump to history_dir (as JPG) if requested
-        # and if the screendump differs from the previous one
-        if (keep_screendump_history and
-            whole_image_md5sum not in prev_whole_image_md5sums[:1]):
-            try:
-                os.makedirs(history_dir)
-            except:
-                pass
-            history_scrdump_filename = os.path.join(history_dir,
-                    "scrdump-step_%s-%s.jpg" % (current_step_num,
-                                                time.strftime("%Y%m%d-%H%M%S")))
+    # Main loop
+    try:
+        while True:
+            # Check for timeouts
+            if time.time() > end_time:
+                failure_message = "regular timeout"
+                break
+            if time.time() > end_time_stuck:
+                failure_message = "guest is stuck"
+                break
+
+            # Make sure vm is alive
+            if not vm.is_alive():
+                failure_message = "VM is dead"
+                break
+
+            # Request screendump
             try:
-                image = PIL.Image.open(scrdump_filename)
-                image.save(history_scrdump_filename, format = 'JPEG',
-                           quality = 30)
-            except NameError:
-                pass
-
-        # Compare md5sum of barrier region with the expected md5sum
-        calced_md5sum = ppm_utils.get_region_md5sum(w, h, data, x1, y1, dx, dy,
+                frame = service.capture()
+            except kvm_monitor.MonitorError, e:
+                logging.warn(e)
+                continue
+
+            # Make sure image is valid
+            if not frame:
+                continue
+            last_frame = frame
+
+            # Compute md5sum of whole image
+            whole_image_md5sum = frame.get_md5sum()
+
+            # Write screendump to history_dir (as JPG) if requested
+            # and if the screendump differs from the previous one
+            if (keep_screendump_history and
+                whole_image_md5sum not in prev_whole_image_md5sums[:1]):
+                try:
+                    os.makedirs(history_dir)
+                except:
+                    pass
+                history_scrdump_filename = os.path.join(history_dir,
+                        "scrdump-step_%s-%s.jpg" %
+                        (current_step_num, time.strftime("%Y%m%d-%H%M%S")))
+                try:
+                    frame.save_jpeg(history_scrdump_filename, quality=30)
+                except NameError:
+                    pass
+
+            # Compare md5sum of barrier region with the expected md5sum
+            calced_md5sum = frame.get_region_md5sum(x1, y1, dx, dy,
                                                     cropped_scrdump_filename)
-        if calced_md5sum == md5sum:
-            # Success -- remove screendump history unless requested not to
-            if keep_screendump_history and not keep_all_history:
-                shutil.rmtree(history_dir)
-            # Report success
-            return True
-
-        # Insert image md5sum into queue of last seen images:
-        # If md5sum is already in queue...
-        if whole_image_md5sum in prev_whole_image_md5sums:
-            # Remove md5sum from queue
-            prev_whole_image_md5sums.remove(whole_image_md5sum)
-        else:
-            # Otherwise extend 'stuck' timeout
-            end_time_stuck = time.time() + fail_if_stuck_for
-        # Insert md5sum at beginning of queue
-        prev_whole_image_md5sums.insert(0, whole_image_md5sum)
-        # Limit queue length to stuck_detection_history
-        prev_whole_image_md5sums = \
-                prev_whole_image_md5sums[:stuck_detection_history]
-
-        # Sleep for a while
-        time.sleep(sleep_duration)
+            if calced_md5sum == md5sum:
+                # Success -- remove screendump history unless requested not to
+                if keep_screendump_history and not keep_all_history:
+                    shutil.rmtree(history_dir)
+                # Report success
+                return True
+
+            # Insert image md5sum into queue of last seen images:
+            # If md5sum is already in queue...
+            if whole_image_md5sum in prev_whole_image_md5sums:
+                # Remove md5sum from queue
+                prev_whole_image_md5sums.remove(whole_image_md5sum)
+            else:
+                # Otherwise extend 'stuck' timeout
+                end_time_stuck = time.time() + fail_if_stuck_for
+            # Insert md5sum at beginning of queue
+            prev_whole_image_md5sums.insert(0, whole_image_md5sum)
+            # Limit queue length to stuck_detection_history
+            prev_whole_image_md5sums = \
+                    prev_whole_image_md5sums[:stuck_detection_history]
+
+            # Sleep for a while
+            time.sleep(sleep_duration)
+    finally:
+        service.unsubscribe(stuck_detector)
 
     # Failure
     message = ("Barrier failed at step %s after %.2f seconds (%s)" %
@@ -158,7 +164,10 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
         return False
     else:
         # Collect information and put it in debug_dir
-        if data_scrdump_filename and os.path.exists(data_scrdump_filename):
+        if last_frame:
+            last_frame.save_ppm(scrdump_filename)
+        if (last_frame and data_scrdump_filename and
+            os.path.exists(data_scrdump_filename)):
             # Read expected screendump image
             (ew, eh, edata) = \
                     ppm_utils.image_read_from_ppm_file(data_scrdump_filename)
@@ -169,7 +178,8 @@ def barrier_2(vm, words, params, debug_dir, data_scrdump_filename,
             ppm_utils.get_region_md5sum(ew, eh, edata, x1, y1, dx, dy,
                                         expected_cropped_scrdump_filename)
             # Perform comparison
-            (w, h, data) = ppm_utils.image_read_from_ppm_file(scrdump_filename)
+            (w, h, data) = (last_frame.width, last_frame.height,
+                            last_frame.data)
             if w == ew and h == eh:
                 (w, h, data) = ppm_utils.image_comparison(w, h, data, edata)
                 ppm_utils.image_write_to_ppm_file(comparison_filename, w, h,
@@ -24,6 +24,26 @@ import urllib2
 class JSONRPCException(Exception):
     pass
 
+def _decode_response(respdata):
+    # pull in simplejson imports lazily so that the library isn't required
+    # unless you actually need to do encoding and decoding
+    from simplejson import decoder
+    try:
+        return decoder.JSONDecoder().decode(respdata)
+    except ValueError:
+        raise JSONRPCException('Error decoding JSON reponse:\n' + respdata)
+
+
+def _result_from_response(resp):
+    if resp['error'] is not None:
+        error_message = (resp['error']['name'] + ': ' +
+                         resp['error']['message'] + '\n' +
+                         resp['error']['traceback'])
+        raise JSONRPCException(error_message)
+    else:
+        return resp['result']
+
+
 class ServiceProxy(object):
     def __init__(self, serviceURL, serviceName=None, headers=None):
         self.__serviceURL = serviceURL
@@ -36,24 +56,98 @@ class ServiceProxy(object):
         return ServiceProxy(self.__serviceURL, name, self.__headers)
 
     def __call__(self, *args, **kwargs):
-        # pull in simplejson imports lazily so that the library isn't required
-        # unless you actually need to do encoding and decoding
-        from simplejson import decoder, encoder
+        resp = self._send_request({"method": self.__serviceName,
+                                   'params': args + (kwargs,),
+                                   'id':'jsonrpc'})
+        return _result_from_response(resp)
+
+    def _send_request(self, request_obj):
+        """
+        Post an encoded request object (or list of request objects, for a
+        batch) and return the decoded response.
+        """
+        from simplejson import encoder
 
-        postdata = encoder.JSONEncoder().encode({"method": self.__serviceName,
-                                                'params': args + (kwargs,),
-                                                'id':'jsonrpc'})
+        postdata = encoder.JSONEncoder().encode(request_obj)
         request = urllib2.Request(self.__serviceURL, data=postdata,
                                   headers=self.__headers)
         respdata = urllib2.urlopen(request).read()
-        try:
-            resp = decoder.JSONDecoder().decode(respdata)
-        except ValueError:
-            raise JSONRPCException('Error decoding JSON reponse:\n' + respdata)
-        if resp['error'] is not None:
-            error_message = (resp['error']['name'] + ': ' +
-                             resp['error']['message'] + '\n' +
-                             resp['error']['traceback'])
-            raise JSONRPCException(error_message)
-        else:
-            return resp['result']
+        return _decode_response(respdata)
+
+    def _send_batch(self, calls):
+        """
+        Send a list of BatchedCall objects in a single request and fill in
+        their responses.
+        """
+        request_list = [{'method': call.method, 'params': call.params,
+                         'id': index} for index, call in enumerate(calls)]
+        responses = self._send_request(request_list)
+        if not isinstance(responses, list) or len(responses) != len(calls):
+            raise JSONRPCException('Invalid batch response: %r' % responses)
+        for resp in responses:
+            calls[resp['id']].response = resp
+
+
+class BatchedCall(object):
+    """
+    A call queued on a BatchServiceProxy.  Its result becomes available
+    once the batch has been executed.
+    """
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.response = None
+
+    @property
+    def result(self):
+        """
+        The result of the call.  Raises JSONRPCException if the call failed
+        or the batch has not been executed yet.
+        """
+        if self.response is None:
+            raise JSONRPCException('Batch containing %s was not executed' %
+                                   self.method)
+        return _result_from_response(self.response)
+
+
+class BatchServiceProxy(object):
+    """
+    Queues calls made through it and sends them all in one JSON-RPC batch
+    request when execute() is called (or when a "with" block ends).
+
+        batch = BatchServiceProxy(proxy)
+        calls = [batch.get_hosts(hostname=name) for name in hostnames]
+        batch.execute()
+        hosts = [call.result for call in calls]
+    """
+    def __init__(self, service_proxy):
+        self._service_proxy = service_proxy
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def queue_call(*args, **kwargs):
+            call = BatchedCall(name, args + (kwargs,))
+            self._calls.append(call)
+            return call
+        return queue_call
+
+    def execute(self):
+        """
+        Send all the queued calls in a single request.
+
+        @returns the list of BatchedCall objects that were sent.
+        """
+        calls, self._calls = self._calls, []
+        if calls:
+            self._service_proxy._send_batch(calls)
+        return calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
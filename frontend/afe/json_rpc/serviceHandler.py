@@ -49,6 +49,13 @@ json_encoder = encoder.JSONEncoder()
 json_decoder = decoder.JSONDecoder()
 
 
+def isBatchRequest(request):
+    """\
+    A JSON-RPC batch request is a list of individual request objects.
+    """
+    return isinstance(request, list)
+
+
 def ServiceMethod(fn):
     fn.IsServiceMethod = True
     return fn
@@ -101,6 +108,17 @@ class ServiceHandler(object):
         return results
 
 
+    def dispatchBatchRequest(self, requests):
+        """
+        Invoke a batch of json RPC calls, one after the other.
+        @param requests: a list of decoded json requests
+        @returns a list of result dictionaries, in the same order as requests
+        """
+        if not requests:
+            raise BadServiceRequest(requests)
+        return [self.dispatchRequest(request) for request in requests]
+
+
     def _getRequestId(self, request):
         try:
             return request['id']
@@ -110,6 +128,9 @@ class ServiceHandler(object):
 
     def handleRequest(self, jsonRequest):
         request = self.translateRequest(jsonRequest)
+        if isBatchRequest(request):
+            results = self.dispatchBatchRequest(request)
+            return self.translateBatchResult(results)
         results = self.dispatchRequest(request)
         return self.translateResult(results)
 
@@ -162,3 +183,15 @@ class ServiceHandler(object):
                                         "error":err})
 
         return data
+
+
+    @staticmethod
+    def translateBatchResult(result_dicts):
+        """
+        @param result_dicts: a list of result dictionaries, as returned by
+                             dispatchBatchRequest()
+        @returns translated json list of results
+        """
+        results = [ServiceHandler.translateResult(result_dict)
+                   for result_dict in result_dicts]
+        return '[%s]' % ', '.join(results)
@@ -44,6 +44,8 @@ json_request3 = """
 }
 """
 
+json_batch_request = '[%s, %s]' % (json_request1, json_request3)
+
 
 class TestServiceHandler(unittest.TestCase):
     def setUp(self):
@@ -67,5 +69,21 @@ class TestServiceHandler(unittest.TestCase):
         self.assertNotEquals(response_obj['error'], 'None')
 
 
+    def test_handleBatchRequest(self):
+        response = self.serviceHandler.handleRequest(json_batch_request)
+        response_list = eval(response.replace('null', 'None'))
+        self.assertEquals(len(response_list), 2)
+        self.assertEquals(response_list[0]['result'], 16)
+        self.assertEquals(response_list[0]['error'], None)
+        self.assertEquals(response_list[1]['result'], None)
+        self.assertEquals(response_list[1]['error']['name'],
+                          'ServiceMethodNotFound')
+
+
+    def test_handleEmptyBatchRequest(self):
+        self.assertRaises(serviceHandler.BadServiceRequest,
+                          self.serviceHandler.handleRequest, '[]')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -19,6 +19,14 @@ def get_proxy(*args, **kwargs):
     return proxy.ServiceProxy(*args, **kwargs)
 
 
+def get_batch_proxy(service_proxy):
+    """
+    Use this to queue several calls on a proxy returned by get_proxy() and
+    send them to the server in a single request.
+    """
+    return proxy.BatchServiceProxy(service_proxy)
+
+
 def _base_authorization_headers(username, server):
     """
     Don't call this directly, call authorization_headers().
@@ -6,9 +6,10 @@ defined in rpc_interface.py.
 __author__ = 'showard@google.com (Steve Howard)'
 
 import traceback, pydoc, re, urllib, logging, logging.handlers, inspect
+from django.db import transaction
 from autotest_lib.frontend.afe.json_rpc import serviceHandler
 from autotest_lib.frontend.afe import models, rpc_utils
-from autotest_lib.client.common_lib import global_config
+from autotest_lib.client.common_lib import global_config, rpc_cache
 from autotest_lib.frontend.afe import rpcserver_logging
 
 LOGGING_REGEXPS = [r'.*add_.*',
@@ -24,6 +25,13 @@ def should_log_message(name):
     return COMPILED_REGEXP.match(name)
 
 
+def is_read_only_method(name):
+    return name.startswith('get_')
+
+
+rpc_cache.invalidate_on_model_changes()
+
+
 class RpcMethodHolder(object):
     'Dummy class to hold RPC interface methods as attributes.'
 
@@ -63,7 +71,42 @@ class RpcHandler(object):
 
 
     def dispatch_request(self, decoded_request):
-        return self._dispatcher.dispatchRequest(decoded_request)
+        result = self._dispatcher.dispatchRequest(decoded_request)
+        self._invalidate_cache_after([decoded_request])
+        return result
+
+
+    def dispatch_batch_request(self, decoded_requests):
+        """\
+        Dispatch all the calls of a batch request inside a single database
+        transaction.  Every call gets its own result dictionary, so a failing
+        call doesn't prevent the following ones from running.
+        """
+        results = self._dispatch_batch_in_transaction(decoded_requests)
+        # only once committed, or concurrent readers could cache the results
+        # the transaction was about to change under the new generation
+        self._invalidate_cache_after(decoded_requests)
+        return results
+
+
+    @transaction.commit_on_success
+    def _dispatch_batch_in_transaction(self, decoded_requests):
+        return self._dispatcher.dispatchBatchRequest(decoded_requests)
+
+
+    def _invalidate_cache_after(self, decoded_requests):
+        """\
+        Writes that don't go through model saves (e.g. many-to-many changes)
+        must still invalidate cached RPC results.  Calls without a method
+        name are taken for writes.
+        """
+        for decoded_request in decoded_requests:
+            method = None
+            if isinstance(decoded_request, dict):
+                method = decoded_request.get('method')
+            if not method or not is_read_only_method(method):
+                rpc_cache.invalidate()
+                return
 
 
     def log_request(self, user, decoded_request, decoded_result,
@@ -82,10 +125,16 @@ class RpcHandler(object):
         return self._dispatcher.translateResult(results)
 
 
+    def encode_batch_result(self, results):
+        return self._dispatcher.translateBatchResult(results)
+
+
     def handle_rpc_request(self, request):
         user = models.User.current_user()
         json_request = self.raw_request_data(request)
         decoded_request = self.decode_request(json_request)
+        if serviceHandler.isBatchRequest(decoded_request):
+            return self._handle_batch_rpc_request(user, decoded_request)
         decoded_result = self.dispatch_request(decoded_request)
         result = self.encode_result(decoded_result)
         if rpcserver_logging.LOGGING_ENABLED:
@@ -93,6 +142,16 @@ class RpcHandler(object):
         return rpc_utils.raw_http_response(result)
 
 
+    def _handle_batch_rpc_request(self, user, decoded_requests):
+        decoded_results = self.dispatch_batch_request(decoded_requests)
+        result = self.encode_batch_result(decoded_results)
+        if rpcserver_logging.LOGGING_ENABLED:
+            for decoded_request, decoded_result in zip(decoded_requests,
+                                                       decoded_results):
+                self.log_request(user, decoded_request, decoded_result)
+        return rpc_utils.raw_http_response(result)
+
+
     def handle_jsonp_rpc_request(self, request):
         request_data = request.GET['request']
         callback_name = request.GET['callback']
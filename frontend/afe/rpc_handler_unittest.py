@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import unittest
+import common
+from autotest_lib.frontend import setup_django_environment
+from autotest_lib.frontend.afe import frontend_test_utils, rpc_handler
+from django.db import transaction
+from autotest_lib.client.common_lib import rpc_cache
+
+
+class rpc_methods(object):
+    """A stand-in for an RPC interface module."""
+    @staticmethod
+    def get_labels():
+        return []
+
+
+    @staticmethod
+    def modify_label(id):
+        return None
+
+
+class RpcHandlerTest(unittest.TestCase,
+                     frontend_test_utils.FrontendTestMixin):
+    def setUp(self):
+        self._frontend_common_setup(fill_data=False)
+        self.handler = rpc_handler.RpcHandler([rpc_methods])
+        self.invalidations = []
+        self.god.stub_with(rpc_cache, 'invalidate', self._invalidate)
+
+
+    def tearDown(self):
+        self._frontend_common_teardown()
+
+
+    def _invalidate(self):
+        self.invalidations.append(transaction.is_managed())
+
+
+    def _batch(self, *methods):
+        requests = [{'method': method, 'params': [], 'id': i}
+                    for i, method in enumerate(methods)]
+        return self.handler.dispatch_batch_request(requests)
+
+
+    def test_read_only_batch(self):
+        self._batch('get_labels', 'get_labels')
+        self.assertEquals(self.invalidations, [])
+
+
+    def test_batch_invalidates_after_commit(self):
+        self._batch('get_labels', 'modify_label')
+        # once, outside of the batch's transaction
+        self.assertEquals(self.invalidations, [False])
+
+
+    def test_malformed_request(self):
+        self.assertRaises(rpc_handler.serviceHandler.BadServiceRequest,
+                          self.handler.dispatch_batch_request,
+                          [{'params': [], 'id': 0}])
+        # nothing was committed
+        self.assertEquals(self.invalidations, [])
+        # calls without a method are taken for writes
+        self.handler._invalidate_cache_after([{'params': [], 'id': 0}])
+        self.assertEquals(self.invalidations, [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -33,7 +33,7 @@ import datetime
 import common
 from autotest_lib.frontend.afe import models, model_logic, model_attributes
 from autotest_lib.frontend.afe import control_file, rpc_utils
-from autotest_lib.client.common_lib import global_config
+from autotest_lib.client.common_lib import global_config, rpc_cache
 
 
 # labels
@@ -594,6 +594,7 @@ def get_num_jobs(not_yet_run=False, running=False, finished=False,
     return models.Job.query_count(filter_data)
 
 
+@rpc_cache.cacheable(ttl=10)
 def get_jobs_summary(**filter_data):
     """\
     Like get_jobs(), but adds a 'status_counts' field, which is a dictionary
@@ -669,6 +670,7 @@ def get_num_host_queue_entries(**filter_data):
     return models.HostQueueEntry.query_count(filter_data)
 
 
+@rpc_cache.cacheable(ttl=10)
 def get_hqe_percentage_complete(**filter_data):
     """
     Computes the fraction of host queue entries matching the given filter data
@@ -767,6 +769,7 @@ def get_motd():
     return rpc_utils.get_motd()
 
 
+@rpc_cache.cacheable(ttl=60, key_function=rpc_utils.get_current_user_login)
 def get_static_data():
     """\
     Returns a dictionary containing a bunch of data that shouldn't change
@@ -841,5 +844,13 @@ def get_static_data():
     return result
 
 
+def get_rpc_cache_stats():
+    """\
+    Returns hit/miss counts and hit rates of the cached RPCs served by this
+    server process, as a dictionary keyed by RPC name.
+    """
+    return rpc_cache.stats.get_stats()
+
+
 def get_server_time():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -368,6 +368,13 @@ def check_modify_host_locking(host, update_data):
                     'locked': 'Host already unlocked.'})
 
 
+def get_current_user_login():
+    """\
+    Cache key function for cached RPC results that depend on the user.
+    """
+    return models.User.current_user().login
+
+
 def get_motd():
     dirname = os.path.dirname(__file__)
     filename = os.path.join(dirname, "..", "..", "motd.txt")
@@ -0,0 +1,32 @@
+# The latest valid test for each (test name, machine, kernel, job label),
+# maintained by the TKO parser so get_latest_tests doesn't have to aggregate
+# over the whole test history.  Unlabeled jobs are grouped under the empty
+# label.
+UP_SQL = """
+CREATE TABLE `tko_latest_tests` (
+    `test_idx` int(10) unsigned NOT NULL PRIMARY KEY,
+    `test` varchar(300) NOT NULL,
+    `machine_idx` int(10) unsigned NOT NULL,
+    `kernel_idx` int(10) unsigned NOT NULL,
+    `job_label` varchar(300) NOT NULL,
+    UNIQUE KEY `tko_latest_tests_group` (`test`, `machine_idx`, `kernel_idx`,
+                                         `job_label`),
+    FOREIGN KEY (`test_idx`) REFERENCES `tko_tests` (`test_idx`)
+        ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+INSERT INTO tko_latest_tests (test_idx, test, machine_idx, kernel_idx,
+                              job_label)
+SELECT MAX(tko_tests.test_idx), tko_tests.test, tko_tests.machine_idx,
+       tko_tests.kernel_idx, IFNULL(tko_jobs.label, '')
+FROM tko_tests
+INNER JOIN tko_jobs ON tko_jobs.job_idx = tko_tests.job_idx
+INNER JOIN tko_status ON tko_status.status_idx = tko_tests.status
+WHERE tko_status.word NOT IN ('TEST_NA', 'NOSTATUS')
+GROUP BY tko_tests.test, tko_tests.machine_idx, tko_tests.kernel_idx,
+         IFNULL(tko_jobs.label, '');
+"""
+
+DOWN_SQL = """
+DROP TABLE tko_latest_tests;
+"""
@@ -13,6 +13,7 @@ settings.DATABASE_NAME = ':memory:'
 
 from django.db import connection
 from autotest_lib.frontend.afe import readonly_connection
+from autotest_lib.client.common_lib import rpc_cache
 
 def run_syncdb(verbosity=0):
     management.call_command('syncdb', verbosity=verbosity, interactive=False)
@@ -34,10 +35,12 @@ def destroy_test_database():
 def set_up():
     run_syncdb()
     readonly_connection.ReadOnlyConnection.set_globally_disabled(True)
+    rpc_cache.set_globally_disabled(True)
 
 
 def tear_down():
     readonly_connection.ReadOnlyConnection.set_globally_disabled(False)
+    rpc_cache.set_globally_disabled(False)
     destroy_test_database()
 
 
@@ -0,0 +1,220 @@
+"""\
+Content-addressed cache of rendered graph images.
+
+Images are stored as files named after a hash of the graph type and its
+parameters, so embedded graphs built from identical queries share a single
+image.  The graph refresher (graph_refresher.py) renders images in the
+background.  Web requests leave a refresh request next to the images they
+read, so the refresher renders them ahead of the age they want.  A request
+renders an image itself only when there is none at all, and only after
+claiming the render, so that concurrent requests don't all render it.
+"""
+
+import errno, os, tempfile, time
+from simplejson import encoder
+from autotest_lib.client.common_lib import global_config, utils
+
+_IMAGE_SUFFIX = '.png'
+_REQUEST_SUFFIX = '.wanted'
+_CLAIM_SUFFIX = '.rendering'
+
+_json_encoder = encoder.JSONEncoder(sort_keys=True)
+
+
+def get_graph_key(graph_type, params):
+    """\
+    Compute the cache key of a graph from its type and parameters (as stored,
+    unpickled, in EmbeddedGraphingQuery.params).
+    """
+    description = _json_encoder.encode([graph_type, params])
+    return utils.hash('sha1', description).hexdigest()
+
+
+def _default_cache_dir():
+    return global_config.global_config.get_config_value(
+            'AUTOTEST_WEB', 'graph_cache_dir',
+            default=os.path.join(tempfile.gettempdir(),
+                                 'autotest_graph_cache'))
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = _default_cache_dir()
+        self.cache_dir = cache_dir
+
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+
+    def _ensure_cache_dir(self):
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+    def get(self, key):
+        """\
+        @returns a tuple (png data, age in minutes), or None if there is no
+                image cached for key.
+        """
+        path = self._path(key, _IMAGE_SUFFIX)
+        try:
+            image_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            age = (time.time() - os.fstat(image_file.fileno()).st_mtime) / 60
+            return image_file.read(), age
+        finally:
+            image_file.close()
+
+
+    def get_age(self, key):
+        """\
+        @returns the age, in minutes, of the image cached for key, or None if
+                there is none.
+        """
+        try:
+            mtime = os.stat(self._path(key, _IMAGE_SUFFIX)).st_mtime
+        except OSError:
+            return None
+        return (time.time() - mtime) / 60
+
+
+    def put(self, key, png):
+        """\
+        Atomically store the image for key, so readers never see a partially
+        written file.
+        """
+        self._ensure_cache_dir()
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            os.write(fd, png)
+            os.close(fd)
+            os.rename(temp_path, self._path(key, _IMAGE_SUFFIX))
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def request_refresh(self, key, max_age):
+        """\
+        Record that a client wants the image for key to be no older than
+        max_age minutes, so the refresher renders it ahead of that age.
+        The request is rewritten when it is older than max_age, letting the
+        refresher tell graphs that are still being looked at from idle ones.
+        """
+        current = self.get_refresh_request(key)
+        if current is not None:
+            current_max_age, request_age = current
+            if current_max_age <= max_age and request_age < max_age:
+                return
+            max_age = min(max_age, current_max_age)
+        self._ensure_cache_dir()
+        request_file = open(self._path(key, _REQUEST_SUFFIX), 'w')
+        try:
+            request_file.write(str(max_age))
+        finally:
+            request_file.close()
+
+
+    def get_refresh_request(self, key):
+        """\
+        @returns a tuple (requested max_age, age of the request), in minutes,
+                of the pending refresh request for key, or None.
+        """
+        path = self._path(key, _REQUEST_SUFFIX)
+        try:
+            max_age = int(utils.read_one_line(path))
+            request_age = (time.time() - os.stat(path).st_mtime) / 60
+        except (IOError, OSError, ValueError):
+            return None
+        return max_age, request_age
+
+
+    def clear_refresh_request(self, key):
+        try:
+            os.remove(self._path(key, _REQUEST_SUFFIX))
+        except OSError:
+            pass
+
+
+    def claim_render(self, key, timeout):
+        """\
+        Atomically claim the rendering of the image for key, so that only
+        one of the concurrent requests wanting it renders it.  Claims older
+        than timeout minutes, left by requests which died while rendering,
+        are broken.
+
+        @returns True if the claim was taken, False if somebody else holds
+                it.  Call release_render() once done.
+        """
+        self._ensure_cache_dir()
+        path = self._path(key, _CLAIM_SUFFIX)
+        for attempt in xrange(2):
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0644))
+                return True
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                claim_age = (time.time() - os.stat(path).st_mtime) / 60
+            except OSError:
+                # released in the meantime
+                continue
+            if claim_age < timeout:
+                return False
+            self.release_render(key)
+        return False
+
+
+    def release_render(self, key):
+        try:
+            os.remove(self._path(key, _CLAIM_SUFFIX))
+        except OSError:
+            pass
+
+
+    def remove_unused(self, used_keys):
+        """\
+        Delete cached images (and requests) whose key isn't in used_keys.
+        """
+        used_keys = set(used_keys)
+        try:
+            file_names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for file_name in file_names:
+            key, suffix = os.path.splitext(file_name)
+            if suffix in (_IMAGE_SUFFIX, _REQUEST_SUFFIX, _CLAIM_SUFFIX):
+                if key not in used_keys:
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+
+def needs_refresh(image_cache, key, refresh_interval, lead_time):
+    """\
+    Decide if the image for key should be rendered again.
+
+    @param refresh_interval: Minutes after which every image gets refreshed.
+    @param lead_time: Minutes before expiry at which to refresh, so that
+            requests never see an expired image.
+    """
+    age = image_cache.get_age(key)
+    if age is None:
+        return True
+    request = image_cache.get_refresh_request(key)
+    if request is not None:
+        requested_max_age, request_age = request
+        if request_age >= refresh_interval:
+            # nobody has looked at this graph for a while
+            image_cache.clear_refresh_request(key)
+        elif age + lead_time >= requested_max_age:
+            return True
+    return age + lead_time >= refresh_interval
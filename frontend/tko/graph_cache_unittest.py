@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, time, unittest
+import common
+from autotest_lib.frontend.tko import graph_cache
+
+
+class GraphKeyTest(unittest.TestCase):
+    def test_key_ignores_dict_ordering(self):
+        params1 = {'query': 'SELECT 1', 'interval': 10, 'filter_string': ''}
+        params2 = {'filter_string': '', 'interval': 10, 'query': 'SELECT 1'}
+        self.assertEquals(graph_cache.get_graph_key('qual', params1),
+                          graph_cache.get_graph_key('qual', params2))
+
+
+    def test_key_depends_on_content(self):
+        params = {'query': 'SELECT 1'}
+        self.assertNotEquals(graph_cache.get_graph_key('qual', params),
+                             graph_cache.get_graph_key('metrics', params))
+        self.assertNotEquals(graph_cache.get_graph_key('qual', params),
+                             graph_cache.get_graph_key('qual',
+                                                       {'query': 'SELECT 2'}))
+
+
+class ImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.image_cache = graph_cache.ImageCache(
+                os.path.join(self.cache_dir, 'graphs'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+    def _age_file(self, key, suffix, minutes):
+        path = os.path.join(self.image_cache.cache_dir, key + suffix)
+        timestamp = time.time() - minutes * 60
+        os.utime(path, (timestamp, timestamp))
+
+
+    def test_get_put(self):
+        self.assertEquals(self.image_cache.get('key'), None)
+        self.assertEquals(self.image_cache.get_age('key'), None)
+        self.image_cache.put('key', 'png data')
+        png, age = self.image_cache.get('key')
+        self.assertEquals(png, 'png data')
+        self.assert_(age < 1)
+
+
+    def test_refresh_request_keeps_smallest_max_age(self):
+        self.image_cache.request_refresh('key', 30)
+        self.image_cache.request_refresh('key', 60)
+        self.assertEquals(self.image_cache.get_refresh_request('key')[0], 30)
+        self.image_cache.request_refresh('key', 10)
+        self.assertEquals(self.image_cache.get_refresh_request('key')[0], 10)
+        self.image_cache.clear_refresh_request('key')
+        self.assertEquals(self.image_cache.get_refresh_request('key'), None)
+
+
+    def test_needs_refresh(self):
+        self.assert_(graph_cache.needs_refresh(self.image_cache, 'key', 60, 1))
+        self.image_cache.put('key', 'png data')
+        self.assertFalse(graph_cache.needs_refresh(self.image_cache, 'key',
+                                                   60, 1))
+        self._age_file('key', '.png', 20)
+        self.assertFalse(graph_cache.needs_refresh(self.image_cache, 'key',
+                                                   60, 1))
+        self.image_cache.request_refresh('key', 20)
+        self.assert_(graph_cache.needs_refresh(self.image_cache, 'key', 60, 1))
+        self._age_file('key', '.png', 59.5)
+        self.image_cache.clear_refresh_request('key')
+        self.assert_(graph_cache.needs_refresh(self.image_cache, 'key', 60, 1))
+
+
+    def test_idle_refresh_request_is_dropped(self):
+        self.image_cache.put('key', 'png data')
+        self._age_file('key', '.png', 30)
+        self.image_cache.request_refresh('key', 10)
+        self._age_file('key', '.wanted', 90)
+        self.assertFalse(graph_cache.needs_refresh(self.image_cache, 'key',
+                                                   60, 1))
+        self.assertEquals(self.image_cache.get_refresh_request('key'), None)
+
+
+    def test_remove_unused(self):
+        self.image_cache.put('used', 'png data')
+        self.image_cache.put('unused', 'png data')
+        self.image_cache.request_refresh('unused', 10)
+        self.image_cache.remove_unused(['used'])
+        self.assertEquals(sorted(os.listdir(self.image_cache.cache_dir)),
+                          ['used.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
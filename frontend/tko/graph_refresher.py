@@ -0,0 +1,58 @@
+#!/usr/bin/python
+"""\
+Background worker keeping the embedded graph image cache fresh, so that
+graph requests don't have to wait for matplotlib.  Without it, requests
+render the graphs themselves whenever their image is too old.  It is
+started by utils/autotest.init, next to the scheduler.
+"""
+
+import logging, optparse, time
+import common
+from autotest_lib.frontend import setup_django_environment
+from autotest_lib.client.common_lib import global_config
+from autotest_lib.frontend.tko import graph_cache, graphing_utils
+
+
+def parse_args():
+    refresh_interval = global_config.global_config.get_config_value(
+            'AUTOTEST_WEB', 'graph_refresh_interval_minutes', type=int,
+            default=60)
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--once', action='store_true', default=False,
+                      help='refresh stale graphs once and exit')
+    parser.add_option('--poll-interval', type='int', default=30,
+                      help='seconds to sleep between checks (default 30)')
+    parser.add_option('--refresh-interval', type='int',
+                      default=refresh_interval,
+                      help='minutes after which every graph is refreshed, '
+                           'even if nobody requested it (default %default)')
+    return parser.parse_args()
+
+
+def main():
+    options, args = parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    setup_django_environment.enable_autocommit()
+    image_cache = graph_cache.ImageCache()
+    # refresh a bit ahead of expiry, so requests never see an expired image
+    lead_time = 2 * options.poll_interval / 60.0
+
+    while True:
+        start_time = time.time()
+        try:
+            rendered = graphing_utils.refresh_embedded_plots(
+                    image_cache, options.refresh_interval, lead_time)
+        except Exception:
+            logging.exception('Failed to refresh embedded graphs')
+        else:
+            if rendered:
+                logging.info('Rendered %d graphs in %.1f seconds', rendered,
+                             time.time() - start_time)
+        if options.once:
+            break
+        time.sleep(options.poll_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
-import base64, os, tempfile, operator, pickle, datetime, django.db
-import os.path, getpass
+import base64, os, tempfile, operator, pickle, datetime
+import os.path, getpass, logging, django.http
 from math import sqrt
 
 # When you import matplotlib, it tries to write some temp files for better
@@ -19,12 +19,12 @@ import matplotlib
 matplotlib.use('Agg')
 
 import matplotlib.figure, matplotlib.backends.backend_agg
-import StringIO, colorsys, PIL.Image, PIL.ImageChops
+import StringIO, colorsys, numpy, PIL.Image, PIL.ImageChops
 from autotest_lib.frontend.afe import readonly_connection
 from autotest_lib.frontend.afe.model_logic import ValidationError
 from simplejson import encoder
 from autotest_lib.client.common_lib import global_config
-from autotest_lib.frontend.tko import models, tko_rpc_utils
+from autotest_lib.frontend.tko import graph_cache, models, tko_rpc_utils
 
 _FIGURE_DPI = 100
 _FIGURE_WIDTH_IN = 10
@@ -63,18 +63,14 @@ def _colors(n):
         yield colorsys.hsv_to_rgb(float(i) / n, 1.0, 1.0)
 
 
-def _resort(kernel_labels, list_to_sort):
+def _kernel_sort_order(kernel_labels):
     """\
-    Resorts a list, using a list of kernel strings as the keys. Returns the
-    resorted list.
+    Returns the array of indices that sorts a list of kernel strings by kernel
+    version.  It can be used to reorder any array aligned with the labels.
     """
-
     labels = [tko_rpc_utils.KernelString(label) for label in kernel_labels]
-    resorted_pairs = sorted(zip(labels, list_to_sort))
-
-    # We only want the resorted list; we are not interested in the kernel
-    # strings.
-    return [pair[1] for pair in resorted_pairs]
+    return numpy.array(sorted(xrange(len(labels)), key=labels.__getitem__),
+                       dtype=int)
 
 
 def _quote(string):
@@ -386,39 +382,39 @@ def _normalize(data_values, data_errors, base_values, base_errors):
     Normalize the data against a baseline.
 
     data_values: y-values for the to-be-normalized data
-    data_errors: standard deviations for the to-be-normalized data
-    base_values: list of values normalize against
-    base_errors: list of standard deviations for those base values
+    data_errors: standard deviations for the to-be-normalized data, or None
+    base_values: values to normalize against
+    base_errors: standard deviations for those base values, or None
+
+    All the values are sequences (or NumPy arrays) of the same length; the
+    result is a tuple of arrays (values, errors), errors being None if
+    data_errors is None.
     """
-    values = []
-    for value, base in zip(data_values, base_values):
-        try:
-            values.append(100 * (value - base) / base)
-        except ZeroDivisionError:
-            # Base is 0.0 so just simplify:
-            #   If value < base: append -100.0;
-            #   If value == base: append 0.0 (obvious); and
-            #   If value > base: append 100.0.
-            values.append(100 * float(cmp(value, base)))
+    data = numpy.asarray(data_values, dtype=float)
+    base = numpy.asarray(base_values, dtype=float)
+    zero_base = (base == 0)
+    # avoid dividing by zero; those points are handled separately
+    divisor = numpy.where(zero_base, 1.0, base)
+
+    # Base is 0.0 so just simplify:
+    #   If value < base: -100.0; if value == base: 0.0; if value > base: 100.0
+    values = numpy.where(zero_base, 100 * numpy.sign(data - base),
+                         100 * (data - base) / divisor)
 
     # Based on error for f(x,y) = 100 * (x - y) / y
-    if data_errors:
-        if not base_errors:
-            base_errors = [0] * len(data_errors)
-        errors = []
-        for data, error, base_value, base_error in zip(
-                data_values, data_errors, base_values, base_errors):
-            try:
-                errors.append(sqrt(error**2 * (100 / base_value)**2
-                        + base_error**2 * (100 * data / base_value**2)**2
-                        + error * base_error * (100 / base_value**2)**2))
-            except ZeroDivisionError:
-                # Again, base is 0.0 so do the simple thing.
-                errors.append(100 * abs(error))
+    if data_errors is None:
+        return values, None
+    error = numpy.asarray(data_errors, dtype=float)
+    if base_errors is None:
+        base_error = numpy.zeros(len(error))
     else:
-        errors = None
-
-    return (values, errors)
+        base_error = numpy.asarray(base_errors, dtype=float)
+    errors = numpy.sqrt(error**2 * (100 / divisor)**2
+                        + base_error**2 * (100 * data / divisor**2)**2
+                        + error * base_error * (100 / divisor**2)**2)
+    # Again, base is 0.0 so do the simple thing.
+    errors = numpy.where(zero_base, 100 * abs(error), errors)
+    return values, errors
 
 
 def _create_png(figure):
@@ -490,37 +486,128 @@ def _normalize_to_series(plots, base_series):
     del plots[base_series_index]
 
     for plot in plots:
-        old_xs, old_values, old_errors = plot['x'], plot['y'], plot['errors']
-        new_xs, new_values, new_errors = [], [], []
-        new_base_values, new_base_errors = [], []
         # Select only points in the to-be-normalized data that have a
-        # corresponding baseline value
-        for index, x_value in enumerate(old_xs):
-            try:
-                base_index = base_xs.index(x_value)
-            except ValueError:
-                continue
-
-            new_xs.append(x_value)
-            new_values.append(old_values[index])
-            new_base_values.append(base_values[base_index])
-            if old_errors:
-                new_errors.append(old_errors[index])
-                new_base_errors.append(base_errors[base_index])
-
-        if not new_xs:
+        # corresponding baseline value.  x values are sorted, so a binary
+        # search finds the candidate baseline point for each x.
+        base_indices = numpy.searchsorted(base_xs, plot['x'])
+        base_indices = numpy.minimum(base_indices, len(base_xs) - 1)
+        has_base = (base_xs[base_indices] == plot['x'])
+        if not has_base.any():
             raise NoDataError('No normalizable data for series ' +
                               plot['label'])
-        plot['x'] = new_xs
-        plot['y'] = new_values
-        if old_errors:
-            plot['errors'] = new_errors
+        base_indices = base_indices[has_base]
+
+        plot['x'] = plot['x'][has_base]
+        plot['y'] = plot['y'][has_base]
+        new_base_errors = None
+        if plot['errors'] is not None:
+            plot['errors'] = plot['errors'][has_base]
+            if base_errors is not None:
+                new_base_errors = base_errors[base_indices]
 
         plot['y'], plot['errors'] = _normalize(plot['y'], plot['errors'],
-                                               new_base_values,
+                                               base_values[base_indices],
                                                new_base_errors)
 
 
+def _get_metrics_plot_data(rows, column_names):
+    """\
+    Extract the data for each series from the rows of a metrics plot main
+    query (see MetricsPlot).
+
+    rows: sequence of row tuples
+    column_names: names of the query columns
+
+    Returns a tuple (plots, labels).  plots is a list of dicts containing:
+            label: series name
+            x: array of x-values (indices into labels) with data
+            y: array of corresponding y-values
+            errors: array of errors for each data point, or None if no error
+                    information is available
+    labels is the list of x-axis labels.
+    """
+    labels = [str(row[0]) for row in rows]
+    # NULL values become NaN, marking points with no data
+    values = numpy.array([row[1:] for row in rows], dtype=float)
+    values = values.reshape(len(rows), len(column_names) - 1)
+
+    if column_names[0] == 'kernel':
+        order = _kernel_sort_order(labels)
+        labels = [labels[index] for index in order]
+        values = values[order]
+
+    plots = []
+    col = 1
+    while col < len(column_names):
+        y = values[:, col - 1]
+        label = column_names[col]
+        col += 1
+        errors = None
+        if (col < len(column_names) and
+            'errors-' + label == column_names[col]):
+            errors = values[:, col - 1]
+            col += 1
+
+        x = numpy.flatnonzero(~numpy.isnan(y))
+        if not len(x):
+            raise NoDataError('No data for series ' + label)
+        if errors is not None:
+            errors = errors[x]
+        plots.append({'label': label, 'x': x, 'y': y[x], 'errors': errors})
+
+    return plots, labels
+
+
+def _normalize_plots(plots, labels, normalize_to):
+    """\
+    Normalize the plot data as requested by MetricsPlot.normalize_to.
+    """
+    if normalize_to.startswith('series__'):
+        _normalize_to_series(plots, normalize_to[8:])
+        return
+    if normalize_to != 'first' and not normalize_to.startswith('x__'):
+        return
+
+    if normalize_to != 'first':
+        baseline = normalize_to[3:]
+        try:
+            baseline_index = labels.index(baseline)
+        except ValueError:
+            raise ValidationError({
+                'Normalize' : 'Invalid baseline %s' % baseline
+                })
+    for plot in plots:
+        if normalize_to == 'first':
+            plot_index = 0
+        else:
+            plot_indices = numpy.flatnonzero(plot['x'] == baseline_index)
+            # if the value is not found, then we cannot normalize
+            if not len(plot_indices):
+                raise ValidationError({
+                    'Normalize' : ('%s does not have a value for %s'
+                                   % (plot['label'], normalize_to[3:]))
+                    })
+            plot_index = plot_indices[0]
+        base_values = numpy.repeat(plot['y'][plot_index], len(plot['y']))
+        base_errors = None
+        if plot['errors'] is not None:
+            base_errors = numpy.repeat(plot['errors'][plot_index],
+                                       len(plot['errors']))
+        plot['y'], plot['errors'] = _normalize(plot['y'], plot['errors'],
+                                               base_values, base_errors)
+
+
+def _plot_data_to_lists(plots):
+    """\
+    Convert the arrays in the plot data to plain lists for the drawing code.
+    """
+    for plot in plots:
+        plot['x'] = plot['x'].tolist()
+        plot['y'] = plot['y'].tolist()
+        if plot['errors'] is not None:
+            plot['errors'] = plot['errors'].tolist()
+
+
 def _create_metrics_plot_helper(plot_info, extra_text=None):
     """
     Create a metrics plot of the given plot data.
@@ -535,81 +622,10 @@ def _create_metrics_plot_helper(plot_info, extra_text=None):
 
     if not cursor.rowcount:
         raise NoDataError('query did not return any data')
-    rows = cursor.fetchall()
-    # "transpose" rows, so columns[0] is all the values from the first column,
-    # etc.
-    columns = zip(*rows)
-
-    plots = []
-    labels = [str(label) for label in columns[0]]
-    needs_resort = (cursor.description[0][0] == 'kernel')
-
-    # Collect all the data for the plot
-    col = 1
-    while col < len(cursor.description):
-        y = columns[col]
-        label = cursor.description[col][0]
-        col += 1
-        if (col < len(cursor.description) and
-            'errors-' + label == cursor.description[col][0]):
-            errors = columns[col]
-            col += 1
-        else:
-            errors = None
-        if needs_resort:
-            y = _resort(labels, y)
-            if errors:
-                errors = _resort(labels, errors)
-
-        x = [index for index, value in enumerate(y) if value is not None]
-        if not x:
-            raise NoDataError('No data for series ' + label)
-        y = [y[i] for i in x]
-        if errors:
-            errors = [errors[i] for i in x]
-        plots.append({
-            'label': label,
-            'x': x,
-            'y': y,
-            'errors': errors
-        })
-
-    if needs_resort:
-        labels = _resort(labels, labels)
-
-    # Normalize the data if necessary
-    normalize_to = plot_info.normalize_to
-    if normalize_to == 'first' or normalize_to.startswith('x__'):
-        if normalize_to != 'first':
-            baseline = normalize_to[3:]
-            try:
-                baseline_index = labels.index(baseline)
-            except ValueError:
-                raise ValidationError({
-                    'Normalize' : 'Invalid baseline %s' % baseline
-                    })
-        for plot in plots:
-            if normalize_to == 'first':
-                plot_index = 0
-            else:
-                try:
-                    plot_index = plot['x'].index(baseline_index)
-                # if the value is not found, then we cannot normalize
-                except ValueError:
-                    raise ValidationError({
-                        'Normalize' : ('%s does not have a value for %s'
-                                       % (plot['label'], normalize_to[3:]))
-                        })
-            base_values = [plot['y'][plot_index]] * len(plot['y'])
-            if plot['errors']:
-                base_errors = [plot['errors'][plot_index]] * len(plot['errors'])
-            plot['y'], plot['errors'] = _normalize(plot['y'], plot['errors'],
-                                                   base_values,
-                                                   None or base_errors)
-
-    elif normalize_to.startswith('series__'):
-        base_series = normalize_to[8:]
-        _normalize_to_series(plots, base_series)
+    column_names = [column[0] for column in cursor.description]
+    plots, labels = _get_metrics_plot_data(cursor.fetchall(), column_names)
+    _normalize_plots(plots, labels, plot_info.normalize_to)
+    _plot_data_to_lists(plots)
 
     # Call the appropriate function to draw the line or bar plot
     if plot_info.is_line:
@@ -633,16 +649,50 @@ def create_metrics_plot(query_dict, plot_type, inverted_series, normalize_to,
     return _create_image_html(figure, area_data, plot_info)
 
 
-def _get_hostnames_in_bucket(hist_data, bucket):
+def _get_qual_histogram_data(rows):
     """\
-    Get all the hostnames that constitute a particular bucket in the histogram.
+    Classify the machines of a qualification histogram query by pass rate.
 
-    hist_data: list containing tuples of (hostname, pass_rate)
-    bucket: tuple containing the (low, high) values of the target bucket
+    rows: sequence of (hostname, total, good) tuples
+
+    Returns a tuple (hist_hostnames, pass_rates, no_tests, no_pass, perfect):
+    hist_hostnames and the pass_rates array hold the machines that have pass
+    rates between 0 and 100%, exclusive; no_tests lists machines that have
+    run none of the selected tests, no_pass those with a 0% pass rate and
+    perfect those with a 100% pass rate.
     """
+    hostnames = numpy.array([row[0] for row in rows], dtype=object)
+    counts = numpy.array([row[1:] for row in rows], dtype=float)
+    counts = counts.reshape(len(rows), 2)
+    total, good = counts[:, 0], counts[:, 1]
+
+    no_tests = (total == 0)
+    no_pass = ~no_tests & (good == 0)
+    perfect = ~no_tests & (good == total)
+    in_histogram = ~(no_tests | no_pass | perfect)
 
-    return [hostname for hostname, pass_rate in hist_data
-            if bucket[0] <= pass_rate < bucket[1]]
+    pass_rates = 100.0 * good[in_histogram] / total[in_histogram]
+    return (hostnames[in_histogram].tolist(), pass_rates,
+            hostnames[no_tests].tolist(), hostnames[no_pass].tolist(),
+            hostnames[perfect].tolist())
+
+
+def _get_hostnames_in_buckets(hostnames, pass_rates, buckets):
+    """\
+    Get all the hostnames that constitute each bucket in the histogram.
+
+    hostnames: list of hostnames
+    pass_rates: array of the corresponding pass rates
+    buckets: list of contiguous (low, high) bucket limits
+
+    Returns a list containing the list of hostnames for each bucket.
+    """
+    edges = [bucket[0] for bucket in buckets] + [buckets[-1][1]]
+    # bucket_numbers[i] == n means buckets[n - 1][0] <= rate < buckets[n - 1][1]
+    bucket_numbers = numpy.digitize(pass_rates, edges)
+    return [[hostnames[index]
+             for index in numpy.flatnonzero(bucket_numbers == number)]
+            for number in xrange(1, len(buckets) + 1)]
 
 
 def _create_qual_histogram_helper(plot_info, extra_text=None):
@@ -661,30 +711,8 @@ def _create_qual_histogram_helper(plot_info, extra_text=None):
     if not cursor.rowcount:
         raise NoDataError('query did not return any data')
 
-    # Lists to store the plot data.
-    # hist_data store tuples of (hostname, pass_rate) for machines that have
-    #     pass rates between 0 and 100%, exclusive.
-    # no_tests is a list of machines that have run none of the selected tests
-    # no_pass is a list of machines with 0% pass rate
-    # perfect is a list of machines with a 100% pass rate
-    hist_data = []
-    no_tests = []
-    no_pass = []
-    perfect = []
-
-    # Construct the lists of data to plot
-    for hostname, total, good in cursor.fetchall():
-        if total == 0:
-            no_tests.append(hostname)
-            continue
-
-        if good == 0:
-            no_pass.append(hostname)
-        elif good == total:
-            perfect.append(hostname)
-        else:
-            percentage = 100.0 * good / total
-            hist_data.append((hostname, percentage))
+    hist_hostnames, pass_rates, no_tests, no_pass, perfect = (
+            _get_qual_histogram_data(cursor.fetchall()))
 
     interval = plot_info.interval
     bins = range(0, 100, interval)
@@ -695,8 +723,7 @@ def _create_qual_histogram_helper(plot_info, extra_text=None):
     subplot = figure.add_subplot(1, 1, 1)
 
     # Plot the data and get all the bars plotted
-    _,_, bars = subplot.hist([data[1] for data in hist_data],
-                         bins=bins, align='left')
+    _,_, bars = subplot.hist(pass_rates, bins=bins, align='left')
     bars += subplot.bar([-interval], len(no_pass),
                     width=interval, align='center')
     bars += subplot.bar([bins[-1]], len(perfect),
@@ -732,8 +759,7 @@ def _create_qual_histogram_helper(plot_info, extra_text=None):
     titles.append('N/A: %d machines' % len(no_tests))
 
     # Get the hostnames for each bucket in the histogram
-    names_list = [_get_hostnames_in_bucket(hist_data, bucket)
-                  for bucket in buckets]
+    names_list = _get_hostnames_in_buckets(hist_hostnames, pass_rates, buckets)
     names_list += [no_pass, perfect]
 
     if plot_info.filter_string:
@@ -784,11 +810,18 @@ def create_embedded_plot(model, update_time):
     model: EmbeddedGraphingQuery object
     update_time: 'Last updated' time
     """
+    return _create_embedded_plot_png(model.graph_type,
+                                     pickle.loads(model.params), update_time)
 
-    params = pickle.loads(model.params)
+
+def _create_embedded_plot_png(graph_type, params, update_time):
+    """\
+    Generate the PNG image of an embedded graph, given its type and its
+    unpickled parameters.
+    """
     extra_text = 'Last updated: %s' % update_time
 
-    if model.graph_type == 'metrics':
+    if graph_type == 'metrics':
         plot_info = MetricsPlot(query_dict=params['queries'],
                                 plot_type=params['plot'],
                                 inverted_series=params['invert'],
@@ -796,59 +829,119 @@ def create_embedded_plot(model, update_time):
                                 drilldown_callback='')
         figure, areas_unused = _create_metrics_plot_helper(plot_info,
                                                            extra_text)
-    elif model.graph_type == 'qual':
+    elif graph_type == 'qual':
         plot_info = QualificationHistogram(
             query=params['query'], filter_string=params['filter_string'],
             interval=params['interval'], drilldown_callback='')
         figure, areas_unused = _create_qual_histogram_helper(plot_info,
                                                              extra_text)
     else:
-        raise ValueError('Invalid graph_type %s' % model.graph_type)
+        raise ValueError('Invalid graph_type %s' % graph_type)
 
     image, bounding_box_unused = _create_png(figure)
     return image
 
 
 _cache_timeout = global_config.global_config.get_config_value(
-    'AUTOTEST_WEB', 'graph_cache_creation_timeout_minutes')
+    'AUTOTEST_WEB', 'graph_cache_creation_timeout_minutes', type=int,
+    default=10)
 
 
 def handle_plot_request(id, max_age):
     """\
-    Given the embedding id of a graph, generate a PNG of the embedded graph
-    associated with that id.
+    Given the embedding id of a graph, return the PNG of the embedded graph
+    associated with that id.  The image comes from the image cache kept up
+    to date by graph_refresher.py, which is asked to refresh it ahead of
+    max_age; a stale image is served until then.  Only if the image cache
+    has no image at all is it rendered here, by a single request at a time,
+    the others getting the image stored when the graph was embedded.
 
     id: id of the embedded graph
     max_age: maximum age, in minutes, that a cached version should be held
     """
-    model = models.EmbeddedGraphingQuery.objects.get(id=id)
-
-    # Check if the cached image needs to be updated
-    now = datetime.datetime.now()
-    update_time = model.last_updated + datetime.timedelta(minutes=int(max_age))
-    if now > update_time:
-        cursor = django.db.connection.cursor()
-
-        # We want this query to update the refresh_time only once, even if
-        # multiple threads are running it at the same time. That is, only the
-        # first thread will win the race, and it will be the one to update the
-        # cached image; all other threads will show that they updated 0 rows
-        query = """
-            UPDATE embedded_graphing_queries
-            SET refresh_time = NOW()
-            WHERE id = %s AND (
-                refresh_time IS NULL OR
-                refresh_time + INTERVAL %s MINUTE < NOW()
-            )
-        """
-        cursor.execute(query, (id, _cache_timeout))
+    max_age = int(max_age)
+    try:
+        model = models.EmbeddedGraphingQuery.objects.get(id=id)
+    except models.EmbeddedGraphingQuery.DoesNotExist:
+        raise django.http.Http404('No embedded graph with id %s' % id)
+    params = pickle.loads(model.params)
+    key = graph_cache.get_graph_key(model.graph_type, params)
+    image_cache = graph_cache.ImageCache()
+
+    cached = image_cache.get(key)
+    try:
+        image_cache.request_refresh(key, max_age)
+        if cached is not None or not image_cache.claim_render(
+                key, _cache_timeout):
+            if cached is not None:
+                return cached[0]
+            return model.cached_png
+    except (IOError, OSError), e:
+        logging.warning('Could not use the graph cache %s: %s',
+                        image_cache.cache_dir, e)
+        if cached is not None:
+            return cached[0]
+        return model.cached_png
+
+    try:
+        update_time = datetime.datetime.now().ctime()
+        try:
+            png = _create_embedded_plot_png(model.graph_type, params,
+                                            update_time)
+        except NoDataError, e:
+            logging.warning('Could not render graph %s: %s', id, e)
+            return model.cached_png
+        try:
+            image_cache.put(key, png)
+        except (IOError, OSError), e:
+            logging.warning('Could not cache graph %s in %s: %s', id,
+                            image_cache.cache_dir, e)
+        return png
+    finally:
+        image_cache.release_render(key)
 
-        # Only refresh the cached image if we were successful in updating the
-        # refresh time
-        if cursor.rowcount:
-            model.cached_png = create_embedded_plot(model, now.ctime())
-            model.last_updated = now
-            model.refresh_time = None
-            model.save()
 
-    return model.cached_png
+def _group_embedded_graphs():
+    """\
+    Group all the embedded graphs by image cache key, so identical queries
+    get rendered only once.
+
+    @returns a dictionary mapping keys to (graph_type, params) tuples.
+    """
+    graphs = {}
+    for graph_info in models.EmbeddedGraphingQuery.objects.values('graph_type',
+                                                                  'params'):
+        graph_type = graph_info['graph_type']
+        params = pickle.loads(graph_info['params'])
+        graphs[graph_cache.get_graph_key(graph_type, params)] = (graph_type,
+                                                                 params)
+    return graphs
+
+
+def refresh_embedded_plots(image_cache, refresh_interval, lead_time):
+    """\
+    Render the embedded graphs whose cached image is missing or about to
+    expire, and delete cached images that no graph uses anymore.
+
+    image_cache: a graph_cache.ImageCache
+    refresh_interval: minutes after which every image gets refreshed
+    lead_time: minutes before expiry at which images get refreshed
+
+    @returns the number of images rendered.
+    """
+    graphs = _group_embedded_graphs()
+    image_cache.remove_unused(graphs.keys())
+    rendered = 0
+    for key, (graph_type, params) in graphs.iteritems():
+        if not graph_cache.needs_refresh(image_cache, key, refresh_interval,
+                                         lead_time):
+            continue
+        update_time = datetime.datetime.now().ctime()
+        try:
+            png = _create_embedded_plot_png(graph_type, params, update_time)
+        except NoDataError, e:
+            logging.warning('Not refreshing graph %s: %s', key, e)
+            continue
+        image_cache.put(key, png)
+        rendered += 1
+    return rendered
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+
+"""\
+Tests for the data preparation in graphing_utils.  The expected results come
+from the former pure-Python implementation, kept here as a reference.
+
+Run with "benchmark" as argument to compare the speed of both
+implementations on a large data set.
+"""
+
+import datetime, os, pickle, random, shutil, sys, tempfile, time, unittest
+from math import sqrt
+import common
+from autotest_lib.frontend import setup_django_environment
+from autotest_lib.frontend import setup_test_environment
+from autotest_lib.client.common_lib.test_utils import mock
+from autotest_lib.frontend.tko import graph_cache, graphing_utils, models
+from autotest_lib.frontend.tko import tko_rpc_utils
+import django.http
+
+
+def _reference_normalize(data_values, data_errors, base_values, base_errors):
+    values = []
+    for value, base in zip(data_values, base_values):
+        try:
+            values.append(100 * (value - base) / base)
+        except ZeroDivisionError:
+            values.append(100 * float(cmp(value, base)))
+    if data_errors:
+        if not base_errors:
+            base_errors = [0] * len(data_errors)
+        errors = []
+        for data, error, base_value, base_error in zip(
+                data_values, data_errors, base_values, base_errors):
+            try:
+                errors.append(sqrt(error**2 * (100 / base_value)**2
+                        + base_error**2 * (100 * data / base_value**2)**2
+                        + error * base_error * (100 / base_value**2)**2))
+            except ZeroDivisionError:
+                errors.append(100 * abs(error))
+    else:
+        errors = None
+    return (values, errors)
+
+
+def _reference_resort(kernel_labels, list_to_sort):
+    labels = [tko_rpc_utils.KernelString(label) for label in kernel_labels]
+    return [pair[1] for pair in sorted(zip(labels, list_to_sort))]
+
+
+def _reference_normalize_to_series(plots, base_series):
+    base_series_index = graphing_utils._find_plot_by_label(plots, base_series)
+    base_plot = plots.pop(base_series_index)
+    base_xs, base_values = base_plot['x'], base_plot['y']
+    base_errors = base_plot['errors']
+    for plot in plots:
+        new_xs, new_values, new_errors = [], [], []
+        new_base_values, new_base_errors = [], []
+        for index, x_value in enumerate(plot['x']):
+            try:
+                base_index = base_xs.index(x_value)
+            except ValueError:
+                continue
+            new_xs.append(x_value)
+            new_values.append(plot['y'][index])
+            new_base_values.append(base_values[base_index])
+            if plot['errors']:
+                new_errors.append(plot['errors'][index])
+                new_base_errors.append(base_errors[base_index])
+        plot['x'] = new_xs
+        plot['y'] = new_values
+        if plot['errors']:
+            plot['errors'] = new_errors
+        plot['y'], plot['errors'] = _reference_normalize(
+                plot['y'], plot['errors'], new_base_values, new_base_errors)
+
+
+def _reference_metrics_plot_data(rows, column_names, normalize_to):
+    columns = zip(*rows)
+    plots = []
+    labels = [str(label) for label in columns[0]]
+    needs_resort = (column_names[0] == 'kernel')
+    col = 1
+    while col < len(column_names):
+        y = columns[col]
+        label = column_names[col]
+        col += 1
+        if (col < len(column_names) and
+            'errors-' + label == column_names[col]):
+            errors = columns[col]
+            col += 1
+        else:
+            errors = None
+        if needs_resort:
+            y = _reference_resort(labels, y)
+            if errors:
+                errors = _reference_resort(labels, errors)
+        x = [index for index, value in enumerate(y) if value is not None]
+        y = [y[i] for i in x]
+        if errors:
+            errors = [errors[i] for i in x]
+        plots.append({'label': label, 'x': x, 'y': y, 'errors': errors})
+    if needs_resort:
+        labels = _reference_resort(labels, labels)
+
+    if normalize_to == 'first':
+        for plot in plots:
+            base_values = [plot['y'][0]] * len(plot['y'])
+            base_errors = None
+            if plot['errors']:
+                base_errors = [plot['errors'][0]] * len(plot['errors'])
+            plot['y'], plot['errors'] = _reference_normalize(
+                    plot['y'], plot['errors'], base_values, base_errors)
+    elif normalize_to.startswith('series__'):
+        _reference_normalize_to_series(plots, normalize_to[8:])
+    return plots, labels
+
+
+def _reference_qual_histogram_data(rows, buckets):
+    hist_data, no_tests, no_pass, perfect = [], [], [], []
+    for hostname, total, good in rows:
+        if total == 0:
+            no_tests.append(hostname)
+        elif good == 0:
+            no_pass.append(hostname)
+        elif good == total:
+            perfect.append(hostname)
+        else:
+            hist_data.append((hostname, 100.0 * good / total))
+    names_list = [[hostname for hostname, pass_rate in hist_data
+                   if bucket[0] <= pass_rate < bucket[1]]
+                  for bucket in buckets]
+    return ([pass_rate for hostname, pass_rate in hist_data], names_list,
+            no_tests, no_pass, perfect)
+
+
+def _make_metrics_rows(num_rows, num_series, kernels=False):
+    random.seed(num_rows)
+    rows = []
+    for index in xrange(num_rows):
+        if kernels:
+            label = '2.6.%d-rc%d' % (random.randint(0, 40),
+                                      random.randint(1, 9))
+            label += '-%d' % index  # keep labels unique
+        else:
+            label = 'label%d' % index
+        row = [label]
+        for series in xrange(num_series):
+            value = random.uniform(-50, 150)
+            if random.random() < 0.1:
+                value = None
+            elif random.random() < 0.05:
+                value = 0.0
+            row += [value, random.uniform(0, 5)]
+        rows.append(tuple(row))
+    if kernels:
+        column_names = ['kernel']
+    else:
+        column_names = ['machine']
+    for series in xrange(num_series):
+        column_names += ['series%d' % series, 'errors-series%d' % series]
+    return rows, column_names
+
+
+def _make_qual_rows(num_rows):
+    random.seed(num_rows)
+    rows = []
+    for index in xrange(num_rows):
+        total = random.randint(0, 20)
+        rows.append(('host%d' % index, total, random.randint(0, total)))
+    return rows
+
+
+def _new_metrics_plot_data(rows, column_names, normalize_to):
+    plots, labels = graphing_utils._get_metrics_plot_data(rows, column_names)
+    graphing_utils._normalize_plots(plots, labels, normalize_to)
+    graphing_utils._plot_data_to_lists(plots)
+    return plots, labels
+
+
+def _new_qual_histogram_data(rows, buckets):
+    hist_hostnames, pass_rates, no_tests, no_pass, perfect = (
+            graphing_utils._get_qual_histogram_data(rows))
+    names_list = graphing_utils._get_hostnames_in_buckets(
+            hist_hostnames, pass_rates, buckets)
+    return pass_rates.tolist(), names_list, no_tests, no_pass, perfect
+
+
+class MetricsPlotDataTest(unittest.TestCase):
+    def _assert_close(self, list1, list2):
+        self.assertEquals(len(list1), len(list2))
+        for value1, value2 in zip(list1, list2):
+            self.assert_(abs(value1 - value2) <= 1e-9 * max(1, abs(value2)),
+                         '%r != %r' % (value1, value2))
+
+
+    def _check(self, rows, column_names, normalize_to=''):
+        expected_plots, expected_labels = _reference_metrics_plot_data(
+                rows, column_names, normalize_to)
+        plots, labels = _new_metrics_plot_data(rows, column_names,
+                                               normalize_to)
+        self.assertEquals(labels, expected_labels)
+        self.assertEquals(len(plots), len(expected_plots))
+        for plot, expected in zip(plots, expected_plots):
+            self.assertEquals(plot['label'], expected['label'])
+            self.assertEquals(plot['x'], expected['x'])
+            self._assert_close(plot['y'], expected['y'])
+            self._assert_close(plot['errors'], expected['errors'])
+
+
+    def test_plain(self):
+        self._check(*_make_metrics_rows(50, 3))
+
+
+    def test_kernel_resort(self):
+        self._check(*_make_metrics_rows(50, 3, kernels=True))
+
+
+    def test_normalize_to_first(self):
+        rows, column_names = _make_metrics_rows(50, 3)
+        rows = [(rows[0][0],) + (1.5, 0.1) * 3] + rows[1:]
+        self._check(rows, column_names, 'first')
+
+
+    def test_normalize_to_series(self):
+        self._check(*_make_metrics_rows(50, 3) + ('series__series1',))
+
+
+    def test_normalize_to_x(self):
+        rows = [('a', 2.0, 4.0), ('b', 3.0, None), ('c', 4.0, 6.0)]
+        plots, labels = _new_metrics_plot_data(rows, ['x', 's1', 's2'],
+                                               'x__c')
+        self.assertEquals(plots[0]['y'], [-50.0, -25.0, 0.0])
+        self.assertEquals(plots[1]['x'], [0, 2])
+        self.assertEquals(plots[1]['errors'], None)
+
+
+    def test_series_without_data(self):
+        rows = [('a', 1, None), ('b', 2, None)]
+        self.assertRaises(graphing_utils.NoDataError,
+                          graphing_utils._get_metrics_plot_data, rows,
+                          ['x', 's1', 's2'])
+
+
+class QualHistogramDataTest(unittest.TestCase):
+    def test_matches_reference(self):
+        rows = _make_qual_rows(500)
+        buckets = [(bucket, min(bucket + 30, 100))
+                   for bucket in range(0, 100, 30)]
+        self.assertEquals(_new_qual_histogram_data(rows, buckets),
+                          _reference_qual_histogram_data(rows, buckets))
+
+
+class PlotRequestTest(unittest.TestCase):
+    def setUp(self):
+        setup_test_environment.set_up()
+        self.god = mock.mock_god()
+        self.cache_dir = tempfile.mkdtemp()
+        self.god.stub_with(graph_cache, '_default_cache_dir',
+                           lambda: self.cache_dir)
+        self.rendered = []
+        self.god.stub_with(graphing_utils, '_create_embedded_plot_png',
+                           self._create_png)
+        self.graph = models.EmbeddedGraphingQuery.objects.create(
+                url_token='token', graph_type='qual',
+                params=pickle.dumps({'query': 'SELECT 1'}),
+                last_updated=datetime.datetime.now(),
+                refresh_time=datetime.datetime.now(),
+                cached_png='embedded png')
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.cache_dir)
+        setup_test_environment.tear_down()
+
+
+    def _create_png(self, graph_type, params, update_time):
+        self.rendered.append(graph_type)
+        if params['query'] == 'no data':
+            raise graphing_utils.NoDataError('no data')
+        return 'png %d' % len(self.rendered)
+
+
+    def _age_image(self, minutes):
+        key = graph_cache.get_graph_key('qual', {'query': 'SELECT 1'})
+        path = os.path.join(self.cache_dir, key + '.png')
+        timestamp = time.time() - minutes * 60
+        os.utime(path, (timestamp, timestamp))
+
+
+    def _key(self):
+        return graph_cache.get_graph_key('qual', {'query': 'SELECT 1'})
+
+
+    def test_renders_missing_images_only(self):
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'), 'png 1')
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'), 'png 1')
+        # stale images are served while the refresher is asked for a new one
+        self._age_image(11)
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '5'), 'png 1')
+        self.assertEquals(self.rendered, ['qual'])
+        image_cache = graph_cache.ImageCache()
+        self.assertEquals(image_cache.get_refresh_request(self._key())[0], 5)
+
+
+    def test_render_claimed_elsewhere(self):
+        image_cache = graph_cache.ImageCache()
+        self.assert_(image_cache.claim_render(self._key(), 10))
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'),
+                          'embedded png')
+        self.assertEquals(self.rendered, [])
+        # claims of requests which died while rendering are broken
+        self.assertFalse(image_cache.claim_render(self._key(), 10))
+        self.assert_(image_cache.claim_render(self._key(), 0))
+
+
+    def test_cache_not_writable(self):
+        def put(key, png):
+            raise IOError('Permission denied')
+        self.god.stub_with(graph_cache.ImageCache, 'put',
+                           lambda self, key, png: put(key, png))
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'), 'png 1')
+        # the render claim was released
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'), 'png 2')
+
+
+    def test_no_data(self):
+        self.graph.params = pickle.dumps({'query': 'no data'})
+        self.graph.save()
+        self.assertEquals(graphing_utils.handle_plot_request(self.graph.id,
+                                                             '10'),
+                          'embedded png')
+
+
+    def test_bad_id(self):
+        self.assertRaises(django.http.Http404,
+                          graphing_utils.handle_plot_request, 12345, '10')
+
+
+def _time(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def benchmark():
+    rows, column_names = _make_metrics_rows(5000, 5, kernels=True)
+    for normalize_to in ('', 'first', 'series__series0'):
+        print 'metrics, normalize_to=%r: reference %.3fs, numpy %.3fs' % (
+                normalize_to,
+                _time(_reference_metrics_plot_data, rows, column_names,
+                      normalize_to),
+                _time(_new_metrics_plot_data, rows, column_names,
+                      normalize_to))
+    rows = _make_qual_rows(100000)
+    buckets = [(bucket, bucket + 10) for bucket in range(0, 100, 10)]
+    print 'qualification histogram: reference %.3fs, numpy %.3fs' % (
+            _time(_reference_qual_histogram_data, rows, buckets),
+            _time(_new_qual_histogram_data, rows, buckets))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        unittest.main()
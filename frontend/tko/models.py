@@ -254,6 +254,23 @@ class TestLabel(dbmodels.Model, model_logic.ModelExtensions):
         db_table = 'tko_test_labels'
 
 
+class LatestTest(dbmodels.Model):
+    """\
+    The latest valid test for each (test name, machine, kernel, job label),
+    kept up to date by the TKO parser (see tko/db.py).
+    """
+    test = dbmodels.ForeignKey(Test, db_column='test_idx', primary_key=True)
+    test_name = dbmodels.CharField(max_length=300, db_column='test')
+    machine_idx = dbmodels.IntegerField()
+    kernel_idx = dbmodels.IntegerField()
+    job_label = dbmodels.CharField(max_length=300)
+
+    class Meta:
+        db_table = 'tko_latest_tests'
+        unique_together = ('test_name', 'machine_idx', 'kernel_idx',
+                           'job_label')
+
+
 class SavedQuery(dbmodels.Model, model_logic.ModelExtensions):
     # TODO: change this to foreign key once DBs are merged
     owner = dbmodels.CharField(max_length=80)
@@ -270,10 +287,8 @@ class EmbeddedGraphingQuery(dbmodels.Model, model_logic.ModelExtensions):
     params = dbmodels.TextField(null=False, blank=False)
     last_updated = dbmodels.DateTimeField(null=False, blank=False,
                                           editable=False)
-    # refresh_time shows the time at which a thread is updating the cached
-    # image, or NULL if no one is updating the image. This is used so that only
-    # one thread is updating the cached image at a time (see
-    # graphing_utils.handle_plot_request)
+    # refresh_time is no longer used: rendered images are kept in
+    # graph_cache.ImageCache (see graphing_utils.handle_plot_request)
     refresh_time = dbmodels.DateTimeField(editable=False)
     cached_png = dbmodels.TextField(editable=False)
 
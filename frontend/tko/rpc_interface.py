@@ -2,7 +2,9 @@ import os, pickle, datetime, itertools, operator
 from django.db import models as dbmodels
 from autotest_lib.frontend.afe import rpc_utils, model_logic
 from autotest_lib.frontend.afe import models as afe_models, readonly_connection
+from autotest_lib.client.common_lib import rpc_cache
 from autotest_lib.frontend.tko import models, tko_rpc_utils, graphing_utils
+from autotest_lib.frontend.tko import graph_cache
 from autotest_lib.frontend.tko import preconfigs
 
 # table/spreadsheet view support
@@ -67,6 +69,7 @@ def get_num_groups(group_by, **filter_data):
     return models.TestView.objects.get_num_groups(query, group_by)
 
 
+@rpc_cache.cacheable(ttl=30, generations=(rpc_cache.TKO_GENERATION,))
 def get_status_counts(group_by, header_groups=[], fixed_headers={},
                       **filter_data):
     """
@@ -80,6 +83,7 @@ def get_status_counts(group_by, header_groups=[], fixed_headers={},
                             **filter_data)
 
 
+@rpc_cache.cacheable(ttl=30, generations=(rpc_cache.TKO_GENERATION,))
 def get_latest_tests(group_by, header_groups=[], fixed_headers={},
                      extra_info=[], **filter_data):
     """
@@ -90,12 +94,22 @@ def get_latest_tests(group_by, header_groups=[], fixed_headers={},
     @param extra_info a list containing the field names that should be returned
                       with each cell. The fields are returned in the extra_info
                       field of the return dictionary.
+
+    When grouping and filtering only on test name, machine, kernel and job name
+    fields, only the tests in the precomputed tko_latest_tests table are
+    considered, instead of the whole test history.
     """
+    use_latest_tests = tko_rpc_utils.can_use_latest_tests_index(group_by,
+                                                                filter_data)
     # find latest test per group
     initial_query = models.TestView.objects.get_query_set_with_joins(
             filter_data)
+    latest_query = initial_query
+    if use_latest_tests:
+        latest_query = models.TestView.objects.add_join(
+                initial_query, 'tko_latest_tests', join_key='test_idx')
     query = models.TestView.query_objects(filter_data,
-                                          initial_query=initial_query,
+                                          initial_query=latest_query,
                                           apply_presentation=False)
     query = query.exclude(status__in=tko_rpc_utils._INVALID_STATUSES)
     query = query.extra(
@@ -273,6 +287,8 @@ def get_embedding_id(url_token, graph_type, params):
         model.cached_png = graphing_utils.create_embedded_plot(model,
                                                                now.ctime())
         model.save()
+        key = graph_cache.get_graph_key(graph_type, params)
+        graph_cache.ImageCache().put(key, model.cached_png)
 
     return model.id
 
@@ -378,6 +394,8 @@ def get_motd():
     return rpc_utils.get_motd()
 
 
+@rpc_cache.cacheable(ttl=60, generations=rpc_cache.ALL_GENERATIONS,
+                     key_function=rpc_utils.get_current_user_login)
 def get_static_data():
     result = {}
     group_fields = []
@@ -6,7 +6,7 @@ from autotest_lib.frontend import setup_django_environment
 from autotest_lib.frontend import setup_test_environment
 from autotest_lib.client.common_lib.test_utils import mock
 from django.db import connection
-from autotest_lib.frontend.tko import models, rpc_interface
+from autotest_lib.frontend.tko import models, rpc_interface, tko_rpc_utils
 
 # this will need to be updated when the view changes for the test to be
 # consistent with reality
@@ -173,6 +173,13 @@ class TkoTestMixin(object):
                                                 status=good_status,
                                                 machine=machine)
 
+        for test in (job1_test1, job1_test2, job2_test1):
+            models.LatestTest.objects.create(
+                    test=test, test_name=test.test,
+                    machine_idx=test.machine.machine_idx,
+                    kernel_idx=test.kernel.kernel_idx,
+                    job_label=test.job.label)
+
         job1.jobkeyval_set.create(key='keyval_key', value='keyval_value')
 
         # create test attributes, test labels, and iterations
@@ -379,6 +386,38 @@ class RpcInterfaceTest(unittest.TestCase, TkoTestMixin):
         self.assertEquals(group2['extra_info'], ['2-myjobtag2'])
 
 
+    def test_get_latest_tests_uses_index(self):
+        # an older test, superseded in the index by job1_test1
+        job1 = models.Job.objects.get(tag='1-myjobtag1')
+        models.Test.objects.create(job=job1, test='mytest1',
+                                   kernel=self.first_test.kernel,
+                                   status=self.first_test.status,
+                                   machine=self.first_test.machine)
+        counts = rpc_interface.get_latest_tests(
+                group_by=['test_name'], extra_where='test_name = "mytest1"')
+        self.assertEquals(counts['groups'][0]['test_idx'], 1)
+        # filtering on fields outside of the index goes over all tests
+        counts = rpc_interface.get_latest_tests(group_by=['test_name'],
+                                                test_name='mytest1',
+                                                job_tag='1-myjobtag1')
+        self.assertEquals(counts['groups'][0]['test_idx'], 4)
+
+
+    def test_can_use_latest_tests_index(self):
+        can_use = tko_rpc_utils.can_use_latest_tests_index
+        self.assertTrue(can_use(['platform', 'kernel'], {}))
+        self.assertTrue(can_use(['hostname'],
+                                {'test_name__in': ['a'], 'sort_by': ['kernel'],
+                                 'extra_where': 'kernel = "reason" AND '
+                                                'job_name LIKE \'x\\\'y\''}))
+        self.assertFalse(can_use(['test_idx'], {}))
+        self.assertFalse(can_use(['hostname'], {'status': 'GOOD'}))
+        self.assertFalse(can_use(['hostname'],
+                                 {'extra_where': 'reason = "x"'}))
+        self.assertFalse(can_use(['hostname'],
+                                 {'test_attribute_fields': ['myattr']}))
+
+
     def test_get_job_ids(self):
         self.assertEquals([1,2], rpc_interface.get_job_ids())
         self.assertEquals([1], rpc_interface.get_job_ids(test_name='mytest2'))
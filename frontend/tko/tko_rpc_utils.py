@@ -1,3 +1,4 @@
+import re
 from autotest_lib.frontend.afe import rpc_utils
 from autotest_lib.client.common_lib import kernel_versions
 from autotest_lib.frontend.tko import models
@@ -74,6 +75,53 @@ def add_status_counts(group_dict, status):
     group_dict[models.TestView.objects._GROUP_COUNT_NAME] = 1
 
 
+# TestView fields which are constant within a tko_latest_tests group, i.e.
+# functions of (test name, machine, kernel, job label)
+_LATEST_TEST_GROUP_FIELDS = frozenset([
+        'test_name', 'machine_idx', 'hostname', 'platform', 'machine_owner',
+        'kernel_idx', 'kernel', 'kernel_hash', 'kernel_base', 'job_name'])
+_PRESENTATION_KEYS = ('sort_by', 'query_start', 'query_limit')
+_SQL_STRING_RE = re.compile(r'\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"')
+_SQL_IDENTIFIER_RE = re.compile(r'[A-Za-z_][\w.]*')
+_SQL_KEYWORDS = frozenset(['and', 'or', 'not', 'in', 'is', 'null', 'like',
+                           'between', 'regexp', 'rlike'])
+
+
+def _where_uses_only(extra_where, fields):
+    """
+    Conservatively check that the SQL condition extra_where only refers to
+    the given fields.
+    """
+    identifiers = _SQL_IDENTIFIER_RE.findall(
+            _SQL_STRING_RE.sub('', extra_where))
+    for identifier in identifiers:
+        if identifier not in fields and identifier.lower() not in _SQL_KEYWORDS:
+            return False
+    return True
+
+
+def can_use_latest_tests_index(group_by, filter_data):
+    """
+    Check whether the latest test per group can be found among the
+    tko_latest_tests entries only.  That is the case when both the grouping
+    and the filters only involve fields that are constant within a
+    tko_latest_tests group, since the latest test of a coarser group is then
+    the latest test of one of its tko_latest_tests groups.
+    """
+    for field in group_by:
+        if field not in _LATEST_TEST_GROUP_FIELDS:
+            return False
+    for key, value in filter_data.iteritems():
+        if key in _PRESENTATION_KEYS:
+            continue
+        if key == 'extra_where':
+            if not _where_uses_only(value, _LATEST_TEST_GROUP_FIELDS):
+                return False
+        elif key.split('__')[0] not in _LATEST_TEST_GROUP_FIELDS:
+            return False
+    return True
+
+
 def _construct_machine_label_header_sql(machine_labels):
     """
     Example result for machine_labels=['Index', 'Diskful']:
@@ -21,6 +21,29 @@ autoserv_prebuild = get_value('AUTOSERV', 'enable_server_prebuild',
                               type=bool, default=False)
 
 
+def _get_drone_cache(pkgmgr, repos, send_file):
+    """
+    Get the fetcher serving packages through the drone's cache.
+
+    @param pkgmgr: The package manager the packages are fetched for.
+    @param repos: The repositories the packages are cached from, in the order
+            of the package manager's repositories.
+    @param send_file: Function copying a cached package to its destination.
+    @return: A packages.CachingFetcher, or None if no drone_cache_dir is
+            configured.
+    """
+    c = global_config.global_config
+    cache_dir = c.get_config_value("PACKAGES", 'drone_cache_dir',
+                                   default=None)
+    if not cache_dir:
+        return None
+    cache_size = c.get_config_value("PACKAGES", 'drone_cache_size_mb',
+                                    type=int, default=2048)
+    return packages.CachingFetcher(pkgmgr, cache_dir, repos,
+                                   max_size=cache_size * 1024 * 1024,
+                                   send_file=send_file)
+
+
 class AutodirNotFoundError(Exception):
     """No Autotest installation could be found."""
 
@@ -143,6 +166,10 @@ class BaseAutotest(installable_object.InstallableObject):
                                          do_locking=False,
                                          run_function=host.run,
                                          run_function_dargs=dict(timeout=600))
+        # serve the packages through the drone's cache, if there is one
+        drone_cache = _get_drone_cache(pkgmgr, repos, host.send_file)
+        if drone_cache:
+            pkgmgr.add_repository(drone_cache)
         # The packages dir is used to store all the packages that
         # are fetched on that client. (for the tests,deps etc.
         # too apart from the client)
@@ -850,6 +877,7 @@ class client_logger(object):
         self.leftover = ""
         self.last_line = ""
         self.logs = {}
+        self._drone_cache = None
 
 
     def _process_log_dict(self, log_dict):
@@ -943,12 +971,15 @@ class client_logger(object):
             pkg_name, dest_path, fifo_path = fetch_package_match.groups()
             serve_packages = global_config.global_config.get_config_value(
                 "PACKAGES", "serve_packages_from_autoserv", type=bool)
+            sent = False
             if serve_packages and pkg_name.endswith(".tar.bz2"):
                 try:
-                    self._send_tarball(pkg_name, dest_path)
+                    sent = self._send_tarball(pkg_name, dest_path)
                 except Exception:
                     msg = "Package tarball creation failed, continuing anyway"
                     logging.exception(msg)
+            if not sent:
+                self._fetch_from_drone_cache(pkg_name, dest_path)
             try:
                 self.host.run("echo B > %s" % fifo_path)
             except Exception:
@@ -958,7 +989,47 @@ class client_logger(object):
             logging.info(line)
 
 
+    def _fetch_from_drone_cache(self, pkg_name, remote_dest):
+        """
+        Send a package requested by the client through the drone's cache.
+
+        The client asks autoserv for its test, profiler and dep packages
+        before trying its own repositories, so fetching the ones autoserv
+        doesn't bundle from its own tree here keeps them going through the
+        cache shared by the drone's machines.
+
+        @param pkg_name: The name of the requested package.
+        @param remote_dest: The path the package is fetched to on the host.
+        @return: True if the package was sent, False if there is no drone
+                cache or it could not provide the package.
+        """
+        if not self._drone_cache:
+            repos = global_config.global_config.get_config_value(
+                "PACKAGES", 'fetch_location', type=list, default=[])
+            if not repos:
+                return False
+            repos.reverse()
+            self._drone_cache = _get_drone_cache(self.job.pkgmgr, repos,
+                                                 self.host.send_file)
+            if not self._drone_cache:
+                return False
+        try:
+            self._drone_cache.fetch_pkg_file(pkg_name, remote_dest)
+        except error.PackageFetchError, e:
+            logging.info('Could not fetch %s through the drone cache: %s',
+                         pkg_name, e)
+            return False
+        return True
+
+
     def _send_tarball(self, pkg_name, remote_dest):
+        """
+        Bundle a package from the server's autotest tree and send it to the
+        client.
+
+        @return: True if the package was sent, False if the tree doesn't
+                have it.
+        """
         name, pkg_type = self.job.pkgmgr.parse_tarball_name(pkg_name)
         src_dirs = []
         if pkg_type == 'test':
@@ -976,9 +1047,9 @@ class client_logger(object):
         elif pkg_type == 'dep':
             src_dirs += [os.path.join(self.job.clientdir, 'deps', name)]
         elif pkg_type == 'client':
-            return  # you must already have a client to hit this anyway
+            return False  # you must already have a client to hit this anyway
         else:
-            return  # no other types are supported
+            return False  # no other types are supported
 
         # iterate over src_dirs until we find one that exists, then tar it
         for src_dir in src_dirs:
@@ -987,12 +1058,17 @@ class client_logger(object):
                     logging.info('Bundling %s into %s', src_dir, pkg_name)
                     temp_dir = autotemp.tempdir(unique_id='autoserv-packager',
                                                 dir=self.job.tmpdir)
+                    compression = global_config.global_config.get_config_value(
+                        "PACKAGES", "autoserv_package_compression",
+                        default="bzip2")
                     tarball_path = self.job.pkgmgr.tar_package(
-                        pkg_name, src_dir, temp_dir.name, " .")
+                        pkg_name, src_dir, temp_dir.name, " .",
+                        compression=compression)
                     self.host.send_file(tarball_path, remote_dest)
                 finally:
                     temp_dir.clean()
-                return
+                return True
+        return False
 
 
     def log_warning(self, msg, warning_type):
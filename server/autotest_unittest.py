@@ -155,6 +155,8 @@ class TestBaseAutotest(unittest.TestCase):
         pkgmgr = packages.PackageManager.expect_new('autodir',
             repo_urls=['repo'], hostname='hostname', do_locking=False,
             run_function=self.host.run, run_function_dargs=dict(timeout=600))
+        c.get_config_value.expect_call('PACKAGES', 'drone_cache_dir',
+                                       default=None).and_return(None)
         pkg_dir = os.path.join('autodir', 'packages')
         cmd = ('cd autodir && ls | grep -v "^packages$"'
                ' | xargs rm -rf && rm -rf .[^.]*')
@@ -295,13 +297,15 @@ class TestBaseAutotest(unittest.TestCase):
     def test_client_logger_process_line_package_install_fifo_failure(self):
         collector = autotest.log_collector.expect_new(self.host, '', '')
         logger = autotest.client_logger(self.host, '', '')
+        self.god.stub_function(logger, '_fetch_from_drone_cache')
         self.god.stub_function(logger, '_send_tarball')
 
         c = autotest.global_config.global_config
         c.get_config_value.expect_call('PACKAGES',
                                        'serve_packages_from_autoserv',
                                        type=bool).and_return(True)
-        logger._send_tarball.expect_call('pkgname.tar.bz2', '/autotest/dest/')
+        logger._send_tarball.expect_call('pkgname.tar.bz2',
+                                         '/autotest/dest/').and_return(True)
 
         self.host.run.expect_call('echo B > /autotest/fifo3').and_raises(
                 Exception('fifo failure'))
@@ -310,6 +314,53 @@ class TestBaseAutotest(unittest.TestCase):
                              '/autotest/dest/:/autotest/fifo3')
 
 
+    def test_client_logger_process_line_package_from_drone_cache(self):
+        collector = autotest.log_collector.expect_new(self.host, '', '')
+        logger = autotest.client_logger(self.host, '', '')
+        self.host.job.pkgmgr = self.god.create_mock_class(
+                packages.PackageManager, 'pkgmgr')
+        self.god.stub_class(packages, 'CachingFetcher')
+        self.god.stub_function(logger, '_send_tarball')
+
+        c = autotest.global_config.global_config
+        # packages aren't served from autoserv, are missing from its tree, or
+        # are bundled by autoserv
+        for i, serve_packages, bundled in ((0, False, False),
+                                           (1, True, False),
+                                           (2, True, True)):
+            dest_path = '/autotest/dest/pkg%d.tar.bz2' % i
+            c.get_config_value.expect_call('PACKAGES',
+                                           'serve_packages_from_autoserv',
+                                           type=bool).and_return(serve_packages)
+            if serve_packages:
+                logger._send_tarball.expect_call(
+                        'pkg%d.tar.bz2' % i, dest_path).and_return(bundled)
+            if not i:
+                # the cache is set up once
+                c.get_config_value.expect_call('PACKAGES', 'fetch_location',
+                                               type=list, default=[]
+                                               ).and_return(['repo1', 'repo2'])
+                c.get_config_value.expect_call('PACKAGES', 'drone_cache_dir',
+                                               default=None
+                                               ).and_return('/drone/cache')
+                c.get_config_value.expect_call('PACKAGES',
+                                               'drone_cache_size_mb', type=int,
+                                               default=2048).and_return(1)
+                cache = packages.CachingFetcher.expect_new(
+                        self.host.job.pkgmgr, '/drone/cache',
+                        ['repo2', 'repo1'], max_size=1024 * 1024,
+                        send_file=self.host.send_file)
+            if not bundled:
+                fetch = cache.fetch_pkg_file.expect_call('pkg%d.tar.bz2' % i,
+                                                         dest_path)
+                if i:
+                    fetch.and_raises(error.PackageFetchError('not found'))
+            self.host.run.expect_call('echo B > /autotest/fifo')
+            logger._process_line('AUTOTEST_FETCH_PACKAGE:pkg%d.tar.bz2:%s:'
+                                 '/autotest/fifo' % (i, dest_path))
+        self.god.check_playback()
+
+
 class test_autotest_mixin(unittest.TestCase):
     def setUp(self):
         # a dummy Autotest and job class for use in the mixin
@@ -17,6 +17,7 @@ For docs, see:
 import getpass, os, time, traceback, re
 import common
 from autotest_lib.frontend.afe import rpc_client_lib
+from autotest_lib.frontend.afe.json_rpc import proxy
 from autotest_lib.client.common_lib import global_config
 from autotest_lib.client.common_lib import utils
 try:
@@ -97,11 +98,60 @@ class RpcClient(object):
             raise
 
 
+    def batch(self):
+        """
+        Return an RpcBatch that queues calls and sends them to the server in
+        a single request:
+
+            with afe.batch() as batch:
+                calls = [batch.run('get_hosts', hostname=h) for h in names]
+            hosts = [call.result for call in calls]
+        """
+        return RpcBatch(self)
+
+
     def log(self, message):
         if self.print_log:
             print message
 
 
+class RpcBatch(object):
+    """
+    Queues RPC calls made through run() and sends them all in one request
+    when execute() is called or when used as a context manager and the
+    block ends.  Each run() returns a call object whose "result" attribute
+    holds the (unicode-stripped) result once the batch has been executed.
+    """
+    def __init__(self, rpc_client):
+        self.rpc_client = rpc_client
+        self._batch_proxy = rpc_client_lib.get_batch_proxy(rpc_client.proxy)
+
+
+    def run(self, call, **dargs):
+        if self.rpc_client.debug:
+            print 'DEBUG (batched): %s %s' % (call, dargs)
+        return getattr(self._batch_proxy, call)(**dargs)
+
+
+    def execute(self):
+        calls = self._batch_proxy.execute()
+        for call in calls:
+            call.response = utils.strip_unicode(call.response)
+            if self.rpc_client.reply_debug:
+                print call.response
+        return calls
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+
 class Planner(RpcClient):
     def __init__(self, user=None, server=None, print_log=True, debug=False,
                  reply_debug=False):
@@ -124,10 +174,17 @@ class TKO(RpcClient):
                                   reply_debug=reply_debug)
 
 
+    @staticmethod
+    def _dict_for_status_counts(job, **data):
+        query_args = dict(data)
+        query_args['group_by'] = ['hostname', 'test_name', 'reason']
+        query_args['job_tag__startswith'] = '%s-' % job
+        return query_args
+
+
     def get_status_counts(self, job, **data):
         entries = self.run('get_status_counts',
-                           group_by=['hostname', 'test_name', 'reason'],
-                           job_tag__startswith='%s-' % job, **data)
+                           **self._dict_for_status_counts(job, **data))
         return [TestStatus(self, e) for e in entries['groups']]
 
 
@@ -246,7 +303,11 @@ class AFE(RpcClient):
     def get_host_queue_entries(self, **data):
         entries = self.run('get_host_queue_entries', **data)
         job_statuses = [JobStatus(self, e) for e in entries]
+        self._attach_hosts(job_statuses)
+        return self._filter_job_statuses(job_statuses)
+
 
+    def _attach_hosts(self, job_statuses):
         # Sadly, get_host_queue_entries doesn't return platforms, we have
         # to get those back from an explicit get_hosts queury, then patch
         # the new host objects back into the host list.
@@ -257,6 +318,10 @@ class AFE(RpcClient):
         for status in job_statuses:
             if status.host:
                 status.host = host_hash[status.host.hostname]
+
+
+    @staticmethod
+    def _filter_job_statuses(job_statuses):
         # filter job statuses that have either host or meta_host
         return [status for status in job_statuses if (status.host or
                                                       status.meta_host)]
@@ -434,9 +499,12 @@ class AFE(RpcClient):
             c) Cannot tell yet (return None)
         """
         results = []
+        pending = [job for job in jobs if getattr(job, 'result', None) is None]
+        fetched = self._fetch_job_results(tko, pending)
         for job in jobs:
             if getattr(job, 'result', None) is None:
-                job.result = self.poll_job_results(tko, job)
+                job.result = self.poll_job_results(tko, job,
+                                                   fetched=fetched.get(job.id))
                 if job.result is not None:
                     self.result_notify(job, email_from, email_to)
 
@@ -507,17 +575,70 @@ class AFE(RpcClient):
         return new_job
 
 
-    def _job_test_results(self, tko, job, debug, tests=[]):
+    def _fetch_job_results(self, tko, jobs):
         """
-        Retrieve test results for a job
+        Fetch the test statuses and the host queue entries of several jobs
+        with a single batched request to each of the TKO and AFE servers,
+        instead of the three requests per job poll_job_results() makes.
+
+        Returns a dictionary mapping the id of each job whose results could
+        be fetched to a (test_statuses, job_statuses) tuple; the other jobs
+        are left for poll_job_results() to fetch (and report) by themselves.
         """
-        job.test_status = {}
+        if not jobs:
+            return {}
         try:
-            test_statuses = tko.get_status_counts(job=job.id)
+            tko_batch = tko.batch()
+            afe_batch = self.batch()
+            calls = []
+            for job in jobs:
+                counts_query = tko._dict_for_status_counts(job=job.id)
+                calls.append((job,
+                              tko_batch.run('get_status_counts',
+                                            **counts_query),
+                              afe_batch.run('get_host_queue_entries',
+                                            job=job.id)))
+            tko_batch.execute()
+            afe_batch.execute()
+
+            fetched = {}
+            all_statuses = []
+            for job, counts_call, entries_call in calls:
+                try:
+                    test_statuses = [TestStatus(tko, e)
+                                     for e in counts_call.result['groups']]
+                    job_statuses = [JobStatus(self, e)
+                                    for e in entries_call.result]
+                except proxy.JSONRPCException:
+                    continue
+                fetched[job.id] = (test_statuses, job_statuses)
+                all_statuses.extend(job_statuses)
+            self._attach_hosts(all_statuses)
         except Exception:
             print "Ignoring exception on poll job; RPC interface is flaky"
             traceback.print_exc()
-            return
+            return {}
+
+        for job_id, (test_statuses, job_statuses) in fetched.items():
+            fetched[job_id] = (test_statuses,
+                               self._filter_job_statuses(job_statuses))
+        return fetched
+
+
+    def _job_test_results(self, tko, job, debug, tests=[],
+                          test_statuses=None):
+        """
+        Retrieve test results for a job, unless they were already fetched
+        and passed in test_statuses
+        """
+        job.test_status = {}
+        if test_statuses is None:
+            try:
+                test_statuses = tko.get_status_counts(job=job.id)
+            except Exception:
+                print "Ignoring exception on poll job; RPC interface is flaky"
+                traceback.print_exc()
+                return
 
         for test_status in test_statuses:
             # SERVER_JOB is buggy, and often gives false failures. Ignore it.
@@ -534,7 +655,7 @@ class AFE(RpcClient):
             job.test_status[hostname].add(test_status)
 
 
-    def _job_results_platform_map(self, job, debug):
+    def _job_results_platform_map(self, job, debug, job_statuses=None):
         # Figure out which hosts passed / failed / aborted in a job
         # Creates a 2-dimensional hash, stored as job.results_platform_map
         #     1st index - platform type (string)
@@ -542,12 +663,13 @@ class AFE(RpcClient):
         #         'Completed' / 'Failed' / 'Aborted'
         #     Data indexed by this hash is a list of hostnames (text strings)
         job.results_platform_map = {}
-        try:
-            job_statuses = self.get_host_queue_entries(job=job.id)
-        except Exception:
-            print "Ignoring exception on poll job; RPC interface is flaky"
-            traceback.print_exc()
-            return None
+        if job_statuses is None:
+            try:
+                job_statuses = self.get_host_queue_entries(job=job.id)
+            except Exception:
+                print "Ignoring exception on poll job; RPC interface is flaky"
+                traceback.print_exc()
+                return None
 
         platform_map = {}
         job.job_status = {}
@@ -607,18 +729,24 @@ class AFE(RpcClient):
             self.job.record(result, None, testname, status='')
 
 
-    def poll_job_results(self, tko, job, debug=False):
+    def poll_job_results(self, tko, job, debug=False, fetched=None):
         """
         Analyse all job results by platform, return:
 
             False: if any platform has more than one failure
             None:  if any platform has more than one machine not yet Good.
             True:  if all platforms have at least all-but-one machines Good.
+
+        fetched is the (test_statuses, job_statuses) tuple of the job when
+        _fetch_job_results() already got them from the servers.
         """
-        self._job_test_results(tko, job, debug)
+        test_statuses = job_statuses = None
+        if fetched:
+            test_statuses, job_statuses = fetched
+        self._job_test_results(tko, job, debug, test_statuses=test_statuses)
         if job.test_status == {}:
             return None
-        self._job_results_platform_map(job, debug)
+        self._job_results_platform_map(job, debug, job_statuses=job_statuses)
 
         good_platforms = []
         failed_platforms = []
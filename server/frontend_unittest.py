@@ -12,6 +12,7 @@ from autotest_lib.client.common_lib import global_config
 from autotest_lib.client.common_lib import utils
 from autotest_lib.client.common_lib.test_utils import mock
 from autotest_lib.frontend.afe import rpc_client_lib
+from autotest_lib.frontend.afe.json_rpc import proxy
 from autotest_lib.server import frontend
 
 GLOBAL_CONFIG = global_config.global_config
@@ -47,6 +48,36 @@ class RpcClientTest(BaseRpcClientTest):
         self.god.check_playback()
 
 
+    def test_batch(self):
+        class fake_service_proxy(object):
+            def _send_batch(self, calls):
+                for index, call in enumerate(calls):
+                    call.response = {'id': index, 'error': None,
+                                     'result': [u'%s-%d' % (call.method,
+                                                            index)]}
+
+        service_proxy = fake_service_proxy()
+        GLOBAL_CONFIG.override_config_value('SERVER', 'hostname', 'test-host')
+        rpc_client_lib.authorization_headers.expect_call(
+                'david', 'http://test-host').and_return({})
+        rpc_client_lib.get_proxy.expect_call(
+                'http://test-host/path', headers={}).and_return(service_proxy)
+        rpc_client_lib.get_batch_proxy.expect_call(service_proxy).and_return(
+                proxy.BatchServiceProxy(service_proxy))
+
+        client = frontend.RpcClient('/path', 'david', None, None, None, None)
+        batch = client.batch()
+        calls = [batch.run('get_hosts', hostname='host%d' % i)
+                 for i in xrange(2)]
+        self.assertRaises(proxy.JSONRPCException, getattr, calls[0], 'result')
+        batch.execute()
+        self.god.check_playback()
+
+        self.assertEquals(calls[0].params, ({'hostname': 'host0'},))
+        self.assertEquals(calls[0].result, ['get_hosts-0'])
+        self.assertEquals(type(calls[1].result[0]), str)
+
+
 class AFETest(BaseRpcClientTest):
     def test_result_notify(self):
         class fake_job(object):
@@ -85,5 +116,79 @@ class AFETest(BaseRpcClientTest):
 
 
 
+    def test_poll_all_jobs_batches_requests(self):
+        class fake_service_proxy(object):
+            def __init__(self, results):
+                self.results = results
+
+            def _send_batch(self, calls):
+                for index, call in enumerate(calls):
+                    result = self.results[call.method](**call.params[0])
+                    if result is None:
+                        error = {'name': 'DoesNotExist', 'message': 'no job',
+                                 'traceback': ''}
+                    else:
+                        error = None
+                    call.response = {'id': index, 'error': error,
+                                     'result': result}
+
+        def status_counts(job_tag__startswith, group_by):
+            if job_tag__startswith == '1-':
+                return {'groups': [{'hostname': 'host1',
+                                    'test_name': 'sleeptest'}]}
+            return None
+
+        def host_queue_entries(job):
+            return [{'job': {'id': job}, 'host': {'hostname': 'host1'},
+                     'meta_host': None, 'status': 'Completed'}]
+
+        class fake_job(object):
+            def __init__(self, id):
+                self.id = id
+
+        afe_proxy = fake_service_proxy(
+                {'get_host_queue_entries': host_queue_entries})
+        tko_proxy = fake_service_proxy({'get_status_counts': status_counts})
+        GLOBAL_CONFIG.override_config_value('SERVER', 'hostname', 'chess')
+        rpc_client_lib.authorization_headers.expect_call(
+                'david', 'http://chess').and_return({})
+        rpc_client_lib.get_proxy.expect_call(
+                'http://chess/afe/server/rpc/', headers={}).and_return(
+                        afe_proxy)
+        rpc_client_lib.authorization_headers.expect_call(
+                'david', 'http://chess').and_return({})
+        rpc_client_lib.get_proxy.expect_call(
+                'http://chess/new_tko/server/rpc/', headers={}).and_return(
+                        tko_proxy)
+        rpc_client_lib.get_batch_proxy.expect_call(tko_proxy).and_return(
+                proxy.BatchServiceProxy(tko_proxy))
+        rpc_client_lib.get_batch_proxy.expect_call(afe_proxy).and_return(
+                proxy.BatchServiceProxy(afe_proxy))
+
+        my_afe = frontend.AFE(user='david', print_log=False)
+        my_tko = frontend.TKO(user='david', print_log=False)
+        self.god.stub_function(my_afe, 'run')
+        my_afe.run.expect_call('get_hosts', hostname__in=['host1']).and_return(
+                [{'hostname': 'host1', 'platform': 'plat1'}])
+
+        polled = {}
+        def poll_job_results(tko, job, fetched=None):
+            polled[job.id] = fetched
+            return None
+        self.god.stub_with(my_afe, 'poll_job_results', poll_job_results)
+        self.god.stub_with(my_afe, 'print_job_result', lambda job: None)
+
+        self.assertEquals(None, my_afe.poll_all_jobs(
+                my_tko, [fake_job(1), fake_job(2)]))
+        self.god.check_playback()
+
+        test_statuses, job_statuses = polled[1]
+        self.assertEquals('sleeptest', test_statuses[0].test_name)
+        self.assertEquals('plat1', job_statuses[0].host.platform)
+        # job 2 failed in the batch, poll_job_results() fetches it by itself
+        self.assertEquals(None, polled[2])
+
+
+
 if __name__ == '__main__':
     unittest.main()
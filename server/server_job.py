@@ -285,6 +285,8 @@ class base_server_job(base_job.base_job):
             new_hosts = self.hosts - self._existing_hosts_on_fork
             for host in new_hosts:
                 host.close()
+            # the subcommand exits without running any exit handlers
+            self._logger.flush()
         subcommand.subcommand.register_fork_hook(on_fork)
         subcommand.subcommand.register_join_hook(on_join)
 
@@ -438,6 +440,7 @@ class base_server_job(base_job.base_job):
         @raises error.AutotestError: If any of the functions failed.
         """
         wrapper = self._make_parallel_wrapper(function, machines, log)
+        self._logger.flush()
         return subcommand.parallel_simple(wrapper, machines,
                                           log=log, timeout=timeout,
                                           return_results=return_results)
@@ -575,6 +578,7 @@ class base_server_job(base_job.base_job):
                 self._execute_code(CLEANUP_CONTROL_FILE, namespace)
             if install_after and machines:
                 self._execute_code(INSTALL_CONTROL_FILE, namespace)
+            self._logger.flush(durable=True)
 
 
     def run_test(self, url, *args, **dargs):
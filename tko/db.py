@@ -2,9 +2,14 @@ import re, os, sys, types, time, random
 
 import common
 from autotest_lib.client.common_lib import global_config
+from autotest_lib.client.common_lib import rpc_cache
 from autotest_lib.tko import utils
 
 
+# statuses of tests that never get reported as the latest result of a group
+INVALID_STATUSES = ('TEST_NA', 'NOSTATUS')
+
+
 class MySQLTooManyRows(Exception):
     pass
 
@@ -18,6 +23,8 @@ class db_sql(object):
 
         self.con = None
         self._init_db()
+        # whether jobs were changed since the last commit
+        self._jobs_changed = False
 
         # if not present, insert statuses
         self.status_idx = {}
@@ -133,6 +140,27 @@ class db_sql(object):
 
     def commit(self):
         self.con.commit()
+        if self._jobs_changed:
+            self._invalidate_rpc_cache()
+
+
+    def _jobs_updated(self, commit):
+        """
+        Invalidate the cached TKO RPC results once the changes made to a job
+        are committed: now if they are, or else at the next commit().
+        """
+        if self.autocommit or commit:
+            self._invalidate_rpc_cache()
+        else:
+            self._jobs_changed = True
+
+
+    def _invalidate_rpc_cache(self):
+        # let the frontend know that cached TKO results are stale (only
+        # possible with a backend shared between processes, see rpc_cache)
+        self._jobs_changed = False
+        if rpc_cache.is_shared():
+            rpc_cache.invalidate(rpc_cache.TKO_GENERATION)
 
 
     def get_last_autonumber_value(self):
@@ -251,7 +279,7 @@ class db_sql(object):
             # take one shot at running the query
             self.cur.execute(sql, values)
             if commit:
-                self.con.commit()
+                self.commit()
 
 
     def insert(self, table, data, commit=None):
@@ -310,15 +338,24 @@ class db_sql(object):
 
     def delete_job(self, tag, commit = None):
         job_idx = self.find_job(tag)
+        latest_groups = []
         for test_idx in self.find_tests(job_idx):
             where = {'test_idx' : test_idx}
             self.delete('tko_iteration_result', where)
             self.delete('tko_iteration_attributes', where)
             self.delete('tko_test_attributes', where)
             self.delete('tko_test_labels_tests', {'test_id': test_idx})
+            latest_group = self._find_latest_test_group(test_idx)
+            if latest_group:
+                self.delete('tko_latest_tests', where)
+                latest_groups.append(latest_group)
         where = {'job_idx' : job_idx}
         self.delete('tko_tests', where)
         self.delete('tko_jobs', where)
+        # the deleted tests may have hidden older results of their groups
+        for latest_group in latest_groups:
+            self._recompute_latest_test(latest_group, commit=commit)
+        self._jobs_updated(commit)
 
 
     def insert_job(self, tag, job, commit = None):
@@ -347,6 +384,7 @@ class db_sql(object):
         self.update_job_keyvals(job, commit=commit)
         for test in job.tests:
             self.insert_test(job, test, commit=commit)
+        self._jobs_updated(commit)
 
 
     def update_job_keyvals(self, job, commit=None):
@@ -407,6 +445,80 @@ class db_sql(object):
                 data = {'test_id': test_idx, 'testlabel_id': label_index}
                 self.insert('tko_test_labels_tests', data, commit=commit)
 
+        self.update_latest_test(job, test, kver, commit=commit)
+
+
+    def _find_latest_test_group(self, test_idx):
+        """
+        @returns the tko_latest_tests group (as a where dict) test_idx is
+                the latest test of, or None.
+        """
+        rows = self.select('test, machine_idx, kernel_idx, job_label',
+                           'tko_latest_tests', {'test_idx': test_idx})
+        if not rows:
+            return None
+        test_name, machine_idx, kernel_idx, job_label = rows[0]
+        return {'test': test_name, 'machine_idx': machine_idx,
+                'kernel_idx': kernel_idx, 'job_label': job_label}
+
+
+    def _recompute_latest_test(self, group, commit=None):
+        """
+        Recompute the latest test of group from the full test history.  Used
+        only when the current latest test gets invalidated, since a new
+        test is the latest of its group by construction.
+        """
+        self.delete('tko_latest_tests', group, commit=commit)
+        invalid_statuses = [self.status_idx[word] for word in INVALID_STATUSES
+                            if word in self.status_idx]
+        where_sql = ('tko_tests.test = %s AND tko_tests.machine_idx = %s '
+                     'AND tko_tests.kernel_idx = %s '
+                     'AND IFNULL(tko_jobs.label, \'\') = %s')
+        values = [group['test'], group['machine_idx'], group['kernel_idx'],
+                  group['job_label']]
+        if invalid_statuses:
+            where_sql += ' AND tko_tests.status NOT IN (%s)' % ','.join(
+                    ['%s'] * len(invalid_statuses))
+            values += invalid_statuses
+        rows = self.select('MAX(tko_tests.test_idx)',
+                           'tko_tests INNER JOIN tko_jobs '
+                           'ON tko_jobs.job_idx = tko_tests.job_idx',
+                           (where_sql, values))
+        if rows and rows[0][0] is not None:
+            self.insert('tko_latest_tests', dict(group, test_idx=rows[0][0]),
+                        commit=commit)
+
+
+    def update_latest_test(self, job, test, kernel_idx, commit=None):
+        """
+        Keep tko_latest_tests, the latest valid test per (test name, machine,
+        kernel, job label), up to date after test has been inserted or
+        updated.  Unlabeled jobs are grouped under the empty label.
+        """
+        group = {'test': test.testname, 'machine_idx': job.machine_idx,
+                 'kernel_idx': kernel_idx, 'job_label': job.label or ''}
+        old_group = self._find_latest_test_group(test.test_idx)
+        if old_group and old_group != group:
+            # a reparse moved the test to another group
+            self._recompute_latest_test(old_group, commit=commit)
+            old_group = None
+
+        is_valid = test.status not in INVALID_STATUSES
+        if old_group:
+            if not is_valid:
+                self._recompute_latest_test(group, commit=commit)
+            return
+        if not is_valid:
+            return
+
+        rows = self.select('test_idx', 'tko_latest_tests', group)
+        if not rows:
+            self.insert('tko_latest_tests',
+                        dict(group, test_idx=test.test_idx), commit=commit)
+        elif rows[0][0] < test.test_idx:
+            self.update('tko_latest_tests', {'test_idx': test.test_idx},
+                        group, commit=commit)
+
 
     def read_machine_map(self):
         if self.machine_group or not self.machine_map:
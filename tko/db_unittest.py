@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+import os, shutil, sqlite3, tempfile, unittest
+import common
+from autotest_lib.client.common_lib import rpc_cache
+from autotest_lib.tko import db, models
+from autotest_lib.tko.parsers import version_0
+
+
+# the parts of the TKO schema touched by inserting jobs and tests
+_SCHEMA = """
+CREATE TABLE tko_status (status_idx INTEGER PRIMARY KEY, word TEXT);
+INSERT INTO tko_status (word) VALUES ('GOOD');
+INSERT INTO tko_status (word) VALUES ('FAIL');
+INSERT INTO tko_status (word) VALUES ('TEST_NA');
+CREATE TABLE tko_machines (machine_idx INTEGER PRIMARY KEY, hostname TEXT,
+                           machine_group TEXT, owner TEXT);
+CREATE TABLE tko_kernels (kernel_idx INTEGER PRIMARY KEY, kernel_hash TEXT,
+                          base TEXT, printable TEXT);
+CREATE TABLE tko_patches (kernel_idx INTEGER, name TEXT, url TEXT,
+                          hash TEXT);
+CREATE TABLE tko_jobs (job_idx INTEGER PRIMARY KEY, tag TEXT, label TEXT,
+                       username TEXT, machine_idx INTEGER,
+                       queued_time TEXT, started_time TEXT,
+                       finished_time TEXT, afe_job_id INTEGER);
+CREATE TABLE tko_job_keyvals (id INTEGER PRIMARY KEY, job_id INTEGER,
+                              `key` TEXT, value TEXT);
+CREATE TABLE tko_tests (test_idx INTEGER PRIMARY KEY, job_idx INTEGER,
+                        test TEXT, subdir TEXT, kernel_idx INTEGER,
+                        status INTEGER, reason TEXT, machine_idx INTEGER,
+                        started_time TEXT, finished_time TEXT);
+CREATE TABLE tko_iteration_attributes (test_idx INTEGER, iteration INTEGER,
+                                       attribute TEXT, value TEXT);
+CREATE TABLE tko_iteration_result (test_idx INTEGER, iteration INTEGER,
+                                   attribute TEXT, value NUMERIC);
+CREATE TABLE tko_test_attributes (id INTEGER PRIMARY KEY, test_idx INTEGER,
+                                  attribute TEXT, value TEXT,
+                                  user_created INTEGER DEFAULT 0);
+CREATE TABLE tko_test_labels_tests (test_id INTEGER, testlabel_id INTEGER);
+CREATE TABLE tko_latest_tests (test_idx INTEGER PRIMARY KEY,
+                               test TEXT NOT NULL,
+                               machine_idx INTEGER NOT NULL,
+                               kernel_idx INTEGER NOT NULL,
+                               job_label TEXT NOT NULL,
+                               UNIQUE (test, machine_idx, kernel_idx,
+                                       job_label));
+"""
+
+
+class _sqlite_cursor(object):
+    """A cursor taking the MySQLdb parameter style."""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
+    def execute(self, sql, values=()):
+        sql = sql.replace('%s', '?').replace('LAST_INSERT_ID()',
+                                             'last_insert_rowid()')
+        self.cursor.execute(sql, list(values))
+
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class _sqlite_connection(object):
+    def __init__(self, filename):
+        self.con = sqlite3.connect(filename)
+
+
+    def cursor(self):
+        return _sqlite_cursor(self.con.cursor())
+
+
+    def commit(self):
+        self.con.commit()
+
+
+    def close(self):
+        self.con.close()
+
+
+class db_sqlite(db.db_sql):
+    def connect(self, host, database, user, password):
+        return _sqlite_connection(database)
+
+
+class _shared_backend(object):
+    """A cache backend taken for one shared between processes."""
+    def __init__(self):
+        self.incremented = []
+
+
+    def get(self, key):
+        return None
+
+
+    def set(self, key, value, ttl=None):
+        pass
+
+
+    def incr(self, key):
+        self.incremented.append(key)
+        return len(self.incremented)
+
+
+class db_test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(self.tmpdir, 'tko.db')
+        con = sqlite3.connect(filename)
+        con.executescript(_SCHEMA)
+        con.close()
+        # autocommit would retry on errors of the configured (MySQL) driver
+        self.db = db_sqlite(autocommit=False, host='localhost',
+                            database=filename, user='', password='')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _parse_job(self, keyval):
+        job_dir = os.path.join(self.tmpdir, 'results')
+        if not os.path.isdir(job_dir):
+            os.mkdir(job_dir)
+        keyval_file = open(os.path.join(job_dir, 'keyval'), 'w')
+        for key, value in keyval.iteritems():
+            keyval_file.write('%s=%s\n' % (key, value))
+        keyval_file.close()
+        return version_0.job(job_dir)
+
+
+    def _add_test(self, job, status):
+        kernel = models.kernel('2.6.32', [], 'abcdef')
+        test = models.test('sleeptest', 'sleeptest', status, '', kernel,
+                           job.machine, None, None, [], {}, [])
+        job.tests.append(test)
+        return test
+
+
+    def _latest_tests(self):
+        return self.db.select('test_idx, test, job_label',
+                              'tko_latest_tests', None)
+
+
+    def test_unlabeled_job(self):
+        job = self._parse_job({'hostname': 'host1', 'user': 'me'})
+        self.assertEquals(job.label, None)
+        test = self._add_test(job, 'GOOD')
+        self.db.insert_job('1-me/host1', job)
+        self.assertEquals(self._latest_tests(),
+                          [(test.test_idx, 'sleeptest', '')])
+
+        # a newer test of the group supersedes it, and invalidating that
+        # one brings the older test back
+        job = self._parse_job({'hostname': 'host1', 'user': 'me'})
+        newer_test = self._add_test(job, 'GOOD')
+        self.db.insert_job('2-me/host1', job)
+        self.assertEquals(self._latest_tests(),
+                          [(newer_test.test_idx, 'sleeptest', '')])
+        newer_test.status = 'TEST_NA'
+        self.db.insert_test(job, newer_test)
+        self.assertEquals(self._latest_tests(),
+                          [(test.test_idx, 'sleeptest', '')])
+
+
+    def test_rpc_cache_invalidated_once_per_job(self):
+        backend = _shared_backend()
+        rpc_cache.set_backend(backend)
+        try:
+            job = self._parse_job({'hostname': 'host1'})
+            for i in range(3):
+                self._add_test(job, 'GOOD')
+            self.db.insert_job('1-me/host1', job)
+            # not before the job is committed
+            self.assertEquals(backend.incremented, [])
+            self.db.commit()
+            self.assertEquals(len(backend.incremented), 1)
+            self.db.commit()
+            self.assertEquals(len(backend.incremented), 1)
+        finally:
+            rpc_cache.set_backend(None)
+
+
+    def test_labeled_job(self):
+        job = self._parse_job({'hostname': 'host1', 'label': 'nightly'})
+        test = self._add_test(job, 'FAIL')
+        self.db.insert_job('1-me/host1', job)
+        self.assertEquals(self._latest_tests(),
+                          [(test.test_idx, 'sleeptest', 'nightly')])
+        self.db.delete_job('1-me/host1')
+        self.assertEquals(self._latest_tests(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
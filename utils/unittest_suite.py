@@ -31,6 +31,7 @@ REQUIRES_DJANGO = set((
         'rpc_utils_unittest.py',
         'site_rpc_utils_unittest.py',
         'execution_engine_unittest.py',
+        'graphing_utils_unittest.py',
         'service_proxy_lib_test.py',
         ))
 
@@ -46,6 +47,7 @@ REQUIRES_GWT = set((
 REQUIRES_SIMPLEJSON = set((
         'resources_test.py',
         'serviceHandler_unittest.py',
+        'graph_cache_unittest.py',
         ))
 
 REQUIRES_AUTH = set ((